@@ -0,0 +1,3085 @@
+# addendas.py
+# Núcleo sin GUI: XSD, contexto del CFDI, autollenado, perfiles, plantillas y validación.
+import os
+import re
+import copy
+import io
+import json
+import mmap
+import time
+import shutil
+import sqlite3
+import hashlib
+from array import array
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import quoteattr
+
+# -------- Utilidades de red/XSD (URL) -------------
+import urllib.error
+import urllib.parse
+import urllib.request
+
+def _xsd_cache_dir_default() -> str:
+    """Caché a nivel usuario (no depende de dónde se abrió la app)."""
+    if os.environ.get("ADDENDAS_XSD_CACHE"):
+        return os.environ["ADDENDAS_XSD_CACHE"]
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+        return os.path.join(base, "Addendados", "xsd_cache")
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "addendados", "xsd")
+
+def _shapes_cache_dir_default() -> str:
+    if os.environ.get("ADDENDAS_SHAPES_CACHE"):
+        return os.environ["ADDENDAS_SHAPES_CACHE"]
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+        return os.path.join(base, "Addendados", "shapes_cache")
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "addendados", "shapes")
+
+def _datos_dir_default() -> str:
+    """Datos a nivel usuario: reglas, estado, plantillas y biblioteca de XSD."""
+    if os.environ.get("ADDENDAS_DATOS"):
+        return os.environ["ADDENDAS_DATOS"]
+    if os.name == "nt":
+        base = os.environ.get("APPDATA") or os.path.expanduser("~")
+        return os.path.join(base, "Addendados")
+    base = os.environ.get("XDG_DATA_HOME") or os.path.join(os.path.expanduser("~"), ".local", "share")
+    return os.path.join(base, "addendados")
+
+XSD_CACHE_DIR = _xsd_cache_dir_default()
+DATOS_DIR = _datos_dir_default()
+LEGADO_DIR = os.getcwd()   # versiones anteriores guardaban reglas y plantillas en la carpeta de trabajo
+XSD_CACHE_LEGACY_DIR = os.path.join(XSD_CACHE_DIR, "legado")   # versiones anteriores: sha1(url).xsd
+XSD_CACHE_TTL = 7 * 24 * 3600            # segundos que se sirve sin revalidar
+XSD_CACHE_MAX_BYTES = 50 * 1024 * 1024   # tope; se desalojan las URL menos usadas
+XSD_CACHE_OFFLINE = os.environ.get("ADDENDAS_OFFLINE", "") not in ("", "0")
+_XSD_INDEX_LOCK = threading.Lock()
+_XSD_USOS = {}   # url -> used_at de aciertos que aún no se escriben en index.json
+
+def _es_url(s: str) -> bool:
+    try:
+        u = urllib.parse.urlparse(s)
+        return u.scheme in ("http", "https")
+    except Exception:
+        return False
+
+def _xsd_index_path() -> str:
+    return os.path.join(XSD_CACHE_DIR, "index.json")
+
+def _xsd_index_load() -> dict:
+    try:
+        with open(_xsd_index_path(), "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except Exception:
+        return {}
+
+def _xsd_index_save(index: dict):
+    os.makedirs(XSD_CACHE_DIR, exist_ok=True)
+    tmp = _xsd_index_path() + f".{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp, _xsd_index_path())
+
+def _xsd_blob_path(sha1: str) -> str:
+    return os.path.join(XSD_CACHE_DIR, sha1 + ".xsd")
+
+def _xsd_legado_path(url: str) -> str:
+    """Copia de versiones anteriores (sha1(url).xsd); la primera vez se trae .xsd_cache de la carpeta de trabajo."""
+    _traer_legado(".xsd_cache", XSD_CACHE_LEGACY_DIR)
+    return os.path.join(XSD_CACHE_LEGACY_DIR, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".xsd")
+
+def _xsd_cache_evict(index: dict, keep_url: str):
+    """LRU por URL hasta quedar bajo XSD_CACHE_MAX_BYTES; un blob se borra cuando ya nadie lo usa."""
+    blobs = {e["sha1"]: e.get("size", 0) for e in index.values() if e.get("sha1")}
+    total = sum(blobs.values())
+    for url, ent in sorted(index.items(), key=lambda kv: kv[1].get("used_at", 0)):
+        if total <= XSD_CACHE_MAX_BYTES:
+            break
+        if url == keep_url:
+            continue
+        index.pop(url, None)
+        sha = ent.get("sha1")
+        if sha and not any(e.get("sha1") == sha for e in index.values()):
+            total -= blobs.get(sha, 0)
+            try:
+                os.remove(_xsd_blob_path(sha))
+            except OSError:
+                pass
+
+def _xsd_fetch(url: str, ent: dict):
+    """GET (condicional si hay ETag/Last-Modified). Regresa (bytes|None si 304, headers)."""
+    req = urllib.request.Request(url, headers={"User-Agent": "Addendados/1.0"})
+    if ent and os.path.exists(_xsd_blob_path(ent.get("sha1", ""))):
+        if ent.get("etag"):
+            req.add_header("If-None-Match", ent["etag"])
+        if ent.get("last_modified"):
+            req.add_header("If-Modified-Since", ent["last_modified"])
+    try:
+        with urllib.request.urlopen(req, timeout=30) as resp:
+            return resp.read(), resp.headers
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return None, e.headers
+        raise
+
+def descargar_xsd_cache(url: str, ttl: int = None, offline: bool = None) -> str:
+    """
+    URL → ruta local de su XSD, con caché direccionada por contenido:
+      - dentro del TTL se sirve sin tocar la red;
+      - vencido, se revalida con GET condicional (304 = se renueva el TTL);
+      - si la red falla se sirve la copia vieja; en modo offline nunca se descarga.
+    """
+    if not _es_url(url):
+        raise ValueError("La dirección no parece una URL válida.")
+    ttl = XSD_CACHE_TTL if ttl is None else ttl
+    offline = XSD_CACHE_OFFLINE if offline is None else offline
+    now = time.time()
+    with _XSD_INDEX_LOCK:
+        index = _xsd_index_load()
+        ent = index.get(url) or {}
+        blob = _xsd_blob_path(ent["sha1"]) if ent.get("sha1") else None
+        if blob and not os.path.exists(blob):
+            ent, blob = {}, None
+        if blob is None:
+            legacy = _xsd_legado_path(url)
+            if offline and os.path.exists(legacy) and os.path.getsize(legacy) > 0:
+                return legacy
+        fresh = blob is not None and (now - ent.get("fetched_at", 0)) < ttl
+        if blob and (fresh or offline):
+            # un acierto no reescribe el índice: el uso se anota con la siguiente escritura
+            _XSD_USOS[url] = now
+            return blob
+        if offline:
+            raise IOError(f"Modo sin conexión: el XSD no está en caché:\n{url}")
+
+    try:
+        data, headers = _xsd_fetch(url, ent)
+    except Exception:
+        if blob:
+            return blob   # copia vencida, mejor que nada
+        raise
+
+    with _XSD_INDEX_LOCK:
+        index = _xsd_index_load()
+        if data is not None:
+            if not data.strip():
+                raise IOError("El archivo descargado está vacío.")
+            sha = hashlib.sha1(data).hexdigest()
+            blob = _xsd_blob_path(sha)
+            if not os.path.exists(blob):
+                os.makedirs(XSD_CACHE_DIR, exist_ok=True)
+                tmp = blob + f".{os.getpid()}.tmp"
+                with open(tmp, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, blob)
+            ent = {"sha1": sha, "size": len(data)}
+        ent["etag"] = headers.get("ETag") or ent.get("etag")
+        ent["last_modified"] = headers.get("Last-Modified") or ent.get("last_modified")
+        ent["fetched_at"] = now
+        ent["used_at"] = now
+        index[url] = ent
+        for u, t in _XSD_USOS.items():
+            if u in index and t > index[u].get("used_at", 0):
+                index[u]["used_at"] = t
+        _XSD_USOS.clear()
+        _xsd_cache_evict(index, url)
+        _xsd_index_save(index)
+    return blob
+
+def _descargar_xsd(url: str) -> str:
+    """
+    Descarga un XSD desde internet a caché local y regresa la ruta del archivo.
+    """
+    return descargar_xsd_cache(url)
+
+def _xsd_cache_path_for_url(url: str):
+    """Ruta local de una URL ya descargada (caché de usuario o copia legada), o None."""
+    ent = _xsd_index_load().get(url) or {}
+    if ent.get("sha1") and os.path.exists(_xsd_blob_path(ent["sha1"])):
+        return _xsd_blob_path(ent["sha1"])
+    legacy = _xsd_legado_path(url)
+    return legacy if os.path.exists(legacy) else None
+
+# Catálogo estilo XML Catalog: URL o namespace → archivo local
+XSD_CATALOG_PATH = os.path.join(DATOS_DIR, "xsd_catalog.json")
+
+def _copiar_catalogo(origen, destino):
+    """El catálogo viejo resolvía rutas relativas desde la carpeta de trabajo: se copian ya absolutas."""
+    with open(origen, "r", encoding="utf-8") as f:
+        cat = json.load(f)
+    base = os.path.dirname(os.path.abspath(origen))
+    if isinstance(cat, dict):
+        cat = {k: os.path.join(base, v) if isinstance(v, str) and not os.path.isabs(v) else v
+               for k, v in cat.items()}
+    tmp = destino + f".{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(cat, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, destino)
+
+def load_xsd_catalog() -> dict:
+    _traer_legado("xsd_catalog.json", XSD_CATALOG_PATH, _copiar_catalogo)
+    try:
+        with open(XSD_CATALOG_PATH, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except Exception:
+        return {}
+
+def resolver_ubicacion_xsd(loc: str, base_dir: str = None, namespace: str = None, catalogo: dict = None):
+    """
+    schemaLocation de un include/import → ruta local, sin tocar la red.
+    Orden: catálogo (por URL y luego por namespace), URL ya descargada en la
+    caché, ruta relativa al XSD que la declara. None si no hay copia local.
+    """
+    cat = load_xsd_catalog() if catalogo is None else catalogo
+    for key in (loc, namespace):
+        if key and key in cat:
+            p = cat[key]
+            if not os.path.isabs(p):
+                p = os.path.join(os.path.dirname(os.path.abspath(XSD_CATALOG_PATH)), p)
+            if os.path.exists(p):
+                return p
+    if not loc:
+        return None
+    if _es_url(loc):
+        p = _xsd_cache_path_for_url(loc)
+        if p and os.path.getsize(p) > 0:
+            return p
+        # mismo nombre de archivo junto al XSD que lo importa
+        if base_dir:
+            p = os.path.join(base_dir, os.path.basename(urllib.parse.urlparse(loc).path))
+            if os.path.isfile(p):
+                return p
+        return None
+    if loc.startswith("file:"):
+        loc = urllib.request.url2pathname(urllib.parse.urlparse(loc).path)
+    p = loc if os.path.isabs(loc) else os.path.join(base_dir or "", loc)
+    return p if os.path.exists(p) else None
+
+def cargar_xsd_desde_fuente(path_o_url: str) -> str:
+    """Ruta local o URL http/https → ruta local."""
+    if _es_url(path_o_url):
+        return _descargar_xsd(path_o_url)
+    if not os.path.exists(path_o_url):
+        raise FileNotFoundError("No se encontró el archivo XSD especificado.")
+    return path_o_url
+
+# ========= Validación XSD (lxml opcional) =========
+try:
+    from lxml import etree as LET
+    HAS_LXML = True
+except Exception:
+    HAS_LXML = False
+
+# ========= Columnas de conceptos (NumPy opcional) =========
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except Exception:
+    HAS_NUMPY = False
+
+# ================== Constantes =====================
+CFDI_NS = "http://www.sat.gob.mx/cfd/4"
+TFD_NS  = "http://www.sat.gob.mx/TimbreFiscalDigital"
+CFDI    = "{%s}" % CFDI_NS
+XS_NS   = "{http://www.w3.org/2001/XMLSchema}"
+XSI_NS  = "http://www.w3.org/2001/XMLSchema-instance"
+XSI     = "{%s}" % XSI_NS
+
+ET.register_namespace("cfdi", CFDI_NS)
+
+# ========= Backend XML del CFDI (lxml si está, ElementTree si no) =========
+# Todo lo que toca el CFDI/Addenda (parseo, construcción, copia, serialización,
+# validación) pasa por XML.*; el parseo de XSD y el streaming siguen con ET.
+class _BackendET:
+    nombre = "etree"
+
+    def __init__(self):
+        self.Element = ET.Element
+        self.SubElement = ET.SubElement
+
+    def registrar_ns(self, prefix, uri):
+        ET.register_namespace(prefix, uri)
+
+    def parse(self, source):
+        return ET.parse(source)
+
+    def fromstring(self, data):
+        return ET.fromstring(data)
+
+    def tostring(self, el) -> str:
+        return ET.tostring(el, encoding="unicode")
+
+    def indent(self, el, level=0):
+        ET.indent(el, space="  ", level=level)
+
+    def copiar(self, el):
+        return copy.deepcopy(el)
+
+    def prestar(self, nodos) -> list:
+        """Copias de los nodos para colgarlos de otro padre: al serializar se les
+        quita el tail y se indentan, y eso no debe tocar el documento cargado."""
+        return [copy.deepcopy(n) for n in nodos]
+
+    def para_validar(self, el):
+        """Documento lxml equivalente al subárbol (ET → bytes → lxml)."""
+        return LET.fromstring(ET.tostring(el, encoding="utf-8", xml_declaration=True), _parser_doc())
+
+class _BackendLXML(_BackendET):
+    """Un solo árbol lxml: se parsea una vez y se valida ese mismo árbol."""
+    nombre = "lxml"
+
+    def __init__(self):
+        self.Element = LET.Element
+        self.SubElement = LET.SubElement
+
+    def registrar_ns(self, prefix, uri):
+        ET.register_namespace(prefix, uri)
+        try:
+            LET.register_namespace(prefix, uri)
+        except ValueError:
+            pass   # lxml no acepta prefijo vacío; queda el que asigne al serializar
+
+    def parse(self, source):
+        return LET.parse(source, _parser_cfdi())
+
+    def fromstring(self, data):
+        return LET.fromstring(data, _parser_cfdi())
+
+    def tostring(self, el) -> str:
+        # lxml arrastra los xmlns de los ancestros; se limpian en una copia para
+        # sacar lo mismo que ET (solo los namespaces que usa el subárbol, "<x />", "&#09;")
+        c = copy.deepcopy(el)
+        LET.cleanup_namespaces(c)
+        return LET.tostring(c, encoding="unicode").replace("/>", " />").replace("&#9;", "&#09;")
+
+    def indent(self, el, level=0):
+        LET.indent(el, space="  ", level=level)
+
+    def para_validar(self, el):
+        return el
+
+def _parser_cfdi():
+    # como ET.parse: sin comentarios ni PIs en el árbol (no cuentan como hijos)
+    p = getattr(_PARSERS, "cfdi", None)
+    if p is None:
+        p = _PARSERS.cfdi = LET.XMLParser(load_dtd=False, no_network=True, resolve_entities=False,
+                                          remove_comments=True, remove_pis=True, huge_tree=True)
+    return p
+
+def leer_cfdi_lxml(path):
+    """Árbol lxml del CFDI (con sourceline), con el parser del backend lxml sin importar el activo."""
+    return LET.parse(path, _parser_cfdi())
+
+def usar_backend_xml(nombre: str = "auto"):
+    """Selecciona el backend (auto | lxml | etree). Sin lxml siempre queda ET."""
+    global XML
+    nombre = (nombre or "auto").strip().lower()
+    if nombre not in ("auto", "lxml", "etree"):
+        raise ValueError(f"Backend XML desconocido: {nombre} (usa auto, lxml o etree)")
+    XML = _BackendLXML() if HAS_LXML and nombre != "etree" else _BackendET()
+    XML.registrar_ns("cfdi", CFDI_NS)
+    return XML
+
+XML = usar_backend_xml(os.environ.get("ADDENDAS_XML", "auto"))
+
+CACHE_PATH = os.path.join(LEGADO_DIR, "xsd_autofill_cache.json")   # formato viejo, se importa una vez
+# cache reglas por XSD (SQLite WAL)
+RULES_DB_PATH = os.environ.get("ADDENDAS_RULES_DB") or os.path.join(DATOS_DIR, "xsd_autofill_rules.db")
+# huellas, grafos, paquete, registro de XSD, bitácora de vigilancia
+ESTADO_DB_PATH = os.environ.get("ADDENDAS_ESTADO_DB") or os.path.join(DATOS_DIR, "addendas_estado.db")
+_LEGADO_REVISADO = set()
+_LEGADO_LOCK = threading.Lock()
+
+def _traer_legado(nombre: str, destino: str, copiar=None):
+    """
+    Primera vez que se usa `destino` en el proceso: crea su carpeta y, si aún no
+    existe, copia ahí `nombre` de LEGADO_DIR (una base SQLite vía backup, para
+    incluir lo que siga en su WAL, una carpeta completa o con `copiar(origen, destino)`).
+    """
+    with _LEGADO_LOCK:
+        if destino in _LEGADO_REVISADO:
+            return
+        _LEGADO_REVISADO.add(destino)
+        origen = os.path.join(LEGADO_DIR, nombre)
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(destino)), exist_ok=True)
+            if os.path.exists(destino) or not os.path.exists(origen) \
+                    or os.path.abspath(origen) == os.path.abspath(destino):
+                return
+            if copiar is not None:
+                copiar(origen, destino)
+                return
+            if os.path.isdir(origen):
+                shutil.copytree(origen, destino)
+                return
+            src, dst = sqlite3.connect(origen), sqlite3.connect(destino)
+            try:
+                src.backup(dst)
+            finally:
+                src.close()
+                dst.close()
+        except (OSError, ValueError, sqlite3.Error):
+            pass
+
+# ================= Utilidades XML ==================
+def pretty_xml(tree) -> None:
+    try:
+        XML.indent(tree)
+    except Exception:
+        pass
+
+def q(uri, local):
+    return f"{{{uri}}}{local}" if uri else local
+
+def generate_preview(tree) -> str:
+    try:
+        XML.indent(tree)
+    except Exception:
+        pass
+    return XML.tostring(tree.getroot())
+
+# ======= Escritura por empalme de bytes (solo la Addenda) =======
+# Tokens XML suficientes para ubicar etiquetas sin armar árbol
+_XML_TOKEN = re.compile(
+    rb'<!--.*?-->|<!\[CDATA\[.*?\]\]>|<\?.*?\?>|<!DOCTYPE(?:[^>\[]|\[[^\]]*\])*>'
+    rb'|<(/?)([^\s/>!?]+)((?:[^>"\']|"[^"]*"|\'[^\']*\')*)>', re.S)
+_XMLNS_ATTR = re.compile(rb'xmlns(?::([\w.\-]+))?\s*=\s*(["\'])(.*?)\2', re.S)
+
+def escanear_cfdi_bytes(buf) -> dict:
+    """
+    Recorre el CFDI (bytes o mmap) una vez y regresa offsets:
+      root_start/root_end: (ini, fin) de la etiqueta de apertura y de cierre del Comprobante
+      addenda: (ini, fin) del <cfdi:Addenda> hijo directo, o None
+      root_name: nombre calificado del Comprobante; cfdi_prefix: prefijo del ns CFDI
+    """
+    out = {"root_start": None, "root_end": None, "addenda": None, "root_name": None, "cfdi_prefix": None}
+    depth = 0
+    addenda_ini = None
+    cfdi_ns = CFDI_NS.encode("ascii")
+    for m in _XML_TOKEN.finditer(buf):
+        name = m.group(2)
+        if name is None:
+            continue
+        if m.group(1):
+            depth -= 1
+            if depth == 0:
+                out["root_end"] = (m.start(), m.end())
+                break
+            if depth == 1 and addenda_ini is not None and out["addenda"] is None:
+                out["addenda"] = (addenda_ini, m.end())
+            continue
+        cerrada = m.group(3).rstrip().endswith(b"/")
+        if depth == 0:
+            out["root_start"] = (m.start(), m.end())
+            out["root_name"] = name.decode("utf-8")
+            for pm in _XMLNS_ATTR.finditer(m.group(3)):
+                if pm.group(3) == cfdi_ns:
+                    out["cfdi_prefix"] = (pm.group(1) or b"").decode("utf-8")
+                    break
+        elif depth == 1 and addenda_ini is None and out["cfdi_prefix"] is not None:
+            pref, _, local = name.rpartition(b":")
+            if local == b"Addenda" and pref.decode("utf-8") == out["cfdi_prefix"]:
+                addenda_ini = m.start()
+                if cerrada:
+                    out["addenda"] = (m.start(), m.end())
+        if not cerrada:
+            depth += 1
+    if out["root_end"] is None:
+        raise ValueError("No se encontró el cierre del Comprobante (¿XML incompleto?).")
+    return out
+
+def serializar_addenda(addenda_el, prefix="cfdi", bonito=True) -> bytes:
+    """Solo el subárbol <cfdi:Addenda>, con el prefijo CFDI que ya usa el documento."""
+    return _envolver_addenda(_cuerpo_addenda(list(addenda_el), bonito), prefix, bonito)
+
+def _cuerpo_addenda(nodos, bonito) -> str:
+    """Hijos de la Addenda ya serializados (en bonito, cada uno en su renglón)."""
+    partes = []
+    for ch in nodos:
+        ch.tail = None
+        if bonito:
+            try:
+                XML.indent(ch, level=2)
+            except Exception:
+                pass
+        partes.append(("\n    " if bonito else "") + XML.tostring(ch))
+    return "".join(partes)
+
+def _envolver_addenda(cuerpo, prefix="cfdi", bonito=True) -> bytes:
+    if prefix is None:
+        qn, decl = "cfdi:Addenda", f' xmlns:cfdi="{CFDI_NS}"'
+    else:
+        qn, decl = (f"{prefix}:Addenda" if prefix else "Addenda"), ""
+    if not cuerpo:
+        return f"<{qn}{decl}/>".encode("utf-8")
+    if bonito:
+        cuerpo += "\n  "
+    return f"<{qn}{decl}>{cuerpo}</{qn}>".encode("utf-8")
+
+def _copiar_rango(buf, ini, fin, out, chunk=1 << 20):
+    while ini < fin:
+        n = min(chunk, fin - ini)
+        out.write(buf[ini:ini + n])
+        ini += n
+
+def _abrir_bytes(path):
+    """mmap de solo lectura (o bytes si el archivo está vacío / no se puede mapear).
+    Si `path` ya son bytes (p. ej. un CFDI recibido por HTTP) se usan tal cual."""
+    if isinstance(path, (bytes, bytearray)):
+        return io.BytesIO(), bytes(path)
+    f = open(path, "rb")
+    try:
+        return f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError):
+        data = f.read()
+        return f, data
+
+def escribir_cfdi_con_addenda(src_path, addenda_el, out_path) -> str:
+    """
+    Escribe out_path = CFDI original con la Addenda nueva empalmada a nivel bytes:
+    reemplaza el <cfdi:Addenda> existente o la inserta antes de </cfdi:Comprobante>.
+    Todo lo que está fuera de la Addenda queda idéntico byte a byte. `addenda_el`
+    es el Element <cfdi:Addenda> o un serializador(prefix, bonito) → bytes
+    (p. ej. el de una plantilla).
+    """
+    f, buf = _abrir_bytes(src_path)
+    try:
+        tmp = out_path + f".{os.getpid()}.tmp"
+        with open(tmp, "wb") as out:
+            _empalmar_addenda(buf, addenda_el, out)
+    finally:
+        if isinstance(buf, mmap.mmap):
+            buf.close()
+        f.close()
+    os.replace(tmp, out_path)
+    return out_path
+
+def _empalmar_addenda(buf, addenda_el, out):
+    scan = escanear_cfdi_bytes(buf)
+    fin_root = scan["root_end"][0]
+    bonito = fin_root > 0 and buf[fin_root - 1:fin_root] in (b"\n", b" ", b"\t")
+    if callable(addenda_el):
+        nuevo = addenda_el(scan["cfdi_prefix"], bonito)
+    else:
+        nuevo = serializar_addenda(addenda_el, scan["cfdi_prefix"], bonito)
+    if scan["addenda"]:
+        ini, fin = scan["addenda"]
+        _copiar_rango(buf, 0, ini, out)
+        out.write(nuevo)
+        _copiar_rango(buf, fin, len(buf), out)
+    else:
+        _copiar_rango(buf, 0, fin_root, out)
+        out.write((b"  " + nuevo + b"\n") if buf[fin_root - 1:fin_root] == b"\n" else nuevo)
+        _copiar_rango(buf, fin_root, len(buf), out)
+
+def cfdi_con_addenda_bytes(src_path, addenda_el) -> bytes:
+    """Lo mismo que escribiría escribir_cfdi_con_addenda, en memoria (para validarlo completo)."""
+    f, buf = _abrir_bytes(src_path)
+    try:
+        out = io.BytesIO()
+        _empalmar_addenda(buf, addenda_el, out)
+        return out.getvalue()
+    finally:
+        if isinstance(buf, mmap.mmap):
+            buf.close()
+        f.close()
+
+def escribir_bytes(data: bytes, out_path) -> str:
+    tmp = out_path + f".{os.getpid()}.tmp"
+    with open(tmp, "wb") as out:
+        out.write(data)
+    os.replace(tmp, out_path)
+    return out_path
+
+def leer_addenda_cfdi(path):
+    """
+    Comprobante "mínimo": la etiqueta raíz original (atributos y xmlns) con solo
+    su <cfdi:Addenda> si existe. Sirve para construir/validar sin parsear el CFDI.
+    """
+    f, buf = _abrir_bytes(path)
+    try:
+        scan = escanear_cfdi_bytes(buf)
+        ini, fin = scan["root_start"]
+        head = bytes(buf[ini:fin])
+        if head.rstrip(b">").rstrip().endswith(b"/"):
+            return XML.fromstring(head)
+        cuerpo = bytes(buf[scan["addenda"][0]:scan["addenda"][1]]) if scan["addenda"] else b""
+        return XML.fromstring(head + cuerpo + b"</" + scan["root_name"].encode("utf-8") + b">")
+    finally:
+        if isinstance(buf, mmap.mmap):
+            buf.close()
+        f.close()
+
+# ============ Parseo XSD → Shapes (para UI) =======
+def _xsd_get(el, name, default=None):
+    return el.attrib.get(name, default)
+
+def _xsd_q(tag):
+    return f"{XS_NS}{tag}"
+
+def parse_xsd_target_namespace(xsd_path: str) -> str:
+    try:
+        tree = ET.parse(xsd_path)
+        root = tree.getroot()
+        return root.attrib.get("targetNamespace", "") or ""
+    except Exception:
+        return ""
+
+_FACETAS_NUM = ("minLength", "maxLength", "length", "totalDigits", "fractionDigits")
+_FACETAS_TXT = ("minInclusive", "maxInclusive", "minExclusive", "maxExclusive")
+
+def _facetas_restriccion(st, g, doc, stack=()):
+    """
+    Facetas de un xs:simpleType (restriction), heredando las del tipo base con
+    nombre: {"base", "minLength", "maxLength", "length", "pattern": [[...], ...],
+    "enumeration": [...], "totalDigits", "fractionDigits", min/maxInclusive/Exclusive}.
+    "pattern" lleva un grupo por paso de derivación: los pattern de una misma
+    restriction son alternativas (basta uno), los grupos se acumulan (todos
+    deben cumplirse).
+    """
+    res = st.find(_xsd_q("restriction")) if st is not None else None
+    if res is None:
+        return {}
+    base = res.attrib.get("base") or ""
+    inl = res.find(_xsd_q("simpleType"))
+    if inl is not None:
+        fac = _facetas_restriccion(inl, g, doc, stack)
+    else:
+        fac = _facetas_tipo(base, g, doc, stack)
+    fac = dict(fac, pattern=list(fac.get("pattern", [])))
+    enum, patrones = [], []
+    for f in res:
+        if not isinstance(f.tag, str) or not f.tag.startswith(XS_NS):
+            continue
+        local, val = f.tag[len(XS_NS):], f.attrib.get("value")
+        if val is None:
+            continue
+        if local in _FACETAS_NUM and val.isdigit():
+            fac[local] = int(val)
+        elif local in _FACETAS_TXT:
+            fac[local] = val
+        elif local == "pattern":
+            patrones.append(val)
+        elif local == "enumeration":
+            enum.append(val)
+    if enum:
+        fac["enumeration"] = enum
+    if patrones:
+        fac["pattern"].append(patrones)
+    if not fac["pattern"]:
+        fac.pop("pattern")
+    return fac
+
+def _facetas_tipo(tipo, g, doc, stack=()):
+    """Facetas de un tipo por nombre: builtin xs:* → {"base"}, simpleType del grafo → sus facetas."""
+    if not tipo:
+        return {}
+    prefix, _, local = tipo.rpartition(":")
+    if (doc or {}).get("nsmap", {}).get(prefix) == _XS_URI:
+        return {"base": local}
+    hit = _grafo_lookup(g, "simple_types", tipo, doc) if g is not None else None
+    if hit is None or tipo in stack:
+        return {}
+    return _facetas_restriccion(hit[0], g, hit[1], stack + (tipo,))
+
+def _facetas_de(el, g, doc):
+    """Facetas de un xs:attribute / xs:element simple (type=... o simpleType en línea)."""
+    inl = el.find(_xsd_q("simpleType"))
+    if inl is not None:
+        return _facetas_restriccion(inl, g, doc)
+    return _facetas_tipo(el.attrib.get("type"), g, doc)
+
+def _attr_shape(a, name=None, g=None, doc=None):
+    out = {
+        "name": name or _xsd_get(a, "name"),
+        "type": _xsd_get(a, "type"),
+        "use": _xsd_get(a, "use", "optional"),
+        "fixed": _xsd_get(a, "fixed"),
+        "default": _xsd_get(a, "default")
+    }
+    fac = _facetas_de(a, g, doc)
+    if fac:
+        out["facetas"] = fac
+    return out
+
+def _collect_attributes(ct, g=None, doc=None, seen=()):
+    """Atributos directos, xs:attribute ref=... y xs:attributeGroup ref=... (recursivo)."""
+    attrs = []
+    for a in ct:
+        if a.tag == _xsd_q("attribute"):
+            if a.attrib.get("use") == "prohibited":
+                continue
+            if a.attrib.get("ref"):
+                ref = a.attrib["ref"]
+                hit = _grafo_lookup(g, "attributes", ref, doc) if g else None
+                merged = _attr_shape(hit[0], g=g, doc=hit[1]) if hit else _attr_shape(a, ref.split(":", 1)[-1])
+                for k in ("use", "fixed", "default"):
+                    if a.attrib.get(k) is not None:
+                        merged[k] = a.attrib[k]
+                attrs.append(merged)
+            else:
+                attrs.append(_attr_shape(a, g=g, doc=doc))
+        elif a.tag == _xsd_q("attributeGroup") and g is not None:
+            ref = a.attrib.get("ref")
+            hit = _grafo_lookup(g, "attr_groups", ref, doc) if ref else None
+            if hit and ref not in seen:
+                attrs.extend(_collect_attributes(hit[0], g, hit[1], seen + (ref,)))
+    return attrs
+
+# ----------- Grafo de esquemas (include/import) -----------
+_XS_URI = XS_NS[1:-1]
+_GRAFO_CACHE = {}   # (ruta, fingerprint) -> grafo
+_UBICACIONES_XSD = {}   # schemaLocation ya resuelto → ruta local (lo usa también lxml)
+
+def _parse_xsd_doc(path):
+    """Parsea un XSD conservando el mapa prefijo→namespace (ET no lo guarda)."""
+    nsmap = {}
+    it = ET.iterparse(path, events=("start-ns",))
+    for _ev, (prefix, uri) in it:
+        nsmap.setdefault(prefix or "", uri)
+    return it.root, nsmap
+
+def _grafo_add_doc(g, path, tns_forzado=None):
+    path = os.path.abspath(path)
+    key = (path, tns_forzado)
+    if key in g["vistos"]:
+        return
+    g["vistos"].add(key)
+    root, nsmap = _parse_xsd_doc(path)
+    tns = root.attrib.get("targetNamespace") or tns_forzado or ""
+    doc = {"path": path, "tns": tns, "nsmap": nsmap, "root": root}
+    g["docs"].append(doc)
+
+    tablas = {"complexType": "types", "simpleType": "simple_types", "element": "elements",
+              "group": "groups", "attributeGroup": "attr_groups", "attribute": "attributes"}
+    for ch in root:
+        if not isinstance(ch.tag, str) or not ch.tag.startswith(XS_NS):
+            continue
+        local = ch.tag[len(XS_NS):]
+        tabla = tablas.get(local)
+        if tabla and ch.attrib.get("name"):
+            nm = ch.attrib["name"]
+            g[tabla].setdefault(f"{{{tns}}}{nm}", (ch, doc))
+            g["por_local"][tabla].setdefault(nm, (ch, doc))
+
+    base_dir = os.path.dirname(path)
+    for ch in root:
+        if ch.tag in (_xsd_q("include"), _xsd_q("redefine")):
+            loc = ch.attrib.get("schemaLocation")
+            local = resolver_ubicacion_xsd(loc, base_dir, catalogo=g["catalogo"])
+            if local:
+                if loc and _es_url(loc):
+                    _UBICACIONES_XSD[loc] = os.path.abspath(local)
+                # include "camaleón": sin targetNamespace propio toma el del que incluye
+                _grafo_add_doc(g, local, tns_forzado=tns)
+            else:
+                g["faltantes"].append(loc)
+                g["pendientes"].append((loc, None, base_dir))
+        elif ch.tag == _xsd_q("import"):
+            loc = ch.attrib.get("schemaLocation")
+            ns = ch.attrib.get("namespace")
+            local = resolver_ubicacion_xsd(loc, base_dir, namespace=ns, catalogo=g["catalogo"])
+            if local:
+                if loc:
+                    _UBICACIONES_XSD[loc] = os.path.abspath(local)
+                _grafo_add_doc(g, local)
+            elif loc or ns:
+                g["faltantes"].append(loc or ns)
+                g["pendientes"].append((loc, ns, base_dir))
+
+def cargar_grafo_xsd(xsd_path: str, fingerprint: str = None) -> dict:
+    """
+    Resuelve (una vez, solo con archivos locales) el grafo include/import del XSD
+    y arma las tablas indexadas por nombre calificado {ns}local:
+    types, simple_types, elements, groups, attr_groups, attributes.
+    `faltantes` lista los schemaLocation que no tienen copia local.
+    """
+    fp = fingerprint or xsd_fingerprint(xsd_path)
+    key = (os.path.abspath(xsd_path), fp)
+    g = _GRAFO_CACHE.get(key)
+    if g is not None and _deps_vigentes(_deps_grafo(g)):
+        return g
+    tablas = ("types", "simple_types", "elements", "groups", "attr_groups", "attributes")
+    g = {"root_path": os.path.abspath(xsd_path), "docs": [], "vistos": set(), "faltantes": [], "pendientes": [],
+         "catalogo": load_xsd_catalog(), "por_local": {t: {} for t in tablas}}
+    for t in tablas:
+        g[t] = {}
+    _grafo_add_doc(g, xsd_path)
+    g["huellas"] = [(d["path"], xsd_fingerprint(d["path"])) for d in g["docs"]]
+    _GRAFO_CACHE[key] = g
+    return g
+
+def _grafo_lookup(g, tabla, qname, doc):
+    """QName del XSD ("p:Nombre") → (elemento, doc) usando los prefijos del doc que lo usa."""
+    if not qname:
+        return None
+    if ":" in qname:
+        prefix, local = qname.split(":", 1)
+        ns = (doc or {}).get("nsmap", {}).get(prefix)
+    else:
+        local = qname
+        ns = (doc or {}).get("nsmap", {}).get("", None)
+    if ns == _XS_URI:
+        return None
+    if ns is not None:
+        hit = g[tabla].get(f"{{{ns}}}{local}")
+        if hit:
+            return hit
+    return g["por_local"][tabla].get(local)
+
+def _grafo_qkey(g, tabla, qname, doc):
+    hit = _grafo_lookup(g, tabla, qname, doc)
+    if hit is None:
+        return None
+    el, d = hit
+    return f"{{{d['tns']}}}{el.attrib.get('name')}"
+
+def _particulas(grp, g, doc, parent_path, memo, stack, out):
+    """Elementos de un sequence/choice/all, aplanando grupos y modelos anidados."""
+    for p in grp:
+        if p.tag == _xsd_q("element"):
+            out.append(_shape_from_element(p, g, parent_path, memo, stack, doc))
+        elif p.tag in (_xsd_q("sequence"), _xsd_q("choice"), _xsd_q("all")):
+            _particulas(p, g, doc, parent_path, memo, stack, out)
+        elif p.tag == _xsd_q("group") and p.attrib.get("ref"):
+            ref = p.attrib["ref"]
+            hit = _grafo_lookup(g, "groups", ref, doc)
+            if hit is None or ("group", ref) in stack:
+                continue
+            gel, gdoc = hit
+            for modelo in gel:
+                if modelo.tag in (_xsd_q("sequence"), _xsd_q("choice"), _xsd_q("all")):
+                    _particulas(modelo, g, gdoc, parent_path, memo, stack + (("group", ref),), out)
+
+def _build_shape_from_complexType(ct, g, parent_path, memo=None, stack=(), doc=None):
+    shape = {"attributes": [], "children": []}
+    modelo = ct
+    cc = ct.find(_xsd_q("complexContent"))
+    sc = ct.find(_xsd_q("simpleContent"))
+    if cc is not None or sc is not None:
+        der = (cc if cc is not None else sc)
+        ext = der.find(_xsd_q("extension"))
+        if ext is None:
+            ext = der.find(_xsd_q("restriction"))
+        if ext is not None:
+            base = ext.attrib.get("base")
+            qk = _grafo_qkey(g, "types", base, doc) if (base and g is not None) else None
+            if qk and qk not in stack:
+                body = _expand_named_type(qk, g, memo, stack)
+                shape["attributes"].extend(body["attributes"])
+                if cc is not None and ext.tag == _xsd_q("extension"):
+                    shape["children"].extend(body["children"])
+            modelo = ext
+    propios = _collect_attributes(modelo, g, doc)
+    nombres = {a["name"] for a in propios}
+    shape["attributes"] = [a for a in shape["attributes"] if a["name"] not in nombres] + propios
+    for grp in modelo:
+        if grp.tag in (_xsd_q("sequence"), _xsd_q("choice"), _xsd_q("all"), _xsd_q("group")):
+            _particulas([grp] if grp.tag == _xsd_q("group") else grp, g, doc, parent_path, memo, stack, shape["children"])
+    return shape
+
+def _expand_named_type(tp, g, memo, stack):
+    """
+    Cuerpo {"attributes", "children"} de un complexType con nombre ({ns}local),
+    expandido una sola vez y compartido por todos los elementos que lo usan. Los
+    paths de los hijos son relativos al elemento que usa el tipo.
+    """
+    if memo is not None and tp in memo:
+        return memo[tp]
+    ct, doc = g["types"][tp]
+    body = _build_shape_from_complexType(ct, g, "", memo, stack + (tp,), doc)
+    if memo is not None:
+        memo[tp] = body
+    return body
+
+def _shape_from_element(el, g, parent_path, memo=None, stack=(), doc=None):
+    minOccurs = el.attrib.get("minOccurs", "1")
+    maxOccurs = el.attrib.get("maxOccurs", "1")
+
+    ref = el.attrib.get("ref")
+    if ref and g is not None:
+        hit = _grafo_lookup(g, "elements", ref, doc)
+        if hit is not None and ("element", ref) not in stack:
+            # elemento global: se usa su definición con las ocurrencias de quien lo referencia
+            gel, gdoc = hit
+            sh = _shape_from_element(gel, g, parent_path, memo, stack + (("element", ref),), gdoc)
+            sh["minOccurs"], sh["maxOccurs"] = minOccurs, maxOccurs
+            return sh
+
+    name      = el.attrib.get("name") or (ref.split(":", 1)[-1] if ref else None) or "Elemento"
+    tp        = el.attrib.get("type")
+    cur_path  = f"{parent_path}/{name}" if parent_path else name
+
+    child_shape = {
+        "name": name, "path": cur_path,
+        "minOccurs": minOccurs, "maxOccurs": maxOccurs,
+        "attributes": [], "children": [],
+        "is_simple": False
+    }
+
+    inl = el.find(_xsd_q("complexType"))
+    if inl is not None:
+        inline_ct = _build_shape_from_complexType(inl, g, cur_path, memo, stack, doc)
+        child_shape["attributes"] = inline_ct["attributes"]
+        child_shape["children"]   = inline_ct["children"]
+        return child_shape
+
+    qk = _grafo_qkey(g, "types", tp, doc) if (tp and g is not None) else None
+    if qk:
+        child_shape["type_ref"] = qk
+        if qk in stack:
+            # tipo recursivo: nodo perezoso, se expande bajo demanda (expandir_shape)
+            child_shape["lazy"] = True
+            return child_shape
+        ref_ct = _expand_named_type(qk, g, memo, stack)
+        child_shape["attributes"] = ref_ct["attributes"]
+        child_shape["children"]   = ref_ct["children"]
+        return child_shape
+
+    # sin complexType -> elemento simple (texto)
+    child_shape["is_simple"] = True
+    fac = _facetas_de(el, g, doc)
+    if fac:
+        child_shape["facetas"] = fac
+    return child_shape
+
+def parse_xsd_shapes(xsd_path, root_element_name=None):
+    """
+    Como parse_xsd, pero regresa (shapes, tipos): `tipos` es la tabla de
+    complexTypes con nombre ya expandidos (los shapes comparten esos cuerpos) y
+    sirve para expandir los nodos perezosos de tipos recursivos. Resuelve
+    include/import/group/attributeGroup/extension con cargar_grafo_xsd.
+    """
+    g = cargar_grafo_xsd(xsd_path)
+    root_doc = g["docs"][0]
+    tipos = {}
+    shapes = []
+    for d in g["docs"]:
+        # elementos globales del XSD principal y de sus include (mismo namespace)
+        if d is not root_doc and d["tns"] != root_doc["tns"]:
+            continue
+        for el in d["root"].findall(_xsd_q("element")):
+            name = el.attrib.get("name")
+            if root_element_name and name != root_element_name:
+                continue
+            shapes.append(_shape_from_element(el, g, "", tipos, (), d))
+    return shapes, tipos
+
+def parse_xsd(xsd_path, root_element_name=None):
+    return parse_xsd_shapes(xsd_path, root_element_name)[0]
+
+def expandir_shape(shape, tipos):
+    """Si el shape es un nodo perezoso (tipo recursivo), regresa una copia con su cuerpo."""
+    if not shape.get("lazy"):
+        return shape
+    body = (tipos or {}).get(shape.get("type_ref"))
+    if body is None:
+        return shape
+    out = dict(shape)
+    out["lazy"] = False
+    out["attributes"] = body["attributes"]
+    out["children"]   = body["children"]
+    return out
+
+def _shape_a_json(shape):
+    out = dict(shape)
+    if shape.get("type_ref"):
+        # el cuerpo vive en la tabla de tipos; no se duplica por cada uso
+        out["attributes"], out["children"] = [], []
+    else:
+        out["children"] = [_shape_a_json(ch) for ch in shape.get("children", [])]
+    return out
+
+def shapes_a_json(shapes, tipos) -> dict:
+    """Serializa (shapes, tipos) sin repetir los subárboles compartidos."""
+    return {
+        "tipos": {tp: {"attributes": body["attributes"],
+                       "children": [_shape_a_json(ch) for ch in body["children"]]}
+                  for tp, body in (tipos or {}).items()},
+        "shapes": [_shape_a_json(sh) for sh in shapes],
+    }
+
+def shapes_desde_json(data: dict):
+    """Inverso de shapes_a_json: vuelve a enlazar los cuerpos compartidos → (shapes, tipos)."""
+    enc = data.get("tipos") or {}
+    tipos = {tp: {"attributes": body.get("attributes", []), "children": []} for tp, body in enc.items()}
+
+    def dec(node):
+        out = dict(node)
+        ref = node.get("type_ref")
+        if ref and not node.get("lazy") and ref in tipos:
+            out["attributes"] = tipos[ref]["attributes"]
+            out["children"]   = tipos[ref]["children"]
+        else:
+            out["children"] = [dec(ch) for ch in node.get("children", [])]
+        return out
+
+    for tp, body in enc.items():
+        tipos[tp]["children"].extend(dec(ch) for ch in body.get("children", []))
+    return [dec(sh) for sh in data.get("shapes", [])], tipos
+
+# ========= Facetas → validadores por campo =========
+# Cada combinación de facetas se compila una vez (regex ya compilado, enum como
+# frozenset) en una función valor -> mensaje ("" si está bien). Es la revisión
+# rápida mientras se captura; la validación completa con lxml sigue al guardar.
+_VALIDADORES = {}
+_RE_DECIMAL = re.compile(r"[+-]?(\d+(\.\d*)?|\.\d+)")
+_RE_ENTERO  = re.compile(r"[+-]?\d+")
+_RE_FECHA   = re.compile(r"\d{4}-\d{2}-\d{2}(Z|[+-]\d{2}:\d{2})?")
+_RE_FECHAHORA = re.compile(r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d+)?(Z|[+-]\d{2}:\d{2})?")
+_BASES_ENTERAS = {"integer", "int", "long", "short", "byte", "nonNegativeInteger", "positiveInteger",
+                  "nonPositiveInteger", "negativeInteger", "unsignedLong", "unsignedInt",
+                  "unsignedShort", "unsignedByte"}
+
+def _regex_xsd(patron):
+    """
+    pattern de XSD → regex de Python, para usarse con fullmatch (en XSD el
+    patrón siempre abarca el valor completo). Traduce lo que en re significa
+    otra cosa: ^ y $ son literales, . no incluye \\r y \\s es solo
+    espacio/tab/CR/LF. None si usa algo sin equivalente fiel en re: resta de
+    clases (-[...]), \\w/\\W, \\i, \\c o \\p{..}.
+    """
+    out, i, n, en_clase = [], 0, len(patron), False
+    while i < n:
+        c = patron[i]
+        if c == "\\" and i + 1 < n:
+            e = patron[i + 1]
+            i += 2
+            if e in "wWiIcCpP":
+                return None
+            if e == "s":
+                out.append(" \\t\\n\\r" if en_clase else "[ \\t\\n\\r]")
+            elif e == "S":
+                if en_clase:
+                    return None
+                out.append("[^ \\t\\n\\r]")
+            else:
+                out.append("\\" + e)
+            continue
+        if en_clase:
+            if c == "-" and patron[i + 1:i + 2] == "[":
+                return None
+            if c == "]":
+                en_clase = False
+            out.append("\\" + c if c in "[&~|" else c)
+        elif c == "[":
+            en_clase = True
+            out.append(c)
+            if patron[i + 1:i + 2] == "^":
+                out.append("^")
+                i += 1
+        elif c in "^$":
+            out.append("\\" + c)
+        elif c == ".":
+            out.append("[^\\n\\r]")
+        else:
+            out.append(c)
+        i += 1
+    try:
+        return re.compile("".join(out))
+    except re.error:
+        return None
+
+def compilar_validador(facetas):
+    """Closure valor -> mensaje de error ("" = ok) para las facetas del campo; None si no hay qué revisar."""
+    if not facetas:
+        return None
+    llave = json.dumps(facetas, sort_keys=True)
+    v = _VALIDADORES.get(llave)
+    if v is not None or llave in _VALIDADORES:
+        return v
+
+    checks = []
+    base = facetas.get("base") or ""
+    numerico = False
+    if base in _BASES_ENTERAS:
+        checks.append(lambda x: "" if _RE_ENTERO.fullmatch(x) else "debe ser entero")
+        numerico = True
+    elif base in ("decimal", "float", "double"):
+        checks.append(lambda x: "" if _RE_DECIMAL.fullmatch(x) else "debe ser numérico")
+        numerico = True
+    elif base == "date":
+        checks.append(lambda x: "" if _RE_FECHA.fullmatch(x) else "fecha AAAA-MM-DD")
+    elif base == "dateTime":
+        checks.append(lambda x: "" if _RE_FECHAHORA.fullmatch(x) else "fecha/hora AAAA-MM-DDThh:mm:ss")
+
+    enum = facetas.get("enumeration")
+    if enum:
+        permitidos = frozenset(enum)
+        checks.append(lambda x: "" if x in permitidos else "valor fuera del catálogo")
+    if "length" in facetas:
+        n = facetas["length"]
+        checks.append(lambda x: "" if len(x) == n else f"longitud debe ser {n}")
+    lo, hi = facetas.get("minLength"), facetas.get("maxLength")
+    if lo is not None or hi is not None:
+        lo, hi = lo or 0, hi if hi is not None else float("inf")
+        checks.append(lambda x: "" if lo <= len(x) <= hi else
+                      (f"mínimo {lo} caracteres" if len(x) < lo else f"máximo {hi} caracteres"))
+    for grupo in facetas.get("pattern", []):
+        # misma restriction: alternativas; si alguna no se puede traducir, el grupo no se revisa
+        rxs = [_regex_xsd(p) for p in grupo]
+        if rxs and None not in rxs:
+            rx = re.compile("|".join(f"(?:{r.pattern})" for r in rxs))
+            txt = " | ".join(grupo)
+            checks.append(lambda x, rx=rx, p=txt: "" if rx.fullmatch(x) else f"no cumple el patrón {p}")
+    td, fd = facetas.get("totalDigits"), facetas.get("fractionDigits")
+    if td is not None or fd is not None:
+        def digitos(x):
+            if not _RE_DECIMAL.fullmatch(x):
+                return "debe ser numérico"
+            ent, _, frac = x.lstrip("+-").partition(".")
+            frac = frac.rstrip("0")
+            if fd is not None and len(frac) > fd:
+                return f"máximo {fd} decimales"
+            if td is not None and len(ent.lstrip("0") + frac) > td:
+                return f"máximo {td} dígitos"
+            return ""
+        checks.append(digitos)
+    if numerico:
+        for k, cmp_, txt in (("minInclusive", lambda a, b: a >= b, "≥"), ("maxInclusive", lambda a, b: a <= b, "≤"),
+                             ("minExclusive", lambda a, b: a > b, ">"), ("maxExclusive", lambda a, b: a < b, "<")):
+            if k in facetas:
+                try:
+                    lim = float(facetas[k])
+                except ValueError:
+                    continue
+                checks.append(lambda x, lim=lim, c=cmp_, t=txt:
+                              "" if not _RE_DECIMAL.fullmatch(x) or c(float(x), lim) else f"debe ser {t} {_num_txt(lim)}")
+
+    if not checks:
+        _VALIDADORES[llave] = None
+        return None
+
+    def validar(valor):
+        if not valor:
+            return ""   # vacío: eso lo revisa el chequeo de obligatorios
+        for c in checks:
+            msg = c(valor)
+            if msg:
+                return msg
+        return ""
+    _VALIDADORES[llave] = validar
+    return validar
+
+def _num_txt(x):
+    return str(int(x)) if float(x).is_integer() else str(x)
+
+# ======= Construcción Addenda dentro del CFDI ======
+def _qname_cliente(ns_cfg):
+    XML.registrar_ns("cfdi", CFDI_NS)
+    if ns_cfg and ns_cfg.get("uri"):
+        XML.registrar_ns(ns_cfg.get("prefix",""), ns_cfg["uri"])
+        return lambda local: q(ns_cfg["uri"], local)
+    return lambda local: local
+
+def construir_addenda(root_cfdi, valores_form, ns_cfg=None):
+    """
+    Inserta <cfdi:Addenda> con lo que hay en valores_form:
+    {"roots": [ {"name": "...", "attributes": {...}, "text": "...", "children":[...]}, ... ]}
+    """
+    qname_cli = _qname_cliente(ns_cfg)
+
+    addenda = root_cfdi.find(CFDI + "Addenda")
+    if addenda is None:
+        addenda = XML.SubElement(root_cfdi, CFDI + "Addenda")
+
+    for top in valores_form.get("roots", []):
+        _emit_instance(addenda, top, qname_cli)
+
+def construir_addenda_overlay(valores_form, ns_cfg=None, previa=None):
+    """
+    Como construir_addenda pero sin tocar el CFDI: regresa un <cfdi:Addenda>
+    suelto. Con `previa` (la Addenda que ya trae el CFDI) pone copias de esos
+    nodos antes de los nuevos.
+    """
+    qname_cli = _qname_cliente(ns_cfg)
+    addenda = XML.Element(CFDI + "Addenda")
+    if previa is not None:
+        addenda.extend(XML.prestar(previa))
+    for top in valores_form.get("roots", []):
+        _emit_instance(addenda, top, qname_cli)
+    return addenda
+
+def raiz_con_addenda(addenda, tag=CFDI + "Comprobante"):
+    """Comprobante mínimo que solo contiene la Addenda (para validar el subárbol solo)."""
+    root = XML.Element(tag)
+    root.append(addenda)
+    return root
+
+def resumen_cfdi(root_cfdi, prefix="cfdi") -> list:
+    """
+    Líneas de un resumen colapsado del CFDI (encabezado + un renglón por nodo de
+    primer nivel con su número de hijos) para mostrar junto a la Addenda.
+    """
+    a = root_cfdi.attrib
+    campos = " ".join(f'{k}="{a[k]}"' for k in ("Version", "Serie", "Folio", "Fecha", "Total", "Moneda") if a.get(k))
+    pre = f"{prefix}:" if prefix else ""
+    lineas = [f"<{pre}Comprobante {campos}>"]
+    for ch in root_cfdi:
+        if not isinstance(ch.tag, str) or ch.tag == CFDI + "Addenda":
+            continue
+        local = localname(ch.tag)
+        extra = ch.attrib.get("Rfc") or ""
+        if ch.attrib.get("Nombre"):
+            extra += f" ({ch.attrib['Nombre']})"
+        if local == "Complemento":
+            tfd = ch.find(f"{{{TFD_NS}}}TimbreFiscalDigital")
+            if tfd is not None:
+                extra = f"UUID {tfd.attrib.get('UUID', '')}"
+        n = len(ch)
+        hijos = f" · {n} nodo(s)" if n else ""
+        lineas.append(f"  <!-- {pre}{local}{' ' + extra if extra else ''}{hijos} … -->")
+    return lineas
+
+def _emit_instance(parent, inst, qname_cli):
+    elem = XML.SubElement(parent, qname_cli(inst["name"]))
+    for k, v in inst.get("attributes", {}).items():
+        if v is None or v == "":
+            continue
+        elem.set(k, str(v))
+    if "text" in inst and inst["text"] not in (None, ""):
+        elem.text = str(inst["text"])
+    for ch in inst.get("children", []):
+        _emit_instance(elem, ch, qname_cli)
+
+# ========= VALIDACIÓN contra XSD (con lxml) ========
+# Caché de esquemas compilados por proceso, llave = xsd_fingerprint_grafo (LRU).
+SCHEMA_CACHE_MAX = 8
+_SCHEMA_CACHE = OrderedDict()   # fingerprint -> {"schema", "lock", "path"}
+_SCHEMA_STATS = {"hits": 0, "misses": 0, "evictions": 0}
+_SCHEMA_LOCK  = threading.Lock()
+_PARSERS      = threading.local()  # los parsers de lxml no se comparten entre hilos
+
+if HAS_LXML:
+    class _ResolverLocal(LET.Resolver):
+        """include/import del XSD → copia local (catálogo/caché de descargas); nunca a la red."""
+        def resolve(self, url, pubid, context):
+            local = _UBICACIONES_XSD.get(url) or resolver_ubicacion_xsd(url)
+            if local:
+                return self.resolve_filename(os.path.abspath(local), context)
+            return None
+
+def _parser_xsd():
+    p = getattr(_PARSERS, "xsd", None)
+    if p is None:
+        p = _PARSERS.xsd = LET.XMLParser(load_dtd=False, no_network=True)
+        p.resolvers.add(_ResolverLocal())
+    return p
+
+def _parser_doc():
+    p = getattr(_PARSERS, "doc", None)
+    if p is None:
+        p = _PARSERS.doc = LET.XMLParser(load_dtd=False, no_network=True, resolve_entities=False)
+    return p
+
+def compilar_xsd(xsd_path: str):
+    """Parsea y compila el XSD con lxml (LET.XMLSchema), sin red."""
+    try:
+        cargar_grafo_xsd(xsd_path)   # deja resueltos los import (incluso por namespace)
+    except Exception:
+        pass
+    schema_doc = LET.parse(xsd_path, _parser_xsd())
+    return LET.XMLSchema(schema_doc)
+
+def _ruta_norm(path: str) -> str:
+    return os.path.normcase(os.path.abspath(path))
+
+def _schema_entry(xsd_path: str) -> dict:
+    return _schema_entry_llave(xsd_fingerprint_grafo(xsd_path), lambda: compilar_xsd(xsd_path),
+                               _ruta_norm(xsd_path))
+
+def _schema_entry_llave(key, compilar, path) -> dict:
+    with _SCHEMA_LOCK:
+        ent = _SCHEMA_CACHE.get(key)
+        if ent is not None:
+            _SCHEMA_CACHE.move_to_end(key)
+            _SCHEMA_STATS["hits"] += 1
+            return ent
+        _SCHEMA_STATS["misses"] += 1
+    # compila fuera del candado; si otro hilo ganó, se usa el suyo
+    ent = {"schema": compilar(), "lock": threading.Lock(), "path": path}
+    with _SCHEMA_LOCK:
+        ent = _SCHEMA_CACHE.setdefault(key, ent)
+        _SCHEMA_CACHE.move_to_end(key)
+        while len(_SCHEMA_CACHE) > SCHEMA_CACHE_MAX:
+            _SCHEMA_CACHE.popitem(last=False)
+            _SCHEMA_STATS["evictions"] += 1
+    return ent
+
+def obtener_schema(xsd_path: str):
+    """LET.XMLSchema compilado para el XSD, reutilizado mientras no cambie su contenido."""
+    return _schema_entry(xsd_path)["schema"]
+
+def invalidar_schema(xsd_path: str = None):
+    """Saca un XSD de la caché de esquemas (o la vacía completa si no se indica)."""
+    if xsd_path is None:
+        with _SCHEMA_LOCK:
+            _SCHEMA_CACHE.clear()
+        return
+    # la huella puede recorrer el grafo include/import: se calcula antes de tomar el candado
+    try:
+        key = xsd_fingerprint_grafo(xsd_path)
+    except OSError:
+        key = None   # ya no existe: basta con la ruta
+    ruta = _ruta_norm(xsd_path)
+    with _SCHEMA_LOCK:
+        _SCHEMA_CACHE.pop(key, None)
+        for k in [k for k, e in _SCHEMA_CACHE.items() if e["path"] == ruta]:
+            _SCHEMA_CACHE.pop(k, None)
+
+def schema_cache_stats() -> dict:
+    with _SCHEMA_LOCK:
+        return dict(_SCHEMA_STATS, size=len(_SCHEMA_CACHE), max=SCHEMA_CACHE_MAX)
+
+def validate_addenda_subtree_with_xsd(cfdi_root, xsd_path: str, ns_uri: str = "", schema=None):
+    """Valida el hijo de <cfdi:Addenda> (el del namespace ns_uri o el primero).
+    Usa la caché de esquemas compilados salvo que se pase `schema` explícito."""
+    if not HAS_LXML:
+        return (False, "Validación deshabilitada: instala lxml (pip install lxml)")
+    addenda = cfdi_root.find(CFDI + "Addenda")
+    if addenda is None or len(list(addenda)) == 0:
+        return (False, "No hay elementos dentro de <cfdi:Addenda> para validar.")
+
+    target = None
+    if ns_uri:
+        for ch in list(addenda):
+            if isinstance(ch.tag, str) and ch.tag.startswith("{"+ns_uri+"}"):
+                target = ch; break
+    if target is None:
+        target = list(addenda)[0]
+
+    lock = None
+    if schema is None:
+        try:
+            ent = _schema_entry(xsd_path)
+        except Exception as e:
+            return (False, f"XSD inválido o no se pudo cargar:\n{e}")
+        schema, lock = ent["schema"], ent["lock"]
+
+    try:
+        doc = XML.para_validar(target)
+        # validate() y error_log comparten estado en el objeto schema
+        with (lock or threading.Lock()):
+            ok = schema.validate(doc)
+            log = list(schema.error_log)
+        if ok:
+            return (True, "OK")
+        if log:
+            # nodos recién construidos en lxml no tienen línea de origen
+            lineas = [f"Línea {e.line}: {e.message}" if e.line else e.message for e in log]
+            return (False, "\n".join(lineas))
+        return (False, "La Addenda no cumple el XSD.")
+    except Exception as e:
+        return (False, f"Error durante la validación:\n{e}")
+
+def validar_hijo_con_xsd(elem, xsd_path: str):
+    """
+    Valida un elemento lxml (p. ej. el hijo de la Addenda de leer_cfdi_lxml)
+    contra el XSD, con la caché de esquemas. Regresa (ok, [{"linea", "mensaje"}]).
+    """
+    ent = _schema_entry(xsd_path)
+    with ent["lock"]:
+        ok = ent["schema"].validate(elem)
+        log = list(ent["schema"].error_log)
+    return ok, ([] if ok else [{"linea": e.line, "mensaje": e.message} for e in log])
+
+# ===== Validación del CFDI completo (paquete local de esquemas) =====
+# cfdv40 + TFD + complementos del SAT + los XSD de addenda registrados, siempre
+# desde copias locales. Se arma un esquema compuesto (un xs:import por namespace)
+# que se compila una vez por combinación y vive en la misma caché LRU de esquemas.
+PAQUETE_SAT = {
+    CFDI_NS: "http://www.sat.gob.mx/sitio_internet/cfd/4/cfdv40.xsd",
+    TFD_NS:  "http://www.sat.gob.mx/sitio_internet/cfd/TimbreFiscalDigital/TimbreFiscalDigitalv11.xsd",
+    "http://www.sat.gob.mx/Pagos20": "http://www.sat.gob.mx/sitio_internet/cfd/Pagos/Pagos20.xsd",
+    "http://www.sat.gob.mx/implocal": "http://www.sat.gob.mx/sitio_internet/cfd/implocal/implocal.xsd",
+    "http://www.sat.gob.mx/nomina12": "http://www.sat.gob.mx/sitio_internet/cfd/nomina/nomina12.xsd",
+    "http://www.sat.gob.mx/CartaPorte31": "http://www.sat.gob.mx/sitio_internet/cfd/CartaPorte/CartaPorte31.xsd",
+    "http://www.sat.gob.mx/ComercioExterior20":
+        "http://www.sat.gob.mx/sitio_internet/cfd/ComercioExterior20/ComercioExterior20.xsd",
+    "http://www.sat.gob.mx/leyendasFiscales":
+        "http://www.sat.gob.mx/sitio_internet/cfd/leyendasFiscales/leyendasFisc.xsd",
+}
+# carpeta con los XSD del SAT por nombre de archivo (cfdv40.xsd, catCFDI.xsd, tdCFDI.xsd, ...)
+PAQUETE_XSD_DIR = os.environ.get("ADDENDAS_PAQUETE_XSD") or os.path.join(XSD_CACHE_DIR, "paquete")
+
+def registrar_xsd_paquete(xsd_path: str, namespace: str = None) -> str:
+    """Da de alta el XSD de una addenda en el paquete (por su targetNamespace)."""
+    ns = xsd_target_namespace_cached(xsd_path) if namespace is None else namespace
+    try:
+        con = _estado_db()
+        with con:
+            con.execute("INSERT OR REPLACE INTO paquete VALUES (?, ?, ?)",
+                        (ns or "", os.path.abspath(xsd_path), time.time()))
+    except sqlite3.Error:
+        pass
+    return ns or ""
+
+def paquete_registrados() -> dict:
+    """{namespace: xsd} de las addendas registradas que siguen en disco."""
+    try:
+        filas = _estado_db().execute("SELECT namespace, ruta FROM paquete").fetchall()
+    except sqlite3.Error:
+        return {}
+    return {ns: ruta for ns, ruta in filas if os.path.exists(ruta)}
+
+def ubicar_xsd_paquete(ns: str, loc: str = None, registrados: dict = None):
+    """
+    namespace (y el schemaLocation que trae el documento) → XSD local, o None.
+    Orden: addendas registradas, biblioteca de XSD, URL oficial del SAT
+    (catálogo, caché o carpeta del paquete por nombre de archivo), la
+    ubicación declarada. Nunca descarga.
+    """
+    from biblioteca_xsd import buscar_xsd_registro   # el registro usa el store de este módulo
+    regs = paquete_registrados() if registrados is None else registrados
+    if ns in regs:
+        return regs[ns]
+    p = buscar_xsd_registro(ns, ubicacion=loc)
+    if p:
+        return p
+    for u in (PAQUETE_SAT.get(ns), loc):
+        p = resolver_ubicacion_xsd(u, base_dir=PAQUETE_XSD_DIR, namespace=ns or None)
+        if p:
+            return os.path.abspath(p)
+    return None
+
+def ns_de(tag) -> str:
+    return tag[1:].split("}", 1)[0] if isinstance(tag, str) and tag.startswith("{") else ""
+
+def revisar_cfdi_paquete(root):
+    """
+    Namespaces a validar (Comprobante + hijos de Complemento y Addenda) con la
+    ubicación que declara el documento, y los problemas de xsi:schemaLocation
+    (pares incompletos, complementos sin declarar, archivo que no corresponde).
+    Regresa ({ns: ubicación o None}, [problemas]).
+    """
+    usados = {ns_de(root.tag): None}
+    nodos, requeridos = [root], {ns_de(root.tag)}
+    for seccion in ("Complemento", "Addenda"):
+        cont = root.find(CFDI + seccion)
+        for ch in (cont if cont is not None else []):
+            if not isinstance(ch.tag, str):
+                continue
+            usados.setdefault(ns_de(ch.tag), None)
+            nodos.append(ch)
+            if seccion == "Complemento":
+                requeridos.add(ns_de(ch.tag))
+    problemas = []
+    for el in nodos:
+        partes = (el.get(XSI + "schemaLocation") or "").split()
+        if len(partes) % 2:
+            problemas.append(f"xsi:schemaLocation de {localname(el.tag)} no viene en pares namespace/ubicación.")
+            partes = partes[:-1]
+        for ns, loc in zip(partes[::2], partes[1::2]):
+            if ns in usados and usados[ns] is None:
+                usados[ns] = loc
+            oficial = PAQUETE_SAT.get(ns)
+            if oficial and os.path.basename(loc).lower() != os.path.basename(oficial).lower():
+                problemas.append(f"xsi:schemaLocation de {ns} apunta a {loc} "
+                                 f"(se espera {os.path.basename(oficial)}).")
+    for ns in sorted(requeridos):
+        if ns and usados.get(ns) is None:
+            problemas.append(f"xsi:schemaLocation no declara el namespace {ns}.")
+    return usados, problemas
+
+def _paquete_compuesto(miembros) -> dict:
+    """Entrada de la caché de esquemas para [(ns, xsd)], compilada una sola vez."""
+    llave = hashlib.sha1("|".join(f"{ns}={xsd_fingerprint_grafo(r)}" for ns, r in miembros)
+                         .encode("utf-8")).hexdigest()
+
+    def compilar():
+        for _, r in miembros:
+            try:
+                cargar_grafo_xsd(r)   # deja resueltos sus include/import locales
+            except Exception:
+                pass
+        imports = "".join(
+            "<xs:import%s schemaLocation=%s/>" % (f" namespace={quoteattr(ns)}" if ns else "",
+                                                 quoteattr("file:" + urllib.request.pathname2url(r)))
+            for ns, r in miembros)
+        wrapper = f'<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema">{imports}</xs:schema>'
+        return LET.XMLSchema(LET.fromstring(wrapper.encode("utf-8"), _parser_xsd()))
+    return _schema_entry_llave("paquete:" + llave, compilar, "<paquete>")
+
+def validar_cfdi_completo(fuente, extra: dict = None):
+    """
+    Valida el CFDI entero (ruta, bytes o Element) contra el paquete local en una
+    pasada de lxml, sin red. `extra` = {namespace: xsd} se suma a lo registrado
+    (p. ej. el XSD de la addenda en pantalla). Los nodos de Complemento/Addenda
+    sin esquema local se quitan de la validación y se avisan.
+    Regresa (ok, mensaje); ok=None si no se pudo validar (sin lxml o sin cfdv40 local).
+    """
+    if not HAS_LXML:
+        return (None, "Validación deshabilitada: instala lxml (pip install lxml)")
+    try:
+        if isinstance(fuente, (bytes, bytearray)):
+            root = LET.fromstring(bytes(fuente), _parser_doc())
+        elif ET.iselement(fuente):
+            root = XML.para_validar(fuente)
+        else:
+            root = LET.parse(fuente, _parser_doc()).getroot()
+    except Exception as e:
+        return (False, f"XML mal formado:\n{e}")
+    propio = root is not fuente
+
+    usados, problemas = revisar_cfdi_paquete(root)
+    regs = paquete_registrados()
+    regs.update(extra or {})
+    miembros, sin_local = {}, []
+    for ns, loc in usados.items():
+        r = ubicar_xsd_paquete(ns, loc, regs)
+        if r:
+            miembros[ns] = r
+        else:
+            sin_local.append(ns)
+    if CFDI_NS not in miembros:
+        if problemas:
+            return (False, "\n".join(problemas))
+        return (None, "Sin copia local de cfdv40.xsd: no se validó el CFDI completo.")
+
+    if sin_local:
+        if not propio:
+            root = copy.deepcopy(root)
+        for seccion in ("Complemento", "Addenda"):
+            cont = root.find(CFDI + seccion)
+            if cont is None:
+                continue
+            for ch in list(cont):
+                if isinstance(ch.tag, str) and ns_de(ch.tag) in sin_local:
+                    cont.remove(ch)
+            if seccion == "Addenda" and len(cont) == 0:
+                root.remove(cont)   # Addenda vacía no es válida; sin ella sí
+    avisos = [f"Sin esquema local (no se validó): {ns or '(sin namespace)'}" for ns in sin_local]
+
+    try:
+        ent = _paquete_compuesto(sorted(miembros.items()))
+    except Exception as e:
+        return (None, f"No se pudo compilar el paquete de esquemas:\n{e}")
+    with ent["lock"]:
+        ok = ent["schema"].validate(root)
+        log = list(ent["schema"].error_log)
+    if ok and not problemas:
+        return (True, "\n".join(["OK"] + avisos))
+    lineas = problemas + [f"Línea {e.line}: {e.message}" if e.line else e.message for e in log]
+    return (False, "\n".join((lineas or ["El CFDI no cumple los esquemas."]) + avisos))
+
+# ======== Contexto desde CFDI =========
+def extract_cfdi_context(cfdi_root: ET.Element) -> dict:
+    ctx = {}
+    comp = cfdi_root
+    if comp is None:
+        return ctx
+
+    g = comp.attrib.get
+    ctx["serie"]       = g("Serie")
+    ctx["folio"]       = g("Folio")
+    ctx["fecha"]       = g("Fecha")
+    ctx["moneda"]      = g("Moneda")
+    ctx["tipocambio"]  = g("TipoCambio")
+    ctx["formapago"]   = g("FormaPago")
+    ctx["metodopago"]  = g("MetodoPago")
+    ctx["subtotal"]    = g("SubTotal") or g("SubTotal")
+    ctx["total"]       = g("Total")
+    ctx["lugar"]       = g("LugarExpedicion")
+    ctx["nocert"]      = g("NoCertificado")
+    ctx["sello"]       = g("Sello")
+
+    em = comp.find(CFDI + "Emisor")
+    re = comp.find(CFDI + "Receptor")
+    if em is not None:
+        gg = em.attrib.get
+        ctx["emisor_rfc"]     = gg("Rfc")
+        ctx["emisor_nombre"]  = gg("Nombre")
+        ctx["emisor_regimen"] = gg("RegimenFiscal")
+    if re is not None:
+        gg = re.attrib.get
+        ctx["receptor_rfc"]            = gg("Rfc")
+        ctx["receptor_nombre"]         = gg("Nombre")
+        ctx["receptor_uso"]            = gg("UsoCFDI")
+        ctx["receptor_domiciliofiscal"]= gg("DomicilioFiscalReceptor")
+        ctx["receptor_regimen"]        = gg("RegimenFiscalReceptor")
+
+    # Concepto 1 (útil para retail)
+    conceptos = comp.find(CFDI + "Conceptos")
+    if conceptos is not None:
+        c0 = conceptos.find(CFDI + "Concepto")
+        if c0 is not None:
+            cg = c0.attrib.get
+            ctx["concepto1_cantidad"]      = cg("Cantidad")
+            ctx["concepto1_descripcion"]   = cg("Descripcion")
+            ctx["concepto1_noid"]          = cg("NoIdentificacion")
+            ctx["concepto1_valorunit"]     = cg("ValorUnitario")
+            ctx["concepto1_importe"]       = cg("Importe")
+            ctx["concepto1_claveprodserv"] = cg("ClaveProdServ")
+            ctx["concepto1_claveunidad"]   = cg("ClaveUnidad")
+
+    # Impuestos
+    iva_total  = 0.0
+    ieps_total = 0.0
+    otros_total= 0.0
+
+    def _to_float(s):
+        try:
+            return float(s)
+        except Exception:
+            return 0.0
+
+    imp = comp.find(CFDI + "Impuestos")
+    if imp is not None:
+        tot_tras = _to_float(imp.attrib.get("TotalImpuestosTrasladados", "0"))
+        iva_total = max(iva_total, tot_tras)
+        tras = imp.find(CFDI + "Traslados")
+        if tras is not None:
+            for t in tras.findall(CFDI + "Traslado"):
+                imp_clave = t.attrib.get("Impuesto")
+                importe   = _to_float(t.attrib.get("Importe", "0"))
+                if imp_clave == "002":
+                    iva_total = max(iva_total, importe) if iva_total else importe
+                elif imp_clave == "003":
+                    ieps_total += importe
+                else:
+                    otros_total += importe
+
+    if conceptos is not None:
+        for c in conceptos.findall(CFDI + "Concepto"):
+            imp_c = c.find(CFDI + "Impuestos")
+            if imp_c is None: continue
+            tras_c = imp_c.find(CFDI + "Traslados")
+            if tras_c is None: continue
+            for t in tras_c.findall(CFDI + "Traslado"):
+                imp_clave = t.attrib.get("Impuesto")
+                importe   = _to_float(t.attrib.get("Importe", "0"))
+                if imp_clave == "002":
+                    iva_total += importe
+                elif imp_clave == "003":
+                    ieps_total += importe
+                else:
+                    otros_total += importe
+
+    ctx["iva_total"]  = f"{iva_total:.2f}" if iva_total else None
+    ctx["ieps_total"] = f"{ieps_total:.2f}" if ieps_total else None
+    ctx["otros_imp"]  = f"{otros_total:.2f}" if otros_total else None
+
+    # Timbre
+    uuid = no_cert_sat = fecha_timbrado = sello_sat = None
+    comp_comp = comp.find(CFDI + "Complemento")
+    if comp_comp is not None:
+        for ch in comp_comp:
+            if isinstance(ch.tag, str) and ch.tag.startswith("{"+TFD_NS+"}"):
+                uuid          = ch.attrib.get("UUID")
+                no_cert_sat   = ch.attrib.get("NoCertificadoSAT")
+                fecha_timbrado= ch.attrib.get("FechaTimbrado")
+                sello_sat     = ch.attrib.get("SelloSAT")
+                break
+    ctx["uuid"]          = uuid
+    ctx["nocertsat"]     = no_cert_sat
+    ctx["fechatimbrado"] = fecha_timbrado
+    ctx["sello_sat"]     = sello_sat
+    return ctx
+
+def extract_cfdi_context_stream(source) -> dict:
+    """
+    Igual que extract_cfdi_context, pero en una sola pasada con iterparse y sin
+    armar el árbol: cada nodo se limpia al cerrarse, así la memoria no crece con
+    el número de conceptos. `source` es una ruta o un archivo binario abierto.
+    Regresa exactamente el mismo dict.
+    """
+    ctx = {}
+
+    def _to_float(s):
+        try:
+            return float(s)
+        except Exception:
+            return 0.0
+
+    HEAD = (("serie", "Serie"), ("folio", "Folio"), ("fecha", "Fecha"), ("moneda", "Moneda"),
+            ("tipocambio", "TipoCambio"), ("formapago", "FormaPago"), ("metodopago", "MetodoPago"),
+            ("subtotal", "SubTotal"), ("total", "Total"), ("lugar", "LugarExpedicion"),
+            ("nocert", "NoCertificado"), ("sello", "Sello"))
+    EMISOR = (("emisor_rfc", "Rfc"), ("emisor_nombre", "Nombre"), ("emisor_regimen", "RegimenFiscal"))
+    RECEPTOR = (("receptor_rfc", "Rfc"), ("receptor_nombre", "Nombre"), ("receptor_uso", "UsoCFDI"),
+                ("receptor_domiciliofiscal", "DomicilioFiscalReceptor"),
+                ("receptor_regimen", "RegimenFiscalReceptor"))
+    CONCEPTO1 = (("concepto1_cantidad", "Cantidad"), ("concepto1_descripcion", "Descripcion"),
+                 ("concepto1_noid", "NoIdentificacion"), ("concepto1_valorunit", "ValorUnitario"),
+                 ("concepto1_importe", "Importe"), ("concepto1_claveprodserv", "ClaveProdServ"),
+                 ("concepto1_claveunidad", "ClaveUnidad"))
+
+    iva_total = ieps_total = otros_total = 0.0
+    # traslados por concepto: se suman al final, en el mismo orden que la versión con árbol
+    # (ahí se procesan después de los del comprobante); array('d') = 8 bytes por línea
+    por_concepto = {"002": array("d"), "003": array("d"), "otros": array("d")}
+    uuid = no_cert_sat = fecha_timbrado = sello_sat = None
+
+    vistos = set()      # "solo el primero" de cada find() del original
+    primeros = set()    # id() de los nodos abiertos que son ese primero
+    stack = []          # elementos abiertos (raíz → actual)
+    en_concepto = {}    # banderas del concepto abierto
+
+    for ev, el in ET.iterparse(source, events=("start", "end")):
+        if ev == "start":
+            stack.append(el)
+            d = len(stack)
+            tag = el.tag
+            if d == 1:
+                g = el.attrib.get
+                for k, a in HEAD:
+                    ctx[k] = g(a)
+            elif d == 2:
+                if tag in (CFDI + "Emisor", CFDI + "Receptor", CFDI + "Conceptos",
+                           CFDI + "Impuestos", CFDI + "Complemento") and tag not in vistos:
+                    vistos.add(tag)
+                    primeros.add(id(el))
+                    if tag == CFDI + "Emisor":
+                        for k, a in EMISOR:
+                            ctx[k] = el.attrib.get(a)
+                    elif tag == CFDI + "Receptor":
+                        for k, a in RECEPTOR:
+                            ctx[k] = el.attrib.get(a)
+                    elif tag == CFDI + "Impuestos":
+                        iva_total = max(iva_total, _to_float(el.attrib.get("TotalImpuestosTrasladados", "0")))
+            elif id(stack[1]) not in primeros:
+                continue
+            elif stack[1].tag == CFDI + "Conceptos":
+                if d == 3 and tag == CFDI + "Concepto":
+                    en_concepto = {}
+                    if "concepto1" not in vistos:
+                        vistos.add("concepto1")
+                        for k, a in CONCEPTO1:
+                            ctx[k] = el.attrib.get(a)
+                elif d == 4 and tag == CFDI + "Impuestos" and stack[2].tag == CFDI + "Concepto" \
+                        and "imp" not in en_concepto:
+                    en_concepto["imp"] = el
+                elif d == 5 and tag == CFDI + "Traslados" and stack[3] is en_concepto.get("imp") \
+                        and "tras" not in en_concepto:
+                    en_concepto["tras"] = el
+                elif d == 6 and tag == CFDI + "Traslado" and stack[4] is en_concepto.get("tras"):
+                    clave = el.attrib.get("Impuesto")
+                    por_concepto[clave if clave in ("002", "003") else "otros"].append(
+                        _to_float(el.attrib.get("Importe", "0")))
+            elif stack[1].tag == CFDI + "Impuestos":
+                if d == 3 and tag == CFDI + "Traslados" and "tras_comp" not in vistos:
+                    vistos.add("tras_comp")
+                    primeros.add(id(el))
+                elif d == 4 and tag == CFDI + "Traslado" and id(stack[2]) in primeros:
+                    imp_clave = el.attrib.get("Impuesto")
+                    importe   = _to_float(el.attrib.get("Importe", "0"))
+                    if imp_clave == "002":
+                        iva_total = max(iva_total, importe) if iva_total else importe
+                    elif imp_clave == "003":
+                        ieps_total += importe
+                    else:
+                        otros_total += importe
+            elif stack[1].tag == CFDI + "Complemento":
+                if d == 3 and "tfd" not in vistos and isinstance(tag, str) and tag.startswith("{"+TFD_NS+"}"):
+                    vistos.add("tfd")
+                    uuid          = el.attrib.get("UUID")
+                    no_cert_sat   = el.attrib.get("NoCertificadoSAT")
+                    fecha_timbrado= el.attrib.get("FechaTimbrado")
+                    sello_sat     = el.attrib.get("SelloSAT")
+        else:
+            stack.pop()
+            primeros.discard(id(el))
+            if stack and len(stack) <= 2:
+                # hijos del comprobante y conceptos completos: fuera del árbol
+                el.clear()
+                stack[-1].remove(el)
+
+    for v in por_concepto["002"]:
+        iva_total += v
+    for v in por_concepto["003"]:
+        ieps_total += v
+    for v in por_concepto["otros"]:
+        otros_total += v
+
+    ctx["iva_total"]  = f"{iva_total:.2f}" if iva_total else None
+    ctx["ieps_total"] = f"{ieps_total:.2f}" if ieps_total else None
+    ctx["otros_imp"]  = f"{otros_total:.2f}" if otros_total else None
+    ctx["uuid"]          = uuid
+    ctx["nocertsat"]     = no_cert_sat
+    ctx["fechatimbrado"] = fecha_timbrado
+    ctx["sello_sat"]     = sello_sat
+    return ctx
+
+# ======== Tabla de conceptos (una columna por campo) =========
+CONCEPTO_COLS_TXT = (("noid", "NoIdentificacion"), ("descripcion", "Descripcion"),
+                     ("claveprodserv", "ClaveProdServ"), ("claveunidad", "ClaveUnidad"),
+                     ("unidad", "Unidad"), ("cantidad", "Cantidad"), ("valorunit", "ValorUnitario"),
+                     ("importe", "Importe"), ("descuento", "Descuento"))
+CONCEPTO_COLS_NUM = ("cantidad", "valorunit", "importe", "iva", "ieps", "otros")
+
+def _tabla_agregar_concepto(tabla, c):
+    g = c.attrib.get
+    for col, attr in CONCEPTO_COLS_TXT:
+        tabla[col].append(g(attr))
+    iva = ieps = otros = 0.0
+    imp = c.find(CFDI + "Impuestos")
+    tras = imp.find(CFDI + "Traslados") if imp is not None else None
+    if tras is not None:
+        for t in tras.findall(CFDI + "Traslado"):
+            try:
+                importe = float(t.attrib.get("Importe", "0"))
+            except Exception:
+                importe = 0.0
+            clave = t.attrib.get("Impuesto")
+            if clave == "002":
+                iva += importe
+            elif clave == "003":
+                ieps += importe
+            else:
+                otros += importe
+    num = tabla["num"]
+    for col, attr in (("cantidad", "Cantidad"), ("valorunit", "ValorUnitario"), ("importe", "Importe")):
+        try:
+            num[col].append(float(g(attr) or 0))
+        except Exception:
+            num[col].append(0.0)
+    num["iva"].append(iva); num["ieps"].append(ieps); num["otros"].append(otros)
+    tabla["n"] += 1
+
+def extraer_tabla_conceptos(source) -> dict:
+    """
+    Conceptos del CFDI en columnas, en una sola pasada:
+      tabla["n"], tabla[col] (texto tal cual viene en el XML) y
+      tabla["num"][col] (cantidad, valorunit, importe e impuestos trasladados
+      por línea: iva, ieps, otros) como numpy.ndarray si hay NumPy, si no array('d').
+    `source` es el Element del Comprobante, una ruta o un archivo binario
+    (estos dos últimos con iterparse, sin armar el árbol).
+    """
+    tabla = {"n": 0, "num": {col: array("d") for col in CONCEPTO_COLS_NUM}}
+    for col, _ in CONCEPTO_COLS_TXT:
+        tabla[col] = []
+    if ET.iselement(source):
+        conceptos = source.find(CFDI + "Conceptos")
+        for c in (conceptos.findall(CFDI + "Concepto") if conceptos is not None else []):
+            _tabla_agregar_concepto(tabla, c)
+    else:
+        stack = []
+        primero = None
+        for ev, el in ET.iterparse(source, events=("start", "end")):
+            if ev == "start":
+                stack.append(el)
+                if len(stack) == 2 and el.tag == CFDI + "Conceptos" and primero is None:
+                    primero = el
+                continue
+            stack.pop()
+            if len(stack) == 2 and stack[1] is primero and el.tag == CFDI + "Concepto":
+                _tabla_agregar_concepto(tabla, el)
+            if stack and len(stack) <= 2:
+                el.clear()
+                stack[-1].remove(el)
+    if HAS_NUMPY:
+        tabla["num"] = {col: np.frombuffer(arr, dtype=np.float64) if len(arr) else np.zeros(0)
+                        for col, arr in tabla["num"].items()}
+    return tabla
+
+def ctx_linea(ctx: dict, tabla: dict, i: int) -> dict:
+    """Contexto del CFDI con los campos concepto1_* apuntando al concepto i (0-based)."""
+    out = dict(ctx)
+    for col, key in (("cantidad", "concepto1_cantidad"), ("descripcion", "concepto1_descripcion"),
+                     ("noid", "concepto1_noid"), ("valorunit", "concepto1_valorunit"),
+                     ("importe", "concepto1_importe"), ("claveprodserv", "concepto1_claveprodserv"),
+                     ("claveunidad", "concepto1_claveunidad")):
+        out[key] = tabla[col][i]
+    num = tabla["num"]
+    out["concepto_num"] = str(i + 1)
+    out["concepto_iva"]  = f"{float(num['iva'][i]):.2f}" if num["iva"][i] else None
+    out["concepto_ieps"] = f"{float(num['ieps'][i]):.2f}" if num["ieps"][i] else None
+    return out
+
+# ======== Heurística simple de autollenado =========
+class _Matcher:
+    """
+    Aho-Corasick sobre un conjunto fijo de palabras: una pasada por el texto
+    regresa la máscara de bits de todas las palabras contenidas (traslapes incluidos).
+    """
+    def __init__(self, palabras):
+        self.palabras = list(dict.fromkeys(palabras))
+        self.bit = {p: 1 << i for i, p in enumerate(self.palabras)}
+        goto, fail, out = [{}], [0], [0]
+        for p in self.palabras:
+            s = 0
+            for c in p:
+                if c not in goto[s]:
+                    goto.append({}); fail.append(0); out.append(0)
+                    goto[s][c] = len(goto) - 1
+                s = goto[s][c]
+            out[s] |= self.bit[p]
+        cola = list(goto[0].values())
+        for s in cola:
+            for c, u in goto[s].items():
+                cola.append(u)
+                f = fail[s]
+                while f and c not in goto[f]:
+                    f = fail[f]
+                fail[u] = goto[f].get(c, 0)
+                out[u] |= out[fail[u]]
+        self._goto, self._fail, self._out = goto, fail, out
+
+    def mascara(self, texto: str) -> int:
+        goto, fail, out = self._goto, self._fail, self._out
+        s = m = 0
+        for c in texto:
+            while s and c not in goto[s]:
+                s = fail[s]
+            s = goto[s].get(c, 0)
+            m |= out[s]
+        return m
+
+    def requiere(self, palabras) -> int:
+        m = 0
+        for p in palabras:
+            m |= self.bit[p]
+        return m
+
+_AUTOFILL_DIRECTO = {
+    "rfcemisor":"emisor_rfc","emisor_rfc":"emisor_rfc",
+    "rfcreceptor":"receptor_rfc","rfc_receptor":"receptor_rfc",
+    "uuid":"uuid","folio":"folio","serie":"serie",
+    "total":"total","subtotal":"subtotal",
+    "moneda":"moneda","fechatimbrado":"fechatimbrado","fecha":"fecha",
+    "formapago":"formapago","metodopago":"metodopago","tipocambio":"tipocambio",
+    "nocertificado":"nocert","nocertificadosat":"nocertsat",
+    "lugarexpedicion":"lugar","sellosat":"sello_sat","sello":"sello",
+    "nombreemisor":"emisor_nombre","nombrereceptor":"receptor_nombre",
+    "usocfdi":"receptor_uso","domiciliofiscalreceptor":"receptor_domiciliofiscal",
+    "regimenfiscalreceptor":"receptor_regimen","regimenfiscalemisor":"emisor_regimen",
+    "iva":"iva_total","ieps":"ieps_total","otrosimpuestos":"otros_imp",
+    "descripcion":"concepto1_descripcion","cantidad":"concepto1_cantidad",
+    "preciounitario":"concepto1_valorunit","montolinea":"concepto1_importe",
+}
+
+# (palabras que deben estar en el nombre, llaves del ctx a probar). Gana la
+# primera regla que aplique aunque el ctx no traiga valor: el orden es la prioridad.
+AUTOFILL_REGLAS_NOMBRE = [
+    (("uuid",), ("uuid",)),
+    (("emisor","rfc"), ("emisor_rfc",)),
+    (("receptor","rfc"), ("receptor_rfc",)),
+    (("rfc",), ("receptor_rfc","emisor_rfc")),
+    (("folio",), ("folio",)),
+    (("serie",), ("serie",)),
+    (("subtotal",), ("subtotal",)),
+    (("iva",), ("iva_total",)),
+    (("ieps",), ("ieps_total",)),
+    (("total",), ("total",)),
+    (("moneda",), ("moneda",)),
+    (("fecha","timbr"), ("fechatimbrado",)),
+    (("fecha",), ("fecha",)),
+    (("metodo",), ("metodopago",)),
+    (("forma","pago"), ("formapago",)),
+    (("cambio",), ("tipocambio",)),
+    (("lug","exped"), ("lugar",)),
+    (("cert","sat"), ("nocertsat",)),
+    (("cert",), ("nocert",)),
+    (("sello","sat"), ("sello_sat",)),
+    (("sello",), ("sello",)),
+    (("descripcion",), ("concepto1_descripcion",)),
+    (("cantidad",), ("concepto1_cantidad",)),
+    (("precio","unit"), ("concepto1_valorunit",)),
+    (("monto",), ("concepto1_importe",)),
+    (("importe",), ("concepto1_importe",)),
+]
+_MATCH_NOMBRE = _Matcher(p for ws, _ in AUTOFILL_REGLAS_NOMBRE for p in ws)
+_REGLAS_NOMBRE = [(_MATCH_NOMBRE.requiere(ws), keys) for ws, keys in AUTOFILL_REGLAS_NOMBRE]
+
+@lru_cache(maxsize=4096)
+def _plan_nombre(name: str):
+    """Parte del autollenado que solo depende del nombre: (llave directa, llaves de la regla)."""
+    n = (name or "").strip().lower()
+    if not n:
+        return None, ()
+    m = _MATCH_NOMBRE.mascara(n)
+    for req, keys in _REGLAS_NOMBRE:
+        if m & req == req:
+            return _AUTOFILL_DIRECTO.get(n), keys
+    return _AUTOFILL_DIRECTO.get(n), ()
+
+def _resolver_plan(plan, ctx: dict) -> str:
+    regla, directo, keys = plan
+    if regla and ctx.get(regla):
+        return regla
+    if directo and ctx.get(directo) is not None:
+        return directo
+    for k in keys:
+        if ctx.get(k):
+            return k
+    return ""
+
+def guess_autofill_key_by_name(name: str, ctx: dict) -> str:
+    """Como guess_autofill_value_by_name, pero regresa la llave del ctx ("" si no aplica)."""
+    if not name: return ""
+    return _resolver_plan((None,) + _plan_nombre(name), ctx)
+
+def guess_autofill_value_by_name(name: str, ctx: dict) -> str:
+    key = guess_autofill_key_by_name(name, ctx)
+    if not key:
+        return ""
+    return ctx.get(key) or ""
+
+_AUTOFILL_PLANES = {}    # (fingerprint XSD, nombre) -> plan
+_AUTOFILL_PLANES_MAX = 20000
+
+def olvidar_planes_autollenado(fingerprint: str = None):
+    """Tira los planes memoizados (de un XSD o todos), p.ej. tras corregir una regla."""
+    if fingerprint is None:
+        _AUTOFILL_PLANES.clear()
+        return
+    for k in [k for k in _AUTOFILL_PLANES if k[0] == fingerprint]:
+        del _AUTOFILL_PLANES[k]
+
+def plan_autollenado(nombre: str, rules: dict) -> tuple:
+    """(regla del XSD, llave directa, llaves de la heurística) de un campo; se resuelve con _resolver_plan."""
+    rules = rules or {}
+    return (rules.get(nombre) or rules.get((nombre or "").lower()),) + _plan_nombre(nombre or "")
+
+def claves_autollenado(nombres, ctx: dict, rules: dict, fingerprint: str = None) -> dict:
+    """
+    Resuelve de un jalón la llave del ctx para cada nombre de campo (reglas del
+    XSD primero, luego heurística). Con fingerprint, el plan por campo queda
+    memoizado por (XSD, nombre) y solo se revisa el ctx.
+    """
+    rules = rules or {}
+    out = {}
+    for nombre in nombres:
+        if nombre in out:
+            continue
+        plan = _AUTOFILL_PLANES.get((fingerprint, nombre)) if fingerprint else None
+        if plan is None:
+            plan = plan_autollenado(nombre, rules)
+            if fingerprint:
+                if len(_AUTOFILL_PLANES) >= _AUTOFILL_PLANES_MAX:
+                    _AUTOFILL_PLANES.clear()
+                _AUTOFILL_PLANES[(fingerprint, nombre)] = plan
+        out[nombre] = _resolver_plan(plan, ctx)
+    return out
+
+# --------- Lectura de hints/keywords desde el XSD ----------
+def _xsd_text(el):
+    try:
+        return "".join(el.itertext()).strip().lower()
+    except Exception:
+        return ""
+
+def _xsd_first(el, tag_local):
+    return el.find(f"{XS_NS}{tag_local}")
+
+def _read_annotation_hints(xsd_elem):
+    ann = _xsd_first(xsd_elem, "annotation")
+    if ann is None:
+        return ""
+    buf = []
+    for child in list(ann):
+        if child.tag in (f"{XS_NS}documentation", f"{XS_NS}appinfo"):
+            txt = _xsd_text(child)
+            if txt:
+                buf.append(txt)
+    return " ".join(buf)
+
+XSD_KEYWORDS_TO_CFDI = [
+    (("uuid",), "uuid"),
+    (("receptor","rfc"), "receptor_rfc"),
+    (("emisor","rfc"), "emisor_rfc"),
+    (("folio",), "folio"),
+    (("serie",), "serie"),
+    (("subtotal",), "subtotal"),
+    (("total",), "total"),
+    (("iva","impuesto al valor agregado"), "iva_total"),
+    (("ieps",), "ieps_total"),
+    (("otros","impuestos"), "otros_imp"),
+    (("moneda",), "moneda"),
+    (("fecha timbrado","fechatimbrado"), "fechatimbrado"),
+    (("fecha",), "fecha"),
+    (("metodo","pago"), "metodopago"),
+    (("forma","pago"), "formapago"),
+    (("tipo","cambio"), "tipocambio"),
+    (("lugar","expedicion"), "lugar"),
+    (("certificado","sat"), "nocertsat"),
+    (("certificado",), "nocert"),
+    (("sello","sat"), "sello_sat"),
+    (("sello",), "sello"),
+    (("descripcion","concepto"), "concepto1_descripcion"),
+    (("cantidad","concepto"), "concepto1_cantidad"),
+    (("precio","unitario"), "concepto1_valorunit"),
+    (("monto","linea"), "concepto1_importe"),
+]
+
+_NOMBRE_A_LLAVE = {
+    "uuid":"uuid","folio":"folio","serie":"serie","subtotal":"subtotal","total":"total",
+    "moneda":"moneda","fechatimbrado":"fechatimbrado","fecha":"fecha","formapago":"formapago",
+    "metodopago":"metodopago","tipocambio":"tipocambio","lugarexpedicion":"lugar",
+    "nocertificado":"nocert","nocertificadosat":"nocertsat","sellosat":"sello_sat","sello":"sello",
+    "rfcreceptor":"receptor_rfc","rfcemisor":"emisor_rfc"
+}
+_MATCH_HINTS = _Matcher(k for keys, _ in XSD_KEYWORDS_TO_CFDI for k in keys)
+_REGLAS_HINTS = [(_MATCH_HINTS.requiere(keys), k) for keys, k in XSD_KEYWORDS_TO_CFDI]
+
+@lru_cache(maxsize=8192)
+def _decide_cfdi_key_by_name_and_hints(name: str, hint_text: str) -> str:
+    n = (name or "").strip().lower()
+    if not n and not hint_text:
+        return ""
+    if n in _NOMBRE_A_LLAVE:
+        return _NOMBRE_A_LLAVE[n]
+    mn = _MATCH_HINTS.mascara(n)
+    mh = _MATCH_HINTS.mascara(hint_text or "")
+    for req, cfdi_key in _REGLAS_HINTS:
+        if mn & req == req or mh & req == req:
+            return cfdi_key
+    return ""
+
+def build_autofill_rules_from_xsd(xsd_path, root_element_name=None):
+    rules = {}
+    try:
+        tree = ET.parse(xsd_path)
+        schema_root = tree.getroot()
+
+        def process_element(elem):
+            el_name = elem.attrib.get("name") or elem.attrib.get("ref")
+            hints_el = _read_annotation_hints(elem)
+            inl = elem.find(_xsd_q("complexType"))
+            if inl is not None:
+                for a in inl.findall(_xsd_q("attribute")):
+                    nm = a.attrib.get("name")
+                    if not nm or a.attrib.get("fixed") or a.attrib.get("default"):
+                        continue
+                    k = _decide_cfdi_key_by_name_and_hints(nm, hints_el + " " + _read_annotation_hints(a))
+                    if k: rules[nm] = k
+                group = inl.find(_xsd_q("sequence")) or inl.find(_xsd_q("all")) or inl.find(_xsd_q("choice"))
+                if group is not None:
+                    for e in group.findall(_xsd_q("element")):
+                        nm = e.attrib.get("name") or e.attrib.get("ref")
+                        if not nm:
+                            continue
+                        has_complex = (e.find(_xsd_q("complexType")) is not None)
+                        if not has_complex:
+                            k = _decide_cfdi_key_by_name_and_hints(nm, hints_el + " " + _read_annotation_hints(e))
+                            if k: rules[nm] = k
+            else:
+                if el_name:
+                    k = _decide_cfdi_key_by_name_and_hints(el_name, hints_el)
+                    if k: rules[el_name] = k
+
+        for el in schema_root.findall(_xsd_q("element")):
+            name = el.attrib.get("name")
+            if root_element_name and name != root_element_name:
+                continue
+            process_element(el)
+
+        return rules
+    except Exception:
+        return rules
+
+# --------------- Huellas (fingerprint) de XSD ---------------
+# sha1 del contenido, igual que siempre (las cachés existentes siguen sirviendo),
+# pero solo se recalcula si cambia (tamaño, mtime_ns, inodo). Memo en proceso y
+# en la tabla `huellas` de la base de estado.
+HUELLA_CHUNK    = 1 << 20          # lectura por bloques
+HUELLA_MMAP_MIN = 8 << 20          # a partir de aquí se hashea vía mmap
+_HUELLAS = {}                      # ruta abs -> ((size, mtime_ns, ino), sha1)
+_HUELLAS_LOCK = threading.Lock()
+_GRAFOS = {}                       # (ruta abs, huella raíz) -> deps (lo mismo que la tabla `grafos_xsd`)
+
+def _hash_archivo(path: str) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= HUELLA_MMAP_MIN:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                h.update(mm)
+        else:
+            for bloque in iter(lambda: f.read(HUELLA_CHUNK), b""):
+                h.update(bloque)
+    return h.hexdigest()
+
+def _huella_disco(path, firma):
+    try:
+        row = _estado_db().execute(
+            "SELECT sha1 FROM huellas WHERE ruta=? AND size=? AND mtime_ns=? AND ino=?",
+            (path,) + firma).fetchone()
+        return row[0] if row else None
+    except sqlite3.Error:
+        return None
+
+def _huella_disco_guardar(path, firma, sha1):
+    try:
+        con = _estado_db()
+        with con:
+            con.execute("INSERT OR REPLACE INTO huellas VALUES (?, ?, ?, ?, ?)", (path,) + firma + (sha1,))
+    except sqlite3.Error:
+        pass
+
+def xsd_fingerprint(path: str) -> str:
+    try:
+        ap = os.path.abspath(path)
+        st = os.stat(ap)
+        firma = (st.st_size, st.st_mtime_ns, st.st_ino)
+        with _HUELLAS_LOCK:
+            hit = _HUELLAS.get(ap)
+        if hit and hit[0] == firma:
+            return hit[1]
+        fp = _huella_disco(ap, firma)
+        if fp is None:
+            fp = _hash_archivo(ap)
+            _huella_disco_guardar(ap, firma, fp)
+        with _HUELLAS_LOCK:
+            _HUELLAS[ap] = (firma, fp)
+        return fp
+    except Exception:
+        try:
+            st = os.stat(path)
+            mix = f"{os.path.basename(path)}|{st.st_size}|{int(st.st_mtime)}"
+            return hashlib.sha1(mix.encode("utf-8")).hexdigest()
+        except Exception:
+            return os.path.basename(path)
+
+def _huella_compuesta(fp_raiz, deps) -> str:
+    if not deps:
+        return fp_raiz      # XSD de un solo archivo: misma llave de siempre
+    h = hashlib.sha1(fp_raiz.encode("ascii"))
+    for ruta, fp in deps:
+        h.update(f"|{ruta}={fp}".encode("utf-8"))
+    return h.hexdigest()
+
+def _deps_grafo(g) -> list:
+    """
+    Dependencias del grafo: (ruta, huella) de cada documento que arrastra el
+    raíz y ("?" + schemaLocation, JSON [loc, namespace, carpeta]) de cada uno
+    que faltó, para volver a buscarlo igual que resolver_ubicacion_xsd.
+    """
+    return g["huellas"][1:] + [("?" + str(loc or ns), json.dumps([loc, ns, base]))
+                               for loc, ns, base in g["pendientes"]]
+
+def _deps_vigentes(deps) -> bool:
+    cat = None
+    for ruta, fp in deps:
+        if not ruta.startswith("?"):
+            if xsd_fingerprint(ruta) != fp:
+                return False
+            continue
+        # faltante: sigue vigente mientras no aparezca una copia local
+        if cat is None:
+            cat = load_xsd_catalog()
+        try:
+            loc, ns, base = json.loads(fp)
+        except (ValueError, TypeError):
+            return False
+        if resolver_ubicacion_xsd(loc, base, namespace=ns, catalogo=cat):
+            return False
+    return True
+
+def xsd_fingerprint_grafo(xsd_path: str) -> str:
+    """
+    Huella de todo el grafo include/import: la del XSD raíz más la de cada
+    documento que arrastra (y los schemaLocation que faltan, que invalidan en
+    cuanto aparece su copia local). La lista de dependencias se guarda por
+    (ruta, huella raíz), así que revalidar cuesta un stat por archivo; solo se
+    vuelve a parsear si alguna dependencia cambió.
+    """
+    fp = xsd_fingerprint(xsd_path)
+    # los include/import relativos dependen de dónde está el XSD, no solo de su contenido
+    key = (os.path.abspath(xsd_path), fp)
+    with _HUELLAS_LOCK:
+        deps = _GRAFOS.get(key)
+    if deps is None:
+        try:
+            row = _estado_db().execute("SELECT deps FROM grafos_xsd WHERE ruta=? AND fingerprint=?",
+                                       key).fetchone()
+            deps = [tuple(d) for d in json.loads(row[0])] if row else None
+        except (sqlite3.Error, ValueError):
+            deps = None
+    if deps is None or not _deps_vigentes(deps):
+        g = cargar_grafo_xsd(xsd_path, fp)
+        deps = _deps_grafo(g)
+        try:
+            con = _estado_db()
+            with con:
+                con.execute("INSERT OR REPLACE INTO grafos_xsd VALUES (?, ?, ?)", key + (json.dumps(deps),))
+        except sqlite3.Error:
+            pass
+    with _HUELLAS_LOCK:
+        _GRAFOS[key] = deps
+    return _huella_compuesta(fp, deps)
+
+_RULES_DB = threading.local()   # una conexión por hilo (sqlite3 no comparte entre hilos)
+_ESTADO_DB = threading.local()
+_DB_PREPARADAS = set()          # (ruta, pid) ya importadas/migradas en este proceso
+_DB_LOCK = threading.Lock()
+
+_ESQUEMA_REGLAS = """
+    CREATE TABLE IF NOT EXISTS xsds (
+        fingerprint TEXT PRIMARY KEY,
+        inferido    REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS reglas (
+        fingerprint TEXT NOT NULL,
+        campo       TEXT NOT NULL,
+        llave       TEXT,          -- sugerida por el XSD
+        usuario     TEXT,          -- corrección del usuario (gana sobre llave)
+        PRIMARY KEY (fingerprint, campo)
+    );
+    CREATE TABLE IF NOT EXISTS meta (
+        clave TEXT PRIMARY KEY,
+        valor TEXT
+    );
+"""
+
+_ESQUEMA_ESTADO = """
+    CREATE TABLE IF NOT EXISTS meta (
+        clave TEXT PRIMARY KEY,
+        valor TEXT
+    );
+    CREATE TABLE IF NOT EXISTS huellas (
+        ruta     TEXT PRIMARY KEY,
+        size     INTEGER,
+        mtime_ns INTEGER,
+        ino      INTEGER,
+        sha1     TEXT
+    );
+    DROP TABLE IF EXISTS grafos;        -- versión anterior: llave solo por huella raíz
+    CREATE TABLE IF NOT EXISTS grafos_xsd (
+        ruta        TEXT NOT NULL,      -- XSD raíz (ruta abs)
+        fingerprint TEXT NOT NULL,      -- su huella
+        deps        TEXT,               -- JSON [[ruta, huella], ...]
+        PRIMARY KEY (ruta, fingerprint)
+    );
+    CREATE TABLE IF NOT EXISTS paquete (
+        namespace  TEXT PRIMARY KEY,    -- targetNamespace del XSD de addenda
+        ruta       TEXT NOT NULL,
+        registrado REAL
+    );
+    CREATE TABLE IF NOT EXISTS registro_xsd (
+        ruta      TEXT PRIMARY KEY,     -- XSD de la biblioteca (ruta abs)
+        size      INTEGER,
+        mtime_ns  INTEGER,
+        huella    TEXT,                 -- sha1 del contenido
+        namespace TEXT,                 -- targetNamespace (NULL si no se pudo leer)
+        raices    TEXT                  -- JSON: elementos globales (candidatos a raíz)
+    );
+    CREATE INDEX IF NOT EXISTS registro_xsd_ns ON registro_xsd (namespace);
+    CREATE TABLE IF NOT EXISTS vigilancia (
+        ruta      TEXT PRIMARY KEY,     -- CFDI de la carpeta vigilada (ruta abs)
+        firma     TEXT NOT NULL,        -- size:mtime_ns al procesarlo
+        estado    TEXT,
+        salida    TEXT,
+        mensaje   TEXT,
+        procesado REAL
+    );
+"""
+
+def _conexion(local, path, esquema, preparar, legado=None) -> sqlite3.Connection:
+    """
+    Conexión del hilo a una base SQLite. WAL para que varias instancias (o
+    procesos del lote) lean mientras otra escribe; cada escritura es una
+    transacción. `preparar(con)` corre una vez por proceso (importaciones);
+    `legado` es el nombre que tenía la base en la carpeta de trabajo.
+    """
+    con = getattr(local, "con", None)
+    # tras un fork (procesos del lote) la conexión heredada no sirve
+    if con is not None and getattr(local, "path", None) == path and getattr(local, "pid", None) == os.getpid():
+        return con
+    if legado:
+        _traer_legado(legado, path)
+    else:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    con = sqlite3.connect(path, timeout=10)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.executescript(esquema)
+    with _DB_LOCK:
+        if (path, os.getpid()) not in _DB_PREPARADAS:
+            preparar(con)
+            _DB_PREPARADAS.add((path, os.getpid()))
+    local.con, local.path, local.pid = con, path, os.getpid()
+    return con
+
+def _rules_db() -> sqlite3.Connection:
+    """Store de reglas de autollenado por XSD (xsds, reglas, meta)."""
+    return _conexion(_RULES_DB, RULES_DB_PATH, _ESQUEMA_REGLAS, _importar_cache_json, "xsd_autofill_rules.db")
+
+def _estado_db() -> sqlite3.Connection:
+    """Estado de la app que no son reglas: huellas y grafos de XSD, paquete, registro y vigilancia."""
+    return _conexion(_ESTADO_DB, ESTADO_DB_PATH, _ESQUEMA_ESTADO, _migrar_estado)
+
+def _importar_cache_json(con):
+    """Trae xsd_autofill_cache.json al store una sola vez (queda marcado en meta)."""
+    if con.execute("SELECT 1 FROM meta WHERE clave='json_importado'").fetchone():
+        return
+    viejo = {}
+    if os.path.exists(CACHE_PATH):
+        try:
+            with open(CACHE_PATH, "r", encoding="utf-8") as f:
+                viejo = json.load(f)
+        except Exception:
+            viejo = {}
+    with con:
+        for fp, rules in (viejo.items() if isinstance(viejo, dict) else ()):
+            if not isinstance(rules, dict) or not rules:
+                continue
+            con.execute("INSERT OR IGNORE INTO xsds VALUES (?, ?)", (fp, time.time()))
+            con.executemany(
+                "INSERT INTO reglas (fingerprint, campo, llave) VALUES (?, ?, ?) "
+                "ON CONFLICT(fingerprint, campo) DO UPDATE SET llave=excluded.llave",
+                [(fp, k, v) for k, v in rules.items()])
+        con.execute("INSERT OR REPLACE INTO meta VALUES ('json_importado', ?)", (CACHE_PATH,))
+
+_TABLAS_ESTADO = ("huellas", "grafos", "paquete", "registro_xsd", "vigilancia")
+
+def _migrar_estado(con):
+    """
+    Versiones anteriores guardaban estas tablas en el store de reglas: se copian
+    las que no se pueden reconstruir (paquete, vigilancia) y se quitan de ahí.
+    Una sola vez (queda marcado en meta).
+    """
+    if con.execute("SELECT 1 FROM meta WHERE clave='reglas_migradas'").fetchone():
+        return
+    _traer_legado("xsd_autofill_rules.db", RULES_DB_PATH)
+    if os.path.exists(RULES_DB_PATH) and os.path.abspath(RULES_DB_PATH) != os.path.abspath(ESTADO_DB_PATH):
+        con.execute("ATTACH DATABASE ? AS viejo", (RULES_DB_PATH,))
+        try:
+            hay = {r[0] for r in con.execute("SELECT name FROM viejo.sqlite_master WHERE type='table'")}
+            with con:
+                for t in ("paquete", "vigilancia"):
+                    if t in hay:
+                        con.execute(f"INSERT OR IGNORE INTO main.{t} SELECT * FROM viejo.{t}")
+                for t in _TABLAS_ESTADO:
+                    con.execute(f"DROP TABLE IF EXISTS viejo.{t}")
+        finally:
+            con.execute("DETACH DATABASE viejo")
+    with con:
+        con.execute("INSERT OR REPLACE INTO meta VALUES ('reglas_migradas', ?)", (RULES_DB_PATH,))
+
+def reglas_cargar(fingerprint: str):
+    """Reglas efectivas {campo: llave} de un XSD, o None si nunca se infirieron."""
+    try:
+        con = _rules_db()
+        if not con.execute("SELECT 1 FROM xsds WHERE fingerprint=?", (fingerprint,)).fetchone():
+            return None
+        rows = con.execute("SELECT campo, COALESCE(usuario, llave) FROM reglas WHERE fingerprint=?",
+                           (fingerprint,))
+        return {campo: llave for campo, llave in rows if llave}
+    except sqlite3.Error:
+        return None
+
+def reglas_guardar(fingerprint: str, rules: dict):
+    """Guarda lo inferido para el XSD en una transacción; no pisa correcciones del usuario."""
+    try:
+        con = _rules_db()
+        with con:
+            con.execute("INSERT OR REPLACE INTO xsds VALUES (?, ?)", (fingerprint, time.time()))
+            con.executemany(
+                "INSERT INTO reglas (fingerprint, campo, llave) VALUES (?, ?, ?) "
+                "ON CONFLICT(fingerprint, campo) DO UPDATE SET llave=excluded.llave",
+                [(fingerprint, k, v) for k, v in rules.items()])
+    except sqlite3.Error:
+        pass
+
+def reglas_override(fingerprint: str, campo: str, llave: str):
+    """Corrección del usuario para un campo ("" o None = volver a la sugerida)."""
+    con = _rules_db()
+    with con:
+        con.execute(
+            "INSERT INTO reglas (fingerprint, campo, usuario) VALUES (?, ?, ?) "
+            "ON CONFLICT(fingerprint, campo) DO UPDATE SET usuario=excluded.usuario",
+            (fingerprint, campo, llave or None))
+    olvidar_planes_autollenado(fingerprint)
+
+def reglas_para_xsd(xsd_path: str, root_element_name=None, fingerprint: str = None) -> dict:
+    """Reglas del store; si el XSD es nuevo se infieren y se guardan."""
+    fp = fingerprint or xsd_fingerprint(xsd_path)
+    rules = reglas_cargar(fp)
+    if rules is None:
+        rules = build_autofill_rules_from_xsd(xsd_path, root_element_name=root_element_name)
+        reglas_guardar(fp, rules)
+    return rules
+
+def bitacora_vigilancia(carpeta: str) -> dict:
+    """{ruta: firma} de los CFDI de la carpeta que la vigilancia ya procesó."""
+    prefijo = os.path.join(os.path.abspath(carpeta), "")
+    rows = _estado_db().execute("SELECT ruta, firma FROM vigilancia WHERE substr(ruta, 1, ?) = ?",
+                               (len(prefijo), prefijo)).fetchall()
+    return dict(rows)
+
+def bitacora_vigilancia_guardar(fila: dict, firma: str):
+    """Anota un CFDI procesado (fila de procesar_cfdi) con la firma size:mtime_ns que tenía."""
+    con = _estado_db()
+    with con:
+        con.execute("INSERT OR REPLACE INTO vigilancia (ruta, firma, estado, salida, mensaje, procesado) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (fila["archivo"], firma, fila["estado"], fila["salida"], fila["mensaje"], time.time()))
+
+def registro_biblioteca_xsd(carpeta: str) -> list:
+    """Filas del registro de XSD bajo la carpeta: (ruta, size, mtime_ns, huella, namespace, raices JSON)."""
+    prefijo = os.path.join(os.path.abspath(carpeta), "")
+    return _estado_db().execute("SELECT ruta, size, mtime_ns, huella, namespace, raices FROM registro_xsd "
+                                "WHERE substr(ruta, 1, ?) = ?", (len(prefijo), prefijo)).fetchall()
+
+def registro_biblioteca_xsd_guardar(cambios, borrados):
+    """Altas/cambios (filas como las de registro_biblioteca_xsd) y bajas (rutas) en una transacción."""
+    con = _estado_db()
+    with con:
+        con.executemany("INSERT OR REPLACE INTO registro_xsd (ruta, size, mtime_ns, huella, namespace, raices) "
+                        "VALUES (?, ?, ?, ?, ?, ?)", cambios)
+        con.executemany("DELETE FROM registro_xsd WHERE ruta = ?", [(p,) for p in borrados])
+
+# --------------- Cache de shapes por XSD ---------------
+SHAPES_CACHE_DIR = _shapes_cache_dir_default()   # un JSON por fingerprint
+SHAPES_CACHE_VERSION = 5                 # subir si cambia el formato de los shapes
+
+def _shapes_cache_file(fp: str) -> str:
+    return os.path.join(SHAPES_CACHE_DIR, f"{fp}.json")
+
+def _shapes_cache_load(fp: str) -> dict:
+    try:
+        with open(_shapes_cache_file(fp), "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except Exception:
+        return {}
+    if not isinstance(data, dict) or data.get("version") != SHAPES_CACHE_VERSION or data.get("fingerprint") != fp:
+        return {}
+    return data
+
+def _shapes_cache_save(fp: str, data: dict):
+    try:
+        os.makedirs(SHAPES_CACHE_DIR, exist_ok=True)
+        data["version"] = SHAPES_CACHE_VERSION
+        data["fingerprint"] = fp
+        tmp = _shapes_cache_file(fp) + f".{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, _shapes_cache_file(fp))
+    except Exception:
+        pass
+
+def parse_xsd_cached(xsd_path, root_element_name=None, fingerprint=None):
+    """
+    parse_xsd_shapes con caché en disco por (fingerprint, elemento raíz) → (shapes, tipos).
+    Si el XSD no cambió, no se vuelve a parsear; si cambió el contenido o el
+    formato de la caché, se parsea de nuevo y se reescribe. La llave es la huella
+    del grafo completo: cambiar un include también invalida.
+    """
+    fp = fingerprint or xsd_fingerprint_grafo(xsd_path)
+    root_key = root_element_name or "*"
+    data = _shapes_cache_load(fp)
+    enc = (data.get("shapes") or {}).get(root_key)
+    if isinstance(enc, dict):
+        try:
+            return shapes_desde_json(enc)
+        except Exception:
+            pass
+    shapes, tipos = parse_xsd_shapes(xsd_path, root_element_name=root_element_name)
+    data.setdefault("shapes", {})[root_key] = shapes_a_json(shapes, tipos)
+    if "target_ns" not in data:
+        data["target_ns"] = parse_xsd_target_namespace(xsd_path)
+    _shapes_cache_save(fp, data)
+    return shapes, tipos
+
+def xsd_target_namespace_cached(xsd_path, fingerprint=None) -> str:
+    fp = fingerprint or xsd_fingerprint_grafo(xsd_path)
+    data = _shapes_cache_load(fp)
+    if "target_ns" in data:
+        return data["target_ns"] or ""
+    tns = parse_xsd_target_namespace(xsd_path)
+    data["target_ns"] = tns
+    _shapes_cache_save(fp, data)
+    return tns
+
+# --------------- Perfiles de campos ---------------
+PERFIL_VERSION = 1
+
+def _clave_autollenado(nombre: str, ctx: dict, rules: dict) -> str:
+    """Llave del ctx para un campo: primero reglas del XSD, luego heurística."""
+    return claves_autollenado((nombre,), ctx, rules)[nombre]
+
+def _vincular_instancia(inst, ctx, rules):
+    """Copia de la instancia donde cada valor que salió del CFDI queda como {"ctx": llave}."""
+    out = {"name": inst["name"], "attributes": {}, "children": []}
+    for k, v in inst.get("attributes", {}).items():
+        key = _clave_autollenado(k, ctx, rules) if v else ""
+        out["attributes"][k] = {"ctx": key} if key and str(ctx.get(key)) == v else v
+    if inst.get("text"):
+        key = _clave_autollenado(inst["name"], ctx, rules)
+        out["text"] = {"ctx": key} if key and str(ctx.get(key)) == inst["text"] else inst["text"]
+    for ch in inst.get("children", []):
+        out["children"].append(_vincular_instancia(ch, ctx, rules))
+    return out
+
+def guardar_perfil(path, valores_form, xsd_path, ns_cfg, root_element_name=None, ctx=None, rules=None,
+                   por_concepto=False):
+    """
+    Guarda el formulario como perfil reutilizable (JSON). Los valores que
+    coinciden con el CFDI abierto se guardan ligados a su llave de contexto,
+    para que en lote se tomen de cada CFDI y no se copien literales.
+    """
+    perfil = armar_perfil(valores_form, xsd_path, ns_cfg, root_element_name, ctx, rules, por_concepto)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(perfil, f, indent=2, ensure_ascii=False)
+
+def armar_perfil(valores_form, xsd_path, ns_cfg, root_element_name=None, ctx=None, rules=None,
+                 por_concepto=False) -> dict:
+    ctx = ctx or {}
+    rules = rules or {}
+    return {
+        "version": PERFIL_VERSION,
+        "xsd": os.path.abspath(xsd_path) if xsd_path else None,
+        "ns": {"prefix": (ns_cfg or {}).get("prefix") or "cli", "uri": (ns_cfg or {}).get("uri") or ""},
+        "root_element": root_element_name,
+        "por_concepto": bool(por_concepto),
+        "roots": [_vincular_instancia(r, ctx, rules) for r in valores_form.get("roots", [])],
+    }
+
+def cargar_perfil(path) -> dict:
+    with open(path, "r", encoding="utf-8") as f:
+        perfil = json.load(f)
+    if not isinstance(perfil, dict) or perfil.get("version") != PERFIL_VERSION:
+        raise ValueError("El perfil no es válido o es de otra versión.")
+    return perfil
+
+def _resolver_valor(nombre, v, ctx, rules):
+    if isinstance(v, dict):
+        return ctx.get(v.get("ctx")) or ""
+    if v in (None, ""):
+        k = _clave_autollenado(nombre, ctx, rules)
+        return (ctx.get(k) or "") if k else ""
+    return v
+
+def _resolver_instancia(inst, ctx, rules):
+    out = {"name": inst["name"], "attributes": {}, "children": []}
+    for k, v in inst.get("attributes", {}).items():
+        out["attributes"][k] = _resolver_valor(k, v, ctx, rules)
+    if "text" in inst:
+        out["text"] = _resolver_valor(inst["name"], inst["text"], ctx, rules)
+    for ch in inst.get("children", []):
+        out["children"].append(_resolver_instancia(ch, ctx, rules))
+    return out
+
+def aplicar_perfil(perfil: dict, ctx: dict, rules=None, shapes=None, tabla=None, tipos=None) -> dict:
+    """
+    Perfil → valores_form para construir_addenda. Ligas {"ctx": llave} toman el
+    valor del CFDI; campos vacíos se autollenan igual que en la UI. Con `shapes`
+    y `tabla` (extraer_tabla_conceptos) los nodos por línea se repiten por concepto.
+    """
+    rules = rules or {}
+    if shapes is not None and tabla is not None:
+        return generar_valores_por_concepto(perfil.get("roots", []), shapes, ctx, tabla, rules, tipos)
+    return {"roots": [_resolver_instancia(r, ctx, rules) for r in perfil.get("roots", [])]}
+
+def _depende_de_concepto(inst, ctx, rules) -> bool:
+    """¿Algún campo de la instancia (o de sus hijos) sale de concepto1_*?"""
+    def liga(nombre, v):
+        if isinstance(v, dict):
+            return str(v.get("ctx") or "").startswith("concepto1_")
+        if v in (None, ""):
+            return _clave_autollenado(nombre, ctx, rules).startswith("concepto1_")
+        return False
+    for k, v in inst.get("attributes", {}).items():
+        if liga(k, v):
+            return True
+    if "text" in inst and liga(inst["name"], inst["text"]):
+        return True
+    return any(_depende_de_concepto(ch, ctx, rules) for ch in inst.get("children", []))
+
+def _max_ocurrencias(shape, n):
+    mx = shape.get("maxOccurs", "1")
+    if mx == "unbounded":
+        return n
+    try:
+        return min(n, int(mx))
+    except Exception:
+        return n
+
+def _generar_hijos(instancias, shapes, ctx, tabla, rules, tipos):
+    por_nombre = {sh["name"]: expandir_shape(sh, tipos) for sh in (shapes or [])}
+    out, expandidos = [], set()
+    for inst in instancias:
+        sh = por_nombre.get(inst["name"])
+        repetible = sh is not None and sh.get("maxOccurs", "1") != "1"
+        if inst["name"] in expandidos:
+            # la primera instancia capturada es la plantilla; las demás eran ejemplo
+            continue
+        if repetible and tabla and tabla["n"] and _depende_de_concepto(inst, ctx, rules):
+            expandidos.add(inst["name"])
+            for i in range(_max_ocurrencias(sh, tabla["n"])):
+                out.append(_generar_instancia(inst, sh, ctx_linea(ctx, tabla, i), tabla, rules, tipos))
+        else:
+            out.append(_generar_instancia(inst, sh, ctx, tabla, rules, tipos))
+    return out
+
+def _generar_instancia(inst, shape, ctx, tabla, rules, tipos):
+    out = {"name": inst["name"], "attributes": {}, "children": []}
+    for k, v in inst.get("attributes", {}).items():
+        out["attributes"][k] = _resolver_valor(k, v, ctx, rules)
+    if "text" in inst:
+        out["text"] = _resolver_valor(inst["name"], inst["text"], ctx, rules)
+    out["children"] = _generar_hijos(inst.get("children", []), (shape or {}).get("children"),
+                                     ctx, tabla, rules, tipos)
+    return out
+
+def generar_valores_por_concepto(roots, shapes, ctx, tabla, rules=None, tipos=None) -> dict:
+    """
+    Generador sin UI: cada nodo con maxOccurs>1 cuyos campos salen del concepto
+    (ligas/autollenado concepto1_*) se repite una vez por concepto de `tabla`,
+    ligado al concepto i. `roots` son instancias de perfil (con o sin ligas).
+    Regresa valores_form listos para construir_addenda.
+    """
+    rules = rules or {}
+    return {"roots": _generar_hijos(roots, shapes, ctx, tabla, rules, tipos)}
+
+# --------------- Plantillas compiladas por receptor ---------------
+# Un perfil ya resuelto contra el XSD queda como esqueleto de texto: constantes
+# pre-escapadas, huecos ligados a llaves del ctx (o al plan de autollenado) y
+# bucles por concepto. Rendir una addenda es pegar cadenas, sin armar árbol; la
+# salida es la misma que construir_addenda + serializar_addenda.
+# un JSON por RFC receptor
+PLANTILLAS_DIR = os.environ.get("ADDENDAS_PLANTILLAS") or os.path.join(DATOS_DIR, "plantillas_addenda")
+PLANTILLA_VERSION = 1
+_PLANTILLAS = {}                         # rfc -> (mtime_ns, plantilla); recarga si cambia el archivo
+_PLANTILLAS_LOCK = threading.Lock()
+
+def _esc_texto(v: str) -> str:
+    return v.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+def _esc_attr(v: str) -> str:
+    # mismo escape que ElementTree para valores de atributo
+    return (_esc_texto(v).replace('"', "&quot;").replace("\r", "&#13;")
+            .replace("\n", "&#10;").replace("\t", "&#09;"))
+
+def _hueco(nombre, v, rules) -> dict:
+    if isinstance(v, dict):
+        return {"ctx": v.get("ctx")}
+    regla, directo, keys = plan_autollenado(nombre, rules)
+    return {"plan": [regla, directo, list(keys)]}
+
+class _ContenidoMixto(ValueError):
+    """Nodo con texto e hijos: no cabe en las partes de una plantilla compilada."""
+
+def _plantilla_instancia(inst, shape, cli, nivel, ctx, rules, tipos, tope=False) -> list:
+    """Partes de un nodo: str, ("bonito", txt) que solo va en modo bonito, huecos {...} y bucles."""
+    prefix, uri = cli
+    qn = f"{prefix}:{inst['name']}" if uri else inst["name"]
+    partes = [f"<{qn}"]
+    if tope and uri:
+        partes.append(f' xmlns:{prefix}="{_esc_attr(uri)}"')   # ET lo declara en cada nodo de primer nivel
+    for k, v in inst.get("attributes", {}).items():
+        if isinstance(v, dict) or v in (None, ""):
+            partes.append(dict(_hueco(k, v, rules), a=k))
+        else:
+            partes.append(f' {k}="{_esc_attr(str(v))}"')
+    hijos = _plantilla_hijos(inst.get("children", []), (shape or {}).get("children"), cli, nivel + 1,
+                             ctx, rules, tipos)
+    texto = inst.get("text")
+    if hijos:
+        if texto not in (None, ""):
+            raise _ContenidoMixto(f"{inst['name']}: contenido mixto (texto e hijos) no se puede compilar")
+        partes += [">"] + hijos + [("bonito", "\n" + "  " * nivel), f"</{qn}>"]
+    elif isinstance(texto, dict) or ("text" in inst and texto in (None, "")):
+        partes.append(dict(_hueco(inst["name"], texto, rules), t=qn))
+    elif texto not in (None, ""):
+        partes.append(f">{_esc_texto(str(texto))}</{qn}>")
+    else:
+        partes.append(" />")
+    return partes
+
+def _plantilla_hijos(instancias, shapes, cli, nivel, ctx, rules, tipos, tope=False) -> list:
+    """Igual que _generar_hijos, pero la repetición por concepto queda como bucle."""
+    por_nombre = {sh["name"]: expandir_shape(sh, tipos) for sh in (shapes or [])}
+    partes, expandidos = [], {}
+    sangria = ("bonito", "\n" + "  " * nivel)
+    for inst in instancias:
+        sh = por_nombre.get(inst["name"])
+        cuerpo = [sangria] + _plantilla_instancia(inst, sh, cli, nivel, ctx, rules, tipos, tope)
+        if inst["name"] in expandidos:
+            # sin conceptos _generar_hijos deja también las instancias de ejemplo
+            expandidos[inst["name"]]["resto"] += cuerpo
+            continue
+        if sh is not None and sh.get("maxOccurs", "1") != "1" and _depende_de_concepto(inst, ctx, rules):
+            mx = sh.get("maxOccurs", "1")
+            bucle = {"bucle": None if mx == "unbounded" else int(mx), "partes": cuerpo, "resto": []}
+            expandidos[inst["name"]] = bucle
+            partes.append(bucle)
+        else:
+            partes += cuerpo
+    return partes
+
+def _fijar_variante(partes, bonito) -> list:
+    """Deja solo lo de una variante (compacta o bonita) y junta las cadenas seguidas."""
+    out = []
+    for p in partes:
+        if isinstance(p, tuple):
+            p = p[1] if bonito else ""
+        elif isinstance(p, dict) and "bucle" in p:
+            p = dict(p, partes=_fijar_variante(p["partes"], bonito),
+                     resto=_fijar_variante(p.get("resto", []), bonito))
+        if isinstance(p, str):
+            if not p:
+                continue
+            if out and isinstance(out[-1], str):
+                out[-1] += p
+                continue
+        out.append(p)
+    return out
+
+def compilar_plantilla(perfil: dict, ctx: dict, rules=None, shapes=None, tipos=None, ns_cfg=None) -> dict:
+    """
+    Perfil (armar_perfil/cargar_perfil) → plantilla para el RFC receptor de `ctx`.
+    Con "por_concepto" y `shapes`, los nodos por línea quedan como bucle sobre
+    los conceptos, igual que generar_valores_por_concepto. Si algún nodo trae
+    texto e hijos, la plantilla guarda el perfil y las reglas en lugar de las
+    partes, y serializador_plantilla la arma por el árbol.
+    """
+    rules = rules or {}
+    ns_cfg = ns_cfg or perfil.get("ns") or {}
+    cli = (ns_cfg.get("prefix") or "cli", ns_cfg.get("uri") or "")
+    try:
+        partes = _plantilla_hijos(perfil.get("roots", []), shapes if perfil.get("por_concepto") else None,
+                                  cli, 2, ctx, rules, tipos, tope=True)
+    except _ContenidoMixto:
+        partes = None
+    xsd = perfil.get("xsd")
+    pl = {
+        "version": PLANTILLA_VERSION,
+        "rfc": (ctx.get("receptor_rfc") or "").strip().upper(),
+        "xsd": xsd,
+        "huella": xsd_fingerprint_grafo(xsd) if xsd and os.path.exists(xsd) else None,
+        "ns": {"prefix": cli[0], "uri": cli[1]},
+        "root_element": perfil.get("root_element"),
+        "por_concepto": bool(perfil.get("por_concepto")) and shapes is not None,
+        "creada": time.time(),
+    }
+    if partes is None:
+        pl.update(perfil=perfil, reglas=rules)
+    else:
+        pl.update(compacta=_fijar_variante(partes, False), bonita=_fijar_variante(partes, True))
+    return pl
+
+def _valor_hueco(h, ctx) -> str:
+    if "ctx" in h:
+        v = ctx.get(h["ctx"])
+    else:
+        k = _resolver_plan(h["plan"], ctx)
+        v = ctx.get(k) if k else None
+    return str(v) if v else ""
+
+def _rendir(partes, ctx, tabla, out):
+    for p in partes:
+        if isinstance(p, str):
+            out.append(p)
+        elif "bucle" in p:
+            n = tabla["n"] if tabla else 0
+            if not n:
+                _rendir(p["partes"], ctx, tabla, out)
+                _rendir(p.get("resto", ()), ctx, tabla, out)
+                continue
+            for i in range(n if p["bucle"] is None else min(n, p["bucle"])):
+                _rendir(p["partes"], ctx_linea(ctx, tabla, i), tabla, out)
+        else:
+            v = _valor_hueco(p, ctx)
+            if "a" in p:
+                if v:
+                    out.append(f' {p["a"]}="{_esc_attr(v)}"')
+            elif v:
+                out.append(f">{_esc_texto(v)}</{p['t']}>")
+            else:
+                out.append(" />")
+
+def rendir_plantilla(plantilla: dict, ctx: dict, tabla=None, bonito=False) -> str:
+    """Hijos de la <cfdi:Addenda> como texto XML para este CFDI."""
+    out = []
+    _rendir(plantilla["bonita" if bonito else "compacta"], ctx, tabla, out)
+    return "".join(out)
+
+def serializador_plantilla(plantilla: dict, ctx: dict, tabla=None, previa=None):
+    """
+    serializador(prefix, bonito) → bytes de la <cfdi:Addenda> (la `previa` del
+    CFDI y luego lo de la plantilla), para escribir_cfdi_con_addenda.
+    """
+    nodos = XML.prestar(previa) if previa is not None else []
+    if "perfil" in plantilla:
+        return _serializador_sin_compilar(plantilla, ctx, tabla, nodos)
+
+    def serializar(prefix, bonito):
+        cuerpo = _cuerpo_addenda(nodos, bonito)
+        return _envolver_addenda(cuerpo + rendir_plantilla(plantilla, ctx, tabla, bonito), prefix, bonito)
+    return serializar
+
+def _serializador_sin_compilar(plantilla, ctx, tabla, nodos):
+    """Plantilla con contenido mixto: aplica el perfil guardado y serializa el árbol, como el lote."""
+    perfil, rules, xsd = plantilla["perfil"], plantilla.get("reglas") or {}, plantilla.get("xsd")
+    if plantilla.get("por_concepto") and xsd and os.path.exists(xsd):
+        shapes, tipos = parse_xsd_cached(xsd, root_element_name=plantilla.get("root_element"))
+        valores = aplicar_perfil(perfil, ctx, rules, shapes=shapes, tabla=tabla, tipos=tipos)
+    else:
+        valores = aplicar_perfil(perfil, ctx, rules)
+
+    def serializar(prefix, bonito):
+        # nodos nuevos en cada llamada: _cuerpo_addenda los indenta en sitio
+        nuevos = list(construir_addenda_overlay(valores, plantilla["ns"]))
+        return _envolver_addenda(_cuerpo_addenda(nodos + nuevos, bonito), prefix, bonito)
+    return serializar
+
+def raiz_de_serializador(serializar):
+    """Comprobante mínimo con la Addenda que produce `serializar` (para validarla)."""
+    return XML.fromstring(b"<Comprobante>" + serializar(None, False) + b"</Comprobante>")
+
+def carpeta_plantillas() -> str:
+    """Carpeta de las plantillas compiladas (trae una vez las de la carpeta de trabajo)."""
+    _traer_legado("plantillas_addenda", PLANTILLAS_DIR)
+    return PLANTILLAS_DIR
+
+def _plantilla_archivo(rfc: str) -> str:
+    return os.path.join(carpeta_plantillas(), re.sub(r"[^\w&Ñ-]", "_", rfc.strip().upper()) + ".json")
+
+def guardar_plantilla(plantilla: dict) -> str:
+    if not plantilla.get("rfc"):
+        raise ValueError("El CFDI no trae RFC del receptor; no se puede ligar la plantilla.")
+    os.makedirs(carpeta_plantillas(), exist_ok=True)
+    path = _plantilla_archivo(plantilla["rfc"])
+    tmp = path + f".{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(plantilla, f, ensure_ascii=False)
+    os.replace(tmp, path)
+    return path
+
+def cargar_plantilla(rfc: str):
+    """Plantilla del RFC receptor (o None). Se relee sola si el archivo cambió."""
+    if not rfc:
+        return None
+    rfc = rfc.strip().upper()
+    path = _plantilla_archivo(rfc)
+    try:
+        mt = os.stat(path).st_mtime_ns
+    except OSError:
+        with _PLANTILLAS_LOCK:
+            _PLANTILLAS.pop(rfc, None)
+        return None
+    with _PLANTILLAS_LOCK:
+        hit = _PLANTILLAS.get(rfc)
+    if hit and hit[0] == mt:
+        return hit[1]
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            pl = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(pl, dict) or pl.get("version") != PLANTILLA_VERSION:
+        return None
+    with _PLANTILLAS_LOCK:
+        _PLANTILLAS[rfc] = (mt, pl)
+    return pl
+
+# -------- Helpers Addenda/XML -------------
+def localname(tag: str) -> str:
+    if not isinstance(tag, str):
+        return ""
+    if tag.startswith("{"):
+        return tag.split("}", 1)[1]
+    return tag
+
+def hijos_addenda(cfdi_root) -> list:
+    """Elementos dentro de <cfdi:Addenda> (sin comentarios ni PIs)."""
+    addenda = cfdi_root.find(CFDI + "Addenda")
+    return [ch for ch in addenda if isinstance(ch.tag, str)] if addenda is not None else []
+
+def describir_hijo_addenda(ch) -> str:
+    pista_attr = next(iter(ch.attrib.keys()), "")
+    pista_child = localname(ch[0].tag) if len(ch) else ""
+    return (f"{localname(ch.tag)}   ns={ns_de(ch.tag) or '—'}   attr={localname(pista_attr) or '—'}"
+            f"   child={pista_child or '—'}")
+
+def elegir_hijo_addenda_auto(hijos, tiene_xsd=None, ns: str = None):
+    """
+    Lo de _elegir_hijo_addenda sin diálogo: uno solo → ese; varios → el del
+    namespace `ns` si se pide, si no el primero con XSD conocido (`tiene_xsd(ns,
+    local)`), si no el primero (el que el diálogo deja preseleccionado).
+    """
+    if len(hijos) <= 1:
+        return hijos[0] if hijos else None
+    if ns is not None:
+        return next((ch for ch in hijos if ns_de(ch.tag) == ns), hijos[0])
+    if tiene_xsd is not None:
+        for ch in hijos:
+            if tiene_xsd(ns_de(ch.tag), localname(ch.tag)):
+                return ch
+    return hijos[0]
+
+def _walk_collect_simple_values(elem, out, path=""):
+    """
+    Recolecta:
+      - Atributos: out[("attr", owner_local, attr_local, path)] = [lista de valores]
+      - Texto:     out[("text", owner_local, "#text", path)]    = [lista de textos]
+    Guarda listas y toma texto aunque existan hijos.
+    """
+    owner_local = localname(elem.tag)
+    cur_path = f"{path}/{owner_local}" if path else owner_local
+
+    # atributos (normaliza ns/prefijos)
+    for k, v in elem.attrib.items():
+        if v in (None, ""):
+            continue
+        if isinstance(k, str) and k.startswith("{"):
+            attr_local = k.split("}",1)[1].lower()
+        else:
+            attr_local = k.split(":",1)[-1].lower()
+        if attr_local == "schemalocation":
+            continue
+        key = ("attr", owner_local, attr_local, cur_path)
+        out.setdefault(key, []).append(v)
+
+    # texto
+    txt = (elem.text or "").strip()
+    if txt:
+        keyt = ("text", owner_local, "#text", cur_path)
+        out.setdefault(keyt, []).append(txt)
+
+    for ch in list(elem):
+        _walk_collect_simple_values(ch, out, cur_path)
+
+def parse_addenda_xml_values(path_or_xml_tree, elegir=None):
+    """
+    Devuelve diccionario de valores simples para prellenar el UI. En un CFDI con
+    varias addendas `elegir(root)` decide cuál (sin él, elegir_hijo_addenda_auto).
+    """
+    if hasattr(path_or_xml_tree, "getroot"):
+        tree = path_or_xml_tree
+    else:
+        tree = XML.parse(path_or_xml_tree)
+    root = tree.getroot()
+
+    # CFDI → entrar a Addenda (y elegir si hay varias)
+    if localname(root.tag).lower() == "comprobante":
+        base = elegir(root) if elegir else elegir_hijo_addenda_auto(hijos_addenda(root))
+        if base is None:
+            return {}
+    else:
+        base = root
+
+    values = {}
+    _walk_collect_simple_values(base, values)
+
+    scl = base.attrib.get(XSI + "schemaLocation") or root.attrib.get(XSI + "schemaLocation")
+    ns_uri = base.tag.split('}')[0][1:] if base.tag.startswith("{") else ""
+    info = {"values": values, "schemaLocation": scl, "ns_uri": ns_uri}
+    info.update(indexar_valores_addenda(values))
+    return info
+
+def indexar_valores_addenda(values: dict) -> dict:
+    """
+    Índices secundarios sobre values (para no barrer todas las llaves por campo):
+      - por_nombre: ("attr", owner_local, attr_local) -> lista de la primera ruta que lo trae
+      - por_local:  owner_local -> lista de textos de la primera ruta con ese elemento
+    "Primera ruta" = mismo orden de documento que usaba el barrido lineal.
+    """
+    por_nombre, por_local = {}, {}
+    for k, lista in values.items():
+        if len(k) != 4:
+            continue
+        if k[0] == "attr":
+            por_nombre.setdefault(k[:3], lista)
+        elif k[0] == "text":
+            por_local.setdefault(k[1], lista)
+    return {"por_nombre": por_nombre, "por_local": por_local}
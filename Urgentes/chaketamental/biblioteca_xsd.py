@@ -0,0 +1,123 @@
+# biblioteca_xsd.py
+# Registro de la biblioteca local de XSD (namespace/raíz → archivo).
+import os
+import json
+import time
+import sqlite3
+import threading
+import xml.etree.ElementTree as ET
+import urllib.parse
+
+from addendas import (
+    DATOS_DIR, registro_biblioteca_xsd, registro_biblioteca_xsd_guardar, xsd_fingerprint, XS_NS)
+
+# --------------- Registro de la biblioteca de XSD ---------------
+# Índice de todos los XSD de la carpeta de addendas por targetNamespace,
+# elementos globales, nombre de archivo y huella. Se guarda en la base de
+# estado y se actualiza por size/mtime (solo se reparsean los que cambiaron);
+# en memoria queda como diccionarios, así ubicar el XSD de una addenda o de
+# un schemaLocation no abre archivos.
+XSD_BIBLIOTECA_DIR = os.environ.get("ADDENDAS_XSD_DIR") or os.path.join(DATOS_DIR, "xsd")
+REGISTRO_XSD_TTL = 30.0   # segundos entre revisiones (stat) de la carpeta
+_REGISTRO_XSD = {"carpeta": None, "revisado": 0.0, "ns_de": {}, "por_ns": {}, "por_raiz": {},
+                 "por_nombre": {}, "por_huella": {}}
+_REGISTRO_XSD_LOCK = threading.Lock()
+
+def cabecera_xsd(path):
+    """targetNamespace y elementos globales del documento (sin seguir include/import)."""
+    root = ET.parse(path).getroot()
+    raices = [ch.attrib["name"] for ch in root if ch.tag == XS_NS + "element" and ch.attrib.get("name")]
+    return root.attrib.get("targetNamespace") or "", raices
+
+def indexar_biblioteca_xsd(carpeta: str = None) -> dict:
+    """
+    Recorre la carpeta (con subcarpetas) y actualiza el registro: parsea solo los
+    XSD nuevos o con otro size/mtime y quita los que ya no existen.
+    Regresa {"total", "nuevos", "actualizados", "borrados", "ilegibles"}.
+    """
+    carpeta = os.path.abspath(carpeta or XSD_BIBLIOTECA_DIR)
+    filas = registro_biblioteca_xsd(carpeta)
+    previos = {r[0]: (r[1], r[2]) for r in filas}
+    res = {"total": 0, "nuevos": 0, "actualizados": 0, "borrados": 0, "ilegibles": 0}
+    vistos, cambios = set(), []
+    for dirpath, _dirs, files in os.walk(carpeta):
+        for nombre in files:
+            if not nombre.lower().endswith(".xsd"):
+                continue
+            path = os.path.join(dirpath, nombre)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            vistos.add(path)
+            if previos.get(path) == (st.st_size, st.st_mtime_ns):
+                continue
+            try:
+                tns, raices = cabecera_xsd(path)
+                huella = xsd_fingerprint(path)
+            except (ET.ParseError, OSError):
+                # se registra sin namespace para no reparsearlo en cada revisión
+                tns, raices, huella = None, [], None
+                res["ilegibles"] += 1
+            cambios.append((path, st.st_size, st.st_mtime_ns, huella, tns, json.dumps(raices)))
+            res["actualizados" if path in previos else "nuevos"] += 1
+    borrados = [p for p in previos if p not in vistos]
+    if cambios or borrados:
+        registro_biblioteca_xsd_guardar(cambios, borrados)
+        filas = registro_biblioteca_xsd(carpeta)
+    res["total"], res["borrados"] = len(vistos), len(borrados)
+    _registro_xsd_cargar(filas, carpeta)
+    return res
+
+def _registro_xsd_cargar(filas, carpeta):
+    ns_de, por_ns, por_raiz, por_nombre, por_huella = {}, {}, {}, {}, {}
+    # primero los que declaran elementos globales: un include de puros tipos no es "el" XSD del namespace
+    filas = sorted(filas, key=lambda r: (r[5] == "[]", r[0]))
+    for ruta, _size, _mt, huella, ns, raices in filas:
+        if ns is None:
+            continue
+        ns_de[ruta] = ns
+        por_ns.setdefault(ns, []).append(ruta)
+        for r in json.loads(raices or "[]"):
+            por_raiz.setdefault((ns, r), ruta)
+        por_nombre.setdefault(os.path.basename(ruta).lower(), ruta)
+        por_huella.setdefault(huella, ruta)
+    with _REGISTRO_XSD_LOCK:
+        _REGISTRO_XSD.update(carpeta=carpeta, revisado=time.time(), ns_de=ns_de, por_ns=por_ns,
+                             por_raiz=por_raiz, por_nombre=por_nombre, por_huella=por_huella)
+
+def registro_xsd(carpeta: str = None) -> dict:
+    """Índices de la biblioteca; la carpeta se revisa (solo stat) a lo más cada REGISTRO_XSD_TTL s."""
+    carpeta = os.path.abspath(carpeta or XSD_BIBLIOTECA_DIR)
+    with _REGISTRO_XSD_LOCK:
+        vigente = _REGISTRO_XSD["carpeta"] == carpeta and time.time() - _REGISTRO_XSD["revisado"] < REGISTRO_XSD_TTL
+    if not vigente:
+        try:
+            if os.path.isdir(carpeta):
+                indexar_biblioteca_xsd(carpeta)
+            else:
+                with _REGISTRO_XSD_LOCK:
+                    _REGISTRO_XSD.update(carpeta=carpeta, revisado=time.time(), ns_de={}, por_ns={},
+                                         por_raiz={}, por_nombre={}, por_huella={})
+        except sqlite3.Error:
+            pass
+    return _REGISTRO_XSD
+
+def buscar_xsd_registro(ns: str = None, raiz: str = None, ubicacion: str = None, carpeta: str = None):
+    """
+    XSD de la biblioteca para un namespace (y elemento raíz) o un schemaLocation, o None.
+    Con `ubicacion` se busca por nombre de archivo, siempre que el namespace coincida;
+    sin namespace hace falta la ubicación o el elemento raíz (el namespace solo es ambiguo).
+    """
+    reg = registro_xsd(carpeta)
+    if ubicacion:
+        nombre = os.path.basename(urllib.parse.urlparse(ubicacion).path or ubicacion).lower()
+        p = reg["por_nombre"].get(nombre)
+        if p and (ns is None or reg["ns_de"].get(p) == ns):
+            return p
+    if ns is None:
+        return None
+    if raiz and (ns, raiz) in reg["por_raiz"]:
+        return reg["por_raiz"][(ns, raiz)]
+    rutas = reg["por_ns"].get(ns) if ns else None
+    return rutas[0] if rutas else None
@@ -0,0 +1,199 @@
+# lote.py
+# Perfil → Addenda para muchos CFDI (lo comparten el lote, la vigilancia y el servicio).
+import os
+import csv
+import glob
+import io
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import addendas
+from addendas import (
+    aplicar_perfil, cargar_perfil, cargar_plantilla, cargar_xsd_desde_fuente, CFDI,
+    cfdi_con_addenda_bytes, construir_addenda, escribir_bytes, escribir_cfdi_con_addenda,
+    extract_cfdi_context_stream, extraer_tabla_conceptos, HAS_LXML, leer_addenda_cfdi,
+    obtener_schema, parse_xsd_cached, parse_xsd_target_namespace, raiz_de_serializador,
+    registrar_xsd_paquete, reglas_para_xsd, serializador_plantilla, usar_backend_xml,
+    validar_cfdi_completo, validate_addenda_subtree_with_xsd)
+
+# ============== Lote (sin GUI) =====================
+def preparar_perfil(xsd_path, perfil) -> dict:
+    """Lo que se reutiliza entre CFDI con un mismo perfil: ns, reglas, shapes y esquema compilado."""
+    ns = perfil.get("ns") or {}
+    est = {"xsd": xsd_path, "perfil": perfil,
+           "ns_cfg": {"prefix": ns.get("prefix") or "cli",
+                      "uri": ns.get("uri") or parse_xsd_target_namespace(xsd_path)},
+           "rules": reglas_para_xsd(xsd_path, root_element_name=perfil.get("root_element")),
+           "por_concepto": bool(perfil.get("por_concepto")),
+           "schema": None, "schema_error": None}
+    est["shapes"], est["tipos"] = parse_xsd_cached(xsd_path, root_element_name=perfil.get("root_element"))
+    if HAS_LXML:
+        try:
+            est["schema"] = obtener_schema(xsd_path)
+        except Exception as e:
+            est["schema_error"] = f"XSD inválido o no se pudo cargar: {e}"
+    return est
+
+class SinPerfil(LookupError):
+    """No hay perfil ni plantilla que aplique al CFDI (o al perfil pedido)."""
+
+def _flujo(fuente):
+    """Ruta o bytes → algo que acepten los lectores por streaming."""
+    return io.BytesIO(fuente) if isinstance(fuente, (bytes, bytearray)) else fuente
+
+def armar_addenda_cfdi(est, fuente, plantillas=False, ctx=None) -> dict:
+    """
+    Addenda para un CFDI (ruta o bytes) sin armar su árbol: con la plantilla del
+    RFC receptor si `plantillas` y existe, si no con el perfil preparado `est`.
+    Regresa {"ctx", "addenda" (Element o serializador), "raiz" (Comprobante
+    mínimo para validarla), "xsd", "ns", "schema", "schema_error", "notas"}.
+    SinPerfil si no hay plantilla y `est` es None.
+    """
+    if ctx is None:
+        ctx = extract_cfdi_context_stream(_flujo(fuente))
+    root = leer_addenda_cfdi(fuente)
+    pl = cargar_plantilla(ctx.get("receptor_rfc")) if plantillas else None
+    arm = {"ctx": ctx, "notas": []}
+    if pl is not None:
+        # plantilla del receptor (puede traer otro XSD que el perfil): texto, sin árbol
+        tabla = extraer_tabla_conceptos(_flujo(fuente)) if pl.get("por_concepto") else None
+        addenda = serializador_plantilla(pl, ctx, tabla, previa=root.find(CFDI + "Addenda"))
+        arm.update(addenda=addenda, raiz=raiz_de_serializador(addenda), xsd=pl["xsd"],
+                   ns=pl["ns"]["uri"], schema=None, schema_error=None)
+        arm["notas"].append(f"plantilla {pl['rfc']}")
+        return arm
+    if est is None:
+        raise SinPerfil(f"Sin plantilla ni perfil para el receptor {ctx.get('receptor_rfc') or '(sin RFC)'}")
+    if est["por_concepto"]:
+        valores = aplicar_perfil(est["perfil"], ctx, est["rules"], shapes=est["shapes"],
+                                 tabla=extraer_tabla_conceptos(_flujo(fuente)), tipos=est["tipos"])
+    else:
+        valores = aplicar_perfil(est["perfil"], ctx, est["rules"])
+    construir_addenda(root, valores, ns_cfg=est["ns_cfg"])
+    arm.update(addenda=root.find(CFDI + "Addenda"), raiz=root, xsd=est["xsd"], ns=est["ns_cfg"]["uri"],
+               schema=est["schema"], schema_error=est["schema_error"])
+    return arm
+
+def validar_addenda_armada(arm):
+    """validate_addenda_subtree_with_xsd sobre lo que regresó armar_addenda_cfdi."""
+    if HAS_LXML and arm["schema_error"]:
+        raise RuntimeError(arm["schema_error"])
+    return validate_addenda_subtree_with_xsd(arm["raiz"], arm["xsd"], ns_uri=arm["ns"], schema=arm["schema"])
+
+# Estado por proceso: el XSD se compila una sola vez por worker.
+_LOTE = {}
+
+def _lote_init(xsd_path, perfil, salida, backend="auto", completo=False, plantillas=False):
+    _LOTE.clear()
+    usar_backend_xml(backend)
+    _LOTE.update(preparar_perfil(xsd_path, perfil))
+    _LOTE["salida"] = salida
+    _LOTE["completo"] = completo
+    _LOTE["plantillas"] = plantillas
+
+def _lote_procesar(path):
+    return procesar_cfdi(path, _LOTE, _LOTE["salida"], plantillas=_LOTE["plantillas"], completo=_LOTE["completo"])
+
+def procesar_cfdi(path, est, salida, plantillas=False, completo=False, ctx=None) -> dict:
+    """Un CFDI: contexto → addenda → validación → escritura. Regresa fila del reporte."""
+    t0 = time.perf_counter()
+    fila = {"archivo": path, "estado": "", "salida": "", "mensaje": "", "segundos": ""}
+    try:
+        # sin árbol del CFDI: contexto por streaming, raíz mínima con la Addenda, empalme de bytes
+        arm = armar_addenda_cfdi(est, path, plantillas=plantillas, ctx=ctx)
+        notas = arm["notas"]
+        if HAS_LXML:
+            ok, errs = validar_addenda_armada(arm)
+            if not ok:
+                fila["estado"] = "invalido"
+                fila["mensaje"] = " | ".join(notas + [errs.replace("\n", " | ")])
+                return fila
+        base, ext = os.path.splitext(os.path.basename(path))
+        out_path = os.path.join(salida, f"{base}_con_addenda{ext or '.xml'}")
+        if completo:
+            data = cfdi_con_addenda_bytes(path, arm["addenda"])
+            ok, msg = validar_cfdi_completo(data, extra={arm["ns"]: arm["xsd"]})
+            if ok is False:
+                fila["estado"] = "invalido"
+                fila["mensaje"] = " | ".join(notas + ["CFDI: " + msg.replace("\n", " | ")])
+                return fila
+            if ok is None or "\n" in msg:
+                notas.append(msg.replace("\n", " | "))
+            escribir_bytes(data, out_path)
+        else:
+            escribir_cfdi_con_addenda(path, arm["addenda"], out_path)
+        fila["mensaje"] = " | ".join(notas)
+        fila["estado"] = "ok" if HAS_LXML else "ok_sin_validar"
+        fila["salida"] = out_path
+    except SinPerfil as e:
+        fila["estado"] = "sin_cliente"
+        fila["mensaje"] = str(e)
+    except Exception as e:
+        fila["estado"] = "error"
+        fila["mensaje"] = str(e).replace("\n", " | ")
+    finally:
+        fila["segundos"] = f"{time.perf_counter() - t0:.4f}"
+    return fila
+
+def listar_cfdis(entrada: str) -> list:
+    """Carpeta (todos los *.xml) o patrón glob. Omite los *_con_addenda.xml ya generados."""
+    if os.path.isdir(entrada):
+        paths = glob.glob(os.path.join(entrada, "*.xml")) + glob.glob(os.path.join(entrada, "*.XML"))
+    else:
+        paths = glob.glob(entrada, recursive=True)
+    vistos, out = set(), []
+    for p in sorted(paths):
+        if p in vistos or not os.path.isfile(p):
+            continue
+        vistos.add(p)
+        if os.path.splitext(p)[0].endswith("_con_addenda"):
+            continue
+        out.append(p)
+    return out
+
+def procesar_lote(entrada, perfil_path, salida, xsd_path=None, reporte=None, procesos=None, log=print,
+                  backend=None, completo=False, plantillas=False):
+    """
+    Aplica la addenda del perfil a todos los CFDI de `entrada` en un pool de procesos.
+    Escribe el reporte CSV por archivo y regresa (filas, resumen).
+    """
+    perfil = cargar_perfil(perfil_path)
+    xsd_path = cargar_xsd_desde_fuente(xsd_path or perfil.get("xsd") or "")
+    registrar_xsd_paquete(xsd_path)
+    archivos = listar_cfdis(entrada)
+    os.makedirs(salida, exist_ok=True)
+    reporte = reporte or os.path.join(salida, "reporte_lote.csv")
+
+    t0 = time.perf_counter()
+    filas = []
+    if archivos:
+        with ProcessPoolExecutor(max_workers=procesos or None, initializer=_lote_init,
+                                 initargs=(xsd_path, perfil, salida, backend or addendas.XML.nombre, completo, plantillas)) as pool:
+            futs = [pool.submit(_lote_procesar, p) for p in archivos]
+            for fut in as_completed(futs):
+                filas.append(fut.result())
+    elapsed = time.perf_counter() - t0
+    filas.sort(key=lambda f: f["archivo"])
+
+    with open(reporte, "w", newline="", encoding="utf-8") as f:
+        w = csv.DictWriter(f, fieldnames=["archivo", "estado", "salida", "mensaje", "segundos"])
+        w.writeheader()
+        w.writerows(filas)
+
+    resumen = {
+        "archivos": len(filas),
+        "ok": sum(1 for r in filas if r["estado"].startswith("ok")),
+        "invalidos": sum(1 for r in filas if r["estado"] == "invalido"),
+        "errores": sum(1 for r in filas if r["estado"] == "error"),
+        "segundos": elapsed,
+        "archivos_por_seg": (len(filas) / elapsed) if elapsed > 0 else 0.0,
+        "reporte": reporte,
+    }
+    if log:
+        log(f"{resumen['archivos']} archivos en {elapsed:.2f}s "
+            f"({resumen['archivos_por_seg']:.1f} archivos/seg) • ok={resumen['ok']} "
+            f"invalidos={resumen['invalidos']} errores={resumen['errores']}")
+        log(f"Reporte: {reporte}")
+        if not HAS_LXML:
+            log("Aviso: sin lxml no se validó contra el XSD (pip install lxml).")
+    return filas, resumen
@@ -1,568 +1,40 @@
 # main.py
 import os
+import sys
 import json
-import hashlib
+import time
+import argparse
+import queue
+from concurrent.futures import ThreadPoolExecutor
 import tkinter as tk
-from tkinter import ttk, filedialog, messagebox
-import xml.etree.ElementTree as ET
-
-# -------- Utilidades de red/XSD (URL) -------------
+from tkinter import ttk, filedialog, messagebox, simpledialog
 import urllib.parse
-import urllib.request
-
-XSD_CACHE_DIR = os.path.join(os.getcwd(), ".xsd_cache")
-os.makedirs(XSD_CACHE_DIR, exist_ok=True)
-
-def _es_url(s: str) -> bool:
-    try:
-        u = urllib.parse.urlparse(s)
-        return u.scheme in ("http", "https")
-    except Exception:
-        return False
-
-def _descargar_xsd(url: str) -> str:
-    """
-    Descarga un XSD desde internet a caché local y regresa la ruta del archivo.
-    """
-    if not _es_url(url):
-        raise ValueError("La dirección no parece una URL válida.")
-    nombre = hashlib.sha1(url.encode("utf-8")).hexdigest() + ".xsd"
-    destino = os.path.join(XSD_CACHE_DIR, nombre)
-    urllib.request.urlretrieve(url, destino)
-    if os.path.getsize(destino) == 0:
-        raise IOError("El archivo descargado está vacío.")
-    return destino
-
-def cargar_xsd_desde_fuente(path_o_url: str) -> str:
-    """Ruta local o URL http/https → ruta local."""
-    if _es_url(path_o_url):
-        return _descargar_xsd(path_o_url)
-    if not os.path.exists(path_o_url):
-        raise FileNotFoundError("No se encontró el archivo XSD especificado.")
-    return path_o_url
-
-# ========= Validación XSD (lxml opcional) =========
-try:
-    from lxml import etree as LET
-    HAS_LXML = True
-except Exception:
-    HAS_LXML = False
-
-# ================== Constantes =====================
-CFDI_NS = "http://www.sat.gob.mx/cfd/4"
-TFD_NS  = "http://www.sat.gob.mx/TimbreFiscalDigital"
-CFDI    = "{%s}" % CFDI_NS
-XS_NS   = "{http://www.w3.org/2001/XMLSchema}"
-
-ET.register_namespace("cfdi", CFDI_NS)
-
-CACHE_PATH = "xsd_autofill_cache.json"   # cache reglas inferidas por XSD
-
-# ================= Utilidades XML ==================
-def pretty_xml(tree: ET.ElementTree) -> None:
-    try:
-        ET.indent(tree, space="  ")
-    except Exception:
-        pass
-
-def q(uri, local):
-    return f"{{{uri}}}{local}" if uri else local
-
-def generate_preview(tree: ET.ElementTree) -> str:
-    try:
-        ET.indent(tree, space="  ")
-    except Exception:
-        pass
-    return ET.tostring(tree.getroot(), encoding="unicode")
-
-# ============ Parseo XSD → Shapes (para UI) =======
-def _xsd_get(el, name, default=None):
-    return el.attrib.get(name, default)
-
-def _xsd_q(tag):
-    return f"{XS_NS}{tag}"
-
-def parse_xsd_target_namespace(xsd_path: str) -> str:
-    try:
-        tree = ET.parse(xsd_path)
-        root = tree.getroot()
-        return root.attrib.get("targetNamespace", "") or ""
-    except Exception:
-        return ""
-
-def _collect_attributes(ct):
-    attrs = []
-    for a in ct.findall(_xsd_q("attribute")):
-        attrs.append({
-            "name": _xsd_get(a, "name"),
-            "type": _xsd_get(a, "type"),
-            "use": _xsd_get(a, "use", "optional"),
-            "fixed": _xsd_get(a, "fixed"),
-            "default": _xsd_get(a, "default")
-        })
-    return attrs
-
-def _resolve_type_map(schema_root):
-    tmap = {}
-    for ct in schema_root.findall(_xsd_q("complexType")):
-        name = _xsd_get(ct, "name")
-        if name:
-            tmap[name] = ct
-    return tmap
-
-def _build_shape_from_complexType(ct, tmap, parent_path):
-    shape = {"attributes": _collect_attributes(ct), "children": []}
-    seq   = ct.find(_xsd_q("sequence"))
-    allg  = ct.find(_xsd_q("all"))
-    choice= ct.find(_xsd_q("choice"))
-    group = seq or allg or choice
-    if group is not None:
-        for e in group.findall(_xsd_q("element")):
-            shape["children"].append(_shape_from_element(e, tmap, parent_path))
-    return shape
-
-def _shape_from_element(el, tmap, parent_path):
-    name      = el.attrib.get("name") or el.attrib.get("ref") or "Elemento"
-    minOccurs = el.attrib.get("minOccurs", "1")
-    maxOccurs = el.attrib.get("maxOccurs", "1")
-    tp        = el.attrib.get("type")
-    cur_path  = f"{parent_path}/{name}" if parent_path else name
-
-    child_shape = {
-        "name": name, "path": cur_path,
-        "minOccurs": minOccurs, "maxOccurs": maxOccurs,
-        "attributes": [], "children": [],
-        "is_simple": False
-    }
-
-    inl = el.find(_xsd_q("complexType"))
-    if inl is not None:
-        inline_ct = _build_shape_from_complexType(inl, tmap, cur_path)
-        child_shape["attributes"] = inline_ct["attributes"]
-        child_shape["children"]   = inline_ct["children"]
-        return child_shape
-
-    if tp and ":" in tp:
-        tp = tp.split(":", 1)[1]
-    if tp and tp in tmap:
-        ct = tmap[tp]
-        ref_ct = _build_shape_from_complexType(ct, tmap, cur_path)
-        child_shape["attributes"] = ref_ct["attributes"]
-        child_shape["children"]   = ref_ct["children"]
-        return child_shape
-
-    # sin complexType -> elemento simple (texto)
-    child_shape["is_simple"] = True
-    return child_shape
-
-def parse_xsd(xsd_path, root_element_name=None):
-    tree = ET.parse(xsd_path)
-    schema_root = tree.getroot()
-    tmap = _resolve_type_map(schema_root)
-    shapes = []
-    for el in schema_root.findall(_xsd_q("element")):
-        name = el.attrib.get("name")
-        if root_element_name and name != root_element_name:
-            continue
-        shapes.append(_shape_from_element(el, tmap, parent_path=""))
-    return shapes
-
-# ======= Construcción Addenda dentro del CFDI ======
-def construir_addenda(root_cfdi, valores_form, ns_cfg=None):
-    """
-    Inserta <cfdi:Addenda> con lo que hay en valores_form:
-    {"roots": [ {"name": "...", "attributes": {...}, "text": "...", "children":[...]}, ... ]}
-    """
-    ET.register_namespace("cfdi", CFDI_NS)
-    qname_cli = (lambda local: local)
-    if ns_cfg and ns_cfg.get("uri"):
-        ET.register_namespace(ns_cfg.get("prefix",""), ns_cfg["uri"])
-        qname_cli = lambda local: q(ns_cfg["uri"], local)
-
-    addenda = root_cfdi.find(CFDI + "Addenda")
-    if addenda is None:
-        addenda = ET.SubElement(root_cfdi, CFDI + "Addenda")
-
-    for top in valores_form.get("roots", []):
-        _emit_instance(addenda, top, qname_cli)
-
-def _emit_instance(parent, inst, qname_cli):
-    elem = ET.SubElement(parent, qname_cli(inst["name"]))
-    for k, v in inst.get("attributes", {}).items():
-        if v is None or v == "":
-            continue
-        elem.set(k, str(v))
-    if "text" in inst and inst["text"] not in (None, ""):
-        elem.text = str(inst["text"])
-    for ch in inst.get("children", []):
-        _emit_instance(elem, ch, qname_cli)
-
-# ========= VALIDACIÓN contra XSD (con lxml) ========
-def validate_addenda_subtree_with_xsd(cfdi_root: ET.Element, xsd_path: str, ns_uri: str = ""):
-    if not HAS_LXML:
-        return (False, "Validación deshabilitada: instala lxml (pip install lxml)")
-    addenda = cfdi_root.find(CFDI + "Addenda")
-    if addenda is None or len(list(addenda)) == 0:
-        return (False, "No hay elementos dentro de <cfdi:Addenda> para validar.")
-
-    target = None
-    if ns_uri:
-        for ch in list(addenda):
-            if isinstance(ch.tag, str) and ch.tag.startswith("{"+ns_uri+"}"):
-                target = ch; break
-    if target is None:
-        target = list(addenda)[0]
-
-    xml_bytes = ET.tostring(target, encoding="utf-8", xml_declaration=True)
-    try:
-        parser = LET.XMLParser(load_dtd=False, no_network=False, recover=True)
-        schema_doc = LET.parse(xsd_path, parser)
-        schema = LET.XMLSchema(schema_doc)
-    except Exception as e:
-        return (False, f"XSD inválido o no se pudo cargar:\n{e}")
-
-    try:
-        doc = LET.fromstring(xml_bytes)
-        ok = schema.validate(doc)
-        if ok:
-            return (True, "OK")
-        log = schema.error_log
-        if log:
-            lineas = [f"Línea {e.line}: {e.message}" for e in log]
-            return (False, "\n".join(lineas))
-        return (False, "La Addenda no cumple el XSD.")
-    except Exception as e:
-        return (False, f"Error durante la validación:\n{e}")
-
-# ======== Contexto desde CFDI =========
-def extract_cfdi_context(cfdi_root: ET.Element) -> dict:
-    ctx = {}
-    comp = cfdi_root
-    if comp is None:
-        return ctx
-
-    g = comp.attrib.get
-    ctx["serie"]       = g("Serie")
-    ctx["folio"]       = g("Folio")
-    ctx["fecha"]       = g("Fecha")
-    ctx["moneda"]      = g("Moneda")
-    ctx["tipocambio"]  = g("TipoCambio")
-    ctx["formapago"]   = g("FormaPago")
-    ctx["metodopago"]  = g("MetodoPago")
-    ctx["subtotal"]    = g("SubTotal") or g("SubTotal")
-    ctx["total"]       = g("Total")
-    ctx["lugar"]       = g("LugarExpedicion")
-    ctx["nocert"]      = g("NoCertificado")
-    ctx["sello"]       = g("Sello")
-
-    em = comp.find(CFDI + "Emisor")
-    re = comp.find(CFDI + "Receptor")
-    if em is not None:
-        gg = em.attrib.get
-        ctx["emisor_rfc"]     = gg("Rfc")
-        ctx["emisor_nombre"]  = gg("Nombre")
-        ctx["emisor_regimen"] = gg("RegimenFiscal")
-    if re is not None:
-        gg = re.attrib.get
-        ctx["receptor_rfc"]            = gg("Rfc")
-        ctx["receptor_nombre"]         = gg("Nombre")
-        ctx["receptor_uso"]            = gg("UsoCFDI")
-        ctx["receptor_domiciliofiscal"]= gg("DomicilioFiscalReceptor")
-        ctx["receptor_regimen"]        = gg("RegimenFiscalReceptor")
-
-    # Concepto 1 (útil para retail)
-    conceptos = comp.find(CFDI + "Conceptos")
-    if conceptos is not None:
-        c0 = conceptos.find(CFDI + "Concepto")
-        if c0 is not None:
-            cg = c0.attrib.get
-            ctx["concepto1_cantidad"]      = cg("Cantidad")
-            ctx["concepto1_descripcion"]   = cg("Descripcion")
-            ctx["concepto1_noid"]          = cg("NoIdentificacion")
-            ctx["concepto1_valorunit"]     = cg("ValorUnitario")
-            ctx["concepto1_importe"]       = cg("Importe")
-            ctx["concepto1_claveprodserv"] = cg("ClaveProdServ")
-            ctx["concepto1_claveunidad"]   = cg("ClaveUnidad")
-
-    # Impuestos
-    iva_total  = 0.0
-    ieps_total = 0.0
-    otros_total= 0.0
-
-    def _to_float(s):
-        try:
-            return float(s)
-        except Exception:
-            return 0.0
-
-    imp = comp.find(CFDI + "Impuestos")
-    if imp is not None:
-        tot_tras = _to_float(imp.attrib.get("TotalImpuestosTrasladados", "0"))
-        iva_total = max(iva_total, tot_tras)
-        tras = imp.find(CFDI + "Traslados")
-        if tras is not None:
-            for t in tras.findall(CFDI + "Traslado"):
-                imp_clave = t.attrib.get("Impuesto")
-                importe   = _to_float(t.attrib.get("Importe", "0"))
-                if imp_clave == "002":
-                    iva_total = max(iva_total, importe) if iva_total else importe
-                elif imp_clave == "003":
-                    ieps_total += importe
-                else:
-                    otros_total += importe
-
-    if conceptos is not None:
-        for c in conceptos.findall(CFDI + "Concepto"):
-            imp_c = c.find(CFDI + "Impuestos")
-            if imp_c is None: continue
-            tras_c = imp_c.find(CFDI + "Traslados")
-            if tras_c is None: continue
-            for t in tras_c.findall(CFDI + "Traslado"):
-                imp_clave = t.attrib.get("Impuesto")
-                importe   = _to_float(t.attrib.get("Importe", "0"))
-                if imp_clave == "002":
-                    iva_total += importe
-                elif imp_clave == "003":
-                    ieps_total += importe
-                else:
-                    otros_total += importe
-
-    ctx["iva_total"]  = f"{iva_total:.2f}" if iva_total else None
-    ctx["ieps_total"] = f"{ieps_total:.2f}" if ieps_total else None
-    ctx["otros_imp"]  = f"{otros_total:.2f}" if otros_total else None
-
-    # Timbre
-    uuid = no_cert_sat = fecha_timbrado = sello_sat = None
-    comp_comp = comp.find(CFDI + "Complemento")
-    if comp_comp is not None:
-        for ch in comp_comp:
-            if isinstance(ch.tag, str) and ch.tag.startswith("{"+TFD_NS+"}"):
-                uuid          = ch.attrib.get("UUID")
-                no_cert_sat   = ch.attrib.get("NoCertificadoSAT")
-                fecha_timbrado= ch.attrib.get("FechaTimbrado")
-                sello_sat     = ch.attrib.get("SelloSAT")
-                break
-    ctx["uuid"]          = uuid
-    ctx["nocertsat"]     = no_cert_sat
-    ctx["fechatimbrado"] = fecha_timbrado
-    ctx["sello_sat"]     = sello_sat
-    return ctx
-
-# ======== Heurística simple de autollenado =========
-def guess_autofill_value_by_name(name: str, ctx: dict) -> str:
-    if not name: return ""
-    n = name.strip().lower()
-
-    direct = {
-        "rfcemisor":"emisor_rfc","emisor_rfc":"emisor_rfc",
-        "rfcreceptor":"receptor_rfc","rfc_receptor":"receptor_rfc",
-        "uuid":"uuid","folio":"folio","serie":"serie",
-        "total":"total","subtotal":"subtotal",
-        "moneda":"moneda","fechatimbrado":"fechatimbrado","fecha":"fecha",
-        "formapago":"formapago","metodopago":"metodopago","tipocambio":"tipocambio",
-        "nocertificado":"nocert","nocertificadosat":"nocertsat",
-        "lugarexpedicion":"lugar","sellosat":"sello_sat","sello":"sello",
-        "nombreemisor":"emisor_nombre","nombrereceptor":"receptor_nombre",
-        "usocfdi":"receptor_uso","domiciliofiscalreceptor":"receptor_domiciliofiscal",
-        "regimenfiscalreceptor":"receptor_regimen","regimenfiscalemisor":"emisor_regimen",
-        "iva":"iva_total","ieps":"ieps_total","otrosimpuestos":"otros_imp",
-        "descripcion":"concepto1_descripcion","cantidad":"concepto1_cantidad",
-        "preciounitario":"concepto1_valorunit","montolinea":"concepto1_importe",
-    }
-    if n in direct:
-        val = ctx.get(direct[n])
-        if val is not None:
-            return val
-
-    def pick(*keys):
-        for k in keys:
-            if ctx.get(k):
-                return ctx[k]
-        return ""
-
-    if "uuid" in n: return pick("uuid")
-    if "emisor" in n and "rfc" in n: return pick("emisor_rfc")
-    if "receptor" in n and "rfc" in n: return pick("receptor_rfc")
-    if "rfc" in n: return pick("receptor_rfc","emisor_rfc")
-    if "folio" in n: return pick("folio")
-    if "serie" in n: return pick("serie")
-    if "subtotal" in n: return pick("subtotal")
-    if "iva" in n: return pick("iva_total")
-    if "ieps" in n: return pick("ieps_total")
-    if "total" in n: return pick("total")
-    if "moneda" in n: return pick("moneda")
-    if "fecha" in n and "timbr" in n: return pick("fechatimbrado")
-    if "fecha" in n: return pick("fecha")
-    if "metodo" in n: return pick("metodopago")
-    if "forma" in n and "pago" in n: return pick("formapago")
-    if "cambio" in n: return pick("tipocambio")
-    if "lug" in n and "exped" in n: return pick("lugar")
-    if "cert" in n and "sat" in n: return pick("nocertsat")
-    if "cert" in n: return pick("nocert")
-    if "sello" in n and "sat" in n: return pick("sello_sat")
-    if "sello" in n: return pick("sello")
-    if "descripcion" in n: return pick("concepto1_descripcion")
-    if "cantidad" in n: return pick("concepto1_cantidad")
-    if "precio" in n and "unit" in n: return pick("concepto1_valorunit")
-    if "monto" in n or "importe" in n: return pick("concepto1_importe")
-    return ""
-
-# --------- Lectura de hints/keywords desde el XSD ----------
-def _xsd_text(el):
-    try:
-        return "".join(el.itertext()).strip().lower()
-    except Exception:
-        return ""
-
-def _xsd_first(el, tag_local):
-    return el.find(f"{XS_NS}{tag_local}")
-
-def _read_annotation_hints(xsd_elem):
-    ann = _xsd_first(xsd_elem, "annotation")
-    if ann is None:
-        return ""
-    buf = []
-    for child in list(ann):
-        if child.tag in (f"{XS_NS}documentation", f"{XS_NS}appinfo"):
-            txt = _xsd_text(child)
-            if txt:
-                buf.append(txt)
-    return " ".join(buf)
-
-XSD_KEYWORDS_TO_CFDI = [
-    (("uuid",), "uuid"),
-    (("receptor","rfc"), "receptor_rfc"),
-    (("emisor","rfc"), "emisor_rfc"),
-    (("folio",), "folio"),
-    (("serie",), "serie"),
-    (("subtotal",), "subtotal"),
-    (("total",), "total"),
-    (("iva","impuesto al valor agregado"), "iva_total"),
-    (("ieps",), "ieps_total"),
-    (("otros","impuestos"), "otros_imp"),
-    (("moneda",), "moneda"),
-    (("fecha timbrado","fechatimbrado"), "fechatimbrado"),
-    (("fecha",), "fecha"),
-    (("metodo","pago"), "metodopago"),
-    (("forma","pago"), "formapago"),
-    (("tipo","cambio"), "tipocambio"),
-    (("lugar","expedicion"), "lugar"),
-    (("certificado","sat"), "nocertsat"),
-    (("certificado",), "nocert"),
-    (("sello","sat"), "sello_sat"),
-    (("sello",), "sello"),
-    (("descripcion","concepto"), "concepto1_descripcion"),
-    (("cantidad","concepto"), "concepto1_cantidad"),
-    (("precio","unitario"), "concepto1_valorunit"),
-    (("monto","linea"), "concepto1_importe"),
-]
-
-def _decide_cfdi_key_by_name_and_hints(name: str, hint_text: str) -> str:
-    n = (name or "").strip().lower()
-    if not n and not hint_text:
-        return ""
-    name_to_key = {
-        "uuid":"uuid","folio":"folio","serie":"serie","subtotal":"subtotal","total":"total",
-        "moneda":"moneda","fechatimbrado":"fechatimbrado","fecha":"fecha","formapago":"formapago",
-        "metodopago":"metodopago","tipocambio":"tipocambio","lugarexpedicion":"lugar",
-        "nocertificado":"nocert","nocertificadosat":"nocertsat","sellosat":"sello_sat","sello":"sello",
-        "rfcreceptor":"receptor_rfc","rfcemisor":"emisor_rfc"
-    }
-    if n in name_to_key:
-        return name_to_key[n]
-    hay = lambda words: all(w in hint_text for w in words)
-    for keys, cfdi_key in XSD_KEYWORDS_TO_CFDI:
-        if all(k in n for k in keys) or hay(keys):
-            return cfdi_key
-    return ""
-
-def build_autofill_rules_from_xsd(xsd_path, root_element_name=None):
-    rules = {}
-    try:
-        tree = ET.parse(xsd_path)
-        schema_root = tree.getroot()
-
-        def process_element(elem):
-            el_name = elem.attrib.get("name") or elem.attrib.get("ref")
-            hints_el = _read_annotation_hints(elem)
-            inl = elem.find(_xsd_q("complexType"))
-            if inl is not None:
-                for a in inl.findall(_xsd_q("attribute")):
-                    nm = a.attrib.get("name")
-                    if not nm or a.attrib.get("fixed") or a.attrib.get("default"):
-                        continue
-                    k = _decide_cfdi_key_by_name_and_hints(nm, hints_el + " " + _read_annotation_hints(a))
-                    if k: rules[nm] = k
-                group = inl.find(_xsd_q("sequence")) or inl.find(_xsd_q("all")) or inl.find(_xsd_q("choice"))
-                if group is not None:
-                    for e in group.findall(_xsd_q("element")):
-                        nm = e.attrib.get("name") or e.attrib.get("ref")
-                        if not nm:
-                            continue
-                        has_complex = (e.find(_xsd_q("complexType")) is not None)
-                        if not has_complex:
-                            k = _decide_cfdi_key_by_name_and_hints(nm, hints_el + " " + _read_annotation_hints(e))
-                            if k: rules[nm] = k
-            else:
-                if el_name:
-                    k = _decide_cfdi_key_by_name_and_hints(el_name, hints_el)
-                    if k: rules[el_name] = k
 
-        for el in schema_root.findall(_xsd_q("element")):
-            name = el.attrib.get("name")
-            if root_element_name and name != root_element_name:
-                continue
-            process_element(el)
-
-        return rules
-    except Exception:
-        return rules
-
-# --------------- Cache reglas por XSD ---------------
-def xsd_fingerprint(path: str) -> str:
-    try:
-        with open(path, "rb") as f:
-            data = f.read()
-        return hashlib.sha1(data).hexdigest()
-    except Exception:
-        try:
-            st = os.stat(path)
-            mix = f"{os.path.basename(path)}|{st.st_size}|{int(st.st_mtime)}"
-            return hashlib.sha1(mix.encode("utf-8")).hexdigest()
-        except Exception:
-            return os.path.basename(path)
-
-def load_cache() -> dict:
-    if not os.path.exists(CACHE_PATH):
-        return {}
-    try:
-        with open(CACHE_PATH, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        return {}
-
-def save_cache(cache: dict):
-    try:
-        with open(CACHE_PATH, "w", encoding="utf-8") as f:
-            json.dump(cache, f, indent=2, ensure_ascii=False)
-    except Exception:
-        pass
-
-# -------- Helpers Addenda/XML -------------
-def _localname(tag: str) -> str:
-    if not isinstance(tag, str):
-        return ""
-    if tag.startswith("{"):
-        return tag.split("}", 1)[1]
-    return tag
+import addendas
+from addendas import (
+    armar_perfil, cargar_plantilla, cargar_xsd_desde_fuente, CFDI, cfdi_con_addenda_bytes,
+    claves_autollenado, compilar_plantilla, compilar_validador, construir_addenda_overlay,
+    describir_hijo_addenda, _es_url, escribir_bytes, expandir_shape, extract_cfdi_context,
+    extract_cfdi_context_stream, extraer_tabla_conceptos, generar_valores_por_concepto,
+    guardar_perfil, guardar_plantilla, guess_autofill_key_by_name, HAS_LXML, hijos_addenda,
+    indexar_valores_addenda, localname, ns_de, obtener_schema, paquete_registrados, PAQUETE_SAT,
+    parse_addenda_xml_values, parse_xsd_cached, raiz_con_addenda, raiz_de_serializador,
+    registrar_xsd_paquete, reglas_cargar, reglas_override, reglas_para_xsd, resumen_cfdi,
+    schema_cache_stats, serializador_plantilla, serializar_addenda, ubicar_xsd_paquete,
+    validar_cfdi_completo, validate_addenda_subtree_with_xsd, _vincular_instancia, xsd_fingerprint,
+    xsd_target_namespace_cached, XSI)
+from lote import procesar_lote
+from biblioteca_xsd import (
+    buscar_xsd_registro, indexar_biblioteca_xsd, registro_xsd, XSD_BIBLIOTECA_DIR)
+from validacion import validar_lote_addendas
+from vigilancia import (
+    cargar_clientes, CLIENTES_PATH, VIGILAR_ASENTAMIENTO, vigilar_carpeta, VIGILAR_INTERVALO)
+from servicio import iniciar_servicio, _SERVICIO
 
 def _elegir_hijo_addenda(cfdi_root):
     """Devuelve el Element objetivo dentro de <cfdi:Addenda>.
     Si hay más de uno, deja elegir."""
-    addenda = cfdi_root.find(CFDI + "Addenda")
-    if addenda is None:
-        return None
-    hijos = [ch for ch in list(addenda)]
+    hijos = hijos_addenda(cfdi_root)
     if not hijos:
         return None
     if len(hijos) == 1:
@@ -573,13 +45,7 @@ def _elegir_hijo_addenda(cfdi_root):
     ttk.Label(win, text="Este CFDI tiene varias addendas. Elige cuál usar:").pack(anchor="w", padx=10, pady=(10,6))
     lb = tk.Listbox(win, width=80, height=min(10, len(hijos)))
     for ch in hijos:
-        tag = ch.tag
-        ns = tag.split("}")[0][1:] if tag.startswith("{") else ""
-        ln = tag.split("}",1)[1] if tag.startswith("{") else tag
-        pista_attr = next(iter(ch.attrib.keys()), "")
-        pista_child = (ch[0].tag.split("}",1)[1] if len(ch) else "")
-        desc = f"{ln}   ns={ns or '—'}   attr={_localname(pista_attr) or '—'}   child={pista_child or '—'}"
-        lb.insert(tk.END, desc)
+        lb.insert(tk.END, describir_hijo_addenda(ch))
     lb.pack(fill="both", expand=True, padx=10)
 
     choice = {"idx": 0}
@@ -591,62 +57,6 @@ def _elegir_hijo_addenda(cfdi_root):
     win.grab_set(); win.wait_window()
     return hijos[choice["idx"]]
 
-def _walk_collect_simple_values(elem, out, path=""):
-    """
-    Recolecta:
-      - Atributos: out[("attr", owner_local, attr_local, path)] = [lista de valores]
-      - Texto:     out[("text", owner_local, "#text", path)]    = [lista de textos]
-    Guarda listas y toma texto aunque existan hijos.
-    """
-    owner_local = _localname(elem.tag)
-    cur_path = f"{path}/{owner_local}" if path else owner_local
-
-    # atributos (normaliza ns/prefijos)
-    for k, v in elem.attrib.items():
-        if v in (None, ""):
-            continue
-        if isinstance(k, str) and k.startswith("{"):
-            attr_local = k.split("}",1)[1].lower()
-        else:
-            attr_local = k.split(":",1)[-1].lower()
-        if attr_local == "schemalocation":
-            continue
-        key = ("attr", owner_local, attr_local, cur_path)
-        out.setdefault(key, []).append(v)
-
-    # texto
-    txt = (elem.text or "").strip()
-    if txt:
-        keyt = ("text", owner_local, "#text", cur_path)
-        out.setdefault(keyt, []).append(txt)
-
-    for ch in list(elem):
-        _walk_collect_simple_values(ch, out, cur_path)
-
-def parse_addenda_xml_values(path_or_xml_tree):
-    """Devuelve diccionario de valores simples para prellenar el UI."""
-    if isinstance(path_or_xml_tree, ET.ElementTree):
-        tree = path_or_xml_tree
-    else:
-        tree = ET.parse(path_or_xml_tree)
-    root = tree.getroot()
-
-    # CFDI → entrar a Addenda (y elegir si hay varias)
-    if _localname(root.tag).lower() == "comprobante":
-        base = _elegir_hijo_addenda(root)
-        if base is None:
-            return {}
-    else:
-        base = root
-
-    values = {}
-    _walk_collect_simple_values(base, values)
-
-    XSI = "{http://www.w3.org/2001/XMLSchema-instance}"
-    scl = base.attrib.get(XSI + "schemaLocation") or root.attrib.get(XSI + "schemaLocation")
-    ns_uri = base.tag.split('}')[0][1:] if base.tag.startswith("{") else ""
-    return {"values": values, "schemaLocation": scl, "ns_uri": ns_uri}
-
 # =============== Helper índice n-ésimo ===============
 def _pick_n(lista, n):
     """Devuelve el elemento n (1-based) o el primero si no alcanza."""
@@ -656,6 +66,295 @@ def _pick_n(lista, n):
         n = 1
     return lista[n-1] if len(lista) >= n else lista[0]
 
+# ============ Modelo del formulario =================
+class CampoSlot:
+    """Un campo capturable (atributo o texto). Si hay widget, el valor vive en su StringVar."""
+    __slots__ = ("kind", "name", "owner", "owner_path", "required", "value", "var", "facetas", "validar")
+
+    def __init__(self, kind, name, owner, owner_path, required=False, value="", facetas=None):
+        self.kind, self.name, self.owner, self.owner_path = kind, name, owner, owner_path
+        self.required = required
+        self.value = value or ""
+        self.var = None
+        self.facetas = facetas or {}
+        self.validar = compilar_validador(self.facetas)
+
+    def error(self) -> str:
+        """Mensaje si el valor no cumple las facetas del XSD ("" si está bien o vacío)."""
+        return self.validar(self.get().strip()) if self.validar else ""
+
+    def get(self) -> str:
+        return self.var.get() if self.var is not None else self.value
+
+    def set(self, v):
+        if self.var is not None:
+            self.var.set(v)
+        else:
+            self.value = v
+
+    def bind(self, var):
+        if self.var is not None:  # re-render: conserva lo capturado
+            self.value = self.var.get()
+        var.set(self.value)
+        self.var = var
+
+    def unbind(self):
+        if self.var is not None:
+            self.value = self.var.get()
+            self.var = None
+
+    @property
+    def logical_name(self):
+        """Nombre con el que se busca en reglas/heurística (atributo o elemento dueño)."""
+        return self.name if self.kind == "attr" else self.owner
+
+def _min_ocurrencias(shape) -> int:
+    mn = str(shape.get("minOccurs", "1"))
+    return int(mn) if mn.isdigit() else 1
+
+class InstanciaNodo:
+    """Una ocurrencia de un elemento del XSD: sus campos y una lista de instancias por hijo."""
+    def __init__(self, shape, path):
+        self.shape = shape
+        self.path = path
+        self.attrs = {}     # nombre -> CampoSlot
+        self.text = None    # CampoSlot de texto (elemento simple)
+        self.hijos = []     # [(shape_hijo, [InstanciaNodo])] en el orden del XSD
+
+class FormModel:
+    """
+    Estado del formulario indexado por path de shape. Los widgets solo se ligan a
+    los CampoSlot; recolectar, validar obligatorios, autollenar y prellenar son
+    pasadas sobre los campos (a cualquier profundidad) y funcionan sin UI.
+    """
+    def __init__(self, shapes, tipos=None):
+        self.tipos = tipos or {}
+        self.slots = {}           # id(slot) -> slot, en orden de creación
+        self.raices = []          # [(shape, [InstanciaNodo])]
+        for sh in shapes:
+            self.raices.append((sh, [self.nueva_instancia(sh, sh["name"])]))
+
+    # ---- estructura ----
+    def nueva_instancia(self, shape, path, recursion=0) -> InstanciaNodo:
+        shape = expandir_shape(shape, self.tipos)
+        inst = InstanciaNodo(shape, path)
+        for a in shape.get("attributes", []):
+            ini = a.get("fixed") if a.get("fixed") is not None else (a.get("default") or "")
+            inst.attrs[a["name"]] = self._slot(CampoSlot("attr", a["name"], shape["name"], path,
+                                                         a.get("use") == "required", ini, a.get("facetas")))
+        if shape.get("is_simple") and not shape.get("attributes") and not shape.get("children"):
+            inst.text = self._slot(CampoSlot("text", "#text", shape["name"], path,
+                                             facetas=shape.get("facetas")))
+        for ch in shape.get("children", []):
+            p = f"{path}/{ch['name']}"
+            if ch.get("lazy"):
+                # tipo recursivo: las ocurrencias obligatorias se crean un nivel; más abajo, a mano
+                n = _min_ocurrencias(ch) if recursion < 1 else 0
+                lst = [self.nueva_instancia(ch, p, recursion + 1) for _ in range(n)]
+            else:
+                lst = [self.nueva_instancia(ch, p, recursion)]
+            inst.hijos.append((ch, lst))
+        return inst
+
+    def _slot(self, slot):
+        self.slots[id(slot)] = slot
+        return slot
+
+    def agregar(self, lista, shape, path):
+        inst = self.nueva_instancia(shape, path)
+        lista.append(inst)
+        return inst
+
+    def eliminar(self, lista, inst):
+        if inst in lista:
+            lista.remove(inst)
+        for slot in self.campos_de(inst):
+            self.slots.pop(id(slot), None)
+
+    def campos_de(self, inst):
+        out = list(inst.attrs.values())
+        if inst.text is not None:
+            out.append(inst.text)
+        for _sh, lst in inst.hijos:
+            for ch in lst:
+                out.extend(self.campos_de(ch))
+        return out
+
+    def campos(self):
+        return list(self.slots.values())
+
+    def buscar(self, owner_path, kind, name, idx=0):
+        """Campo por (path del dueño, tipo, nombre); idx = n-ésima instancia con ese path."""
+        hits = [s for s in self.slots.values()
+                if s.owner_path == owner_path and s.kind == kind and s.name == name]
+        return hits[idx] if idx < len(hits) else None
+
+    def encontrar(self, texto: str) -> list:
+        """Campos cuyo nombre o ruta contiene el texto (sin importar mayúsculas), en orden del form."""
+        t = (texto or "").lower()
+        if not t:
+            return []
+        return [s for s in self.slots.values()
+                if t in (s.logical_name or "").lower() or t in (s.owner_path or "").lower()]
+
+    def ruta_de(self, slot):
+        """[(lista, instancia), ...] de la raíz hasta la instancia dueña del campo."""
+        def dfs(inst, cadena):
+            if slot is inst.text or any(slot is a for a in inst.attrs.values()):
+                return cadena
+            for _sh, lst in inst.hijos:
+                for ch in lst:
+                    hit = dfs(ch, cadena + [(lst, ch)])
+                    if hit:
+                        return hit
+            return None
+        for _sh, lst in self.raices:
+            for inst in lst:
+                hit = dfs(inst, [(lst, inst)])
+                if hit:
+                    return hit
+        return []
+
+    # ---- pasadas ----
+    def _collect_inst(self, inst, siempre=False):
+        out = {"name": inst.shape["name"], "attributes": {}, "children": []}
+        tiene = False
+        for nm, slot in inst.attrs.items():
+            v = slot.get().strip()
+            out["attributes"][nm] = v
+            tiene = tiene or bool(v)
+        if inst.text is not None:
+            t = inst.text.get().strip()
+            if t:
+                out["text"] = t
+                tiene = True
+        for _sh, lst in inst.hijos:
+            for ch in lst:
+                c = self._collect_inst(ch)
+                if c is not None:
+                    out["children"].append(c)
+                    tiene = True
+        # como el _collect_instances original: un hijo sin texto ni hijos emitidos
+        # solo se emite si declara atributos (aunque vengan vacíos)
+        if siempre or tiene or inst.attrs:
+            return out
+        return None
+
+    def collect(self) -> dict:
+        roots = []
+        for _sh, lst in self.raices:
+            for inst in lst:
+                roots.append(self._collect_inst(inst, siempre=True))
+        return {"roots": roots}
+
+    def _faltantes_inst(self, inst, out, invalidos, siempre=False):
+        if not siempre and self._collect_inst(inst) is None:
+            return
+        for slot in inst.attrs.values():
+            if slot.required and not slot.get().strip():
+                out.append(slot.name)
+        for slot in list(inst.attrs.values()) + ([inst.text] if inst.text is not None else []):
+            msg = slot.error()
+            if msg:
+                invalidos.append(f"{slot.logical_name}: {msg}")
+        for _sh, lst in inst.hijos:
+            for ch in lst:
+                self._faltantes_inst(ch, out, invalidos)
+
+    def revisar(self):
+        """(obligatorios vacíos, valores que no cumplen facetas) de las instancias que sí se emiten."""
+        out, invalidos = [], []
+        for _sh, lst in self.raices:
+            for inst in lst:
+                self._faltantes_inst(inst, out, invalidos, siempre=True)
+        return out, invalidos
+
+    def faltantes(self) -> list:
+        """Obligatorios vacíos en las instancias que sí se van a emitir."""
+        return self.revisar()[0]
+
+    def autollenar(self, ctx, rules, fingerprint=None) -> int:
+        vacios = [slot for slot in self.slots.values() if not slot.get().strip()]
+        claves = claves_autollenado([s.logical_name for s in vacios], ctx, rules, fingerprint)
+        count = 0
+        for slot in vacios:
+            k = claves[slot.logical_name]
+            val = ctx.get(k) if k else None
+            if val:
+                slot.set(val)
+                count += 1
+        return count
+
+    @staticmethod
+    def _lista_prefill(slot, info):
+        """Lista de valores para el campo: ruta exacta, luego por nombre (índices de info)."""
+        vals = info.get("values", {})
+        if slot.kind == "attr":
+            attr_local = (slot.name or "").lower()
+            lista = vals.get(("attr", slot.owner, attr_local, slot.owner_path))
+            return lista or info["por_nombre"].get(("attr", slot.owner, attr_local))
+        lista = vals.get(("text", slot.owner, "#text", slot.owner_path))
+        return lista or info["por_local"].get(slot.owner)
+
+    @staticmethod
+    def _info_indexada(info):
+        if "por_nombre" not in info:
+            info = dict(info)
+            info.update(indexar_valores_addenda(info.get("values", {})))
+        return info
+
+    def prefill(self, info: dict, n: int) -> int:
+        """Llena campos vacíos con valores de una Addenda (parse_addenda_xml_values), ocurrencia n."""
+        info = self._info_indexada(info)
+        count = 0
+        for slot in self.slots.values():
+            if slot.get().strip():
+                continue
+            picked = _pick_n(self._lista_prefill(slot, info), n)
+            if picked:
+                slot.set(picked); count += 1
+        return count
+
+    def prefill_rango(self, info: dict, n: int, m: int) -> int:
+        """
+        Prefill de ocurrencias n..m en una pasada: cada elemento repetible recibe
+        (m-n+1) instancias y la k-ésima toma la ocurrencia n+k. Lo que no está
+        bajo un repetible usa la ocurrencia n, igual que prefill().
+        """
+        info = self._info_indexada(info)
+        total = max(1, m - n + 1)
+        cuenta = [0]
+
+        def llenar(inst, occ, estricto):
+            for slot in list(inst.attrs.values()) + ([inst.text] if inst.text is not None else []):
+                if slot.get().strip():
+                    continue
+                lista = self._lista_prefill(slot, info)
+                if estricto:
+                    picked = lista[occ-1] if lista and len(lista) >= occ else None
+                else:
+                    picked = _pick_n(lista, occ)
+                if picked:
+                    slot.set(picked); cuenta[0] += 1
+            for sh, lst in inst.hijos:
+                recorrer(sh, lst, f"{inst.path}/{sh['name']}", occ, estricto)
+
+        def recorrer(sh, lst, path, occ, estricto):
+            if sh.get("maxOccurs", "1") == "1" and not sh.get("lazy"):
+                for inst in lst:
+                    llenar(inst, occ, estricto)
+                return
+            mx = sh.get("maxOccurs", "1")
+            tope = int(mx) if mx.isdigit() else total
+            while len(lst) < min(total, tope):
+                self.agregar(lst, sh, path)
+            for k, inst in enumerate(lst[:total]):
+                llenar(inst, n + k, k > 0 or estricto)
+
+        for sh, lst in self.raices:
+            recorrer(sh, lst, sh["name"], n, False)
+        return cuenta[0]
+
 # ================== UI App =========================
 class AddendaApp:
     def __init__(self, root):
@@ -664,25 +363,42 @@ class AddendaApp:
         self.xml_path = None
         self.xsd_path = None
         self.cfdi_tree = None
+        self._addenda_adjunta = None  # <cfdi:Addenda> suelta de "Adjuntar Addenda desde XML"
         self.shapes = []
+        self.shape_types = {}  # complexTypes expandidos (para nodos perezosos)
         self.xsd_ns_uri = ""   # targetNamespace detectado
 
         self.ns_prefix_var = tk.StringVar(value="cli")
         self.ns_uri_var    = tk.StringVar(value="")
         self.root_elem_name= tk.StringVar(value="")
         self.prefill_index_var = tk.IntVar(value=1)  # índice 1-based para ocurrencias
+        self.prefill_hasta_var = tk.IntVar(value=0)  # >n: prefill masivo n..m
+        self.por_concepto_var  = tk.BooleanVar(value=False)  # repetir nodos por línea del CFDI
 
         self._cfdi_ctx      = {}
-        self._entry_widgets = []  # [(entry, kind, owner_name)]
-        self._field_names   = set()
+        self.model          = None  # FormModel del XSD cargado
 
         self._auto_rules = {}     # reglas inferidas para este XSD
-        self._cache = load_cache()
+        self._xsd_fp     = None   # fingerprint del XSD cargado (memo de autollenado)
+
+        # trabajo pesado (descarga, parseo, validación) fuera del hilo de Tk
+        self._pool     = ThreadPoolExecutor(max_workers=2, thread_name_prefix="addendados")
+        self._cola     = queue.Queue()   # resultados de los workers → hilo de Tk
+        self._tareas   = {}              # canal -> (generación vigente, future)
+        self._activas  = 0
+        self._atendiendo = False         # hay un root.after(_atender_cola) pendiente
+        self.status_var = tk.StringVar(value="")
+        self.buscar_var = tk.StringVar(value="")
+        self._secciones = {}
+        self._widgets_slot = {}
+        self._busqueda = ("", 0)
 
         self._build_ui()
+        self.root.protocol("WM_DELETE_WINDOW", self._cerrar)
 
     # --------------- UI Build -----------------------
     def _build_ui(self):
+        ttk.Style(self.root).configure("Invalido.TEntry", fieldbackground="#ffe0e0", foreground="#b00020")
         menubar = tk.Menu(self.root)
         filem = tk.Menu(menubar, tearoff=0)
         filem.add_command(label="Abrir CFDI XML...", command=self.abrir_cfdi)
@@ -693,11 +409,17 @@ class AddendaApp:
         filem.add_command(label="Importar Addenda desde XML (prefill)...", command=self.prefill_addenda_desde_xml)
         filem.add_command(label="Adjuntar Addenda desde XML (directo)...", command=self.adjuntar_addenda_desde_xml)
         filem.add_separator()
+        filem.add_command(label="Guardar perfil de campos (para lote)...", command=self.guardar_perfil_campos)
+        filem.add_command(label="Guardar plantilla para este receptor", command=self.guardar_plantilla_receptor)
+        filem.add_command(label="Aplicar plantilla del receptor y guardar...", command=self.aplicar_plantilla_receptor)
+        filem.add_separator()
         filem.add_command(label="Salir", command=self.root.quit)
         menubar.add_cascade(label="Archivo", menu=filem)
 
         tools = tk.Menu(menubar, tearoff=0)
         tools.add_command(label="Autollenar desde CFDI", command=self.autollenar_desde_cfdi)
+        tools.add_command(label="Corregir regla de autollenado...", command=self.corregir_regla)
+        tools.add_command(label="Estadísticas de caché XSD", command=self.mostrar_stats_cache)
         menubar.add_cascade(label="Herramientas", menu=tools)
 
         self.root.config(menu=menubar)
@@ -717,8 +439,14 @@ class AddendaApp:
         ttk.Label(top, text="Prefill índice:").grid(row=0, column=6, sticky="e", padx=5, pady=2)
         tk.Spinbox(top, from_=1, to=999, textvariable=self.prefill_index_var, width=5).grid(row=0, column=7, sticky="w", padx=5, pady=2)
 
+        ttk.Label(top, text="hasta:").grid(row=0, column=8, sticky="e", padx=(0,2), pady=2)
+        tk.Spinbox(top, from_=0, to=999, textvariable=self.prefill_hasta_var, width=5).grid(row=0, column=9, sticky="w", padx=5, pady=2)
+
+        ttk.Checkbutton(top, text="Un nodo por concepto", variable=self.por_concepto_var
+                        ).grid(row=0, column=10, sticky="w", padx=5, pady=2)
+
         hint = ttk.Label(top, text="Carga el XSD que toque (Soriana, Walmart, etc.) y dale prefill/adjuntar. Simple y sin drama.")
-        hint.grid(row=1, column=0, columnspan=8, sticky="w", padx=5, pady=(0,8))
+        hint.grid(row=1, column=0, columnspan=11, sticky="w", padx=5, pady=(0,8))
 
         # zona scroll form
         self.canvas = tk.Canvas(self.root, borderwidth=0, highlightthickness=0)
@@ -738,9 +466,73 @@ class AddendaApp:
         bottom.pack(fill="x")
         ttk.Button(bottom, text="Previsualizar (valida XSD)", command=self.previsualizar).pack(side="left")
         ttk.Button(bottom, text="Guardar Addenda en CFDI...", command=self.guardar_definitivo).pack(side="right")
+        self.progreso = ttk.Progressbar(bottom, mode="indeterminate", length=120)
+        self.progreso.pack(side="right", padx=8)
+        ttk.Label(bottom, textvariable=self.status_var).pack(side="right", padx=8)
 
         self._render_placeholder()
 
+    # --------------- Trabajo en segundo plano -----------------
+    def _en_fondo(self, canal, texto, trabajo, listo, fallo=None):
+        """
+        Corre trabajo() en el pool y entrega el resultado a listo(res) en el hilo de
+        Tk (vía root.after). Una tarea nueva en el mismo canal deja obsoleta a la
+        anterior: si aún no arrancó se cancela, y si ya corría su resultado se tira.
+        """
+        gen = self._tareas.get(canal, (0, None))[0] + 1
+        previo = self._tareas.get(canal, (0, None))[1]
+        if previo is not None and previo.cancel():
+            self._tarea_terminada()
+        fut = self._pool.submit(trabajo)
+        self._tareas[canal] = (gen, fut)
+        self._activas += 1
+        self.status_var.set(texto)
+        self.progreso.start(12)
+
+        def entregar(f):
+            if f.cancelled():
+                return
+            err = f.exception()
+            self._cola.put((canal, gen, listo, fallo, err, None if err else f.result()))
+        fut.add_done_callback(entregar)
+        if not self._atendiendo:
+            self._atendiendo = True
+            self.root.after(50, self._atender_cola)
+
+    def _atender_cola(self):
+        while True:
+            try:
+                canal, gen, listo, fallo, err, res = self._cola.get_nowait()
+            except queue.Empty:
+                break
+            self._tarea_terminada()
+            if self._tareas.get(canal, (0, None))[0] != gen:
+                continue   # la reemplazó una más nueva
+            try:
+                if err is not None:
+                    (fallo or self._fallo_tarea)(err)
+                else:
+                    listo(res)
+            except Exception as e:
+                messagebox.showerror("Error", str(e))
+        if self._activas > 0:
+            self.root.after(50, self._atender_cola)
+        else:
+            self._atendiendo = False
+
+    def _tarea_terminada(self):
+        self._activas = max(0, self._activas - 1)
+        if self._activas == 0:
+            self.progreso.stop()
+            self.status_var.set("")
+
+    def _fallo_tarea(self, err):
+        messagebox.showerror("Error", str(err))
+
+    def _cerrar(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self.root.destroy()
+
     # --------------- Scroll helpers -----------------
     def _on_frame_configure(self, event):
         self.canvas.configure(scrollregion=self.canvas.bbox("all"))
@@ -754,8 +546,7 @@ class AddendaApp:
     def _render_placeholder(self):
         for w in self.form_frame.winfo_children():
             w.destroy()
-        self._entry_widgets.clear()
-        self._field_names.clear()
+        self.model = None
         ttk.Label(self.form_frame, text="Carga un CFDI y su XSD para empezar.",
                   font=("Segoe UI", 11, "italic")).pack(pady=20)
 
@@ -766,14 +557,18 @@ class AddendaApp:
         if not path:
             return
         try:
-            tree = ET.parse(path)
+            tree = addendas.XML.parse(path)
             root = tree.getroot()
             if not (root.tag.endswith("Comprobante")):
                 messagebox.showwarning("Ojo", "El XML no parece ser un CFDI válido (no se encontró 'Comprobante').")
             self.cfdi_tree = tree
             self.xml_path = path
+            self._addenda_adjunta = None
             self._cfdi_ctx = extract_cfdi_context(root)
             messagebox.showinfo("Listo", os.path.basename(path))
+            if cargar_plantilla(self._cfdi_ctx.get("receptor_rfc")):
+                self.status_var.set(f"Hay plantilla de addenda para {self._cfdi_ctx['receptor_rfc']} "
+                                    "(Archivo → Aplicar plantilla del receptor)")
         except Exception as e:
             messagebox.showerror("Error al abrir CFDI", f"Ocurrió un problema al leer el XML:\n{e}")
 
@@ -782,11 +577,7 @@ class AddendaApp:
                                           filetypes=[("XSD", "*.xsd"), ("Todos", "*.*")])
         if not path:
             return
-        try:
-            real_path = cargar_xsd_desde_fuente(path)
-            self._post_carga_xsd(real_path)
-        except Exception as e:
-            messagebox.showerror("Error al cargar XSD", str(e))
+        self._cargar_xsd_async(path)
 
     def cargar_xsd_url(self):
         url_win = tk.Toplevel(self.root)
@@ -800,24 +591,18 @@ class AddendaApp:
             if not url:
                 messagebox.showinfo("Falta URL", "Escribe la URL del XSD.")
                 return
-            try:
-                local = cargar_xsd_desde_fuente(url)
-                self._post_carga_xsd(local)
-                url_win.destroy()
-            except Exception as e:
-                messagebox.showerror("Error al descargar XSD", str(e))
+            url_win.destroy()
+            self._cargar_xsd_async(url, "Error al descargar XSD")
         ttk.Button(frm, text="Cargar", command=do).pack(anchor="e")
 
     def cargar_xsd_desde_schemaLocation(self):
         if not self.cfdi_tree:
             messagebox.showinfo("Sin CFDI", "Primero abre un CFDI XML.")
             return
-        root = self.cfdi_tree.getroot()
-        addenda = root.find(CFDI + "Addenda")
+        addenda = self._addenda_previa()
         if addenda is None or len(list(addenda)) == 0:
             messagebox.showinfo("Sin Addenda", "Este CFDI no tiene Addenda todavía.")
             return
-        XSI = "{http://www.w3.org/2001/XMLSchema-instance}"
         objetivo = list(addenda)[0]
         scl = objetivo.attrib.get(XSI + "schemaLocation")
         if not scl:
@@ -825,18 +610,46 @@ class AddendaApp:
             return
         partes = scl.split()
         url = partes[1] if len(partes) >= 2 else None
+        # copia local en la biblioteca de XSD antes que la red
+        local = buscar_xsd_registro(ns_de(objetivo.tag), localname(objetivo.tag), url)
+        if local:
+            self._cargar_xsd_async(local, "Error al cargar XSD")
+            return
         if not url or not _es_url(url):
             messagebox.showwarning("No válido", f"No se pudo obtener una URL válida del schemaLocation:\n{scl}")
             return
-        try:
-            local = cargar_xsd_desde_fuente(url)
-            self._post_carga_xsd(local)
-        except Exception as e:
-            messagebox.showerror("Error al obtener XSD", str(e))
-
-    def _post_carga_xsd(self, xsd_local_path: str):
-        self.xsd_path = xsd_local_path
-        self.xsd_ns_uri = parse_xsd_target_namespace(self.xsd_path) or ""
+        self._cargar_xsd_async(url, "Error al obtener XSD")
+
+    @staticmethod
+    def _preparar_xsd(fuente, root_name):
+        """Parte pesada de cargar un XSD (corre en el pool): descarga, shapes, reglas, esquema."""
+        local = cargar_xsd_desde_fuente(fuente)
+        fp = xsd_fingerprint(local)
+        shapes, tipos = parse_xsd_cached(local, root_element_name=root_name)
+        if not shapes:
+            raise RuntimeError("No se encontraron elementos en el XSD (checa 'Elemento raíz').")
+        res = {"path": local, "fp": fp, "shapes": shapes, "tipos": tipos,
+               "tns": xsd_target_namespace_cached(local) or "",
+               "rules": reglas_para_xsd(local, root_element_name=root_name, fingerprint=fp)}
+        registrar_xsd_paquete(local, res["tns"])
+        if HAS_LXML:
+            try:
+                obtener_schema(local)   # deja compilado el esquema para previsualizar/guardar
+            except Exception:
+                pass
+        return res
+
+    def _cargar_xsd_async(self, fuente, titulo_error="Error al cargar XSD"):
+        root_name = self.root_elem_name.get().strip() or None
+        nombre = os.path.basename(urllib.parse.urlparse(fuente).path or fuente) or fuente
+        self._en_fondo("xsd", f"Cargando {nombre}…",
+                       lambda: self._preparar_xsd(fuente, root_name),
+                       self._xsd_listo,
+                       lambda e: messagebox.showerror(titulo_error, str(e)))
+
+    def _xsd_listo(self, res):
+        self.xsd_path = res["path"]
+        self.xsd_ns_uri = res["tns"]
         if not self.ns_uri_var.get().strip() and self.xsd_ns_uri:
             self.ns_uri_var.set(self.xsd_ns_uri)
         elif self.xsd_ns_uri and self.ns_uri_var.get().strip() and self.ns_uri_var.get().strip() != self.xsd_ns_uri:
@@ -847,197 +660,203 @@ class AddendaApp:
                 "¿Usar el namespace del XSD?"
             ):
                 self.ns_uri_var.set(self.xsd_ns_uri)
-        self._parsear_xsd_y_render()
-
-    def _parsear_xsd_y_render(self):
-        if not self.xsd_path:
-            return
-        try:
-            root_name = self.root_elem_name.get().strip() or None
-            self.shapes = parse_xsd(self.xsd_path, root_element_name=root_name)
-            if not self.shapes:
-                raise RuntimeError("No se encontraron elementos en el XSD (checa 'Elemento raíz').")
-            self._render_form()
-
-            # reglas cache/inferencia
-            key = xsd_fingerprint(self.xsd_path)
-            cached = self._cache.get(key)
-            if isinstance(cached, dict) and cached:
-                self._auto_rules = cached
-            else:
-                self._auto_rules = build_autofill_rules_from_xsd(self.xsd_path, root_element_name=root_name)
-                self._cache[key] = self._auto_rules
-                save_cache(self._cache)
-
-            if self._cfdi_ctx:
-                self.autollenar_desde_cfdi()
-        except Exception as e:
-            messagebox.showerror("Error XSD", f"Problema al analizar el XSD:\n{e}")
+        self._xsd_fp = res["fp"]
+        self.shapes, self.shape_types = res["shapes"], res["tipos"]
+        self._render_form()
+        self._auto_rules = res["rules"]
+        if self._cfdi_ctx:
+            self.autollenar_desde_cfdi()
 
     # ------------- Render dinámico ------------------
-    def _add_instance_ui(self, parent, shape):
-        inst_frame = ttk.Frame(parent, relief="groove", padding=6)
-        inst_frame.pack(fill="x", pady=4)
-
-        def eliminar():
-            inst_frame.destroy()
-
-        head = ttk.Frame(inst_frame)
-        head.pack(fill="x")
-        ttk.Label(head, text=shape["name"], font=("Segoe UI", 10, "bold")).pack(side="left")
-        ttk.Button(head, text="Eliminar", command=eliminar).pack(side="right")
-
-        # Atributos raíz
-        if shape.get("attributes"):
-            atf = ttk.LabelFrame(inst_frame, text="Atributos")
+    def _entry_campo(self, row, slot):
+        """Entry (o Combobox si el XSD trae enumeration) ligado al slot, con revisión por tecla."""
+        var = tk.StringVar(master=self.root)
+        slot.bind(var)
+        enum = slot.facetas.get("enumeration")
+        if enum:
+            valores = list(enum) if slot.required else [""] + list(enum)
+            w = ttk.Combobox(row, textvariable=var, values=valores, state="readonly")
+        else:
+            w = ttk.Entry(row, textvariable=var)
+        w.pack(side="left", fill="x", expand=True)
+        self._widgets_slot[id(slot)] = w
+        if slot.validar is None or enum:
+            return
+        aviso = ttk.Label(row, foreground="#b00020")
+        aviso.pack(side="left", padx=(6,0))
+        def revisar(*_):
+            msg = slot.error()
+            aviso.configure(text=msg)
+            w.configure(style="Invalido.TEntry" if msg else "TEntry")
+        var.trace_add("write", revisar)
+        revisar()
+
+    def _render_campos(self, parent, inst):
+        """Entries de los campos de la instancia, ligados a sus CampoSlot."""
+        if inst.attrs:
+            atf = ttk.LabelFrame(parent, text="Atributos")
             atf.pack(fill="x", padx=4, pady=4)
-            for a in shape["attributes"]:
+            for slot in inst.attrs.values():
                 row = ttk.Frame(atf); row.pack(fill="x", padx=2, pady=2)
-                ttk.Label(row, text=f'{a["name"]}{" *" if a.get("use")=="required" else ""}:', width=24).pack(side="left")
-                ent = ttk.Entry(row)
-                ent.pack(side="left", fill="x", expand=True)
-                if a.get("fixed") is not None:
-                    ent.insert(0, a["fixed"])
-                elif a.get("default") is not None:
-                    ent.insert(0, a["default"])
-                ent._field_meta = {
-                    "kind":"attr", "name": a["name"], "required": a.get("use")=="required",
-                    "owner": shape["name"], "owner_path": shape.get("path") or shape["name"]
-                }
-                self._entry_widgets.append((ent, "attr", shape["name"]))
-
-        # Hijos
-        for ch in shape.get("children", []):
-            grp = ttk.LabelFrame(inst_frame, text=ch["name"])
-            grp.pack(fill="x", padx=4, pady=4)
-
-            # Atributos directos
-            if ch.get("attributes"):
-                atf = ttk.LabelFrame(grp, text="Atributos")
-                atf.pack(fill="x", padx=4, pady=4)
-                for a in ch["attributes"]:
-                    row = ttk.Frame(atf); row.pack(fill="x", padx=2, pady=2)
-                    ttk.Label(row, text=f'{a["name"]}{" *" if a.get("use")=="required" else ""}:', width=24).pack(side="left")
-                    ent = ttk.Entry(row)
-                    ent.pack(side="left", fill="x", expand=True)
-                    if a.get("fixed") is not None:
-                        ent.insert(0, a["fixed"])
-                    elif a.get("default") is not None:
-                        ent.insert(0, a["default"])
-                    ent._field_meta = {
-                        "kind":"attr", "name": a["name"], "required": a.get("use")=="required",
-                        "owner": ch["name"], "owner_path": ch.get("path") or f"{shape.get('path')}/{ch['name']}"
-                    }
-                    self._entry_widgets.append((ent, "attr", ch["name"]))
-
-            # Elemento simple (texto)
-            if ch.get("is_simple") and not ch.get("attributes") and not ch.get("children"):
-                row = ttk.Frame(grp); row.pack(fill="x", padx=2, pady=2)
-                ttk.Label(row, text="Valor:", width=24).pack(side="left")
-                ent = ttk.Entry(row)
-                ent.pack(side="left", fill="x", expand=True)
-                ent._field_meta = {
-                    "kind":"text", "name":"#text", "required": False,
-                    "owner": ch["name"], "owner_path": ch.get("path") or f"{shape.get('path')}/{ch['name']}"
-                }
-                self._entry_widgets.append((ent, "text", ch["name"]))
-
-            # Nietos
-            if ch.get("children"):
-                rep_wrap = ttk.Frame(grp); rep_wrap.pack(fill="x", padx=4, pady=4)
-                self._add_child_instance_ui(rep_wrap, ch)
-                if ch.get("maxOccurs","1") != "1":
-                    ttk.Button(grp, text="+ Añadir otro",
-                               command=lambda w=rep_wrap, s=ch: self._add_child_instance_ui(w, s)
-                               ).pack(anchor="w", padx=6, pady=(0,6))
-
-    def _add_child_instance_ui(self, parent, shape):
-        inst = ttk.Frame(parent, relief="ridge", padding=6)
-        inst.pack(fill="x", pady=4)
-        head = ttk.Frame(inst); head.pack(fill="x")
-        ttk.Label(head, text=f"Instancia de {shape['name']}", font=("Segoe UI", 9, "italic")).pack(side="left")
-        ttk.Button(head, text="Eliminar", command=inst.destroy).pack(side="right")
-
-        for gg in shape.get("children", []):
-            sub = ttk.LabelFrame(inst, text=gg["name"])
-            sub.pack(fill="x", padx=4, pady=4)
-            if gg.get("attributes"):
-                atf = ttk.LabelFrame(sub, text="Atributos")
-                atf.pack(fill="x", padx=4, pady=4)
-                for a in gg["attributes"]:
-                    row = ttk.Frame(atf); row.pack(fill="x", padx=2, pady=2)
-                    ttk.Label(row, text=f'{a["name"]}{" *" if a.get("use")=="required" else ""}:', width=24).pack(side="left")
-                    ent = ttk.Entry(row)
-                    ent.pack(side="left", fill="x", expand=True)
-                    if a.get("fixed") is not None:
-                        ent.insert(0, a["fixed"])
-                    elif a.get("default") is not None:
-                        ent.insert(0, a["default"])
-                    ent._field_meta = {
-                        "kind":"attr", "name": a["name"], "required": a.get("use")=="required",
-                        "owner": gg["name"], "owner_path": gg.get("path") or gg["name"]
-                    }
-                    self._entry_widgets.append((ent, "attr", gg["name"]))
-            if gg.get("is_simple") and not gg.get("attributes") and not gg.get("children"):
-                row = ttk.Frame(sub); row.pack(fill="x", padx=2, pady=2)
-                ttk.Label(row, text="Valor:", width=24).pack(side="left")
-                ent = ttk.Entry(row)
-                ent.pack(side="left", fill="x", expand=True)
-                ent._field_meta = {
-                    "kind":"text", "name":"#text", "required": False,
-                    "owner": gg["name"], "owner_path": gg.get("path") or gg["name"]
-                }
-                self._entry_widgets.append((ent, "text", gg["name"]))
-
-            for bis in gg.get("children", []):
-                bisf = ttk.LabelFrame(sub, text=bis["name"])
-                bisf.pack(fill="x", padx=4, pady=4)
-                if bis.get("attributes"):
-                    atf = ttk.LabelFrame(bisf, text="Atributos")
-                    atf.pack(fill="x", padx=4, pady=4)
-                    for a in bis.get("attributes", []):
-                        row = ttk.Frame(atf); row.pack(fill="x", padx=2, pady=2)
-                        ttk.Label(row, text=f'{a["name"]}{" *" if a.get("use")=="required" else ""}:', width=24).pack(side="left")
-                        ent = ttk.Entry(row)
-                        ent.pack(side="left", fill="x", expand=True)
-                        if a.get("fixed") is not None:
-                            ent.insert(0, a["fixed"])
-                        elif a.get("default") is not None:
-                            ent.insert(0, a["default"])
-                        ent._field_meta = {
-                            "kind":"attr", "name": a["name"], "required": a.get("use")=="required",
-                            "owner": bis["name"], "owner_path": bis.get("path") or bis["name"]
-                        }
-                        self._entry_widgets.append((ent, "attr", bis["name"]))
-                if bis.get("is_simple") and not bis.get("attributes") and not bis.get("children"):
-                    row = ttk.Frame(bisf); row.pack(fill="x", padx=2, pady=2)
-                    ttk.Label(row, text="Valor:", width=24).pack(side="left")
-                    ent = ttk.Entry(row)
-                    ent.pack(side="left", fill="x", expand=True)
-                    ent._field_meta = {
-                        "kind":"text", "name":"#text", "required": False,
-                        "owner": bis["name"], "owner_path": bis.get("path") or bis["name"]
-                    }
-                    self._entry_widgets.append((ent, "text", bis["name"]))
+                ttk.Label(row, text=f'{slot.name}{" *" if slot.required else ""}:', width=24).pack(side="left")
+                self._entry_campo(row, slot)
+        if inst.text is not None:
+            row = ttk.Frame(parent); row.pack(fill="x", padx=2, pady=2)
+            ttk.Label(row, text="Valor:", width=24).pack(side="left")
+            self._entry_campo(row, inst.text)
+
+    def _seccion(self, parent, titulo, construir, abierta=False):
+        """
+        Sección colapsable: el contenido se construye (construir(body)) la primera
+        vez que se abre. Regresa la función que la abre (la usa el buscador).
+        """
+        cont = ttk.Frame(parent)
+        cont.pack(fill="x", padx=4, pady=2)
+        body = ttk.Frame(cont, padding=(14, 0, 0, 0))
+        estado = {"hecho": False, "abierta": False}
+
+        def abrir():
+            if not estado["hecho"]:
+                construir(body)
+                estado["hecho"] = True
+            if not estado["abierta"]:
+                body.pack(fill="x")
+                btn.configure(text=f"▾ {titulo}")
+                estado["abierta"] = True
+
+        def alternar():
+            if estado["abierta"]:
+                body.pack_forget()
+                btn.configure(text=f"▸ {titulo}")
+                estado["abierta"] = False
+            else:
+                abrir()
+
+        btn = ttk.Button(cont, text=f"▸ {titulo}", style="Toolbutton", command=alternar)
+        btn.pack(anchor="w")
+        if abierta:
+            abrir()
+        return abrir
+
+    def _render_instancia(self, parent, inst, lista, nivel=0):
+        frame = ttk.Frame(parent, relief="groove" if nivel == 0 else "ridge", padding=6)
+        frame.pack(fill="x", pady=4)
+        head = ttk.Frame(frame)
+        head.pack(fill="x")
+        if nivel == 0:
+            ttk.Label(head, text=inst.shape["name"], font=("Segoe UI", 10, "bold")).pack(side="left")
+        else:
+            ttk.Label(head, text=f"Instancia de {inst.shape['name']}", font=("Segoe UI", 9, "italic")).pack(side="left")
+        ttk.Button(head, text="Eliminar",
+                   command=lambda: self._eliminar_instancia(frame, lista, inst)).pack(side="right")
+        self._render_campos(frame, inst)
+        self._render_hijos(frame, inst, nivel)
+
+    def _render_hijos(self, parent, inst, nivel):
+        for sh, lst in inst.hijos:
+            repetible = sh.get("maxOccurs", "1") != "1" or sh.get("lazy")
+            if not repetible and not sh.get("children") and len(lst) == 1:
+                # hijo simple de una sola ocurrencia: sus campos directo en el grupo
+                grp = ttk.LabelFrame(parent, text=sh["name"])
+                grp.pack(fill="x", padx=4, pady=4)
+                self._render_campos(grp, lst[0])
+                continue
+            path = f"{inst.path}/{sh['name']}"
+            self._secciones[id(lst)] = self._seccion(
+                parent, sh["name"],
+                lambda body, sh=sh, lst=lst, path=path, rep=repetible: self._render_lista(body, sh, lst, path, nivel + 1, rep))
+
+    def _render_lista(self, body, shape, lista, path, nivel, repetible):
+        wrap = ttk.Frame(body); wrap.pack(fill="x", padx=4, pady=4)
+        for ch in lista:
+            self._render_instancia(wrap, ch, lista, nivel)
+        if repetible:
+            ttk.Button(body, text="+ Añadir otro",
+                       command=lambda: self._agregar_instancia(wrap, shape, lista, path, nivel)
+                       ).pack(anchor="w", padx=6, pady=(0,6))
+
+    def _agregar_instancia(self, wrap, shape, lista, path, nivel):
+        mx = shape.get("maxOccurs", "1")
+        if mx not in ("unbounded",) and mx.isdigit() and len(lista) >= int(mx):
+            messagebox.showinfo("Límite", f"{shape['name']} admite máximo {mx} ocurrencias.")
+            return
+        inst = self.model.agregar(lista, shape, path)
+        self._render_instancia(wrap, inst, lista, nivel)
+
+    def _eliminar_instancia(self, frame, lista, inst):
+        for slot in self.model.campos_de(inst):
+            self._widgets_slot.pop(id(slot), None)
+        pendientes = [inst]
+        while pendientes:
+            nodo = pendientes.pop()
+            for _sh, lst in nodo.hijos:
+                self._secciones.pop(id(lst), None)
+                pendientes.extend(lst)
+        self.model.eliminar(lista, inst)
+        frame.destroy()
 
     def _render_form(self):
+        self.model = FormModel(self.shapes, self.shape_types)
+        self._render_modelo()
+
+    def _render_modelo(self):
+        """
+        Pinta self.model tal cual está (se usa también tras agregar instancias por
+        prefill). Solo la raíz se construye abierta; cada grupo de hijos es una
+        sección que crea sus widgets al abrirse. Los valores viven en el modelo,
+        así que recolectar/autollenar no dependen de lo que esté pintado.
+        """
         for w in self.form_frame.winfo_children():
             w.destroy()
-        self._entry_widgets.clear()
-        self._field_names.clear()
-
-        ttk.Label(self.form_frame, text=f"XSD: {os.path.basename(self.xsd_path) if self.xsd_path else '—'}",
-                  font=("Segoe UI", 10, "bold")).pack(anchor="w", pady=(0,8))
-
-        for top_shape in self.shapes:
-            section = ttk.LabelFrame(self.form_frame, text=top_shape["name"] or "Elemento")
-            section.pack(fill="x", padx=4, pady=6)
-            wrap = ttk.Frame(section)
-            wrap.pack(fill="x", padx=6, pady=6)
-            self._add_instance_ui(wrap, top_shape)
-            if top_shape.get("maxOccurs","1") != "1":
-                ttk.Button(section, text="+ Añadir otro",
-                           command=lambda w=wrap, s=top_shape: self._add_instance_ui(w, s)).pack(anchor="w", padx=6, pady=(0,6))
+        self._secciones = {}      # id(lista de instancias) -> abrir()
+        self._widgets_slot = {}   # id(CampoSlot) -> Entry/Combobox
+        self._busqueda = ("", 0)
+
+        head = ttk.Frame(self.form_frame)
+        head.pack(fill="x", pady=(0,8))
+        ttk.Label(head, text=f"XSD: {os.path.basename(self.xsd_path) if self.xsd_path else '—'}",
+                  font=("Segoe UI", 10, "bold")).pack(side="left")
+        ent = ttk.Entry(head, textvariable=self.buscar_var, width=28)
+        ent.pack(side="right")
+        ent.bind("<Return>", lambda e: self.buscar_campo())
+        ttk.Label(head, text="Buscar campo:").pack(side="right", padx=(0,4))
+
+        for top_shape, lst in self.model.raices:
+            repetible = top_shape.get("maxOccurs","1") != "1"
+            self._secciones[id(lst)] = self._seccion(
+                self.form_frame, top_shape["name"] or "Elemento",
+                lambda body, sh=top_shape, lst=lst, rep=repetible: self._render_lista(body, sh, lst, sh["name"], 0, rep),
+                abierta=True)
+
+    def buscar_campo(self):
+        """Salta al siguiente campo cuyo nombre/ruta contenga el texto, abriendo sus secciones."""
+        if not self.model:
+            return
+        texto = self.buscar_var.get().strip()
+        hits = self.model.encontrar(texto)
+        if not hits:
+            self.status_var.set(f"Sin coincidencias para '{texto}'")
+            return
+        prev, i = self._busqueda
+        i = (i + 1) % len(hits) if prev == texto else 0
+        self._busqueda = (texto, i)
+        slot = hits[i]
+        for lista, _inst in self.model.ruta_de(slot):
+            abrir = self._secciones.get(id(lista))
+            if abrir:
+                abrir()
+        w = self._widgets_slot.get(id(slot))
+        self.status_var.set(f"{slot.owner_path} · {slot.logical_name} ({i + 1}/{len(hits)})")
+        if w is None:
+            return
+        try:
+            self.root.update_idletasks()
+            alto = max(1, self.form_frame.winfo_height())
+            y = w.winfo_rooty() - self.form_frame.winfo_rooty()
+            self.canvas.yview_moveto(max(0.0, (y - 40) / alto))
+            w.focus_set()
+        except tk.TclError:
+            pass
 
     # ------------- Autollenado (desde CFDI) -------------
     def autollenar_desde_cfdi(self):
@@ -1047,111 +866,62 @@ class AddendaApp:
                 return
             self._cfdi_ctx = extract_cfdi_context(self.cfdi_tree.getroot())
 
-        count = 0
-        for ent, kind, owner in self._entry_widgets:
-            try:
-                if ent.get().strip():
-                    continue
-                meta = getattr(ent, "_field_meta", {})
-                logical_name = meta.get("name") if kind == "attr" else owner
-
-                cfdi_key = self._auto_rules.get(logical_name) or self._auto_rules.get((logical_name or "").lower())
-                if cfdi_key:
-                    val = self._cfdi_ctx.get(cfdi_key)
-                    if val:
-                        ent.insert(0, val); count += 1; continue
-
-                val = guess_autofill_value_by_name(logical_name, self._cfdi_ctx)
-                if val:
-                    ent.insert(0, val); count += 1
-            except Exception:
-                pass
+        count = self.model.autollenar(self._cfdi_ctx, self._auto_rules, self._xsd_fp) if self.model else 0
         messagebox.showinfo("Autollenado", f"Campos autollenados: {count}")
 
+    def corregir_regla(self):
+        if not self._xsd_fp:
+            messagebox.showinfo("Sin XSD", "Primero carga un XSD.")
+            return
+        campo = simpledialog.askstring("Regla de autollenado", "Campo (atributo o elemento) del XSD:",
+                                       parent=self.root)
+        if not campo:
+            return
+        actual = self._auto_rules.get(campo) or guess_autofill_key_by_name(campo, self._cfdi_ctx or {})
+        llave = simpledialog.askstring(
+            "Regla de autollenado",
+            f"Llave del CFDI para '{campo}' (vacío = usar la sugerida):\n"
+            f"p.ej. folio, uuid, receptor_rfc, total, concepto1_descripcion",
+            initialvalue=actual or "", parent=self.root)
+        if llave is None:
+            return
+        try:
+            reglas_override(self._xsd_fp, campo.strip(), llave.strip())
+            self._auto_rules = reglas_cargar(self._xsd_fp) or {}
+            messagebox.showinfo("Regla", f"{campo} → {self._auto_rules.get(campo.strip()) or '(heurística)'}")
+        except Exception as e:
+            messagebox.showerror("Error", f"No se pudo guardar la regla:\n{e}")
+
+    def mostrar_stats_cache(self):
+        st = schema_cache_stats()
+        messagebox.showinfo("Caché XSD",
+            f"Esquemas compilados: {st['size']}/{st['max']}\n"
+            f"Aciertos: {st['hits']} • Fallos: {st['misses']} • Desalojados: {st['evictions']}")
+
     # ---------- Recolección + validación UI ----------
     def _collect_instances(self):
-        roots = []
-        for sect in self.form_frame.winfo_children():
-            if not isinstance(sect, ttk.LabelFrame):
-                continue
-            title = sect.cget("text")
-            wrap = None
-            for ch in sect.winfo_children():
-                if isinstance(ch, ttk.Frame):
-                    wrap = ch; break
-            if not wrap:
-                continue
-            for inst_frame in [w for w in wrap.winfo_children() if isinstance(w, ttk.Frame)]:
-                root_inst = {"name": title, "attributes":{}, "children":[]}
-                for sub in inst_frame.winfo_children():
-                    if isinstance(sub, ttk.LabelFrame) and sub.cget("text") == "Atributos":
-                        for row in sub.winfo_children():
-                            for w in row.winfo_children():
-                                if hasattr(w, "_field_meta") and getattr(w, "get", None):
-                                    meta = w._field_meta; val = w.get().strip()
-                                    if meta.get("kind") == "attr":
-                                        root_inst["attributes"][meta["name"]] = val
-                        continue
-                    if isinstance(sub, ttk.LabelFrame) and sub.cget("text") not in ("Atributos",):
-                        child_inst = {"name": sub.cget("text"), "attributes":{}, "children":[]}
-                        text_value = ""
-                        for maybe in sub.winfo_children():
-                            if isinstance(maybe, ttk.LabelFrame) and maybe.cget("text") == "Atributos":
-                                for row in maybe.winfo_children():
-                                    for w in row.winfo_children():
-                                        if hasattr(w, "_field_meta") and getattr(w, "get", None):
-                                            meta = w._field_meta; val = w.get().strip()
-                                            if meta.get("kind") == "attr":
-                                                child_inst["attributes"][meta["name"]] = val
-                            if isinstance(maybe, ttk.Frame):
-                                for w in maybe.winfo_children():
-                                    if hasattr(w, "_field_meta") and w._field_meta.get("kind") == "text":
-                                        text_value = w.get().strip()
-                                for inst in [x for x in maybe.winfo_children() if isinstance(x, ttk.Frame)]:
-                                    for bis in inst.winfo_children():
-                                        if isinstance(bis, ttk.LabelFrame):
-                                            bis_inst = {"name": bis.cget("text"), "attributes":{}, "children":[]}
-                                            bis_text = ""
-                                            for atsub in bis.winfo_children():
-                                                if isinstance(atsub, ttk.LabelFrame) and atsub.cget("text")=="Atributos":
-                                                    for row in atsub.winfo_children():
-                                                        for w in row.winfo_children():
-                                                            if hasattr(w, "_field_meta") and getattr(w, "get", None):
-                                                                meta = w._field_meta; val = w.get().strip()
-                                                                if meta.get("kind")=="attr":
-                                                                    bis_inst["attributes"][meta["name"]] = val
-                                                if isinstance(atsub, ttk.Frame):
-                                                    for w in atsub.winfo_children():
-                                                        if hasattr(w, "_field_meta") and w._field_meta.get("kind")=="text":
-                                                            bis_text = w.get().strip()
-                                            if bis_text:
-                                                bis_inst["text"] = bis_text
-                                            if bis_inst.get("attributes") or bis_inst.get("text"):
-                                                child_inst["children"].append(bis_inst)
-                        if text_value:
-                            child_inst["text"] = text_value
-                        if child_inst.get("attributes") or child_inst.get("children") or child_inst.get("text"):
-                            root_inst["children"].append(child_inst)
-                roots.append(root_inst)
-        return {"roots": roots}
+        return self.model.collect() if self.model else {"roots": []}
 
     def _validate_required_ui(self):
-        faltan = []
-        for ent_frame in self.form_frame.winfo_children():
-            for w in getattr(ent_frame, "winfo_children", lambda:[])():
-                self._validate_recurse(w, faltan)
+        faltan, invalidos = self.model.revisar() if self.model else ([], [])
         if faltan:
             messagebox.showwarning("Campos obligatorios", "Faltan: " + ", ".join(sorted(set(faltan))))
             return False
+        if invalidos:
+            messagebox.showwarning("Valores inválidos", "\n".join(invalidos[:20]))
+            return False
         return True
 
-    def _validate_recurse(self, widget, faltan):
-        if hasattr(widget, "_field_meta"):
-            meta = widget._field_meta
-            if meta.get("required") and not widget.get().strip():
-                faltan.append(meta.get("name") if meta.get("kind")=="attr" else meta.get("owner"))
-        for ch in getattr(widget, "winfo_children", lambda:[])():
-            self._validate_recurse(ch, faltan)
+    def _valores_para_addenda(self):
+        """Lo capturado en el form; con "Un nodo por concepto" los nodos por línea
+        se generan para todos los conceptos sin crear widgets."""
+        valores = self._collect_instances()
+        if not self.por_concepto_var.get() or not self.cfdi_tree:
+            return valores
+        roots = [_vincular_instancia(r, self._cfdi_ctx, self._auto_rules) for r in valores["roots"]]
+        tabla = extraer_tabla_conceptos(self.cfdi_tree.getroot())
+        return generar_valores_por_concepto(roots, self.shapes, self._cfdi_ctx, tabla,
+                                            self._auto_rules, self.shape_types)
 
     # ----------------- Acciones ----------------------
     def previsualizar(self):
@@ -1162,26 +932,54 @@ class AddendaApp:
             return
         ns_cfg = {"prefix": self.ns_prefix_var.get().strip() or "cli",
                   "uri": (self.ns_uri_var.get().strip() or self.xsd_ns_uri)}
-        preview_tree = ET.ElementTree(self.cfdi_tree.getroot())
+        # overlay: la Addenda nueva va aparte; el CFDI cargado no se toca
         try:
-            construir_addenda(preview_tree.getroot(), self._collect_instances(), ns_cfg=ns_cfg)
-            ok, errs = validate_addenda_subtree_with_xsd(preview_tree.getroot(), self.xsd_path, ns_uri=ns_cfg["uri"])
-            if not ok:
-                if HAS_LXML:
-                    messagebox.showerror("XSD no válido", f"Errores de esquema:\n{errs}")
-                    return
-                else:
-                    messagebox.showwarning("Validación deshabilitada",
-                        "Instala lxml para validar contra XSD: pip install lxml")
-            xml_text = generate_preview(preview_tree)
+            addenda = construir_addenda_overlay(self._valores_para_addenda(), ns_cfg=ns_cfg)
+            root = self.cfdi_tree.getroot()
+            previa = self._addenda_previa()
+            lineas = resumen_cfdi(root)
+            if previa is not None and len(previa):
+                lineas.append(f"  <!-- Addenda existente: {len(previa)} nodo(s), se conservan al guardar -->")
+            cuerpo = serializar_addenda(addenda, prefix="cfdi").decode("utf-8")
+            xml_text = "\n".join(lineas) + "\n  " + cuerpo.strip() + "\n</cfdi:Comprobante>\n"
         except Exception as e:
             messagebox.showerror("Error", f"Al construir/validar Addenda:\n{e}")
             return
 
-        top = tk.Toplevel(self.root); top.title("Previsualización")
-        txt = tk.Text(top, wrap="none", height=30, width=120)
-        txt.pack(fill="both", expand=True)
-        txt.insert("1.0", xml_text); txt.configure(state="disabled")
+        def listo(res):
+            if not self._aviso_validacion(res):
+                return
+            top = tk.Toplevel(self.root); top.title("Previsualización")
+            txt = tk.Text(top, wrap="none", height=30, width=120)
+            txt.pack(fill="both", expand=True)
+            txt.insert("1.0", xml_text); txt.configure(state="disabled")
+        self._validar_async(raiz_con_addenda(addenda, self.cfdi_tree.getroot().tag), ns_cfg["uri"], listo)
+
+    def _validar_async(self, raiz, ns_uri, listo):
+        """Valida en el pool la Addenda de `raiz` (árbol suelto, no el CFDI vivo) y llama listo((ok, errs)) en Tk."""
+        xsd_path = self.xsd_path
+        self._en_fondo("validar", "Validando contra XSD…",
+                       lambda: validate_addenda_subtree_with_xsd(raiz, xsd_path, ns_uri=ns_uri),
+                       listo,
+                       lambda e: messagebox.showerror("Error", f"Al construir/validar Addenda:\n{e}"))
+
+    def _addenda_previa(self):
+        """La Addenda que se conserva al guardar: la adjuntada desde XML o la que trae el CFDI."""
+        if self._addenda_adjunta is not None:
+            return self._addenda_adjunta
+        return self.cfdi_tree.getroot().find(CFDI + "Addenda")
+
+    def _aviso_validacion(self, res) -> bool:
+        """Muestra el resultado de validar; False si hay que detenerse."""
+        ok, errs = res
+        if ok:
+            return True
+        if HAS_LXML:
+            messagebox.showerror("XSD no válido", f"Errores de esquema:\n{errs}")
+            return False
+        messagebox.showwarning("Validación deshabilitada",
+            "Instala lxml para validar contra XSD: pip install lxml")
+        return True
 
     def guardar_definitivo(self):
         if not self.cfdi_tree or not self.xsd_path:
@@ -1192,16 +990,41 @@ class AddendaApp:
         ns_cfg = {"prefix": self.ns_prefix_var.get().strip() or "cli",
                   "uri": (self.ns_uri_var.get().strip() or self.xsd_ns_uri)}
         try:
-            construir_addenda(self.cfdi_tree.getroot(), self._collect_instances(), ns_cfg=ns_cfg)
-            ok, errs = validate_addenda_subtree_with_xsd(self.cfdi_tree.getroot(), self.xsd_path, ns_uri=self.ns_uri_var.get().strip() or self.xsd_ns_uri)
-            if not ok:
-                if HAS_LXML:
-                    messagebox.showerror("XSD no válido", f"Errores de esquema:\n{errs}")
-                    return
-                else:
-                    messagebox.showwarning("Validación deshabilitada",
-                        "Instala lxml para validar contra XSD: pip install lxml")
-            pretty_xml(self.cfdi_tree)
+            root = self.cfdi_tree.getroot()
+            addenda = construir_addenda_overlay(self._valores_para_addenda(), ns_cfg=ns_cfg,
+                                                previa=self._addenda_previa())
+        except Exception as e:
+            messagebox.showerror("Error al guardar", f"Ocurrió un problema al guardar:\n{e}")
+            return
+        self._guardar_async(raiz_con_addenda(addenda, root.tag), addenda, self.xsd_path, ns_cfg["uri"])
+
+    def _guardar_async(self, raiz, addenda, xsd_path, ns_uri):
+        """`addenda`: Element <cfdi:Addenda> o serializador (plantilla); `raiz` la contiene para validarla."""
+        src = self.xml_path
+
+        def trabajo():
+            # Addenda contra su XSD; si pasa, el CFDI ya empalmado contra el paquete local
+            res = validate_addenda_subtree_with_xsd(raiz, xsd_path, ns_uri=ns_uri)
+            if not res[0] and HAS_LXML:
+                return res, None, None
+            data = cfdi_con_addenda_bytes(src, addenda)
+            return res, data, validar_cfdi_completo(data, extra={ns_uri: xsd_path})
+        self._en_fondo("validar", "Validando contra XSD…", trabajo, self._guardar_validado,
+                       lambda e: messagebox.showerror("Error", f"Al construir/validar Addenda:\n{e}"))
+
+    def _guardar_validado(self, res):
+        res, data, completo = res
+        if not self._aviso_validacion(res):
+            return
+        ok, msg = completo
+        if ok is False and not messagebox.askyesno(
+                "CFDI completo no válido",
+                f"La Addenda cumple su XSD, pero el CFDI completo no pasa los esquemas locales:\n{msg}\n\n"
+                "¿Guardar de todos modos?"):
+            return
+        if ok is None or len(msg.splitlines()) > 1:
+            self.status_var.set(msg.splitlines()[-1])
+        try:
             out_path = filedialog.asksaveasfilename(
                 title="Guardar CFDI con Addenda",
                 defaultextension=".xml",
@@ -1209,19 +1032,96 @@ class AddendaApp:
             )
             if not out_path:
                 return
-            self.cfdi_tree.write(out_path, encoding="utf-8", xml_declaration=True)
+            # lo mismo que se validó: el CFDI original con solo la Addenda empalmada
+            escribir_bytes(data, out_path)
             messagebox.showinfo("Guardado", f"Se guardó el CFDI con Addenda en:\n{out_path}")
         except Exception as e:
             messagebox.showerror("Error al guardar", f"Ocurrió un problema al guardar:\n{e}")
 
+    # --------- Perfil de campos (lote) ----------
+    def guardar_perfil_campos(self):
+        if not self.xsd_path:
+            messagebox.showinfo("Sin XSD", "Primero carga el XSD de la Addenda.")
+            return
+        out_path = filedialog.asksaveasfilename(title="Guardar perfil de campos",
+                                                defaultextension=".json",
+                                                filetypes=[("Perfil JSON", "*.json")])
+        if not out_path:
+            return
+        ns_cfg = {"prefix": self.ns_prefix_var.get().strip() or "cli",
+                  "uri": (self.ns_uri_var.get().strip() or self.xsd_ns_uri)}
+        try:
+            guardar_perfil(out_path, self._collect_instances(), self.xsd_path, ns_cfg,
+                           root_element_name=self.root_elem_name.get().strip() or None,
+                           ctx=self._cfdi_ctx, rules=self._auto_rules,
+                           por_concepto=self.por_concepto_var.get())
+            messagebox.showinfo("Perfil", f"Perfil guardado en:\n{out_path}")
+        except Exception as e:
+            messagebox.showerror("Error", f"No se pudo guardar el perfil:\n{e}")
+
+    # --------- Plantilla compilada por receptor ----------
+    def guardar_plantilla_receptor(self):
+        if not self.xsd_path or not self.cfdi_tree or not self.model:
+            messagebox.showinfo("Falta info", "Carga CFDI y XSD y llena el formulario primero.")
+            return
+        if not self._validate_required_ui():
+            return
+        ns_cfg = {"prefix": self.ns_prefix_var.get().strip() or "cli",
+                  "uri": (self.ns_uri_var.get().strip() or self.xsd_ns_uri)}
+        try:
+            perfil = armar_perfil(self._collect_instances(), self.xsd_path, ns_cfg,
+                                  root_element_name=self.root_elem_name.get().strip() or None,
+                                  ctx=self._cfdi_ctx, rules=self._auto_rules,
+                                  por_concepto=self.por_concepto_var.get())
+            pl = compilar_plantilla(perfil, self._cfdi_ctx, self._auto_rules, self.shapes,
+                                    self.shape_types, ns_cfg)
+            path = guardar_plantilla(pl)
+            messagebox.showinfo("Plantilla", f"Plantilla para {pl['rfc']} guardada en:\n{path}")
+        except Exception as e:
+            messagebox.showerror("Error", f"No se pudo compilar la plantilla:\n{e}")
+
+    def aplicar_plantilla_receptor(self):
+        """Addenda del CFDI abierto desde la plantilla de su receptor, sin usar el formulario."""
+        if not self.cfdi_tree:
+            messagebox.showinfo("Sin CFDI", "Primero abre un CFDI XML.")
+            return
+        rfc = self._cfdi_ctx.get("receptor_rfc") or ""
+        pl = cargar_plantilla(rfc)
+        if pl is None:
+            messagebox.showinfo("Sin plantilla", f"No hay plantilla guardada para el receptor {rfc or '(sin RFC)'}.")
+            return
+        try:
+            root = self.cfdi_tree.getroot()
+            tabla = extraer_tabla_conceptos(root)
+            ser = serializador_plantilla(pl, self._cfdi_ctx, tabla, previa=self._addenda_previa())
+            raiz = raiz_de_serializador(ser)
+        except Exception as e:
+            messagebox.showerror("Error", f"No se pudo aplicar la plantilla:\n{e}")
+            return
+        self._guardar_async(raiz, ser, pl["xsd"], pl["ns"]["uri"])
+
     # --------- Addenda desde XML: PREFILL ----------
+    def _aplicar_prefill(self, info):
+        """Prefill con el índice de la UI; si 'hasta' > índice, llena n..m de una vez."""
+        if not self.model:
+            return 0, ""
+        n = max(1, int(self.prefill_index_var.get() or 1))
+        m = int(self.prefill_hasta_var.get() or 0)
+        if m <= n:
+            return self.model.prefill(info, n), str(n)
+        antes = len(self.model.slots)
+        count = self.model.prefill_rango(info, n, m)
+        if len(self.model.slots) != antes:
+            self._render_modelo()
+        return count, f"{n}..{m}"
+
     def prefill_addenda_desde_xml(self):
         path = filedialog.askopenfilename(title="Seleccionar XML de Addenda (o CFDI con Addenda)",
                                           filetypes=[("XML", "*.xml"), ("Todos", "*.*")])
         if not path:
             return
         try:
-            info = parse_addenda_xml_values(path)
+            info = parse_addenda_xml_values(path, _elegir_hijo_addenda)
             if not info:
                 messagebox.showinfo("Sin datos", "No se encontraron valores simples en la Addenda.")
                 return
@@ -1244,45 +1144,10 @@ class AddendaApp:
                     ):
                         self.ns_uri_var.set(ns_from_xml)
 
-            # Prefill: por ruta exacta o por nombre, con índice n
-            count = 0
-            n = max(1, int(self.prefill_index_var.get() or 1))
-            for ent, kind, owner in self._entry_widgets:
-                if ent.get().strip():
-                    continue
-                meta = getattr(ent, "_field_meta", {})
-                owner_local = owner
-                owner_path  = meta.get("owner_path") or owner_local
-
-                if kind == "attr":
-                    attr_local = (meta.get("name") or "").lower()
-                    key_path = ("attr", owner_local, attr_local, owner_path)
-                    key_name = None
-                    for k in vals.keys():
-                        if len(k)==4 and k[0]=="attr" and k[1]==owner_local and k[2]==attr_local:
-                            key_name = k; break
-                    picked = None
-                    if key_path in vals and vals[key_path]:
-                        picked = _pick_n(vals[key_path], n)
-                    elif key_name and vals.get(key_name):
-                        picked = _pick_n(vals[key_name], n)
-                    if picked:
-                        ent.insert(0, picked); count += 1
-                else:  # text
-                    key_path = ("text", owner_local, "#text", owner_path)
-                    key_name = None
-                    for k in vals.keys():
-                        if len(k)==4 and k[0]=="text" and k[1]==owner_local:
-                            key_name = k; break
-                    picked = None
-                    if key_path in vals and vals[key_path]:
-                        picked = _pick_n(vals[key_path], n)
-                    elif key_name and vals.get(key_name):
-                        picked = _pick_n(vals[key_name], n)
-                    if picked:
-                        ent.insert(0, picked); count += 1
-
-            messagebox.showinfo("Prefill", f"Índice usado: #{self.prefill_index_var.get()} • Campos llenados: {count}")
+            # Prefill: por ruta exacta o por nombre, con índice n (o rango n..m)
+            count, rango = self._aplicar_prefill(info)
+
+            messagebox.showinfo("Prefill", f"Índice usado: #{rango} • Campos llenados: {count}")
 
             # Ofrecer cargar XSD si trae schemaLocation
             scl = info.get("schemaLocation")
@@ -1290,15 +1155,13 @@ class AddendaApp:
                 partes = scl.split()
                 url = partes[1] if len(partes) >= 2 else None
                 if url:
+                    local = buscar_xsd_registro(info.get("ns_uri") or "", ubicacion=url)
                     if messagebox.askyesno(
                         "XSD detectado",
-                        f"Se detectó schemaLocation en la Addenda:\n{url}\n\n¿Cargar ese XSD ahora?"
+                        f"Se detectó schemaLocation en la Addenda:\n{url}\n"
+                        + (f"(copia local: {local})\n" if local else "") + "\n¿Cargar ese XSD ahora?"
                     ):
-                        try:
-                            local = cargar_xsd_desde_fuente(url)
-                            self._post_carga_xsd(local)
-                        except Exception as e:
-                            messagebox.showerror("Error al cargar XSD", str(e))
+                        self._cargar_xsd_async(local or url)
         except Exception as e:
             messagebox.showerror("Error", f"No se pudo leer la Addenda desde el XML:\n{e}")
 
@@ -1312,9 +1175,9 @@ class AddendaApp:
         if not path:
             return
         try:
-            tree = ET.parse(path)
+            tree = addendas.XML.parse(path)
             r = tree.getroot()
-            if _localname(r.tag).lower() == "comprobante":
+            if localname(r.tag).lower() == "comprobante":
                 base = _elegir_hijo_addenda(r)
                 if base is None:
                     messagebox.showinfo("Sin Addenda", "El XML seleccionado no contiene Addenda.")
@@ -1324,28 +1187,16 @@ class AddendaApp:
                 insert_me = r
 
             ns_uri = insert_me.tag.split('}')[0][1:] if isinstance(insert_me.tag, str) and insert_me.tag.startswith("{") else ""
-            root_cfdi = self.cfdi_tree.getroot()
-            addenda = root_cfdi.find(CFDI + "Addenda")
-            if addenda is None:
-                addenda = ET.SubElement(root_cfdi, CFDI + "Addenda")
-
-            # elimina del mismo namespace para no duplicar vendor
-            to_remove = []
-            for ch in list(addenda):
-                if ns_uri and isinstance(ch.tag, str) and ch.tag.startswith("{"+ns_uri+"}"):
-                    to_remove.append(ch)
-            for ch in to_remove:
-                addenda.remove(ch)
-
-            def _deep_copy(elem):
-                new = ET.Element(elem.tag, attrib=dict(elem.attrib))
-                new.text = elem.text
-                new.tail = elem.tail
-                for c in list(elem):
-                    new.append(_deep_copy(c))
-                return new
-
-            addenda.append(_deep_copy(insert_me))
+            # overlay: la Addenda previa sin los nodos del mismo namespace (para no
+            # duplicar vendor) más la nueva; el CFDI cargado no se toca
+            addenda = addendas.XML.Element(CFDI + "Addenda")
+            previa = self._addenda_previa()
+            if previa is not None:
+                addenda.extend(addendas.XML.prestar(
+                    ch for ch in previa
+                    if not (ns_uri and isinstance(ch.tag, str) and ch.tag.startswith("{" + ns_uri + "}"))))
+            addenda.append(addendas.XML.copiar(insert_me))
+            self._addenda_adjunta = addenda
 
             if ns_uri:
                 if not self.ns_uri_var.get().strip():
@@ -1359,64 +1210,182 @@ class AddendaApp:
                     ):
                         self.ns_uri_var.set(ns_uri)
 
-            if self.xsd_path:
-                ok, errs = validate_addenda_subtree_with_xsd(root_cfdi, self.xsd_path, ns_uri=self.ns_uri_var.get().strip())
+            def prefill():
+                # Prefill inmediato desde ese XML (usando el índice)
+                try:
+                    info = parse_addenda_xml_values(path, _elegir_hijo_addenda)
+                    count, rango = self._aplicar_prefill(info) if info.get("values") else (0, "")
+                    if count:
+                        messagebox.showinfo("Prefill", f"Índice usado: #{rango} • Campos llenados: {count}")
+                except Exception:
+                    pass
+
+            def listo(res):
+                ok, errs = res
                 if ok:
                     messagebox.showinfo("Addenda", "Se adjuntó y validó contra el XSD. Todo bien.")
                 else:
                     messagebox.showerror("Validación XSD", f"Adjuntada, pero NO valida:\n{errs}")
+                prefill()
+
+            if self.xsd_path:
+                raiz = raiz_con_addenda(addendas.XML.copiar(addenda), self.cfdi_tree.getroot().tag)
+                self._validar_async(raiz, self.ns_uri_var.get().strip(), listo)
             else:
                 messagebox.showinfo("Addenda", "Adjuntada al CFDI. Puedes cargar el XSD para validarla.")
-
-            # Prefill inmediato desde ese XML (usando el índice)
-            try:
-                info = parse_addenda_xml_values(path)
-                vals = info.get("values", {})
-                n = max(1, int(self.prefill_index_var.get() or 1))
-                count = 0
-                for ent, kind, owner in self._entry_widgets:
-                    if ent.get().strip(): 
-                        continue
-                    meta = getattr(ent, "_field_meta", {})
-                    owner_local = owner
-                    owner_path  = meta.get("owner_path") or owner_local
-                    if kind == "attr":
-                        attr_local = (meta.get("name") or "").lower()
-                        key_path = ("attr", owner_local, attr_local, owner_path)
-                        key_name = None
-                        for k in vals.keys():
-                            if len(k)==4 and k[0]=="attr" and k[1]==owner_local and k[2]==attr_local:
-                                key_name = k; break
-                        picked = None
-                        if key_path in vals and vals[key_path]:
-                            picked = _pick_n(vals[key_path], n)
-                        elif key_name and vals.get(key_name):
-                            picked = _pick_n(vals[key_name], n)
-                        if picked:
-                            ent.insert(0, picked); count += 1
-                    else:
-                        key_path = ("text", owner_local, "#text", owner_path)
-                        key_name = None
-                        for k in vals.keys():
-                            if len(k)==4 and k[0]=="text" and k[1]==owner_local:
-                                key_name = k; break
-                        picked = None
-                        if key_path in vals and vals[key_path]:
-                            picked = _pick_n(vals[key_path], n)
-                        elif key_name and vals.get(key_name):
-                            picked = _pick_n(vals[key_name], n)
-                        if picked:
-                            ent.insert(0, picked); count += 1
-                if count:
-                    messagebox.showinfo("Prefill", f"Índice usado: #{self.prefill_index_var.get()} • Campos llenados: {count}")
-            except Exception:
-                pass
+                prefill()
 
         except Exception as e:
             messagebox.showerror("Error", f"No se pudo adjuntar la Addenda desde el XML:\n{e}")
 
+def _cli(argv):
+    ap = argparse.ArgumentParser(prog="main.py", description="Addendados Universal (modo línea de comandos)")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    lote = sub.add_parser("lote", help="Aplica una addenda a todos los CFDI de una carpeta o patrón")
+    lote.add_argument("entrada", help="Carpeta con CFDI o patrón glob (ej. 'timbrados/**/*.xml')")
+    lote.add_argument("--perfil", required=True, help="Perfil de campos guardado desde la UI (.json)")
+    lote.add_argument("--xsd", help="XSD (ruta o URL); por defecto el del perfil")
+    lote.add_argument("--salida", required=True, help="Carpeta donde se escriben los *_con_addenda.xml")
+    lote.add_argument("--reporte", help="CSV de resultados (default: <salida>/reporte_lote.csv)")
+    lote.add_argument("--procesos", type=int, default=None, help="Workers del pool (default: núm. de CPUs)")
+    lote.add_argument("--xml", choices=["auto", "lxml", "etree"], default=None,
+                      help="Backend XML (default: $ADDENDAS_XML o lxml si está instalado)")
+    lote.add_argument("--plantillas", action="store_true",
+                      help="Usa la plantilla compilada del RFC receptor cuando exista (si no, el perfil)")
+    lote.add_argument("--completo", action="store_true",
+                      help="Valida además el CFDI completo (cfdv40, complementos, addenda) con el paquete local")
+
+    paq = sub.add_parser("paquete", help="Muestra (o amplía) el paquete local de esquemas para validar el CFDI completo")
+    paq.add_argument("--registrar", nargs="+", metavar="XSD", help="XSD de addenda a registrar")
+    paq.add_argument("--validar", nargs="+", metavar="CFDI", help="CFDI a validar completos contra el paquete")
+
+    srv = sub.add_parser("servicio", help="Servicio HTTP local: contexto, addenda, validar y adjuntar por POST")
+    srv.add_argument("--perfil", required=True, action="append",
+                     help="Perfil .json (repetible; el primero es el default, ?perfil=<nombre> elige otro)")
+    srv.add_argument("--host", default="127.0.0.1")
+    srv.add_argument("--puerto", type=int, default=8765)
+    srv.add_argument("--hilos", type=int, default=None, help="Peticiones trabajando a la vez (default: CPUs+2, máx. 8)")
+    srv.add_argument("--cola", type=int, default=None, help="Peticiones en curso antes de responder 503")
+    srv.add_argument("--plantillas", action="store_true", help="Usa la plantilla del RFC receptor cuando exista")
+    srv.add_argument("--completo", action="store_true", help="Valida también el CFDI completo al adjuntar/validar")
+    srv.add_argument("--xml", choices=["auto", "lxml", "etree"], default=None, help="Backend XML")
+
+    val = sub.add_parser("validar", help="Valida la addenda de todos los *_con_addenda.xml de una carpeta")
+    val.add_argument("entrada", help="Carpeta (se recorre completa) o patrón glob")
+    val.add_argument("--xsd", nargs="+", default=None,
+                     help="XSD (ruta o URL) a usar por su namespace; los demás salen del paquete y la biblioteca")
+    val.add_argument("--ns", default=None, help="Namespace del hijo de la Addenda a validar cuando hay varios")
+    val.add_argument("--patron", default="*_con_addenda.xml", help="Archivos a tomar de la carpeta (default: %(default)s)")
+    val.add_argument("--reporte", help="CSV o .json de resultados (default: <entrada>/reporte_validacion.csv)")
+    val.add_argument("--procesos", type=int, default=None, help="Workers del pool (default: núm. de CPUs)")
+    val.add_argument("--completo", action="store_true", help="Valida además el CFDI completo con el paquete local")
+
+    reg = sub.add_parser("registro", help="Indexa la biblioteca de XSD (namespace, raíces, huella) y busca en ella")
+    reg.add_argument("--carpeta", default=None, help=f"Carpeta de XSD (default: $ADDENDAS_XSD_DIR o {XSD_BIBLIOTECA_DIR})")
+    reg.add_argument("--buscar", nargs="+", metavar="NS_O_URL",
+                     help="Namespace o schemaLocation a resolver (NS#raiz para fijar el elemento raíz)")
+
+    vig = sub.add_parser("vigilar", help="Vigila una carpeta y adjunta la addenda del cliente (por RFC receptor) a cada CFDI nuevo")
+    vig.add_argument("entrada", help="Carpeta donde caen los CFDI timbrados")
+    vig.add_argument("--salida", required=True, help="Carpeta donde se escriben los *_con_addenda.xml")
+    vig.add_argument("--perfil", help="Perfil para receptores sin perfil ni plantilla propios")
+    vig.add_argument("--cliente", action="append", default=[], metavar="RFC=PERFIL",
+                     help="Perfil de un receptor (repetible; se suma a --clientes)")
+    vig.add_argument("--clientes", default=CLIENTES_PATH, help="JSON {RFC: perfil.json} (default: %(default)s)")
+    vig.add_argument("--plantillas", action="store_true", help="Usa primero la plantilla compilada del RFC receptor")
+    vig.add_argument("--completo", action="store_true", help="Valida además el CFDI completo con el paquete local")
+    vig.add_argument("--hilos", type=int, default=None, help="Peticiones trabajando a la vez (default: CPUs+2, máx. 8)")
+    vig.add_argument("--intervalo", type=float, default=VIGILAR_INTERVALO, help="Segundos entre fotos de la carpeta")
+    vig.add_argument("--asentamiento", type=float, default=VIGILAR_ASENTAMIENTO,
+                     help="Segundos sin cambios antes de tomar un archivo")
+    vig.add_argument("--una-vez", action="store_true", help="Procesa lo pendiente y termina (p. ej. desde cron)")
+    vig.add_argument("--xml", choices=["auto", "lxml", "etree"], default=None, help="Backend XML")
+
+    ctxp = sub.add_parser("contexto", help="Imprime (JSON) el contexto de uno o más CFDI sin cargarlos completos")
+    ctxp.add_argument("archivos", nargs="+", help="CFDI XML")
+
+    args = ap.parse_args(argv)
+    if args.cmd == "contexto":
+        for p in args.archivos:
+            print(json.dumps({"archivo": p, "ctx": extract_cfdi_context_stream(p)}, ensure_ascii=False))
+        return 0
+    if args.cmd == "paquete":
+        for x in args.registrar or []:
+            print(f"registrado {registrar_xsd_paquete(cargar_xsd_desde_fuente(x)) or '(sin namespace)'}: {x}")
+        regs = paquete_registrados()
+        biblioteca = set(registro_xsd()["por_ns"]) - {""}
+        for ns in list(PAQUETE_SAT) + sorted((set(regs) | biblioteca) - set(PAQUETE_SAT)):
+            print(f"{ns or '(sin namespace)'}\t{ubicar_xsd_paquete(ns, registrados=regs) or '-- sin copia local --'}")
+        fallas = 0
+        for p in args.validar or []:
+            ok, msg = validar_cfdi_completo(p)
+            fallas += ok is not True
+            print(f"{p}: {msg}" if "\n" not in msg else f"{p}:\n  " + msg.replace("\n", "\n  "))
+        return 1 if fallas else 0
+    if args.cmd == "validar":
+        try:
+            _, resumen = validar_lote_addendas(args.entrada, xsds=args.xsd, ns=args.ns, procesos=args.procesos,
+                                               reporte=args.reporte, completo=args.completo, patron=args.patron)
+        except RuntimeError as e:
+            print(e, file=sys.stderr)
+            return 2
+        return 0 if resumen["validos"] == resumen["archivos"] else 1
+    if args.cmd == "registro":
+        t0 = time.perf_counter()
+        res = indexar_biblioteca_xsd(args.carpeta)
+        print(f"{res['total']} XSD • nuevos={res['nuevos']} actualizados={res['actualizados']} "
+              f"borrados={res['borrados']} ilegibles={res['ilegibles']} • {time.perf_counter() - t0:.3f}s")
+        reg = registro_xsd(args.carpeta)
+        if not args.buscar:
+            for ns in sorted(reg["por_ns"]):
+                raices = sorted(r for (n, r) in reg["por_raiz"] if n == ns)
+                print(f"{ns or '(sin namespace)'}\t{', '.join(raices) or '-'}\t{reg['por_ns'][ns][0]}")
+            return 0
+        faltan = 0
+        for b in args.buscar:
+            # los namespaces suelen ser URLs: primero como namespace, luego como schemaLocation
+            ns, _, raiz = b.partition("#")
+            p = (buscar_xsd_registro(ns, raiz or None, carpeta=args.carpeta)
+                 or buscar_xsd_registro(ubicacion=b, carpeta=args.carpeta))
+            faltan += p is None
+            print(f"{b}\t{p or '-- no está en la biblioteca --'}")
+        return 1 if faltan else 0
+    if args.cmd == "vigilar":
+        clientes = cargar_clientes(args.clientes)
+        for c in args.cliente:
+            rfc, _, perfil = c.partition("=")
+            if not perfil:
+                ap.error(f"--cliente espera RFC=PERFIL: {c}")
+            clientes[rfc.strip().upper()] = perfil
+        res = vigilar_carpeta(args.entrada, args.salida, clientes=clientes, perfil=args.perfil,
+                              plantillas=args.plantillas, completo=args.completo, hilos=args.hilos,
+                              intervalo=args.intervalo, asentamiento=args.asentamiento,
+                              una_vez=args.una_vez, backend=args.xml)
+        return 0 if res["errores"] == 0 and res["invalidos"] == 0 else 1
+    if args.cmd == "servicio":
+        server = iniciar_servicio(args.perfil, host=args.host, puerto=args.puerto, hilos=args.hilos,
+                                  cola=args.cola, plantillas=args.plantillas, completo=args.completo,
+                                  backend=args.xml)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            _SERVICIO["pool"].shutdown(wait=True)
+        return 0
+    if args.cmd == "lote":
+        _, resumen = procesar_lote(args.entrada, args.perfil, args.salida, xsd_path=args.xsd,
+                                   reporte=args.reporte, procesos=args.procesos, backend=args.xml,
+                                   completo=args.completo, plantillas=args.plantillas)
+        return 0 if resumen["errores"] == 0 and resumen["invalidos"] == 0 else 1
+    return 2
+
 # ================== Main ===========================
 def main():
+    if len(sys.argv) > 1:
+        sys.exit(_cli(sys.argv[1:]))
     root = tk.Tk()
     app = AddendaApp(root)
     root.mainloop()
@@ -0,0 +1,220 @@
+# servicio.py
+# Servicio HTTP local (contexto, addenda, adjuntar, validar).
+import os
+import glob
+import io
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import urllib.parse
+
+import addendas
+from addendas import (
+    cargar_perfil, cargar_plantilla, cargar_xsd_desde_fuente, carpeta_plantillas,
+    cfdi_con_addenda_bytes, elegir_hijo_addenda_auto, extract_cfdi_context_stream, HAS_LXML,
+    hijos_addenda, leer_addenda_cfdi, ns_de, obtener_schema, paquete_registrados,
+    registrar_xsd_paquete, schema_cache_stats, serializar_addenda, usar_backend_xml,
+    validar_cfdi_completo, validate_addenda_subtree_with_xsd)
+from lote import armar_addenda_cfdi, preparar_perfil, SinPerfil, validar_addenda_armada
+from biblioteca_xsd import buscar_xsd_registro
+
+# ============== Servicio HTTP local =====================
+# Proceso de larga vida para el ERP: perfiles, reglas, shapes, esquemas y
+# plantillas se cargan una vez y se quedan calientes; cada petición solo
+# extrae el contexto, arma la addenda y valida. Cada petición trabaja en su
+# propio hilo del servidor: a lo más `hilos` a la vez (las demás esperan su
+# turno) y, si ya hay `cola` en curso, se responde 503 en vez de acumular.
+SERVICIO_MAX_BYTES = 32 << 20
+_SERVICIO = {}
+
+def _servicio_perfil(consulta):
+    nombre = (consulta.get("perfil") or [_SERVICIO["default"]])[0]
+    est = _SERVICIO["perfiles"].get(nombre)
+    if est is None:
+        raise SinPerfil(f"Perfil desconocido: {nombre}")
+    return est
+
+def _servicio_flag(consulta, nombre, default):
+    v = consulta.get(nombre)
+    return default if not v else v[0] not in ("0", "no", "false", "")
+
+def _servicio_xsd_por_ns(ns):
+    for est in _SERVICIO["perfiles"].values():
+        if est["ns_cfg"]["uri"] == ns:
+            return est["xsd"]
+    return paquete_registrados().get(ns) or buscar_xsd_registro(ns)
+
+def _servicio_contexto(data, consulta):
+    return 200, extract_cfdi_context_stream(io.BytesIO(data))
+
+def _servicio_armar(data, consulta):
+    arm = armar_addenda_cfdi(_servicio_perfil(consulta), data,
+                             plantillas=_servicio_flag(consulta, "plantillas", _SERVICIO["plantillas"]))
+    ok, errs = validar_addenda_armada(arm) if HAS_LXML else (None, "")
+    return arm, ok, errs
+
+def _servicio_addenda(data, consulta):
+    arm, ok, errs = _servicio_armar(data, consulta)
+    addenda = arm["addenda"]
+    xml = addenda("cfdi", False) if callable(addenda) else serializar_addenda(addenda, "cfdi", False)
+    return 200, {"addenda": xml.decode("utf-8"), "valida": ok, "errores": errs.splitlines() if ok is False else [],
+                 "ns": arm["ns"], "xsd": arm["xsd"], "notas": arm["notas"]}
+
+def _servicio_adjuntar(data, consulta):
+    arm, ok, errs = _servicio_armar(data, consulta)
+    if ok is False:
+        return 422, {"valida": False, "errores": errs.splitlines(), "notas": arm["notas"]}
+    out = cfdi_con_addenda_bytes(data, arm["addenda"])
+    if _servicio_flag(consulta, "completo", _SERVICIO["completo"]):
+        ok, msg = validar_cfdi_completo(out, extra={arm["ns"]: arm["xsd"]})
+        if ok is False:
+            return 422, {"valida": False, "errores": msg.splitlines(), "notas": arm["notas"]}
+    return 200, out
+
+def _servicio_validar(data, consulta):
+    """La addenda que ya trae el CFDI, contra el XSD de su namespace (y el CFDI completo si se pide)."""
+    root = leer_addenda_cfdi(data)
+    ch = elegir_hijo_addenda_auto(hijos_addenda(root), lambda n, _raiz: _servicio_xsd_por_ns(n),
+                                  ns=(consulta.get("ns") or [None])[0])
+    res = {"valida": None, "errores": [], "ns": None, "xsd": None}
+    if ch is None:
+        res.update(valida=False, errores=["No hay elementos dentro de <cfdi:Addenda> para validar."])
+    else:
+        ns = ns_de(ch.tag)
+        xsd = _servicio_xsd_por_ns(ns)
+        res.update(ns=ns, xsd=xsd)
+        if not xsd:
+            res["errores"] = [f"Sin XSD para el namespace {ns or '(sin namespace)'}"]
+        else:
+            ok, errs = validate_addenda_subtree_with_xsd(root, xsd, ns_uri=ns)
+            res.update(valida=ok, errores=[] if ok else errs.splitlines())
+    if _servicio_flag(consulta, "completo", _SERVICIO["completo"]):
+        ok, msg = validar_cfdi_completo(data, extra={res["ns"]: res["xsd"]} if res["xsd"] else None)
+        res["completo"] = {"valido": ok, "mensaje": msg.splitlines()}
+    return 200, res
+
+_SERVICIO_RUTAS = {
+    "/contexto": _servicio_contexto,
+    "/addenda": _servicio_addenda,
+    "/adjuntar": _servicio_adjuntar,
+    "/validar": _servicio_validar,
+}
+
+def servicio_estado() -> dict:
+    with _SERVICIO["lock"]:
+        cont = dict(_SERVICIO["contadores"])
+    atendidas = sum(cont.get(r.strip("/"), 0) for r in _SERVICIO_RUTAS)
+    cont["ms_promedio"] = round(cont.pop("ms_total", 0.0) / atendidas, 2) if atendidas else 0.0
+    seg = time.time() - _SERVICIO["inicio"]
+    return {"perfiles": sorted(_SERVICIO["perfiles"]), "default": _SERVICIO["default"],
+            "hilos": _SERVICIO["hilos"], "cola_max": _SERVICIO["cola_max"], "backend": addendas.XML.nombre,
+            "segundos": round(seg, 1), "peticiones": cont, "schema_cache": schema_cache_stats()}
+
+def _servicio_contar(**inc):
+    with _SERVICIO["lock"]:
+        for k, v in inc.items():
+            _SERVICIO["contadores"][k] = _SERVICIO["contadores"].get(k, 0) + v
+
+class _ServicioHandler(BaseHTTPRequestHandler):
+    server_version = "Addendados/1"
+    protocol_version = "HTTP/1.1"
+
+    def _responder(self, codigo, cuerpo, ms=None):
+        if isinstance(cuerpo, (bytes, bytearray)):
+            data, tipo = bytes(cuerpo), "application/xml; charset=utf-8"
+        else:
+            data, tipo = json.dumps(cuerpo, ensure_ascii=False).encode("utf-8"), "application/json; charset=utf-8"
+        self.send_response(codigo)
+        self.send_header("Content-Type", tipo)
+        self.send_header("Content-Length", str(len(data)))
+        if ms is not None:
+            self.send_header("X-Tiempo-ms", f"{ms:.2f}")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if urllib.parse.urlsplit(self.path).path == "/estado":
+            self._responder(200, servicio_estado())
+        else:
+            self._responder(404, {"error": "Ruta desconocida"})
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        trabajo = _SERVICIO_RUTAS.get(url.path)
+        try:
+            n = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            n = -1
+        if trabajo is None:
+            self.close_connection = True
+            return self._responder(404, {"error": "Ruta desconocida"})
+        if n <= 0 or n > SERVICIO_MAX_BYTES:
+            self.close_connection = True
+            return self._responder(411 if n <= 0 else 413, {"error": "Se espera el CFDI XML en el cuerpo"})
+        data = self.rfile.read(n)
+        if not _SERVICIO["cupo"].acquire(blocking=False):
+            _servicio_contar(rechazadas=1)
+            return self._responder(503, {"error": "Servicio saturado, reintenta"})
+        t0 = time.perf_counter()
+        try:
+            with _SERVICIO["turno"]:
+                codigo, cuerpo = trabajo(data, urllib.parse.parse_qs(url.query))
+        except SinPerfil as e:
+            codigo, cuerpo = 404, {"error": str(e)}
+        except SyntaxError as e:   # ET.ParseError y XMLSyntaxError de lxml
+            codigo, cuerpo = 400, {"error": f"XML mal formado: {e}"}
+        except ValueError as e:
+            codigo, cuerpo = 400, {"error": str(e)}
+        except Exception as e:
+            codigo, cuerpo = 500, {"error": str(e)}
+        finally:
+            _SERVICIO["cupo"].release()
+        ms = (time.perf_counter() - t0) * 1000
+        _servicio_contar(**{url.path.strip("/"): 1, "errores": int(codigo >= 400), "ms_total": ms})
+        self._responder(codigo, cuerpo, ms)
+
+    def log_message(self, fmt, *args):
+        if _SERVICIO.get("log"):
+            _SERVICIO["log"](f"{self.address_string()} {fmt % args}")
+
+def iniciar_servicio(perfiles, host="127.0.0.1", puerto=8765, hilos=None, cola=None,
+                     plantillas=False, completo=False, backend=None, log=print):
+    """
+    Prepara los perfiles (rutas .json; el nombre es el del archivo) y regresa el
+    ThreadingHTTPServer listo para serve_forever(). El primero es el default.
+    """
+    if backend:
+        usar_backend_xml(backend)
+    if not perfiles:
+        raise ValueError("Indica al menos un perfil.")
+    _SERVICIO.clear()
+    _SERVICIO["perfiles"] = {}
+    for path in perfiles:
+        perfil = cargar_perfil(path)
+        xsd = cargar_xsd_desde_fuente(perfil.get("xsd") or "")
+        registrar_xsd_paquete(xsd)
+        est = preparar_perfil(xsd, perfil)
+        # el esquema ya quedó compilado en la caché LRU; sin fijarlo, un XSD editado se recompila solo
+        est["schema"] = None
+        _SERVICIO["perfiles"][os.path.splitext(os.path.basename(path))[0]] = est
+    _SERVICIO["default"] = os.path.splitext(os.path.basename(perfiles[0]))[0]
+    if plantillas:
+        for f in glob.glob(os.path.join(carpeta_plantillas(), "*.json")):
+            pl = cargar_plantilla(os.path.splitext(os.path.basename(f))[0])
+            if pl and HAS_LXML and pl.get("xsd") and os.path.exists(pl["xsd"]):
+                try:
+                    obtener_schema(pl["xsd"])
+                except Exception:
+                    pass
+    hilos = hilos or min(8, (os.cpu_count() or 1) + 2)
+    _SERVICIO.update(hilos=hilos, cola_max=cola or hilos * 4, plantillas=plantillas, completo=completo,
+                     turno=threading.BoundedSemaphore(hilos),
+                     cupo=threading.BoundedSemaphore(cola or hilos * 4), lock=threading.Lock(),
+                     contadores={}, inicio=time.time(), log=log)
+    srv = ThreadingHTTPServer((host, puerto), _ServicioHandler)
+    srv.daemon_threads = True
+    if log:
+        log(f"Servicio en http://{host}:{srv.server_address[1]} • perfiles: {', '.join(sorted(_SERVICIO['perfiles']))} "
+            f"• {hilos} hilos, cola {_SERVICIO['cola_max']}")
+    return srv
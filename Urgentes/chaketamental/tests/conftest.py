@@ -0,0 +1,59 @@
+# conftest.py
+# Cada prueba corre con sus propias carpetas de datos y cachés (nada del usuario ni de la carpeta de trabajo).
+import os
+import shutil
+import sys
+
+import pytest
+
+AQUI = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(AQUI))
+
+import addendas  # noqa: E402
+import biblioteca_xsd  # noqa: E402
+
+DATOS = os.path.join(AQUI, "datos")
+CFDIS = ("C.xml", "M.xml", "P.xml")   # C: una sola línea; M (3 conceptos) y P: con sangría
+
+@pytest.fixture(autouse=True)
+def carpetas_aisladas(tmp_path, monkeypatch):
+    d = tmp_path / "usuario"
+    legado = d / "legado"
+    monkeypatch.setattr(addendas, "XSD_CACHE_DIR", str(d / "xsd_cache"))
+    monkeypatch.setattr(addendas, "XSD_CACHE_LEGACY_DIR", str(d / "xsd_cache" / "legado"))
+    monkeypatch.setattr(addendas, "XSD_CATALOG_PATH", str(d / "datos" / "xsd_catalog.json"))
+    monkeypatch.setattr(addendas, "DATOS_DIR", str(d / "datos"))
+    monkeypatch.setattr(addendas, "LEGADO_DIR", str(legado))
+    monkeypatch.setattr(addendas, "CACHE_PATH", str(legado / "xsd_autofill_cache.json"))
+    monkeypatch.setattr(addendas, "RULES_DB_PATH", str(d / "datos" / "xsd_autofill_rules.db"))
+    monkeypatch.setattr(addendas, "ESTADO_DB_PATH", str(d / "datos" / "addendas_estado.db"))
+    monkeypatch.setattr(addendas, "PAQUETE_XSD_DIR", str(d / "xsd_cache" / "paquete"))
+    monkeypatch.setattr(addendas, "SHAPES_CACHE_DIR", str(d / "shapes"))
+    monkeypatch.setattr(addendas, "PLANTILLAS_DIR", str(d / "datos" / "plantillas_addenda"))
+    monkeypatch.setattr(biblioteca_xsd, "XSD_BIBLIOTECA_DIR", str(d / "datos" / "xsd"))
+    addendas._PLANTILLAS.clear()
+    addendas._XSD_USOS.clear()
+    backend = addendas.XML
+    yield d
+    addendas.XML = backend   # usar_backend_xml lo reasigna
+
+@pytest.fixture
+def datos(tmp_path):
+    """Copia de tests/datos: {"xsd": ruta, "C.xml": ruta, ...}."""
+    dst = tmp_path / "datos"
+    shutil.copytree(DATOS, dst)
+    out = {n: str(dst / n) for n in CFDIS}
+    out["xsd"] = str(dst / "a.xsd")
+    return out
+
+def perfil_prueba(xsd, por_concepto=True) -> dict:
+    """Perfil con constantes que hay que escapar, ligas al ctx, campos vacíos (autollenado) y un nodo por línea."""
+    return {
+        "version": 1, "xsd": xsd, "ns": {"prefix": "a", "uri": ""}, "root_element": None,
+        "por_concepto": por_concepto,
+        "roots": [{"name": "Addenda1", "attributes": {"Version": "1.0"}, "children": [
+            {"name": "Cab", "attributes": {"Pedido": 'P&<"1"\t'}, "children": []},
+            {"name": "Det", "attributes": {"Sku": {"ctx": "concepto1_noid"}, "Cant": ""}, "children": [
+                {"name": "Nota", "attributes": {}, "text": {"ctx": "concepto1_descripcion"}, "children": []}]},
+            {"name": "Det", "attributes": {"Sku": "X"}, "children": []}]}],
+    }
@@ -0,0 +1,167 @@
+# test_autollenado.py
+# El autollenado con _Matcher (una pasada por nombre) decide lo mismo que las cadenas de `in` originales.
+import random
+
+import pytest
+
+import addendas
+from addendas import XSD_KEYWORDS_TO_CFDI
+
+# ---- referencia: las funciones tal como estaban antes de _Matcher ----
+def _guess_original(name, ctx):
+    if not name: return ""
+    n = name.strip().lower()
+
+    direct = {
+        "rfcemisor":"emisor_rfc","emisor_rfc":"emisor_rfc",
+        "rfcreceptor":"receptor_rfc","rfc_receptor":"receptor_rfc",
+        "uuid":"uuid","folio":"folio","serie":"serie",
+        "total":"total","subtotal":"subtotal",
+        "moneda":"moneda","fechatimbrado":"fechatimbrado","fecha":"fecha",
+        "formapago":"formapago","metodopago":"metodopago","tipocambio":"tipocambio",
+        "nocertificado":"nocert","nocertificadosat":"nocertsat",
+        "lugarexpedicion":"lugar","sellosat":"sello_sat","sello":"sello",
+        "nombreemisor":"emisor_nombre","nombrereceptor":"receptor_nombre",
+        "usocfdi":"receptor_uso","domiciliofiscalreceptor":"receptor_domiciliofiscal",
+        "regimenfiscalreceptor":"receptor_regimen","regimenfiscalemisor":"emisor_regimen",
+        "iva":"iva_total","ieps":"ieps_total","otrosimpuestos":"otros_imp",
+        "descripcion":"concepto1_descripcion","cantidad":"concepto1_cantidad",
+        "preciounitario":"concepto1_valorunit","montolinea":"concepto1_importe",
+    }
+    if n in direct:
+        val = ctx.get(direct[n])
+        if val is not None:
+            return val
+
+    def pick(*keys):
+        for k in keys:
+            if ctx.get(k):
+                return ctx[k]
+        return ""
+
+    if "uuid" in n: return pick("uuid")
+    if "emisor" in n and "rfc" in n: return pick("emisor_rfc")
+    if "receptor" in n and "rfc" in n: return pick("receptor_rfc")
+    if "rfc" in n: return pick("receptor_rfc","emisor_rfc")
+    if "folio" in n: return pick("folio")
+    if "serie" in n: return pick("serie")
+    if "subtotal" in n: return pick("subtotal")
+    if "iva" in n: return pick("iva_total")
+    if "ieps" in n: return pick("ieps_total")
+    if "total" in n: return pick("total")
+    if "moneda" in n: return pick("moneda")
+    if "fecha" in n and "timbr" in n: return pick("fechatimbrado")
+    if "fecha" in n: return pick("fecha")
+    if "metodo" in n: return pick("metodopago")
+    if "forma" in n and "pago" in n: return pick("formapago")
+    if "cambio" in n: return pick("tipocambio")
+    if "lug" in n and "exped" in n: return pick("lugar")
+    if "cert" in n and "sat" in n: return pick("nocertsat")
+    if "cert" in n: return pick("nocert")
+    if "sello" in n and "sat" in n: return pick("sello_sat")
+    if "sello" in n: return pick("sello")
+    if "descripcion" in n: return pick("concepto1_descripcion")
+    if "cantidad" in n: return pick("concepto1_cantidad")
+    if "precio" in n and "unit" in n: return pick("concepto1_valorunit")
+    if "monto" in n or "importe" in n: return pick("concepto1_importe")
+    return ""
+
+def _decide_original(name, hint_text):
+    n = (name or "").strip().lower()
+    if not n and not hint_text:
+        return ""
+    name_to_key = {
+        "uuid":"uuid","folio":"folio","serie":"serie","subtotal":"subtotal","total":"total",
+        "moneda":"moneda","fechatimbrado":"fechatimbrado","fecha":"fecha","formapago":"formapago",
+        "metodopago":"metodopago","tipocambio":"tipocambio","lugarexpedicion":"lugar",
+        "nocertificado":"nocert","nocertificadosat":"nocertsat","sellosat":"sello_sat","sello":"sello",
+        "rfcreceptor":"receptor_rfc","rfcemisor":"emisor_rfc"
+    }
+    if n in name_to_key:
+        return name_to_key[n]
+    hay = lambda words: all(w in hint_text for w in words)
+    for keys, cfdi_key in XSD_KEYWORDS_TO_CFDI:
+        if all(k in n for k in keys) or hay(keys):
+            return cfdi_key
+    return ""
+
+# ---- entradas ----
+LLAVES = ["uuid", "emisor_rfc", "receptor_rfc", "folio", "serie", "subtotal", "total", "iva_total",
+          "ieps_total", "otros_imp", "moneda", "fechatimbrado", "fecha", "metodopago", "formapago",
+          "tipocambio", "lugar", "nocertsat", "nocert", "sello_sat", "sello", "emisor_nombre",
+          "receptor_nombre", "receptor_uso", "receptor_domiciliofiscal", "receptor_regimen",
+          "emisor_regimen", "concepto1_descripcion", "concepto1_cantidad", "concepto1_valorunit",
+          "concepto1_importe"]
+TROZOS = sorted({w for ws, _ in addendas.AUTOFILL_REGLAS_NOMBRE for w in ws}
+                | {w for ws, _ in XSD_KEYWORDS_TO_CFDI for w in ws}
+                | set(addendas._AUTOFILL_DIRECTO) | set(addendas._NOMBRE_A_LLAVE)
+                | {"id", "num", "no", "de", "x", "codigo", "proveedor", "pedido", "tienda", "unidad",
+                   "rfce", "serief", "subtota", "fech", "timbrado", "ivaa", "ser", "e"})
+
+def _nombres(n, semilla):
+    rnd = random.Random(semilla)
+    out = [""] + sorted(set(addendas._AUTOFILL_DIRECTO) | set(addendas._NOMBRE_A_LLAVE))
+    for _ in range(n):
+        partes = rnd.sample(TROZOS, rnd.randint(1, 3))
+        s = rnd.choice(["", "_", "-", ".", " "]).join(partes)
+        if rnd.random() < 0.3:
+            s = "".join(c.upper() if rnd.random() < 0.5 else c for c in s)
+        if rnd.random() < 0.1:
+            s = " " + s + " "
+        out.append(s)
+    return out
+
+def _contextos():
+    lleno = {k: f"v_{k}" for k in LLAVES}
+    rnd = random.Random(7)
+    parciales = []
+    for _ in range(12):
+        llaves = rnd.sample(LLAVES, rnd.randint(1, len(LLAVES)))
+        parciales.append({k: rnd.choice([None, "", f"v_{k}"]) for k in llaves})
+    return [lleno, {}, {k: "" for k in LLAVES}, {k: None for k in LLAVES}] + parciales
+
+# ---- pruebas ----
+@pytest.mark.parametrize("palabras", [
+    ["he", "she", "his", "hers"],
+    ["a", "aa", "aaa", "ab", "b"],
+    sorted(TROZOS),
+])
+def test_matcher_igual_que_in(palabras):
+    m = addendas._Matcher(palabras)
+    rnd = random.Random(3)
+    alfabeto = "".join(sorted(set("".join(palabras)))) + "_ "
+    textos = ["", "ushers", "aaaa"] + ["".join(rnd.choice(alfabeto) for _ in range(rnd.randint(0, 40)))
+                                       for _ in range(500)]
+    textos += _nombres(300, 11)
+    for t in textos:
+        esperado = 0
+        for p in palabras:
+            if p in t:
+                esperado |= m.bit[p]
+        assert m.mascara(t) == esperado, t
+        for p in palabras:
+            assert (m.mascara(t) & m.requiere([p]) != 0) == (p in t)
+
+def test_guess_igual_que_el_original():
+    for ctx in _contextos():
+        for nombre in _nombres(3000, 1):
+            esperado = _guess_original(nombre, ctx)
+            assert addendas.guess_autofill_value_by_name(nombre, ctx) == esperado, (nombre, ctx)
+
+def test_llave_da_el_mismo_valor():
+    for ctx in _contextos():
+        for nombre in _nombres(500, 2):
+            k = addendas.guess_autofill_key_by_name(nombre, ctx)
+            assert ((ctx.get(k) or "") if k else "") == (_guess_original(nombre, ctx) or ""), nombre
+
+def test_decide_igual_que_el_original():
+    rnd = random.Random(5)
+    frases = sorted({w for ws, _ in XSD_KEYWORDS_TO_CFDI for w in ws})
+    hints = ["", "sin pistas", "impuesto al valor agregado", "fecha timbrado del cfdi"]
+    for _ in range(300):
+        hints.append(" ".join(rnd.sample(frases, rnd.randint(1, 4))))
+    nombres = _nombres(600, 9)
+    for h in hints:
+        for nombre in nombres:
+            esperado = _decide_original(nombre, h)
+            assert addendas._decide_cfdi_key_by_name_and_hints(nombre, h) == esperado, (nombre, h)
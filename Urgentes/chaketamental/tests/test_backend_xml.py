@@ -0,0 +1,46 @@
+# test_backend_xml.py
+# Con ET o con lxml la Addenda y el CFDI que se escriben son los mismos bytes.
+import os
+
+import pytest
+
+import addendas
+import lote
+from conftest import CFDIS, perfil_prueba
+
+pytestmark = pytest.mark.skipif(not addendas.HAS_LXML, reason="sin lxml")
+
+def _leer(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def _procesar(datos, tmp_path, backend, por_concepto, completo):
+    addendas.usar_backend_xml(backend)
+    perfil = perfil_prueba(datos["xsd"], por_concepto)
+    est = lote.preparar_perfil(datos["xsd"], perfil)
+    salida = str(tmp_path / f"{backend}_{por_concepto}_{completo}")
+    os.makedirs(salida)
+    out = {}
+    for n in CFDIS:
+        fila = lote.procesar_cfdi(datos[n], est, salida, completo=completo)
+        assert fila["estado"] == "ok", fila["mensaje"]
+        out[n] = _leer(fila["salida"])
+    return out
+
+@pytest.mark.parametrize("por_concepto", [True, False])
+@pytest.mark.parametrize("completo", [False, True])
+def test_lote_mismos_bytes(datos, tmp_path, por_concepto, completo):
+    et = _procesar(datos, tmp_path, "etree", por_concepto, completo)
+    lx = _procesar(datos, tmp_path, "lxml", por_concepto, completo)
+    assert et == lx
+
+@pytest.mark.parametrize("n", CFDIS)
+def test_serializar_addenda(datos, n):
+    perfil = perfil_prueba(datos["xsd"])
+    out = {}
+    for backend in ("etree", "lxml"):
+        addendas.usar_backend_xml(backend)
+        est = lote.preparar_perfil(datos["xsd"], perfil)
+        arm = lote.armar_addenda_cfdi(est, datos[n])
+        out[backend] = [addendas.serializar_addenda(arm["addenda"], "cfdi", bonito) for bonito in (True, False)]
+    assert out["etree"] == out["lxml"]
@@ -0,0 +1,83 @@
+# test_biblioteca_xsd.py
+# Registro de la biblioteca de XSD: índices por namespace, raíz, nombre y huella; reindexado por size/mtime y TTL.
+import os
+
+import pytest
+
+import addendas
+import biblioteca_xsd
+
+ESQ = '<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema" targetNamespace="{ns}">{cuerpo}</xs:schema>'
+
+def _xsd(carpeta, nombre, ns, cuerpo=""):
+    p = os.path.join(carpeta, nombre)
+    os.makedirs(os.path.dirname(p), exist_ok=True)
+    with open(p, "w", encoding="utf-8") as f:
+        f.write(ESQ.format(ns=ns, cuerpo=cuerpo))
+    return p
+
+@pytest.fixture
+def biblioteca():
+    carpeta = biblioteca_xsd.XSD_BIBLIOTECA_DIR
+    rutas = {
+        # el de puros tipos va primero en orden alfabético, pero "el" XSD del namespace es el que declara elementos
+        "tipos": _xsd(carpeta, "a_tipos.xsd", "urn:a", '<xs:simpleType name="T"/>'),
+        "a": _xsd(carpeta, "b.xsd", "urn:a", '<xs:element name="Addenda1"/><xs:element name="Otra"/>'),
+        "c": _xsd(carpeta, "sub/c.xsd", "urn:c", '<xs:element name="Raiz"/>'),
+    }
+    with open(os.path.join(carpeta, "roto.xsd"), "w", encoding="utf-8") as f:
+        f.write("<xs:schema")
+    with open(os.path.join(carpeta, "leeme.txt"), "w", encoding="utf-8") as f:
+        f.write("no es XSD")
+    return carpeta, rutas
+
+def test_indices(biblioteca):
+    carpeta, r = biblioteca
+    res = biblioteca_xsd.indexar_biblioteca_xsd()
+    assert res == {"total": 4, "nuevos": 4, "actualizados": 0, "borrados": 0, "ilegibles": 1}
+    reg = biblioteca_xsd.registro_xsd()
+    assert reg["por_ns"] == {"urn:a": [r["a"], r["tipos"]], "urn:c": [r["c"]]}
+    assert reg["por_raiz"] == {("urn:a", "Addenda1"): r["a"], ("urn:a", "Otra"): r["a"], ("urn:c", "Raiz"): r["c"]}
+    assert reg["por_huella"][addendas.xsd_fingerprint(r["c"])] == r["c"]
+    assert reg["por_nombre"]["c.xsd"] == r["c"]
+    assert biblioteca_xsd.cabecera_xsd(r["a"]) == ("urn:a", ["Addenda1", "Otra"])
+
+def test_buscar(biblioteca):
+    _carpeta, r = biblioteca
+    buscar = biblioteca_xsd.buscar_xsd_registro
+    assert buscar("urn:a") == r["a"]
+    assert buscar("urn:a", "Otra") == r["a"]
+    assert buscar("urn:c", "NoExiste") == r["c"]
+    assert buscar("urn:x") is None
+    assert buscar(ubicacion="http://ejemplo.mx/xsd/C.XSD") == r["c"]
+    assert buscar("urn:a", ubicacion="http://ejemplo.mx/xsd/c.xsd") == r["a"]   # otro namespace: no cuenta el nombre
+    assert buscar(None, "Raiz") is None
+
+def test_reindexa_solo_lo_que_cambio(biblioteca):
+    carpeta, r = biblioteca
+    biblioteca_xsd.indexar_biblioteca_xsd()
+    assert biblioteca_xsd.indexar_biblioteca_xsd() == \
+        {"total": 4, "nuevos": 0, "actualizados": 0, "borrados": 0, "ilegibles": 0}
+    _xsd(carpeta, "sub/c.xsd", "urn:c2", '<xs:element name="Raiz"/>')
+    os.remove(r["tipos"])
+    res = biblioteca_xsd.indexar_biblioteca_xsd()
+    assert (res["total"], res["actualizados"], res["borrados"]) == (3, 1, 1)
+    reg = biblioteca_xsd.registro_xsd()
+    assert reg["por_ns"] == {"urn:a": [r["a"]], "urn:c2": [r["c"]]}
+    # el registro persiste en la base de estado
+    filas = {f[0]: f for f in addendas.registro_biblioteca_xsd(carpeta)}
+    assert filas[r["c"]][4] == "urn:c2" and r["tipos"] not in filas
+
+def test_revisa_la_carpeta_al_vencer_el_ttl(biblioteca, monkeypatch):
+    carpeta, _r = biblioteca
+    reg = biblioteca_xsd.registro_xsd()
+    assert "urn:d" not in reg["por_ns"]
+    d = _xsd(carpeta, "d.xsd", "urn:d", '<xs:element name="D"/>')
+    assert "urn:d" not in biblioteca_xsd.registro_xsd()["por_ns"]     # dentro del TTL: ni un stat
+    monkeypatch.setitem(biblioteca_xsd._REGISTRO_XSD, "revisado",
+                        biblioteca_xsd._REGISTRO_XSD["revisado"] - biblioteca_xsd.REGISTRO_XSD_TTL)
+    assert biblioteca_xsd.registro_xsd()["por_ns"]["urn:d"] == [d]
+
+def test_sin_carpeta(tmp_path):
+    reg = biblioteca_xsd.registro_xsd(str(tmp_path / "no_existe"))
+    assert reg["por_ns"] == {} and biblioteca_xsd.buscar_xsd_registro("urn:a") is None
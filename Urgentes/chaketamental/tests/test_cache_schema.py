@@ -0,0 +1,83 @@
+# test_cache_schema.py
+# Caché LRU de esquemas compilados: llave = huella del grafo, se recompila si cambia el contenido.
+import pytest
+
+import addendas
+
+pytestmark = pytest.mark.skipif(not addendas.HAS_LXML, reason="sin lxml")
+
+XSD = """<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema" targetNamespace="urn:s{n}" xmlns="urn:s{n}"
+ elementFormDefault="qualified"><xs:element name="R"><xs:complexType>
+ <xs:attribute name="A" use="{uso}"/></xs:complexType></xs:element></xs:schema>"""
+
+@pytest.fixture(autouse=True)
+def cache_vacia():
+    addendas.invalidar_schema()
+    yield
+    addendas.invalidar_schema()
+
+def _xsd(tmp_path, n, uso="optional"):
+    p = tmp_path / f"s{n}.xsd"
+    p.write_text(XSD.format(n=n, uso=uso), encoding="utf-8")
+    return str(p)
+
+def _delta(antes):
+    ahora = addendas.schema_cache_stats()
+    return {k: ahora[k] - antes[k] for k in ("hits", "misses", "evictions")}
+
+def _valida(schema, n):
+    return schema.validate(addendas.LET.fromstring(f'<R xmlns="urn:s{n}"/>'))
+
+def test_acierto_y_fallo(tmp_path):
+    xsd = _xsd(tmp_path, 1)
+    antes = addendas.schema_cache_stats()
+    s1 = addendas.obtener_schema(xsd)
+    s2 = addendas.obtener_schema(xsd)
+    assert s1 is s2
+    assert _delta(antes) == {"hits": 1, "misses": 1, "evictions": 0}
+    assert addendas.schema_cache_stats()["size"] == 1
+
+def test_desalojo_lru(tmp_path, monkeypatch):
+    monkeypatch.setattr(addendas, "SCHEMA_CACHE_MAX", 2)
+    x1, x2, x3 = (_xsd(tmp_path, n) for n in (1, 2, 3))
+    s1 = addendas.obtener_schema(x1)
+    addendas.obtener_schema(x2)
+    addendas.obtener_schema(x1)          # x1 pasa a ser el más reciente
+    antes = addendas.schema_cache_stats()
+    addendas.obtener_schema(x3)          # sale x2
+    assert _delta(antes) == {"hits": 0, "misses": 1, "evictions": 1}
+    antes = addendas.schema_cache_stats()
+    assert addendas.obtener_schema(x1) is s1
+    addendas.obtener_schema(x2)
+    assert _delta(antes) == {"hits": 1, "misses": 1, "evictions": 1}
+    assert addendas.schema_cache_stats()["size"] == 2
+
+def test_invalidar(tmp_path):
+    x1, x2 = _xsd(tmp_path, 1), _xsd(tmp_path, 2)
+    s1, s2 = addendas.obtener_schema(x1), addendas.obtener_schema(x2)
+    addendas.invalidar_schema(x1)
+    assert addendas.schema_cache_stats()["size"] == 1
+    assert addendas.obtener_schema(x1) is not s1
+    assert addendas.obtener_schema(x2) is s2
+    addendas.invalidar_schema()
+    assert addendas.schema_cache_stats()["size"] == 0
+
+def test_recompila_si_cambia_el_contenido(tmp_path):
+    xsd = _xsd(tmp_path, 1)
+    s1 = addendas.obtener_schema(xsd)
+    assert _valida(s1, 1)
+    _xsd(tmp_path, 1, uso="required")    # misma ruta, otro contenido (y otro tamaño)
+    s2 = addendas.obtener_schema(xsd)
+    assert s2 is not s1
+    assert not _valida(s2, 1)
+
+def test_xsd_mal_formado_no_se_recupera(tmp_path):
+    # sin recover: un XSD truncado es un error, no un esquema a medias
+    p = tmp_path / "roto.xsd"
+    p.write_text(XSD.format(n=9, uso="optional")[:-20], encoding="utf-8")
+    with pytest.raises(addendas.LET.XMLSyntaxError):
+        addendas.compilar_xsd(str(p))
+    raiz = addendas.XML.fromstring(f'<cfdi:Comprobante xmlns:cfdi="{addendas.CFDI_NS}"><cfdi:Addenda>'
+                                   f'<R xmlns="urn:s9"/></cfdi:Addenda></cfdi:Comprobante>')
+    ok, msg = addendas.validate_addenda_subtree_with_xsd(raiz, str(p), "urn:s9")
+    assert not ok and msg.startswith("XSD inválido")
@@ -0,0 +1,77 @@
+# test_cache_shapes.py
+# Caché de shapes en disco: un JSON por huella, no reparsea si el XSD no cambió, invalida por contenido y versión.
+import json
+import os
+
+import pytest
+
+import addendas
+
+def _no_parsear(*a, **kw):
+    raise AssertionError("no debía parsear el XSD")
+
+def _nombres(shapes):
+    return [(s["name"], [c["name"] for c in s["children"]]) for s in shapes]
+
+def test_escribe_por_huella_y_reusa(datos, monkeypatch):
+    shapes, tipos = addendas.parse_xsd_cached(datos["xsd"])
+    fp = addendas.xsd_fingerprint_grafo(datos["xsd"])
+    assert os.listdir(addendas.SHAPES_CACHE_DIR) == [f"{fp}.json"]
+    with open(os.path.join(addendas.SHAPES_CACHE_DIR, f"{fp}.json"), encoding="utf-8") as f:
+        data = json.load(f)
+    assert (data["version"], data["fingerprint"], data["target_ns"]) == (addendas.SHAPES_CACHE_VERSION, fp, "urn:a")
+    assert set(data["shapes"]) == {"*"}
+
+    monkeypatch.setattr(addendas, "parse_xsd_shapes", _no_parsear)
+    otra, _ = addendas.parse_xsd_cached(datos["xsd"])
+    assert otra == shapes
+    assert _nombres(otra) == [("Addenda1", ["Cab", "Det"])]
+    assert addendas.xsd_target_namespace_cached(datos["xsd"]) == "urn:a"
+
+def test_llave_por_elemento_raiz(datos):
+    addendas.parse_xsd_cached(datos["xsd"])
+    shapes, _ = addendas.parse_xsd_cached(datos["xsd"], root_element_name="Addenda1")
+    assert _nombres(shapes) == [("Addenda1", ["Cab", "Det"])]
+    fp = addendas.xsd_fingerprint_grafo(datos["xsd"])
+    assert set(addendas._shapes_cache_load(fp)["shapes"]) == {"*", "Addenda1"}
+
+def test_cambio_de_contenido_invalida(datos):
+    addendas.parse_xsd_cached(datos["xsd"])
+    fp = addendas.xsd_fingerprint_grafo(datos["xsd"])
+    with open(datos["xsd"], encoding="utf-8") as f:
+        xsd = f.read()
+    with open(datos["xsd"], "w", encoding="utf-8") as f:
+        f.write(xsd.replace('<xs:attribute name="Version"/>',
+                            '<xs:attribute name="Version"/><xs:attribute name="Moneda"/>'))
+    nuevo = addendas.xsd_fingerprint_grafo(datos["xsd"])
+    assert nuevo != fp
+    shapes, _ = addendas.parse_xsd_cached(datos["xsd"])
+    assert [a["name"] for a in shapes[0]["attributes"]] == ["Version", "Moneda"]
+    assert sorted(os.listdir(addendas.SHAPES_CACHE_DIR)) == sorted([f"{fp}.json", f"{nuevo}.json"])
+
+def test_otra_version_de_formato_reparsea(datos, monkeypatch):
+    addendas.parse_xsd_cached(datos["xsd"])
+    fp = addendas.xsd_fingerprint_grafo(datos["xsd"])
+    monkeypatch.setattr(addendas, "SHAPES_CACHE_VERSION", addendas.SHAPES_CACHE_VERSION + 1)
+    assert addendas._shapes_cache_load(fp) == {}
+    parseos = []
+    original = addendas.parse_xsd_shapes
+
+    def contar(*a, **kw):
+        parseos.append(a)
+        return original(*a, **kw)
+    monkeypatch.setattr(addendas, "parse_xsd_shapes", contar)
+    addendas.parse_xsd_cached(datos["xsd"])
+    addendas.parse_xsd_cached(datos["xsd"])
+    assert len(parseos) == 1     # se reescribió con la versión nueva
+    assert addendas._shapes_cache_load(fp)["version"] == addendas.SHAPES_CACHE_VERSION
+
+@pytest.mark.parametrize("contenido", ["{no es json", "[]", '{"version": 5, "fingerprint": "otra"}'])
+def test_cache_corrupta_reparsea(datos, contenido):
+    fp = addendas.xsd_fingerprint_grafo(datos["xsd"])
+    os.makedirs(addendas.SHAPES_CACHE_DIR)
+    with open(os.path.join(addendas.SHAPES_CACHE_DIR, f"{fp}.json"), "w", encoding="utf-8") as f:
+        f.write(contenido)
+    shapes, _ = addendas.parse_xsd_cached(datos["xsd"])
+    assert _nombres(shapes) == [("Addenda1", ["Cab", "Det"])]
+    assert addendas._shapes_cache_load(fp)["fingerprint"] == fp
@@ -0,0 +1,197 @@
+# test_cache_xsd.py
+# Caché de descargas de XSD contra un servidor HTTP local: TTL, 304, sin conexión y desalojo LRU.
+import hashlib
+import json
+import os
+import threading
+import time
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import addendas
+
+class _Servidor:
+    """Sirve self.archivos[ruta] = bytes con Last-Modified; respeta If-Modified-Since (304)."""
+
+    def __init__(self):
+        self.archivos = {}
+        self.modificado = time.time() - 3600
+        self.peticiones = []   # (ruta, código)
+        srv = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                data = srv.archivos.get(self.path)
+                if data is None:
+                    return self._responder(404)
+                ims = self.headers.get("If-Modified-Since")
+                if ims and parsedate_to_datetime(ims).timestamp() >= int(srv.modificado):
+                    return self._responder(304)
+                self._responder(200, data)
+
+            def _responder(self, code, data=b""):
+                srv.peticiones.append((self.path, code))
+                self.send_response(code)
+                self.send_header("Last-Modified", formatdate(srv.modificado, usegmt=True))
+                if code != 304:
+                    self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                if code == 200:
+                    self.wfile.write(data)
+
+            def log_message(self, *a):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        self.hilo = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.hilo.start()
+
+    def url(self, ruta):
+        return self.base + ruta
+
+    def apagar(self):
+        if self.hilo.is_alive():
+            self.httpd.shutdown()
+            self.hilo.join()
+        self.httpd.server_close()
+
+@pytest.fixture
+def servidor():
+    srv = _Servidor()
+    yield srv
+    srv.apagar()
+
+def _xsd(n, relleno=0):
+    return (f'<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema" targetNamespace="urn:{n}">'
+            f'<!--{"x" * relleno}--></xs:schema>').encode("utf-8")
+
+def _leer(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def _index():
+    with open(os.path.join(addendas.XSD_CACHE_DIR, "index.json"), encoding="utf-8") as f:
+        return json.load(f)
+
+def test_dentro_del_ttl_no_toca_la_red(servidor):
+    servidor.archivos["/a.xsd"] = _xsd("a")
+    url = servidor.url("/a.xsd")
+    p1 = addendas.descargar_xsd_cache(url, ttl=3600)
+    p2 = addendas.descargar_xsd_cache(url, ttl=3600)
+    assert p1 == p2
+    assert _leer(p1) == _xsd("a")
+    assert servidor.peticiones == [("/a.xsd", 200)]
+
+def test_vencido_revalida_y_304_renueva(servidor):
+    servidor.archivos["/a.xsd"] = _xsd("a")
+    url = servidor.url("/a.xsd")
+    p1 = addendas.descargar_xsd_cache(url, ttl=3600)
+    antes = _index()[url]["fetched_at"]
+    p2 = addendas.descargar_xsd_cache(url, ttl=0)
+    assert p2 == p1
+    assert servidor.peticiones == [("/a.xsd", 200), ("/a.xsd", 304)]
+    assert _index()[url]["fetched_at"] > antes
+    # renovado: dentro del TTL ya no se revalida
+    addendas.descargar_xsd_cache(url, ttl=3600)
+    assert len(servidor.peticiones) == 2
+
+def test_vencido_y_cambiado_descarga_de_nuevo(servidor):
+    servidor.archivos["/a.xsd"] = _xsd("a")
+    url = servidor.url("/a.xsd")
+    p1 = addendas.descargar_xsd_cache(url, ttl=3600)
+    servidor.archivos["/a.xsd"] = _xsd("b")
+    servidor.modificado = time.time() + 5
+    p2 = addendas.descargar_xsd_cache(url, ttl=0)
+    assert servidor.peticiones == [("/a.xsd", 200), ("/a.xsd", 200)]
+    assert p2 != p1 and _leer(p2) == _xsd("b")
+    assert os.path.basename(p2) == _index()[url]["sha1"] + ".xsd"
+
+def test_misma_respuesta_en_dos_urls_comparte_blob(servidor):
+    servidor.archivos["/a.xsd"] = servidor.archivos["/copia/a.xsd"] = _xsd("a")
+    p1 = addendas.descargar_xsd_cache(servidor.url("/a.xsd"))
+    p2 = addendas.descargar_xsd_cache(servidor.url("/copia/a.xsd"))
+    assert p1 == p2
+
+def test_sin_red_sirve_la_copia_vencida(servidor):
+    servidor.archivos["/a.xsd"] = _xsd("a")
+    url = servidor.url("/a.xsd")
+    p1 = addendas.descargar_xsd_cache(url, ttl=3600)
+    servidor.apagar()
+    assert addendas.descargar_xsd_cache(url, ttl=0) == p1
+    with pytest.raises(Exception):
+        addendas.descargar_xsd_cache(servidor.url("/otro.xsd"), ttl=0)
+
+def test_modo_sin_conexion(servidor):
+    servidor.archivos["/a.xsd"] = _xsd("a")
+    url = servidor.url("/a.xsd")
+    with pytest.raises(IOError):
+        addendas.descargar_xsd_cache(url, offline=True)
+    assert servidor.peticiones == []
+    p1 = addendas.descargar_xsd_cache(url)
+    # vencida pero sin conexión: se sirve tal cual, sin revalidar
+    assert addendas.descargar_xsd_cache(url, ttl=0, offline=True) == p1
+    assert servidor.peticiones == [("/a.xsd", 200)]
+
+def test_sin_conexion_usa_cache_legada(servidor):
+    # el .xsd_cache de la carpeta de trabajo se copia una vez a la caché de usuario
+    url = servidor.url("/viejo.xsd")
+    nombre = hashlib.sha1(url.encode("utf-8")).hexdigest() + ".xsd"
+    viejo = os.path.join(addendas.LEGADO_DIR, ".xsd_cache")
+    os.makedirs(viejo)
+    with open(os.path.join(viejo, nombre), "wb") as f:
+        f.write(_xsd("viejo"))
+    p = addendas.descargar_xsd_cache(url, offline=True)
+    assert p == os.path.join(addendas.XSD_CACHE_LEGACY_DIR, nombre)
+    assert _leer(p) == _xsd("viejo")
+    assert servidor.peticiones == []
+
+def test_acierto_no_reescribe_el_indice(servidor):
+    servidor.archivos["/a.xsd"] = _xsd("a")
+    servidor.archivos["/b.xsd"] = _xsd("b")
+    ua, ub = servidor.url("/a.xsd"), servidor.url("/b.xsd")
+    addendas.descargar_xsd_cache(ua)
+    ruta = os.path.join(addendas.XSD_CACHE_DIR, "index.json")
+    antes, mtime = _leer(ruta), os.stat(ruta).st_mtime_ns
+    usado = _index()[ua]["used_at"]
+    time.sleep(0.01)
+    for _ in range(5):
+        addendas.descargar_xsd_cache(ua)
+    assert _leer(ruta) == antes and os.stat(ruta).st_mtime_ns == mtime
+    # el uso se anota con la siguiente escritura (aquí, la descarga de b)
+    addendas.descargar_xsd_cache(ub)
+    assert _index()[ua]["used_at"] > usado
+
+def test_catalogo_legado_con_rutas_absolutas():
+    os.makedirs(os.path.join(addendas.LEGADO_DIR, "xsd"))
+    local = os.path.join(addendas.LEGADO_DIR, "xsd", "a.xsd")
+    with open(local, "wb") as f:
+        f.write(_xsd("a"))
+    with open(os.path.join(addendas.LEGADO_DIR, "xsd_catalog.json"), "w", encoding="utf-8") as f:
+        json.dump({"urn:a": "xsd/a.xsd", "http://x/b.xsd": "/no/existe.xsd"}, f)
+    assert addendas.load_xsd_catalog() == {"urn:a": local, "http://x/b.xsd": "/no/existe.xsd"}
+    assert os.path.exists(addendas.XSD_CATALOG_PATH)
+    assert addendas.resolver_ubicacion_xsd("http://x/a.xsd", namespace="urn:a") == local
+    assert addendas.resolver_ubicacion_xsd("http://x/b.xsd") is None
+
+def test_desalojo_lru(servidor, monkeypatch):
+    for n in "abc":
+        servidor.archivos[f"/{n}.xsd"] = _xsd(n, relleno=1000)
+    tam = len(_xsd("a", relleno=1000))
+    monkeypatch.setattr(addendas, "XSD_CACHE_MAX_BYTES", 2 * tam + 10)
+    pa = addendas.descargar_xsd_cache(servidor.url("/a.xsd"))
+    time.sleep(0.01)
+    pb = addendas.descargar_xsd_cache(servidor.url("/b.xsd"))
+    time.sleep(0.01)
+    addendas.descargar_xsd_cache(servidor.url("/a.xsd"))   # a vuelve a ser la más reciente
+    time.sleep(0.01)
+    pc = addendas.descargar_xsd_cache(servidor.url("/c.xsd"))
+    idx = _index()
+    assert set(idx) == {servidor.url("/a.xsd"), servidor.url("/c.xsd")}
+    assert os.path.exists(pa) and os.path.exists(pc)
+    assert not os.path.exists(pb)
+    # la desalojada se vuelve a descargar
+    addendas.descargar_xsd_cache(servidor.url("/b.xsd"))
+    assert servidor.peticiones.count(("/b.xsd", 200)) == 2
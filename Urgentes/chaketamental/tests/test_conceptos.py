@@ -0,0 +1,74 @@
+# test_conceptos.py
+# Tabla de conceptos en columnas y generación de un nodo por línea ligado al concepto i (con tope maxOccurs).
+import io
+import xml.etree.ElementTree as ET
+
+import pytest
+
+import addendas
+from conftest import perfil_prueba
+
+def _tabla(source):
+    t = addendas.extraer_tabla_conceptos(source)
+    return t, {col: [float(x) for x in arr] for col, arr in t["num"].items()}
+
+def test_tabla_en_columnas(datos):
+    t, num = _tabla(datos["M.xml"])
+    assert t["n"] == 3
+    assert t["noid"] == ["BOTELLA", "VASO&", "TAPA"]
+    assert t["descripcion"] == ["BOTELLA DE AGUA 600ML", 'VASO <grande> "x" &', "BOTELLA DE AGUA 600ML"]
+    assert t["cantidad"] == ["1.00", "1.00", "3.00"] and t["descuento"] == [None] * 3
+    assert num["cantidad"] == [1.0, 1.0, 3.0] and num["importe"] == [15.0] * 3
+    assert (num["iva"], num["ieps"], num["otros"]) == ([2.4] * 3, [0.0] * 3, [0.0] * 3)
+
+def test_mismas_columnas_por_cualquier_fuente(datos):
+    esperado = addendas.extraer_tabla_conceptos(datos["M.xml"])
+    with open(datos["M.xml"], "rb") as f:
+        data = f.read()
+    for fuente in (ET.fromstring(data), io.BytesIO(data)):
+        t = addendas.extraer_tabla_conceptos(fuente)
+        assert {k: v for k, v in t.items() if k != "num"} == {k: v for k, v in esperado.items() if k != "num"}
+        assert {c: list(a) for c, a in t["num"].items()} == {c: list(a) for c, a in esperado["num"].items()}
+
+def test_ctx_linea(datos):
+    ctx = addendas.extract_cfdi_context_stream(datos["M.xml"])
+    t = addendas.extraer_tabla_conceptos(datos["M.xml"])
+    linea = addendas.ctx_linea(ctx, t, 2)
+    assert (linea["concepto1_noid"], linea["concepto1_cantidad"], linea["concepto_num"]) == ("TAPA", "3.00", "3")
+    assert (linea["concepto_iva"], linea["concepto_ieps"]) == ("2.40", None)
+    assert ctx["concepto1_noid"] == "BOTELLA"       # el ctx original no se toca
+
+def _generar(datos, xsd=None, rules=None):
+    xsd = xsd or datos["xsd"]
+    shapes, tipos = addendas.parse_xsd_shapes(xsd)
+    ctx = addendas.extract_cfdi_context_stream(datos["M.xml"])
+    t = addendas.extraer_tabla_conceptos(datos["M.xml"])
+    return addendas.aplicar_perfil(perfil_prueba(xsd), ctx, rules or {}, shapes, t, tipos)["roots"][0]
+
+def test_un_nodo_por_concepto(datos):
+    addenda = _generar(datos)
+    cab, *dets = addenda["children"]
+    assert cab["attributes"] == {"Pedido": 'P&<"1"\t'}
+    # el primer Det del perfil es la plantilla por línea; el segundo (Sku="X") era ejemplo
+    assert [d["attributes"]["Sku"] for d in dets] == ["BOTELLA", "VASO&", "TAPA"]
+    assert [d["children"][0]["text"] for d in dets] == \
+        ["BOTELLA DE AGUA 600ML", 'VASO <grande> "x" &', "BOTELLA DE AGUA 600ML"]
+
+def test_autollenado_por_linea(datos):
+    # un campo vacío cuya regla apunta a concepto1_* también se liga al concepto i
+    dets = _generar(datos, rules={"Cant": "concepto1_cantidad"})["children"][1:]
+    assert [d["attributes"]["Cant"] for d in dets] == ["1.00", "1.00", "3.00"]
+
+@pytest.mark.parametrize("mx, esperado", [("2", ["BOTELLA", "VASO&"]), ("5", ["BOTELLA", "VASO&", "TAPA"])])
+def test_tope_max_occurs(datos, tmp_path, mx, esperado):
+    with open(datos["xsd"], encoding="utf-8") as f:
+        xsd = f.read().replace('maxOccurs="unbounded"', f'maxOccurs="{mx}"')
+    p = tmp_path / f"tope{mx}.xsd"
+    p.write_text(xsd, encoding="utf-8")
+    dets = _generar(datos, xsd=str(p))["children"][1:]
+    assert [d["attributes"]["Sku"] for d in dets] == esperado
+
+def test_sin_tabla_se_queda_el_perfil(datos):
+    ctx = addendas.extract_cfdi_context_stream(datos["M.xml"])
+    addenda = addendas.aplicar_perfil(perfil_prueba(datos["xsd"]), ctx, {})["roots"][0]
+    assert [d["attributes"]["Sku"] for d in addenda["children"][1:]] == ["BOTELLA", "X"]
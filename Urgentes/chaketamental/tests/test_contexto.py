@@ -0,0 +1,44 @@
+# test_contexto.py
+# extract_cfdi_context_stream (iterparse, sin árbol) regresa lo mismo que extract_cfdi_context.
+import io
+import re
+
+import pytest
+
+import addendas
+from conftest import CFDIS
+
+def _leer(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def _quitar(data, etiqueta):
+    """Quita el elemento `etiqueta` (con prefijo) y su contenido."""
+    e = re.escape(etiqueta)
+    return re.sub(rb"<" + e + rb"\b(?:[^>]*/>|.*?</" + e + rb">)", b"", data, count=1, flags=re.S)
+
+def _variantes(datos):
+    m = _leer(datos["M.xml"])
+    yield from ((n, _leer(datos[n])) for n in CFDIS)
+    yield "sin_timbre", _quitar(m, b"cfdi:Complemento")
+    yield "sin_impuestos", re.sub(rb"<cfdi:Impuestos\b(?:[^>]*/>|.*?</cfdi:Impuestos>)", b"", m, flags=re.S)
+    yield "sin_addenda", _quitar(m, b"cfdi:Addenda")
+    yield "otro_prefijo", re.sub(rb"(</?|xmlns:)cfdi\b", rb"\1c", m)
+    yield "sin_conceptos", re.sub(rb"<cfdi:Conceptos\b.*?</cfdi:Conceptos>", b"<cfdi:Conceptos/>", m, flags=re.S)
+    yield "sin_folio", re.sub(rb' (Serie|Folio)="[^"]*"', b"", m)
+
+@pytest.mark.parametrize("backend", ["etree", "lxml"])
+def test_stream_igual_que_arbol(datos, backend):
+    if backend == "lxml" and not addendas.HAS_LXML:
+        pytest.skip("sin lxml")
+    addendas.usar_backend_xml(backend)
+    for nombre, data in _variantes(datos):
+        arbol = addendas.extract_cfdi_context(addendas.XML.fromstring(data))
+        assert addendas.extract_cfdi_context_stream(io.BytesIO(data)) == arbol, nombre
+
+@pytest.mark.parametrize("n", CFDIS)
+def test_stream_desde_ruta(datos, n):
+    arbol = addendas.extract_cfdi_context(addendas.XML.parse(datos[n]).getroot())
+    ctx = addendas.extract_cfdi_context_stream(datos[n])
+    assert ctx == arbol
+    assert ctx["receptor_rfc"] == "AAA010101AAA"
@@ -0,0 +1,100 @@
+# test_empalme.py
+# Empalme de la Addenda sobre los bytes del CFDI: fuera de la <cfdi:Addenda> todo queda idéntico.
+import pytest
+
+import addendas
+from addendas import CFDI, CFDI_NS
+from conftest import CFDIS
+
+def _leer(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def _escribir(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+def _addenda():
+    raiz = addendas.XML.fromstring(f'<cfdi:Comprobante xmlns:cfdi="{CFDI_NS}"/>')
+    add = addendas.XML.SubElement(raiz, CFDI + "Addenda")
+    el = addendas.XML.SubElement(add, "{urn:a}Addenda1", {"Version": "1.0"})
+    addendas.XML.SubElement(el, "{urn:a}Cab", {"Pedido": 'P&<"1"'})
+    return add
+
+def _sin_addenda(data):
+    ini, fin = addendas.escanear_cfdi_bytes(data)["addenda"]
+    if data[ini - 1:ini] == b" ":
+        # quita también la línea (sangría y salto) que ocupaba
+        while data[ini - 1:ini] in (b" ", b"\t"):
+            ini -= 1
+        fin += 1 if data[fin:fin + 1] == b"\n" else 0
+    return data[:ini] + data[fin:]
+
+def _variantes(datos, tmp_path):
+    """(nombre, ruta) con y sin Addenda previa, con CRLF y con señuelos en comentarios/CDATA."""
+    out = []
+    for n in CFDIS:
+        data = _leer(datos[n])
+        out.append((n, datos[n]))
+        out.append(("sin_addenda_" + n, _escribir(str(tmp_path / ("s_" + n)), _sin_addenda(data))))
+    m = _leer(datos["M.xml"])
+    out.append(("crlf", _escribir(str(tmp_path / "crlf.xml"), m.replace(b"\n", b"\r\n"))))
+    cierre = m.rindex(b"</cfdi:Comprobante>")
+    ini = addendas.escanear_cfdi_bytes(m)["addenda"][0]
+    senuelo = (m[:ini] + b"<!-- <cfdi:Addenda></cfdi:Addenda> -->\n  " + m[ini:cierre]
+               + b"<!-- </cfdi:Comprobante> -->\n" + m[cierre:])
+    out.append(("comentarios", _escribir(str(tmp_path / "senuelo.xml"), senuelo)))
+    j = m.index(b">", ini) + 1
+    cdata = m[:j] + b"<![CDATA[ </cfdi:Addenda></cfdi:Comprobante> ]]>" + m[j:]
+    out.append(("cdata", _escribir(str(tmp_path / "cdata.xml"), cdata)))
+    return out
+
+def _tramos(original, nuevo):
+    """Offsets de la Addenda en ambos: (ini, fin) original (o punto de inserción) y fin en el nuevo."""
+    so = addendas.escanear_cfdi_bytes(original)
+    sn = addendas.escanear_cfdi_bytes(nuevo)
+    ini_n, fin_n = sn["addenda"]
+    if so["addenda"]:
+        ini_o, fin_o = so["addenda"]
+    else:
+        ini_o = fin_o = so["root_end"][0]
+    return ini_o, fin_o, ini_n, fin_n
+
+def test_fuera_de_la_addenda_no_cambia_nada(datos, tmp_path):
+    for nombre, path in _variantes(datos, tmp_path):
+        original = _leer(path)
+        out = str(tmp_path / ("out_" + nombre + ".xml"))
+        addendas.escribir_cfdi_con_addenda(path, _addenda(), out)
+        nuevo = _leer(out)
+        assert addendas.cfdi_con_addenda_bytes(path, _addenda()) == nuevo, nombre
+        ini_o, fin_o, ini_n, fin_n = _tramos(original, nuevo)
+        if addendas.escanear_cfdi_bytes(original)["addenda"]:
+            assert nuevo[:ini_n] == original[:ini_o], nombre
+            assert nuevo[fin_n:] == original[fin_o:], nombre
+        else:
+            # inserción antes del cierre: lo de antes y el cierre intactos, solo la sangría nueva en medio
+            assert nuevo.startswith(original[:ini_o]), nombre
+            assert nuevo.endswith(original[fin_o:]), nombre
+            assert nuevo[ini_o:ini_n].strip() == b"" and nuevo[fin_n:len(nuevo) - len(original) + fin_o].strip() == b""
+        assert b"Addenda1" in nuevo[ini_n:fin_n]
+
+def test_reemplaza_la_addenda_conservando_la_previa(datos):
+    # construir_addenda deja lo previo de la Addenda y agrega lo nuevo; el empalme lo respeta
+    for n in CFDIS:
+        previa = addendas.leer_addenda_cfdi(datos[n]).find(CFDI + "Addenda")
+        add = _addenda()
+        for i, ch in enumerate(list(previa)):
+            add.insert(i, ch)
+        nuevo = addendas.cfdi_con_addenda_bytes(datos[n], add)
+        raiz = addendas.XML.fromstring(nuevo)
+        hijos = [ch.tag.rsplit("}", 1)[-1] for ch in raiz.find(CFDI + "Addenda")]
+        assert hijos == ["DSCargaRemisionProv", "Addenda1"], n
+
+@pytest.mark.parametrize("n", CFDIS)
+def test_resultado_bien_formado_y_mismo_contexto(datos, n):
+    nuevo = addendas.cfdi_con_addenda_bytes(datos[n], _addenda())
+    raiz = addendas.XML.fromstring(nuevo)
+    assert len(raiz.findall(CFDI + "Addenda")) == 1
+    original = addendas.XML.fromstring(_leer(datos[n]))
+    assert addendas.extract_cfdi_context(raiz) == addendas.extract_cfdi_context(original)
@@ -0,0 +1,90 @@
+# test_facetas.py
+# Facetas del XSD → validador rápido: pattern de una misma restriction son alternativas,
+# los de cada paso de derivación se acumulan; enum, longitudes y dígitos.
+import pytest
+
+import addendas
+
+XSD = """<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema" targetNamespace="urn:f" xmlns="urn:f"
+ elementFormDefault="qualified">
+ <xs:simpleType name="Codigo"><xs:restriction base="xs:string">
+   <xs:pattern value="[A-Z]{3}"/><xs:pattern value="\\d{3}"/></xs:restriction></xs:simpleType>
+ <xs:simpleType name="CodigoA1"><xs:restriction base="Codigo">
+   <xs:pattern value="A.*"/><xs:pattern value="1.*"/></xs:restriction></xs:simpleType>
+ <xs:element name="Raiz"><xs:complexType>
+   <xs:sequence><xs:element name="Monto"><xs:simpleType><xs:restriction base="xs:decimal">
+     <xs:totalDigits value="5"/><xs:fractionDigits value="2"/></xs:restriction></xs:simpleType></xs:element></xs:sequence>
+   <xs:attribute name="Codigo" type="Codigo"/>
+   <xs:attribute name="Derivado" type="CodigoA1"/>
+   <xs:attribute name="Tipo"><xs:simpleType><xs:restriction base="xs:string">
+     <xs:enumeration value="I"/><xs:enumeration value="E"/></xs:restriction></xs:simpleType></xs:attribute>
+   <xs:attribute name="Clave"><xs:simpleType><xs:restriction base="xs:string">
+     <xs:length value="4"/></xs:restriction></xs:simpleType></xs:attribute>
+ </xs:complexType></xs:element></xs:schema>"""
+
+@pytest.fixture
+def raiz(tmp_path):
+    p = tmp_path / "f.xsd"
+    p.write_text(XSD, encoding="utf-8")
+    shapes, _ = addendas.parse_xsd_shapes(str(p))
+    return shapes[0]
+
+def _facetas_attr(raiz, nombre):
+    return next(a["facetas"] for a in raiz["attributes"] if a["name"] == nombre)
+
+def test_facetas_por_paso_de_derivacion(raiz):
+    assert _facetas_attr(raiz, "Codigo")["pattern"] == [["[A-Z]{3}", "\\d{3}"]]
+    assert _facetas_attr(raiz, "Derivado")["pattern"] == [["[A-Z]{3}", "\\d{3}"], ["A.*", "1.*"]]
+
+def test_pattern_mismo_nivel_es_o(raiz):
+    v = addendas.compilar_validador(_facetas_attr(raiz, "Codigo"))
+    assert v("ABC") == "" and v("123") == ""
+    assert v("AB1") and v("ABCD")
+
+def test_pattern_heredado_es_y(raiz):
+    v = addendas.compilar_validador(_facetas_attr(raiz, "Derivado"))
+    assert v("ABC") == "" and v("123") == ""
+    assert v("BCD")                  # cumple el base, no el derivado
+    assert v("A12")                  # cumple el derivado, no el base
+    assert v("") == ""               # vacío lo revisan los obligatorios
+
+def test_grupo_intraducible_no_se_revisa():
+    v = addendas.compilar_validador({"pattern": [["\\p{Lu}+", "\\d+"], ["[0-9A-Z]{2}"]]})
+    assert v("AB") == "" and v("12") == ""
+    assert v("ABC")
+
+def test_enumeracion_y_longitud(raiz):
+    tipo = addendas.compilar_validador(_facetas_attr(raiz, "Tipo"))
+    assert tipo("I") == "" and tipo("E") == ""
+    assert tipo("P") == "valor fuera del catálogo"
+    clave = addendas.compilar_validador(_facetas_attr(raiz, "Clave"))
+    assert clave("ABCD") == ""
+    assert clave("ABC") == "longitud debe ser 4"
+
+def test_digitos(raiz):
+    monto = next(ch for ch in raiz["children"] if ch["name"] == "Monto")
+    assert monto["facetas"] == {"base": "decimal", "totalDigits": 5, "fractionDigits": 2}
+    v = addendas.compilar_validador(monto["facetas"])
+    assert v("123.45") == "" and v("00123.450") == "" and v("-1") == ""
+    assert v("1.234") == "máximo 2 decimales"
+    assert v("12345.6") == "máximo 5 dígitos"
+    assert v("abc") == "debe ser numérico"
+
+@pytest.mark.parametrize("patron, si, no", [
+    ("a^b$", ["a^b$"], ["ab"]),                       # ^ y $ son literales en XSD
+    ("a.b", ["axb"], ["a\nb", "a\rb"]),               # . no incluye CR/LF
+    ("a\\sb", ["a b", "a\tb"], ["a\u00a0b"]),         # \s es solo espacio/tab/CR/LF
+    ("[\\s,]+", [" ,\t"], ["\u2003"]),
+    ("\\S+", ["abc"], ["a b"]),
+    ("[^a]", ["b"], ["a"]),
+    ("[a|b]", ["|"], ["c"]),                           # | dentro de clase es literal
+])
+def test_regex_xsd(patron, si, no):
+    rx = addendas._regex_xsd(patron)
+    assert rx is not None
+    assert all(rx.fullmatch(x) for x in si)
+    assert not any(rx.fullmatch(x) for x in no)
+
+@pytest.mark.parametrize("patron", ["\\w+", "\\p{Lu}", "\\i\\c*", "[a-z-[aeiou]]", "[\\S]", "(a"])
+def test_regex_xsd_sin_equivalente(patron):
+    assert addendas._regex_xsd(patron) is None
@@ -0,0 +1,134 @@
+# test_fondo.py
+# Trabajo en segundo plano de AddendaApp sin ventana: el resultado llega por root.after, una tarea nueva en el
+# mismo canal cancela o descarta a la anterior, y el indicador de progreso se apaga al terminar la última.
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import addendas
+import main
+
+class _Var:
+    def __init__(self):
+        self.valor = ""
+
+    def get(self):
+        return self.valor
+
+    def set(self, v):
+        self.valor = v
+
+class _Progreso:
+    def __init__(self):
+        self.activo = False
+
+    def start(self, _ms):
+        self.activo = True
+
+    def stop(self):
+        self.activo = False
+
+class _Raiz:
+    """Lo único de Tk que usa el worker: root.after, atendido a mano desde la prueba (el "hilo de Tk")."""
+    def __init__(self):
+        self.pendientes = []
+        self.hilo = threading.get_ident()
+
+    def after(self, _ms, fn):
+        self.pendientes.append(fn)
+
+    def atender(self, hasta=None, limite=5.0):
+        fin = time.monotonic() + limite
+        while self.pendientes and not (hasta and hasta()):
+            assert time.monotonic() < fin, "la cola no se vació"
+            self.pendientes.pop(0)()
+            time.sleep(0.005)
+
+@pytest.fixture
+def app():
+    a = main.AddendaApp.__new__(main.AddendaApp)
+    a.root = _Raiz()
+    a._pool = ThreadPoolExecutor(max_workers=1)
+    a._cola = queue.Queue()
+    a._tareas = {}
+    a._activas = 0
+    a._atendiendo = False
+    a.status_var = _Var()
+    a.progreso = _Progreso()
+    yield a
+    a._pool.shutdown(wait=True, cancel_futures=True)
+
+def test_entrega_en_el_hilo_de_tk(app):
+    hilos, recibido = [], []
+
+    def trabajo():
+        hilos.append(threading.get_ident())
+        return 42
+
+    def listo(res):
+        recibido.append((res, threading.get_ident()))
+    app._en_fondo("xsd", "Cargando…", trabajo, listo)
+    assert app.status_var.get() == "Cargando…" and app.progreso.activo
+    app.root.atender()
+    assert hilos[0] != app.root.hilo
+    assert recibido == [(42, app.root.hilo)]
+    assert (app._activas, app._atendiendo, app.status_var.get(), app.progreso.activo) == (0, False, "", False)
+
+def test_la_nueva_cancela_la_que_no_arranco(app):
+    suelta, llamadas = threading.Event(), []
+    app._en_fondo("otro", "Validando…", suelta.wait, lambda r: llamadas.append("otro"))
+    # el único worker está ocupado: la primera carga queda en espera y la segunda la cancela
+    app._en_fondo("xsd", "Cargando a…", lambda: llamadas.append("corrió a"), lambda r: llamadas.append("a"))
+    app._en_fondo("xsd", "Cargando b…", lambda: "b", llamadas.append)
+    assert app._activas == 2
+    suelta.set()
+    app.root.atender()
+    assert sorted(llamadas) == ["b", "otro"]
+    assert app._activas == 0 and not app.progreso.activo
+
+def test_la_nueva_descarta_la_que_ya_corria(app):
+    app._pool = ThreadPoolExecutor(max_workers=2)
+    arranco, suelta, llamadas = threading.Event(), threading.Event(), []
+
+    def lenta():
+        arranco.set()
+        suelta.wait()
+        return "a"
+    app._en_fondo("xsd", "Cargando a…", lenta, llamadas.append)
+    try:
+        assert arranco.wait(5)
+        app._en_fondo("xsd", "Cargando b…", lambda: "b", llamadas.append)
+        app.root.atender(hasta=lambda: llamadas)
+        # b ya llegó; a sigue corriendo y mantiene el indicador (y la cola atendida)
+        assert llamadas == ["b"] and app.progreso.activo and app.root.pendientes
+    finally:
+        suelta.set()
+    app.root.atender()
+    assert llamadas == ["b"]            # el resultado de a se tiró
+    assert app._activas == 0 and not app.progreso.activo
+
+def test_errores_van_a_fallo(app, monkeypatch):
+    errores, mostrados = [], []
+
+    def truena():
+        raise ValueError("XSD roto")
+    app._en_fondo("xsd", "Cargando…", truena, lambda r: None, errores.append)
+    monkeypatch.setattr(main.messagebox, "showerror", lambda titulo, msg: mostrados.append(msg))
+    app._en_fondo("val", "Validando…", truena, lambda r: None)          # sin fallo: se muestra
+    app._en_fondo("otro", "…", lambda: 1, lambda r: 1 / 0)              # si listo truena, también
+    app.root.atender()
+    assert [str(e) for e in errores] == ["XSD roto"]
+    assert mostrados == ["XSD roto", "division by zero"]
+    assert app._activas == 0
+
+def test_preparar_xsd_fuera_de_tk(datos):
+    res = main.AddendaApp._preparar_xsd(datos["xsd"], None)
+    assert res["path"] == datos["xsd"] and res["tns"] == "urn:a"
+    assert [s["name"] for s in res["shapes"]] == ["Addenda1"]
+    assert res["fp"] == addendas.xsd_fingerprint(datos["xsd"])
+    assert addendas.paquete_registrados() == {"urn:a": datos["xsd"]}
+    with pytest.raises(RuntimeError):
+        main.AddendaApp._preparar_xsd(datos["xsd"], "NoExiste")
@@ -0,0 +1,97 @@
+# test_formmodel.py
+# Modelo del formulario sin UI: recolectar a cualquier profundidad, obligatorios y facetas,
+# autollenado desde el ctx y prefill de la ocurrencia n de una Addenda.
+import io
+
+import pytest
+
+import addendas
+from main import FormModel
+
+ADDENDA = (b'<Addenda1 xmlns="urn:a" Version="1.0"><Cab Pedido="P1"/>'
+           b'<Det Sku="A" Cant="1"><Nota>uno</Nota></Det><Det Sku="B" Cant="2"><Nota>dos</Nota></Det>'
+           b'<Det Sku="C"/></Addenda1>')
+
+@pytest.fixture
+def model(datos):
+    return FormModel(*addendas.parse_xsd_shapes(datos["xsd"]))
+
+def _campo(model, path, name, kind="attr", idx=0):
+    return model.buscar(path, kind, name, idx)
+
+def test_estructura_inicial(model):
+    assert [(s.owner_path, s.kind, s.name) for s in model.campos()] == [
+        ("Addenda1", "attr", "Version"), ("Addenda1/Cab", "attr", "Pedido"),
+        ("Addenda1/Det", "attr", "Sku"), ("Addenda1/Det", "attr", "Cant"),
+        ("Addenda1/Det/Nota", "text", "#text")]
+    assert _campo(model, "Addenda1/Cab", "Pedido").required
+    assert _campo(model, "Addenda1/Det", "Sku", idx=1) is None
+
+def test_collect_a_cualquier_profundidad(model):
+    assert model.collect() == {"roots": [{"name": "Addenda1", "attributes": {"Version": ""}, "children": [
+        {"name": "Cab", "attributes": {"Pedido": ""}, "children": []},
+        {"name": "Det", "attributes": {"Sku": "", "Cant": ""}, "children": []}]}]}
+    _campo(model, "Addenda1/Det/Nota", "#text", "text").set("  hola ")
+    (sh, lst), = [(sh, lst) for sh, lst in model.raices[0][1][0].hijos if sh["name"] == "Det"]
+    otro = model.agregar(lst, sh, "Addenda1/Det")
+    otro.attrs["Sku"].set("Z")
+    dets = model.collect()["roots"][0]["children"][1:]
+    assert dets == [
+        {"name": "Det", "attributes": {"Sku": "", "Cant": ""},
+         "children": [{"name": "Nota", "attributes": {}, "children": [], "text": "hola"}]},
+        {"name": "Det", "attributes": {"Sku": "Z", "Cant": ""}, "children": []}]
+    model.eliminar(lst, otro)
+    assert len(model.collect()["roots"][0]["children"]) == 2
+    assert _campo(model, "Addenda1/Det", "Sku", idx=1) is None      # sus campos salen del modelo
+
+def test_obligatorios(model):
+    assert model.faltantes() == ["Pedido"]
+    _campo(model, "Addenda1/Cab", "Pedido").set("P1")
+    assert model.revisar() == ([], [])
+
+def test_facetas(tmp_path):
+    p = tmp_path / "f.xsd"
+    p.write_text("""<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema" targetNamespace="urn:f">
+ <xs:element name="R"><xs:complexType><xs:sequence>
+   <xs:element name="Opc" minOccurs="0"><xs:complexType>
+     <xs:attribute name="Clave" use="required"><xs:simpleType><xs:restriction base="xs:string">
+       <xs:length value="3"/></xs:restriction></xs:simpleType></xs:attribute></xs:complexType></xs:element>
+ </xs:sequence><xs:attribute name="Moneda"><xs:simpleType><xs:restriction base="xs:string">
+   <xs:enumeration value="MXN"/><xs:enumeration value="USD"/></xs:restriction></xs:simpleType></xs:attribute>
+ </xs:complexType></xs:element></xs:schema>""", encoding="utf-8")
+    model = FormModel(*addendas.parse_xsd_shapes(str(p)))
+    # Opc no se emite (sin valores), pero declara atributos: cuenta su obligatorio
+    assert model.revisar() == (["Clave"], [])
+    model.buscar("R", "attr", "Moneda").set("EUR")
+    model.buscar("R/Opc", "attr", "Clave").set("ABCD")
+    faltan, invalidos = model.revisar()
+    assert faltan == [] and len(invalidos) == 2
+    assert invalidos[0].startswith("Moneda: ") and invalidos[1].startswith("Clave: ")
+
+def test_autollenar(model, datos):
+    ctx = addendas.extract_cfdi_context_stream(datos["M.xml"])
+    _campo(model, "Addenda1", "Version").set("9")
+    n = model.autollenar(ctx, {"Sku": "concepto1_noid", "Pedido": "folio", "Version": "moneda"})
+    assert n == 2
+    assert (_campo(model, "Addenda1/Det", "Sku").get(), _campo(model, "Addenda1/Cab", "Pedido").get()) == \
+        ("BOTELLA", "1")
+    assert _campo(model, "Addenda1", "Version").get() == "9"      # lo capturado no se pisa
+
+@pytest.mark.parametrize("n, esperado", [(1, ("A", "1", "uno")), (2, ("B", "2", "dos")),
+                                         (3, ("C", "1", "uno")), (9, ("A", "1", "uno"))])
+def test_prefill_ocurrencia_n(model, n, esperado):
+    # si la lista no alcanza la ocurrencia n, se toma la primera
+    info = addendas.parse_addenda_xml_values(io.BytesIO(ADDENDA))
+    assert model.prefill(info, n) == 5
+    assert (_campo(model, "Addenda1/Det", "Sku").get(), _campo(model, "Addenda1/Det", "Cant").get(),
+            _campo(model, "Addenda1/Det/Nota", "#text", "text").get()) == esperado
+    assert _campo(model, "Addenda1/Cab", "Pedido").get() == "P1"
+
+def test_prefill_sin_indices_y_por_nombre(model):
+    # values sin los índices por_nombre/por_local (p. ej. de una versión anterior); la ruta no casa
+    info = addendas.parse_addenda_xml_values(io.BytesIO(ADDENDA))
+    values = {(k[0], k[1], k[2], "Otra/" + k[3]): v for k, v in info["values"].items()}
+    _campo(model, "Addenda1/Det", "Sku").set("fijo")
+    assert model.prefill({"values": values}, 2) == 4
+    assert _campo(model, "Addenda1/Det", "Sku").get() == "fijo"
+    assert _campo(model, "Addenda1/Det/Nota", "#text", "text").get() == "dos"
@@ -0,0 +1,93 @@
+# test_grafo_xsd.py
+# Grafo include/import: tipos, grupos, attributeGroup, ref y extension de otros documentos;
+# un import sin copia local queda en "faltantes" sin tronar el parseo.
+import json
+import os
+
+import pytest
+
+import addendas
+
+XS = 'xmlns:xs="http://www.w3.org/2001/XMLSchema"'
+PRINCIPAL = f"""<xs:schema {XS} targetNamespace="urn:m" xmlns:m="urn:m" xmlns:c="urn:c"
+    elementFormDefault="qualified">
+ <xs:include schemaLocation="tipos.xsd"/>
+ <xs:import namespace="urn:c" schemaLocation="comun/c.xsd"/>
+ <xs:import namespace="urn:x" schemaLocation="http://ejemplo.invalid/x/no_hay.xsd"/>
+ <xs:element name="Pedido"><xs:complexType><xs:complexContent>
+   <xs:extension base="m:Base"><xs:sequence>
+     <xs:group ref="m:GDatos"/>
+     <xs:element ref="c:Moneda" minOccurs="0"/>
+   </xs:sequence><xs:attributeGroup ref="m:AComunes"/><xs:attribute ref="c:Divisa" use="required"/>
+   </xs:extension></xs:complexContent></xs:complexType></xs:element>
+</xs:schema>"""
+# include "camaleón": sin targetNamespace, toma urn:m
+TIPOS = f"""<xs:schema {XS}>
+ <xs:complexType name="Base"><xs:sequence><xs:element name="Folio" type="xs:string"/></xs:sequence>
+   <xs:attribute name="Id" use="required"/></xs:complexType>
+ <xs:group name="GDatos"><xs:sequence><xs:element name="Fecha" type="xs:date"/></xs:sequence></xs:group>
+ <xs:attributeGroup name="AComunes"><xs:attribute name="Version" fixed="2.0"/></xs:attributeGroup>
+</xs:schema>"""
+COMUN = f"""<xs:schema {XS} targetNamespace="urn:c">
+ <xs:element name="Moneda"><xs:simpleType><xs:restriction base="xs:string">
+   <xs:enumeration value="MXN"/><xs:enumeration value="USD"/></xs:restriction></xs:simpleType></xs:element>
+ <xs:attribute name="Divisa" type="xs:string"/>
+</xs:schema>"""
+X = f'<xs:schema {XS} targetNamespace="urn:x"><xs:element name="Nada"/></xs:schema>'
+
+@pytest.fixture
+def grafo(tmp_path):
+    d = tmp_path / "xsd"
+    os.makedirs(d / "comun")
+    (d / "principal.xsd").write_text(PRINCIPAL, encoding="utf-8")
+    (d / "tipos.xsd").write_text(TIPOS, encoding="utf-8")
+    (d / "comun" / "c.xsd").write_text(COMUN, encoding="utf-8")
+    return d
+
+def test_resuelve_include_e_import(grafo):
+    principal = str(grafo / "principal.xsd")
+    g = addendas.cargar_grafo_xsd(principal)
+    assert [os.path.relpath(d["path"], grafo) for d in g["docs"]] == \
+        ["principal.xsd", "tipos.xsd", os.path.join("comun", "c.xsd")]
+    assert g["docs"][1]["tns"] == "urn:m"
+    assert g["faltantes"] == ["http://ejemplo.invalid/x/no_hay.xsd"]
+    assert {"{urn:m}Base", "{urn:m}GDatos", "{urn:m}AComunes", "{urn:c}Moneda", "{urn:c}Divisa"} <= \
+        set(g["types"]) | set(g["groups"]) | set(g["attr_groups"]) | set(g["elements"]) | set(g["attributes"])
+    assert addendas.cargar_grafo_xsd(principal) is g
+
+def test_shapes_de_todo_el_grafo(grafo):
+    (pedido,) = addendas.parse_xsd(str(grafo / "principal.xsd"))
+    assert [a["name"] for a in pedido["attributes"]] == ["Id", "Version", "Divisa"]
+    attrs = {a["name"]: a for a in pedido["attributes"]}
+    assert attrs["Version"]["fixed"] == "2.0" and attrs["Divisa"]["use"] == "required"
+    assert [(c["name"], c["minOccurs"]) for c in pedido["children"]] == \
+        [("Folio", "1"), ("Fecha", "1"), ("Moneda", "0")]
+    folio, fecha, moneda = pedido["children"]
+    assert fecha["facetas"] == {"base": "date"}
+    assert moneda["facetas"]["enumeration"] == ["MXN", "USD"]
+    assert moneda["path"] == "Pedido/Moneda"
+
+def test_el_faltante_entra_en_la_huella(grafo):
+    principal = str(grafo / "principal.xsd")
+    fp = addendas.xsd_fingerprint_grafo(principal)
+    assert fp != addendas.xsd_fingerprint(principal)
+    assert addendas.xsd_fingerprint_grafo(principal) == fp
+
+def test_catalogo_resuelve_el_faltante(grafo):
+    (grafo / "x.xsd").write_text(X, encoding="utf-8")
+    os.makedirs(os.path.dirname(addendas.XSD_CATALOG_PATH))
+    with open(addendas.XSD_CATALOG_PATH, "w", encoding="utf-8") as f:
+        json.dump({"urn:x": str(grafo / "x.xsd")}, f)
+    g = addendas.cargar_grafo_xsd(str(grafo / "principal.xsd"))
+    assert g["faltantes"] == [] and "{urn:x}Nada" in g["elements"]
+    # los elementos globales de un import (otro namespace) no son raíces del formulario
+    assert [s["name"] for s in addendas.parse_xsd(str(grafo / "principal.xsd"))] == ["Pedido"]
+
+def test_include_que_no_existe(grafo):
+    (grafo / "tipos.xsd").unlink()
+    g = addendas.cargar_grafo_xsd(str(grafo / "principal.xsd"))
+    assert g["faltantes"] == ["tipos.xsd", "http://ejemplo.invalid/x/no_hay.xsd"]
+    (pedido,) = addendas.parse_xsd(str(grafo / "principal.xsd"))
+    # sin la base ni los grupos quedan los atributos y elementos que sí se resolvieron
+    assert [a["name"] for a in pedido["attributes"]] == ["Divisa"]
+    assert [c["name"] for c in pedido["children"]] == ["Moneda"]
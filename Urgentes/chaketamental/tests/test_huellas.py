@@ -0,0 +1,103 @@
+# test_huellas.py
+# Huellas de XSD: sha1 del contenido memorizado por (size, mtime_ns, ino) en memoria y en la base de estado;
+# la huella del grafo cambia si cambia un include (o aparece uno que faltaba) y se revalida con un stat
+# por dependencia.
+import hashlib
+import os
+
+import pytest
+
+import addendas
+
+XS = 'xmlns:xs="http://www.w3.org/2001/XMLSchema"'
+
+def _sha1(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def _no_hashear(*a, **kw):
+    raise AssertionError("no debía leer el archivo")
+
+def test_huella_es_el_sha1(datos, monkeypatch):
+    fp = addendas.xsd_fingerprint(datos["xsd"])
+    assert fp == _sha1(datos["xsd"])
+    monkeypatch.setattr(addendas, "HUELLA_MMAP_MIN", 1)       # vía mmap da lo mismo
+    assert addendas._hash_archivo(datos["xsd"]) == fp
+
+def test_memo_en_memoria_y_en_disco(datos, monkeypatch):
+    fp = addendas.xsd_fingerprint(datos["xsd"])
+    monkeypatch.setattr(addendas, "_hash_archivo", _no_hashear)
+    assert addendas.xsd_fingerprint(datos["xsd"]) == fp
+    # otro proceso (sin memo en memoria) la toma de la base de estado
+    monkeypatch.setattr(addendas, "_HUELLAS", {})
+    assert addendas.xsd_fingerprint(datos["xsd"]) == fp
+    assert os.path.abspath(datos["xsd"]) in addendas._HUELLAS
+
+def test_cambio_de_contenido(datos):
+    fp = addendas.xsd_fingerprint(datos["xsd"])
+    with open(datos["xsd"], "a", encoding="utf-8") as f:
+        f.write("\n")
+    assert addendas.xsd_fingerprint(datos["xsd"]) == _sha1(datos["xsd"]) != fp
+
+def test_archivo_que_no_existe(tmp_path):
+    assert addendas.xsd_fingerprint(str(tmp_path / "no.xsd")) == "no.xsd"
+
+@pytest.fixture
+def con_include(tmp_path):
+    principal, tipos = tmp_path / "principal.xsd", tmp_path / "tipos.xsd"
+    principal.write_text(f'<xs:schema {XS} targetNamespace="urn:m"><xs:include schemaLocation="tipos.xsd"/>'
+                         f'<xs:element name="R" type="T"/></xs:schema>', encoding="utf-8")
+    tipos.write_text(f'<xs:schema {XS}><xs:complexType name="T"/></xs:schema>', encoding="utf-8")
+    return str(principal), str(tipos)
+
+def test_huella_del_grafo(datos, con_include):
+    # XSD de un solo archivo: la misma llave de siempre
+    assert addendas.xsd_fingerprint_grafo(datos["xsd"]) == addendas.xsd_fingerprint(datos["xsd"])
+    principal, tipos = con_include
+    fp = addendas.xsd_fingerprint_grafo(principal)
+    assert fp != addendas.xsd_fingerprint(principal)
+    raiz = addendas.xsd_fingerprint(principal)
+    with open(tipos, "w", encoding="utf-8") as f:
+        f.write(f'<xs:schema {XS}><xs:complexType name="T"><xs:attribute name="A"/></xs:complexType></xs:schema>')
+    nuevo = addendas.xsd_fingerprint_grafo(principal)
+    assert nuevo != fp and addendas.xsd_fingerprint(principal) == raiz
+
+def test_grafo_sin_reparsear(con_include, monkeypatch):
+    principal, tipos = con_include
+    fp = addendas.xsd_fingerprint_grafo(principal)
+    raiz = addendas.xsd_fingerprint(principal)
+    deps = addendas._estado_db().execute("SELECT deps FROM grafos_xsd WHERE ruta=? AND fingerprint=?",
+                                         (os.path.abspath(principal), raiz)).fetchone()
+    assert deps == (f'[["{os.path.abspath(tipos)}", "{addendas.xsd_fingerprint(tipos)}"]]',)
+
+    def no_parsear(*a, **kw):
+        raise AssertionError("no debía cargar el grafo")
+    monkeypatch.setattr(addendas, "cargar_grafo_xsd", no_parsear)
+    assert addendas.xsd_fingerprint_grafo(principal) == fp
+    monkeypatch.setattr(addendas, "_GRAFOS", {})             # de la base de estado
+    assert addendas.xsd_fingerprint_grafo(principal) == fp
+
+def test_el_include_que_aparece_cambia_la_huella(con_include):
+    principal, tipos = con_include
+    os.remove(tipos)
+    sin = addendas.xsd_fingerprint_grafo(principal)
+    assert sin != addendas.xsd_fingerprint(principal)      # el faltante también cuenta
+    assert addendas.xsd_fingerprint_grafo(principal) == sin
+    with open(tipos, "w", encoding="utf-8") as f:
+        f.write(f'<xs:schema {XS}><xs:complexType name="T"/></xs:schema>')
+    con = addendas.xsd_fingerprint_grafo(principal)
+    assert con != sin
+    assert addendas.cargar_grafo_xsd(principal)["faltantes"] == []
+
+def test_mismo_xsd_en_otra_carpeta(con_include, tmp_path):
+    # mismo contenido del XSD raíz, pero su include relativo es otro archivo
+    principal, _tipos = con_include
+    otra = tmp_path / "otra"
+    os.makedirs(otra)
+    with open(principal, encoding="utf-8") as f:
+        (otra / "principal.xsd").write_text(f.read(), encoding="utf-8")
+    (otra / "tipos.xsd").write_text(f'<xs:schema {XS}><xs:complexType name="T"><xs:sequence/></xs:complexType>'
+                                    f'</xs:schema>', encoding="utf-8")
+    copia = str(otra / "principal.xsd")
+    assert addendas.xsd_fingerprint(copia) == addendas.xsd_fingerprint(principal)
+    assert addendas.xsd_fingerprint_grafo(copia) != addendas.xsd_fingerprint_grafo(principal)
@@ -0,0 +1,78 @@
+# test_overlay.py
+# Previsualizar/guardar sobre un overlay: la Addenda nueva se arma aparte (con copias de la previa), se valida
+# sola y el CFDI cargado no cambia por más veces que se previsualice.
+import pytest
+
+import addendas
+from conftest import perfil_prueba
+
+BACKENDS = ["etree"] + (["lxml"] if addendas.HAS_LXML else [])
+NS = {"prefix": "a", "uri": "urn:a"}
+
+@pytest.fixture(params=BACKENDS)
+def backend(request):
+    return addendas.usar_backend_xml(request.param)
+
+def _valores(datos, n="P.xml"):
+    ctx = addendas.extract_cfdi_context_stream(datos[n])
+    return addendas.aplicar_perfil(perfil_prueba(datos["xsd"]), ctx)
+
+def test_no_toca_el_cfdi_cargado(datos, backend):
+    root = backend.parse(datos["P.xml"]).getroot()
+    antes = backend.tostring(root)
+    previa = root.find(addendas.CFDI + "Addenda")
+    hijos = list(previa)
+    for _ in range(3):          # cada previsualización arma su overlay; nada se acumula en el CFDI
+        addenda = addendas.construir_addenda_overlay(_valores(datos), ns_cfg=NS, previa=previa)
+        addendas.serializar_addenda(addenda)                 # indenta y quita tails de los nodos
+    assert backend.tostring(root) == antes
+    assert list(previa) == hijos and len(root.findall(addendas.CFDI + "Addenda")) == 1
+    assert [addendas.localname(ch.tag) for ch in addenda] == ["DSCargaRemisionProv", "Addenda1"]
+    assert addenda[0] is not hijos[0]
+    assert backend.tostring(addenda[0]).strip() != ""
+
+def test_sin_previa(datos, backend):
+    addenda = addendas.construir_addenda_overlay(_valores(datos, "C.xml"), ns_cfg=NS)
+    assert addenda.tag == addendas.CFDI + "Addenda"
+    (nuevo,) = list(addenda)
+    assert nuevo.tag == "{urn:a}Addenda1" and nuevo.get("Version") == "1.0"
+    assert [addendas.localname(ch.tag) for ch in nuevo] == ["Cab", "Det", "Det"]
+
+@pytest.mark.skipif(not addendas.HAS_LXML, reason="sin lxml")
+def test_valida_solo_el_subarbol(datos, backend):
+    root = backend.parse(datos["M.xml"]).getroot()
+    antes = backend.tostring(root)
+    addenda = addendas.construir_addenda_overlay(_valores(datos, "M.xml"), ns_cfg=NS)
+    raiz = addendas.raiz_con_addenda(addenda, root.tag)
+    assert raiz.tag == root.tag and list(raiz) == [addenda] and len(raiz.attrib) == 0
+    assert addendas.validate_addenda_subtree_with_xsd(raiz, datos["xsd"], ns_uri="urn:a")[0]
+    addenda[0].set("Otro", "1")
+    ok, errs = addendas.validate_addenda_subtree_with_xsd(raiz, datos["xsd"], ns_uri="urn:a")
+    assert not ok and "Otro" in str(errs)
+    assert backend.tostring(root) == antes
+
+def test_guardar_empalma_una_sola_vez(datos, backend):
+    root = backend.parse(datos["P.xml"]).getroot()
+    with open(datos["P.xml"], "rb") as f:
+        original = f.read()
+    salidas = []
+    for _ in range(2):
+        addenda = addendas.construir_addenda_overlay(_valores(datos), ns_cfg=NS,
+                                                     previa=root.find(addendas.CFDI + "Addenda"))
+        salidas.append(addendas.cfdi_con_addenda_bytes(datos["P.xml"], addenda))
+    assert salidas[0] == salidas[1]
+    assert salidas[0].count(b"<cfdi:Addenda>") == 1 and salidas[0].count(b"<DSCargaRemisionProv>") == 1
+    assert salidas[0].count(b"Addenda1") == 2          # apertura y cierre
+    with open(datos["P.xml"], "rb") as f:
+        assert f.read() == original
+
+def test_resumen_cfdi(datos, backend):
+    root = backend.parse(datos["M.xml"]).getroot()
+    lineas = addendas.resumen_cfdi(root)
+    assert lineas == [
+        '<cfdi:Comprobante Version="4.0" Folio="1" Fecha="2025-09-19T13:52:47" Total="17.40" Moneda="MXN">',
+        "  <!-- cfdi:Emisor JUFA7608212V6 (CURSO MENDEZ) … -->",
+        "  <!-- cfdi:Receptor AAA010101AAA (SORIANA) … -->",
+        "  <!-- cfdi:Conceptos · 3 nodo(s) … -->",
+        "  <!-- cfdi:Impuestos · 1 nodo(s) … -->",
+        "  <!-- cfdi:Complemento UUID 00000000-5dd1-427e-8b88-b53ae09eaa74 · 1 nodo(s) … -->"]
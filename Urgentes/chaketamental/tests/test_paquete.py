@@ -0,0 +1,125 @@
+# test_paquete.py
+# Validación del CFDI completo sin red: cfdv40 + TFD desde la carpeta del paquete, más las addendas
+# registradas, en un esquema compuesto que se compila una vez; lo que no tiene esquema local se avisa.
+import os
+
+import pytest
+
+import addendas
+import lote
+from conftest import perfil_prueba
+
+pytestmark = pytest.mark.skipif(not addendas.HAS_LXML, reason="sin lxml")
+
+XS = 'xmlns:xs="http://www.w3.org/2001/XMLSchema"'
+SOLO_ATRIBUTOS = '<xs:complexType><xs:anyAttribute processContents="skip"/></xs:complexType>'
+CUALQUIERA = ('<xs:complexType><xs:sequence><xs:any processContents="skip" minOccurs="0" maxOccurs="unbounded"/>'
+              '</xs:sequence><xs:anyAttribute processContents="skip"/></xs:complexType>')
+# cfdv40 reducido: la forma del Comprobante; Complemento y Addenda validan estricto contra su esquema
+CFDV40 = f"""<xs:schema {XS} targetNamespace="http://www.sat.gob.mx/cfd/4" elementFormDefault="qualified">
+ <xs:element name="Comprobante"><xs:complexType><xs:sequence>
+   <xs:element name="Emisor">{SOLO_ATRIBUTOS}</xs:element>
+   <xs:element name="Receptor">{SOLO_ATRIBUTOS}</xs:element>
+   <xs:element name="Conceptos">{CUALQUIERA}</xs:element>
+   <xs:element name="Impuestos" minOccurs="0">{CUALQUIERA}</xs:element>
+   <xs:element name="Complemento" minOccurs="0"><xs:complexType><xs:sequence>
+     <xs:any processContents="strict" maxOccurs="unbounded"/></xs:sequence></xs:complexType></xs:element>
+   <xs:element name="Addenda" minOccurs="0"><xs:complexType><xs:sequence>
+     <xs:any processContents="strict" maxOccurs="unbounded"/></xs:sequence></xs:complexType></xs:element>
+ </xs:sequence>
+ <xs:attribute name="Version" fixed="4.0" use="required"/><xs:anyAttribute processContents="skip"/>
+ </xs:complexType></xs:element></xs:schema>"""
+TFD = f"""<xs:schema {XS} targetNamespace="http://www.sat.gob.mx/TimbreFiscalDigital">
+ <xs:element name="TimbreFiscalDigital"><xs:complexType>
+   <xs:attribute name="Version" fixed="1.1" use="required"/><xs:anyAttribute processContents="skip"/>
+ </xs:complexType></xs:element></xs:schema>"""
+
+@pytest.fixture
+def paquete():
+    d = addendas.PAQUETE_XSD_DIR
+    os.makedirs(d)
+    for nombre, xsd in (("cfdv40.xsd", CFDV40), ("TimbreFiscalDigitalv11.xsd", TFD)):
+        with open(os.path.join(d, nombre), "w", encoding="utf-8") as f:
+            f.write(xsd)
+    return d
+
+def _leer(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def _con_addenda(datos, n="M.xml"):
+    est = lote.preparar_perfil(datos["xsd"], perfil_prueba(datos["xsd"]))
+    return addendas.cfdi_con_addenda_bytes(datos[n], lote.armar_addenda_cfdi(est, datos[n])["addenda"])
+
+def test_sin_cfdv40_local(datos):
+    assert addendas.validar_cfdi_completo(datos["M.xml"]) == \
+        (None, "Sin copia local de cfdv40.xsd: no se validó el CFDI completo.")
+
+def test_ubicar_en_el_paquete(paquete, datos):
+    assert addendas.ubicar_xsd_paquete(addendas.CFDI_NS) == os.path.join(paquete, "cfdv40.xsd")
+    assert addendas.ubicar_xsd_paquete("urn:a") is None
+    addendas.registrar_xsd_paquete(datos["xsd"])
+    assert addendas.paquete_registrados() == {"urn:a": os.path.abspath(datos["xsd"])}
+    assert addendas.ubicar_xsd_paquete("urn:a") == os.path.abspath(datos["xsd"])
+    # lo registrado gana sobre la carpeta del paquete
+    assert addendas.ubicar_xsd_paquete(addendas.CFDI_NS, registrados={addendas.CFDI_NS: "otro.xsd"}) == "otro.xsd"
+
+def test_valida_todo_y_avisa_lo_que_no_tiene_esquema(paquete, datos):
+    # M.xml trae la DSCargaRemisionProv (sin namespace ni XSD): se quita de la validación y se avisa
+    ok, msg = addendas.validar_cfdi_completo(datos["M.xml"])
+    assert ok is True
+    assert msg == "OK\nSin esquema local (no se validó): (sin namespace)"
+
+def test_addenda_registrada(paquete, datos):
+    # la Addenda1 nueva se valida con su XSD; la DSCargaRemisionProv que ya traía sigue sin esquema
+    data = _con_addenda(datos)
+    assert addendas.validar_cfdi_completo(data, extra={"urn:a": datos["xsd"]}) == \
+        (True, "OK\nSin esquema local (no se validó): (sin namespace)")
+    ok, msg = addendas.validar_cfdi_completo(data)
+    assert ok is True and "(no se validó): urn:a" in msg
+    ok, msg = addendas.validar_cfdi_completo(data.replace(b'Version="1.0"', b'Version="1.0" Otro="1"', 1),
+                                             extra={"urn:a": datos["xsd"]})
+    assert ok is False and msg.startswith("Línea ") and "Otro" in msg
+
+def test_complemento_roto(paquete, datos):
+    data = _leer(datos["M.xml"]).replace(b'Version="1.1" UUID', b'Version="1.0" UUID')
+    ok, msg = addendas.validar_cfdi_completo(data)
+    assert ok is False and "TimbreFiscalDigital" in msg and "1.1" in msg
+
+def test_schema_location_que_no_corresponde(paquete, datos):
+    data = _leer(datos["M.xml"]).replace(b"cfd/4/cfdv40.xsd", b"cfd/4/cfdv33.xsd", 1)
+    ok, msg = addendas.validar_cfdi_completo(data)
+    assert ok is False
+    assert msg.splitlines()[0] == ("xsi:schemaLocation de http://www.sat.gob.mx/cfd/4 apunta a "
+                                   "http://www.sat.gob.mx/sitio_internet/cfd/4/cfdv33.xsd (se espera cfdv40.xsd).")
+
+def test_revisar_schema_location(datos):
+    root = addendas.leer_cfdi_lxml(datos["M.xml"]).getroot()
+    usados, problemas = addendas.revisar_cfdi_paquete(root)
+    # la ubicación que declara el documento (no la oficial); la addenda sin namespace no declara nada
+    assert usados == {
+        addendas.CFDI_NS: "http://www.sat.gob.mx/sitio_internet/cfd/4/cfdv40.xsd",
+        addendas.TFD_NS: "http://www.sat.gob.mx/sitio_internet/cfd/timbrefiscaldigital/TimbreFiscalDigitalv11.xsd",
+        "": None}
+    assert problemas == []
+    tfd = root.find(addendas.CFDI + "Complemento")[0]
+    del tfd.attrib[addendas.XSI + "schemaLocation"]
+    assert addendas.revisar_cfdi_paquete(root)[1] == \
+        [f"xsi:schemaLocation no declara el namespace {addendas.TFD_NS}."]
+
+def test_compila_una_vez(paquete, datos):
+    addendas.validar_cfdi_completo(datos["M.xml"])
+    antes = addendas.schema_cache_stats()
+    for _ in range(3):
+        assert addendas.validar_cfdi_completo(datos["C.xml"])[0] is True
+    despues = addendas.schema_cache_stats()
+    assert despues["misses"] == antes["misses"] and despues["hits"] == antes["hits"] + 3
+
+@pytest.mark.parametrize("backend", ["etree", "lxml"])
+def test_no_toca_el_arbol_cargado(paquete, datos, backend):
+    xml = addendas.usar_backend_xml(backend)
+    root = xml.parse(datos["M.xml"]).getroot()
+    antes = xml.tostring(root)
+    assert addendas.validar_cfdi_completo(root)[0] is True
+    assert xml.tostring(root) == antes
+    assert len(root.find(addendas.CFDI + "Addenda")) == 1
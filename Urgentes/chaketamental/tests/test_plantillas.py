@@ -0,0 +1,75 @@
+# test_plantillas.py
+# Una plantilla compilada rinde los mismos bytes que aplicar_perfil + construir_addenda + serializar_addenda.
+import pytest
+
+import addendas
+import lote
+from addendas import CFDI
+from conftest import CFDIS, perfil_prueba
+
+def _por_arbol(est, path):
+    return addendas.cfdi_con_addenda_bytes(path, lote.armar_addenda_cfdi(est, path)["addenda"])
+
+def _por_plantilla(pl, path):
+    ctx = addendas.extract_cfdi_context_stream(path)
+    tabla = addendas.extraer_tabla_conceptos(path) if pl["por_concepto"] else None
+    previa = addendas.leer_addenda_cfdi(path).find(CFDI + "Addenda")
+    return addendas.cfdi_con_addenda_bytes(path, addendas.serializador_plantilla(pl, ctx, tabla, previa=previa))
+
+def _compilar(est, path):
+    ctx = addendas.extract_cfdi_context_stream(path)
+    return addendas.compilar_plantilla(est["perfil"], ctx, est["rules"], est["shapes"], est["tipos"], est["ns_cfg"])
+
+@pytest.mark.parametrize("por_concepto", [True, False])
+def test_plantilla_igual_que_arbol(datos, por_concepto):
+    # C.xml va en una sola línea (variante compacta); M y P con sangría (variante bonita)
+    est = lote.preparar_perfil(datos["xsd"], perfil_prueba(datos["xsd"], por_concepto))
+    pl = _compilar(est, datos["M.xml"])   # mismo receptor en los tres: una plantilla para todos
+    assert pl["por_concepto"] is por_concepto
+    for n in CFDIS:
+        assert _por_plantilla(pl, datos[n]) == _por_arbol(est, datos[n]), n
+
+@pytest.mark.parametrize("backend", ["etree", "lxml"])
+def test_plantilla_guardada_en_el_lote(datos, tmp_path, backend):
+    if backend == "lxml" and not addendas.HAS_LXML:
+        pytest.skip("sin lxml")
+    addendas.usar_backend_xml(backend)
+    est = lote.preparar_perfil(datos["xsd"], perfil_prueba(datos["xsd"]))
+    addendas.guardar_plantilla(_compilar(est, datos["C.xml"]))
+    for n in CFDIS:
+        arm = lote.armar_addenda_cfdi(None, datos[n], plantillas=True)
+        assert arm["notas"] == ["plantilla AAA010101AAA"]
+        assert addendas.cfdi_con_addenda_bytes(datos[n], arm["addenda"]) == _por_arbol(est, datos[n]), n
+        if addendas.HAS_LXML:
+            ok, errs = lote.validar_addenda_armada(arm)
+            assert ok, errs
+
+def test_rendir_sin_conceptos(datos):
+    # tabla vacía: el nodo por línea va una vez con el ctx de la cabecera, seguido de las instancias de ejemplo
+    est = lote.preparar_perfil(datos["xsd"], perfil_prueba(datos["xsd"]))
+    pl = _compilar(est, datos["M.xml"])
+    ctx = addendas.extract_cfdi_context_stream(datos["M.xml"])
+    valores = addendas.aplicar_perfil(est["perfil"], ctx, est["rules"], shapes=est["shapes"],
+                                      tabla={"n": 0}, tipos=est["tipos"])
+    for bonito in (True, False):
+        # serializar_addenda indenta el árbol en sitio: uno nuevo por variante
+        overlay = addendas.construir_addenda_overlay(valores, est["ns_cfg"])
+        arbol = addendas.serializar_addenda(overlay, "cfdi", bonito)
+        assert addendas.serializador_plantilla(pl, ctx, {"n": 0})("cfdi", bonito) == arbol
+
+@pytest.mark.parametrize("por_concepto", [True, False])
+def test_contenido_mixto_usa_el_arbol(datos, por_concepto):
+    # texto e hijos en el mismo nodo: no se compila, la plantilla guarda el perfil y rinde lo mismo que el árbol
+    perfil = perfil_prueba(datos["xsd"], por_concepto)
+    perfil["roots"][0]["children"][1]["text"] = "texto <y> hijos"
+    est = lote.preparar_perfil(datos["xsd"], perfil)
+    pl = _compilar(est, datos["M.xml"])
+    assert "compacta" not in pl and pl["perfil"] == perfil and pl["reglas"] == est["rules"]
+    addendas.guardar_plantilla(pl)
+    for n in CFDIS:
+        esperado = _por_arbol(est, datos[n])
+        assert b"texto &lt;y&gt; hijos" in esperado
+        assert _por_plantilla(pl, datos[n]) == esperado, n
+        arm = lote.armar_addenda_cfdi(None, datos[n], plantillas=True)
+        assert arm["notas"] == ["plantilla AAA010101AAA"]
+        assert addendas.cfdi_con_addenda_bytes(datos[n], arm["addenda"]) == esperado, n
@@ -0,0 +1,71 @@
+# test_prefill.py
+# Índices de parse_addenda_xml_values (por nombre y por elemento) y prefill en bloque de las ocurrencias n..m.
+import io
+
+import pytest
+
+import addendas
+from main import FormModel
+
+ADDENDA = (b'<Addenda1 xmlns="urn:a" Version="1.0"><Cab Pedido="P1"/>'
+           b'<Det Sku="A" Cant="1"><Nota>uno</Nota></Det><Det Sku="B" Cant="2"><Nota>dos</Nota></Det>'
+           b'<Det Sku="C"/></Addenda1>')
+
+def _info():
+    return addendas.parse_addenda_xml_values(io.BytesIO(ADDENDA))
+
+def test_indices():
+    info = _info()
+    assert info["values"][("attr", "Det", "sku", "Addenda1/Det")] == ["A", "B", "C"]
+    assert info["por_nombre"][("attr", "Det", "cant")] == ["1", "2"]
+    assert info["por_local"] == {"Nota": ["uno", "dos"]}
+    assert info["ns_uri"] == "urn:a"
+
+def test_indice_toma_la_primera_ruta():
+    values = {("attr", "Det", "sku", "A/Det"): ["1"], ("attr", "Det", "sku", "B/Det"): ["2"],
+              ("text", "Nota", "#text", "B/Nota"): ["b"], ("text", "Nota", "#text", "A/Nota"): ["a"],
+              ("raro",): ["x"]}
+    idx = addendas.indexar_valores_addenda(values)
+    assert idx == {"por_nombre": {("attr", "Det", "sku"): ["1"]}, "por_local": {"Nota": ["b"]}}
+
+def test_dentro_de_un_cfdi(datos):
+    info = addendas.parse_addenda_xml_values(datos["M.xml"])
+    assert info["por_local"]["FolioPedido"] == ["123"]      # la de Pedidos; Articulos es otra ruta
+    assert info["por_nombre"][("attr", "Remision", "id")] == ["Remision0"]
+
+@pytest.fixture
+def model(datos):
+    return FormModel(*addendas.parse_xsd_shapes(datos["xsd"]))
+
+def _dets(model):
+    return [(d["attributes"]["Sku"], d["attributes"]["Cant"],
+             d["children"][0]["text"] if d["children"] else None)
+            for d in model.collect()["roots"][0]["children"][1:]]
+
+def test_rango_completo(model):
+    assert model.prefill_rango(_info(), 1, 3) == 9
+    # la k-ésima instancia toma la ocurrencia n+k; lo que no alcanza queda vacío
+    assert _dets(model) == [("A", "1", "uno"), ("B", "2", "dos"), ("C", "", None)]
+    root = model.collect()["roots"][0]
+    assert root["attributes"] == {"Version": "1.0"} and root["children"][0]["attributes"] == {"Pedido": "P1"}
+
+def test_rango_desde_n(model):
+    model.prefill_rango(_info(), 2, 3)
+    assert _dets(model) == [("B", "2", "dos"), ("C", "", None)]
+    # fuera de los repetibles se usa la ocurrencia n (o la primera si no hay tantas)
+    assert model.collect()["roots"][0]["children"][0]["attributes"] == {"Pedido": "P1"}
+
+def test_rango_de_uno_es_prefill(model, datos):
+    otro = FormModel(*addendas.parse_xsd_shapes(datos["xsd"]))
+    assert model.prefill_rango(_info(), 2, 2) == otro.prefill(_info(), 2)
+    assert model.collect() == otro.collect()
+
+def test_rango_respeta_max_occurs_y_lo_capturado(datos, tmp_path):
+    with open(datos["xsd"], encoding="utf-8") as f:
+        xsd = f.read().replace('maxOccurs="unbounded"', 'maxOccurs="2"')
+    p = tmp_path / "tope.xsd"
+    p.write_text(xsd, encoding="utf-8")
+    model = FormModel(*addendas.parse_xsd_shapes(str(p)))
+    model.buscar("Addenda1/Det", "attr", "Sku").set("fijo")
+    model.prefill_rango(_info(), 1, 3)
+    assert _dets(model) == [("fijo", "1", "uno"), ("B", "2", "dos")]
@@ -0,0 +1,80 @@
+# test_reglas_db.py
+# Store SQLite de reglas de autollenado: guardar/cargar, correcciones del usuario, importación única del JSON
+# viejo y migración de las tablas de estado que vivían en la base de reglas.
+import json
+import os
+import sqlite3
+
+import addendas
+
+def test_guardar_y_cargar():
+    assert addendas.reglas_cargar("fp") is None
+    addendas.reglas_guardar("fp", {"Folio": "folio", "Uuid": "uuid"})
+    assert addendas.reglas_cargar("fp") == {"Folio": "folio", "Uuid": "uuid"}
+    addendas.reglas_guardar("fp", {"Folio": "serie", "Total": "total"})
+    assert addendas.reglas_cargar("fp") == {"Folio": "serie", "Uuid": "uuid", "Total": "total"}
+    addendas.reglas_guardar("vacio", {})
+    assert addendas.reglas_cargar("vacio") == {}          # inferido, pero sin reglas: no se vuelve a inferir
+    assert os.path.exists(addendas.RULES_DB_PATH)
+
+def test_correccion_del_usuario_gana():
+    addendas.reglas_guardar("fp", {"Folio": "folio"})
+    addendas.reglas_override("fp", "Folio", "serie")
+    addendas.reglas_override("fp", "Nuevo", "uuid")
+    addendas.reglas_guardar("fp", {"Folio": "folio", "Nuevo": "total"})   # volver a inferir no la pisa
+    assert addendas.reglas_cargar("fp") == {"Folio": "serie", "Nuevo": "uuid"}
+    addendas.reglas_override("fp", "Folio", "")
+    assert addendas.reglas_cargar("fp") == {"Folio": "folio", "Nuevo": "uuid"}
+
+def test_reglas_para_xsd_infiere_una_vez(datos, monkeypatch):
+    inferidas = addendas.reglas_para_xsd(datos["xsd"])
+    fp = addendas.xsd_fingerprint(datos["xsd"])
+    assert addendas.reglas_cargar(fp) == inferidas
+
+    def no_inferir(*a, **kw):
+        raise AssertionError("no debía volver a inferir")
+    monkeypatch.setattr(addendas, "build_autofill_rules_from_xsd", no_inferir)
+    assert addendas.reglas_para_xsd(datos["xsd"]) == inferidas
+
+def test_importa_el_json_viejo_una_vez():
+    os.makedirs(addendas.LEGADO_DIR)
+    with open(addendas.CACHE_PATH, "w", encoding="utf-8") as f:
+        json.dump({"fp1": {"Folio": "folio"}, "fp2": {}, "fp3": "no es dict"}, f)
+    assert addendas.reglas_cargar("fp1") == {"Folio": "folio"}
+    assert addendas.reglas_cargar("fp2") is None and addendas.reglas_cargar("fp3") is None
+    marca = addendas._rules_db().execute("SELECT valor FROM meta WHERE clave='json_importado'").fetchone()
+    assert marca == (addendas.CACHE_PATH,)
+    # ya marcado: otra preparación de la base no vuelve a leer el JSON
+    with open(addendas.CACHE_PATH, "w", encoding="utf-8") as f:
+        json.dump({"fp1": {"Folio": "otro"}}, f)
+    addendas._importar_cache_json(addendas._rules_db())
+    assert addendas.reglas_cargar("fp1") == {"Folio": "folio"}
+
+def test_migra_estado_desde_la_base_de_reglas_vieja(tmp_path):
+    # versión anterior: base de reglas en la carpeta de trabajo con paquete y vigilancia adentro
+    os.makedirs(addendas.LEGADO_DIR)
+    xsd = tmp_path / "p.xsd"
+    xsd.write_text("<x/>", encoding="utf-8")
+    vieja = sqlite3.connect(os.path.join(addendas.LEGADO_DIR, "xsd_autofill_rules.db"))
+    with vieja:
+        vieja.executescript(addendas._ESQUEMA_REGLAS + """
+            CREATE TABLE paquete (namespace TEXT PRIMARY KEY, ruta TEXT NOT NULL, registrado REAL);
+            CREATE TABLE vigilancia (ruta TEXT PRIMARY KEY, firma TEXT NOT NULL, estado TEXT, salida TEXT,
+                                     mensaje TEXT, procesado REAL);
+            CREATE TABLE huellas (ruta TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, ino INTEGER, sha1 TEXT);
+        """)
+        vieja.execute("INSERT INTO xsds VALUES ('fp', 0)")
+        vieja.execute("INSERT INTO reglas VALUES ('fp', 'Folio', 'folio', NULL)")
+        vieja.execute("INSERT INTO paquete VALUES ('urn:p', ?, 0)", (str(xsd),))
+        vieja.execute("INSERT INTO vigilancia VALUES (?, '1:2', 'ok', NULL, '', 0)", (str(tmp_path / "e" / "A.xml"),))
+    vieja.close()
+
+    assert addendas.paquete_registrados() == {"urn:p": str(xsd)}
+    assert addendas.bitacora_vigilancia(str(tmp_path / "e")) == {str(tmp_path / "e" / "A.xml"): "1:2"}
+    assert addendas.reglas_cargar("fp") == {"Folio": "folio"}
+    tablas = {r[0] for r in addendas._rules_db().execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    assert tablas == {"xsds", "reglas", "meta"}
+    # la vieja en la carpeta de trabajo no se toca
+    vieja = sqlite3.connect(os.path.join(addendas.LEGADO_DIR, "xsd_autofill_rules.db"))
+    assert vieja.execute("SELECT COUNT(*) FROM paquete").fetchone() == (1,)
+    vieja.close()
@@ -0,0 +1,136 @@
+# test_secciones.py
+# Formulario perezoso: los valores viven en el modelo (lo no pintado también se recolecta y autollena),
+# el buscador abre las secciones de la ruta del campo y "+ Añadir otro" respeta maxOccurs.
+import pytest
+
+import addendas
+import main
+from main import FormModel
+
+class _Var:
+    """Lo que usa CampoSlot de un tk.StringVar."""
+    def __init__(self, valor=""):
+        self.valor = valor
+
+    def get(self):
+        return self.valor
+
+    def set(self, v):
+        self.valor = v
+
+@pytest.fixture
+def model(datos):
+    return FormModel(*addendas.parse_xsd_shapes(datos["xsd"]))
+
+def _det(model):
+    (addenda,) = model.raices[0][1]
+    return next((sh, lst) for sh, lst in addenda.hijos if sh["name"] == "Det")
+
+def test_slot_ligado_y_sin_ligar(model):
+    slot = model.buscar("Addenda1/Cab", "attr", "Pedido")
+    slot.set("P1")
+    var = _Var("basura")
+    slot.bind(var)                      # al pintarse, el widget toma lo que ya tenía el modelo
+    assert var.get() == "P1"
+    var.set("P2")
+    assert slot.get() == "P2"
+    slot.bind(_Var())                   # re-render: conserva lo capturado
+    assert slot.get() == "P2"
+    slot.unbind()
+    assert (slot.var, slot.get()) == (None, "P2")
+
+def test_secciones_sin_abrir_se_recolectan_y_autollenan(model, datos):
+    # solo la raíz está pintada; Det y Nota nunca se abrieron
+    version = model.buscar("Addenda1", "attr", "Version")
+    version.bind(_Var())
+    ctx = addendas.extract_cfdi_context_stream(datos["M.xml"])
+    n = model.autollenar(ctx, {"Version": "moneda", "Sku": "concepto1_noid", "Nota": "concepto1_descripcion"})
+    assert n == 3 and version.var.get() == "MXN"
+    assert model.buscar("Addenda1/Det", "attr", "Sku").var is None
+    root = model.collect()["roots"][0]
+    assert root["attributes"] == {"Version": "MXN"}
+    assert root["children"][1] == {"name": "Det", "attributes": {"Sku": "BOTELLA", "Cant": ""}, "children": [
+        {"name": "Nota", "attributes": {}, "children": [], "text": "BOTELLA DE AGUA 600ML"}]}
+
+def test_encontrar(model):
+    assert [(s.owner_path, s.name) for s in model.encontrar("NOTA")] == [("Addenda1/Det/Nota", "#text")]
+    # por nombre lógico o por ruta, en orden del formulario
+    assert [s.name for s in model.encontrar("det")] == ["Sku", "Cant", "#text"]
+    assert model.encontrar("") == [] and model.encontrar("nada") == []
+
+def test_ruta_de(model):
+    sh, lst = _det(model)
+    segundo = model.agregar(lst, sh, "Addenda1/Det")
+    nota = segundo.hijos[0][1][0].text
+    ruta = model.ruta_de(nota)
+    assert [inst.path for _lst, inst in ruta] == ["Addenda1", "Addenda1/Det", "Addenda1/Det/Nota"]
+    assert ruta[0][0] is model.raices[0][1] and ruta[1] == (lst, segundo)
+    assert model.ruta_de(main.CampoSlot("attr", "X", "Y", "Y")) == []
+
+class _App:
+    """Lo que usan buscar_campo, _agregar_instancia y _eliminar_instancia de AddendaApp (sin ventana)."""
+    buscar_campo = main.AddendaApp.buscar_campo
+    _agregar_instancia = main.AddendaApp._agregar_instancia
+    _eliminar_instancia = main.AddendaApp._eliminar_instancia
+
+    def __init__(self, model):
+        self.model = model
+        self.buscar_var, self.status_var = _Var(), _Var()
+        self._busqueda = ("", 0)
+        self._widgets_slot = {}
+        self.abiertas, self.pintadas = [], []
+        # como _render_modelo: la raíz y cada grupo de hijos son secciones
+        self._secciones = {}
+        pendientes = list(model.raices)
+        while pendientes:
+            sh, lst = pendientes.pop()
+            self._secciones[id(lst)] = lambda nombre=sh["name"]: self.abiertas.append(nombre)
+            for inst in lst:
+                pendientes.extend(inst.hijos)
+
+    def _render_instancia(self, wrap, inst, lista, nivel):
+        self.pintadas.append(inst.path)
+
+def test_buscar_abre_las_secciones_de_la_ruta(model):
+    app = _App(model)
+    app.buscar_var.set("nota")
+    app.buscar_campo()
+    assert app.abiertas == ["Addenda1", "Det", "Nota"]
+    assert app.status_var.get() == "Addenda1/Det/Nota · Nota (1/1)"
+    app.buscar_var.set("det")
+    for esperado in ("Addenda1/Det · Sku (1/3)", "Addenda1/Det · Cant (2/3)", "Addenda1/Det/Nota · Nota (3/3)",
+                     "Addenda1/Det · Sku (1/3)"):
+        app.buscar_campo()                          # Enter otra vez: siguiente coincidencia
+        assert app.status_var.get() == esperado
+    app.buscar_var.set("zzz")
+    app.buscar_campo()
+    assert app.status_var.get() == "Sin coincidencias para 'zzz'"
+
+def test_agregar_respeta_max_occurs(model, monkeypatch):
+    avisos = []
+    monkeypatch.setattr(main.messagebox, "showinfo", lambda titulo, msg: avisos.append(msg))
+    app = _App(model)
+    sh, lst = _det(model)
+    app._agregar_instancia(None, dict(sh, maxOccurs="2"), lst, "Addenda1/Det", 1)
+    app._agregar_instancia(None, dict(sh, maxOccurs="2"), lst, "Addenda1/Det", 1)
+    assert len(lst) == 2 and app.pintadas == ["Addenda1/Det"]
+    assert avisos == ["Det admite máximo 2 ocurrencias."]
+    app._agregar_instancia(None, sh, lst, "Addenda1/Det", 1)          # unbounded
+    assert len(lst) == 3
+
+def test_eliminar_limpia_secciones_y_campos(model):
+    class _Frame:
+        destruido = False
+
+        def destroy(self):
+            self.destruido = True
+    app = _App(model)
+    sh, lst = _det(model)
+    otro = model.agregar(lst, sh, "Addenda1/Det")
+    app._secciones[id(otro.hijos[0][1])] = lambda: None
+    app._widgets_slot[id(otro.attrs["Sku"])] = object()
+    frame = _Frame()
+    app._eliminar_instancia(frame, lst, otro)
+    assert frame.destruido and len(lst) == 1 and otro not in lst
+    assert id(otro.hijos[0][1]) not in app._secciones and app._widgets_slot == {}
+    assert model.buscar("Addenda1/Det", "attr", "Sku", idx=1) is None
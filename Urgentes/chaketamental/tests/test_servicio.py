@@ -0,0 +1,135 @@
+# test_servicio.py
+# Servicio HTTP local: rutas, códigos de error (404/411/413/400/503), límite de hilos y /estado.
+import http.client
+import json
+import threading
+import time
+
+import pytest
+
+import addendas
+import lote
+import servicio
+from conftest import perfil_prueba
+
+def _leer(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+@pytest.fixture
+def levantar(datos, tmp_path):
+    """levantar(**kw) → puerto de un servicio con el perfil de prueba ("prueba"); se apaga al terminar."""
+    perfil = tmp_path / "prueba.json"
+    perfil.write_text(json.dumps(perfil_prueba(datos["xsd"])), encoding="utf-8")
+    servidores = []
+
+    def _levantar(**kw):
+        srv = servicio.iniciar_servicio([str(perfil)], puerto=0, log=None, **kw)
+        threading.Thread(target=srv.serve_forever, daemon=True).start()
+        servidores.append(srv)
+        return srv.server_address[1]
+    yield _levantar
+    for srv in servidores:
+        srv.shutdown()
+        srv.server_close()
+
+def _pedir(puerto, metodo, ruta, cuerpo=None, headers=None):
+    con = http.client.HTTPConnection("127.0.0.1", puerto, timeout=10)
+    try:
+        con.request(metodo, ruta, body=cuerpo, headers=headers or {})
+        r = con.getresponse()
+        data = r.read()
+        if r.getheader("Content-Type", "").startswith("application/json"):
+            data = json.loads(data)
+        return r.status, data, r
+    finally:
+        con.close()
+
+def test_rutas(datos, levantar):
+    puerto = levantar()
+    cfdi = _leer(datos["M.xml"])
+    codigo, ctx, _ = _pedir(puerto, "POST", "/contexto", cfdi)
+    assert codigo == 200 and ctx == addendas.extract_cfdi_context_stream(datos["M.xml"])
+
+    est = lote.preparar_perfil(datos["xsd"], perfil_prueba(datos["xsd"]))
+    arm = lote.armar_addenda_cfdi(est, datos["M.xml"])
+    codigo, res, r = _pedir(puerto, "POST", "/addenda?perfil=prueba", cfdi)
+    assert codigo == 200 and float(r.getheader("X-Tiempo-ms")) >= 0
+    assert res["addenda"] == addendas.serializar_addenda(arm["addenda"], "cfdi", False).decode("utf-8")
+    assert res["ns"] == "urn:a"
+    if addendas.HAS_LXML:
+        assert res["valida"] is True and res["errores"] == []
+
+    codigo, out, r = _pedir(puerto, "POST", "/adjuntar", cfdi)
+    assert codigo == 200 and r.getheader("Content-Type").startswith("application/xml")
+    assert out == addendas.cfdi_con_addenda_bytes(datos["M.xml"], arm["addenda"])
+
+    if addendas.HAS_LXML:
+        codigo, res, _ = _pedir(puerto, "POST", "/validar?ns=urn:a", out)
+        assert codigo == 200 and res["valida"] is True and res["ns"] == "urn:a"
+        codigo, res, _ = _pedir(puerto, "POST", "/validar", out.replace(b'Version="1.0"', b'Version="1.0" Otro="1"'))
+        assert codigo == 200 and res["valida"] is False and res["errores"]
+
+def test_errores(datos, levantar, monkeypatch):
+    puerto = levantar()
+    cfdi = _leer(datos["C.xml"])
+    assert _pedir(puerto, "POST", "/nada", cfdi)[0] == 404
+    assert _pedir(puerto, "GET", "/nada")[0] == 404
+    assert _pedir(puerto, "POST", "/addenda?perfil=otro", cfdi)[:2] == (404, {"error": "Perfil desconocido: otro"})
+    assert _pedir(puerto, "POST", "/contexto", b"", {"Content-Length": "0"})[0] == 411
+    assert _pedir(puerto, "POST", "/contexto", b"x", {"Content-Length": "abc"})[0] == 411
+    codigo, res, _ = _pedir(puerto, "POST", "/contexto", b"<cfdi:Comprobante")
+    assert codigo == 400 and res["error"].startswith("XML mal formado")
+    monkeypatch.setattr(servicio, "SERVICIO_MAX_BYTES", 100)
+    assert _pedir(puerto, "POST", "/contexto", cfdi)[0] == 413
+
+def test_cola_llena_responde_503(datos, levantar):
+    puerto = levantar(hilos=1, cola=1)
+    cupo = servicio._SERVICIO["cupo"]
+    assert cupo.acquire(blocking=False)       # ocupa el único lugar de la cola
+    try:
+        codigo, res, _ = _pedir(puerto, "POST", "/contexto", _leer(datos["C.xml"]))
+        assert codigo == 503 and "saturado" in res["error"]
+    finally:
+        cupo.release()
+    assert _pedir(puerto, "POST", "/contexto", _leer(datos["C.xml"]))[0] == 200
+    assert servicio.servicio_estado()["peticiones"]["rechazadas"] == 1
+
+def test_a_lo_mas_hilos_trabajando(datos, levantar, monkeypatch):
+    # el trabajo corre en el hilo de cada petición; `hilos` acota cuántos trabajan a la vez
+    puerto = levantar(hilos=2, cola=8)
+    activos, maximo, candado = [0], [0], threading.Lock()
+
+    def lento(data, consulta):
+        with candado:
+            activos[0] += 1
+            maximo[0] = max(maximo[0], activos[0])
+        time.sleep(0.05)
+        with candado:
+            activos[0] -= 1
+        return 200, {"n": len(data)}
+    monkeypatch.setitem(servicio._SERVICIO_RUTAS, "/contexto", lento)
+    codigos = []
+    hilos = [threading.Thread(target=lambda: codigos.append(_pedir(puerto, "POST", "/contexto", b"<a/>")[0]))
+             for _ in range(6)]
+    for h in hilos:
+        h.start()
+    for h in hilos:
+        h.join()
+    assert codigos == [200] * 6
+    assert maximo[0] == 2
+
+def test_estado(datos, levantar):
+    puerto = levantar(hilos=3, cola=5)
+    cfdi = _leer(datos["P.xml"])
+    for ruta in ("/contexto", "/contexto", "/addenda", "/addenda?perfil=otro"):
+        _pedir(puerto, "POST", ruta, cfdi)
+    codigo, est, _ = _pedir(puerto, "GET", "/estado")
+    assert codigo == 200
+    assert est["perfiles"] == ["prueba"] and est["default"] == "prueba"
+    assert (est["hilos"], est["cola_max"]) == (3, 5)
+    assert est["backend"] == addendas.XML.nombre
+    p = est["peticiones"]
+    assert (p["contexto"], p["addenda"], p["errores"]) == (2, 2, 1)
+    assert p["ms_promedio"] > 0 and "ms_total" not in p
+    assert set(est["schema_cache"]) >= {"hits", "misses", "size", "max"}
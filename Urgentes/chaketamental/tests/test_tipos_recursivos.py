@@ -0,0 +1,79 @@
+# test_tipos_recursivos.py
+# Tipos recursivos: el parseo se detiene en nodos perezosos, expandir_shape los abre bajo demanda,
+# los cuerpos de tipos con nombre se comparten y el formulario crea los hijos obligatorios un solo nivel.
+import pytest
+
+import addendas
+from main import FormModel
+
+XSD = """<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema" targetNamespace="urn:r" xmlns="urn:r"
+    elementFormDefault="qualified">
+ <xs:complexType name="NodoT"><xs:sequence>
+   <xs:element name="Hijo" type="NodoT" maxOccurs="unbounded"/>
+   <xs:element name="Extra" type="NodoT" minOccurs="0"/>
+ </xs:sequence><xs:attribute name="Id" use="required"/></xs:complexType>
+ <xs:element name="Arbol"><xs:complexType><xs:sequence>
+   <xs:element name="Raiz" type="NodoT"/>
+   <xs:element name="Otro" type="NodoT" minOccurs="0"/>
+ </xs:sequence></xs:complexType></xs:element>
+</xs:schema>"""
+
+@pytest.fixture
+def recursivo(tmp_path):
+    p = tmp_path / "r.xsd"
+    p.write_text(XSD, encoding="utf-8")
+    return str(p)
+
+def test_nodo_perezoso(recursivo):
+    shapes, tipos = addendas.parse_xsd_shapes(recursivo)
+    (arbol,) = shapes
+    raiz, otro = arbol["children"]
+    assert list(tipos) == ["{urn:r}NodoT"]
+    assert raiz["type_ref"] == otro["type_ref"] == "{urn:r}NodoT"
+    # el cuerpo del tipo se expande una vez y lo comparten todos los que lo usan
+    assert raiz["children"] is otro["children"] is tipos["{urn:r}NodoT"]["children"]
+    hijo, extra = raiz["children"]
+    assert (hijo["lazy"], extra["lazy"]) == (True, True)
+    assert hijo["children"] == [] and hijo["type_ref"] == "{urn:r}NodoT"
+    assert [a["name"] for a in raiz["attributes"]] == ["Id"]
+
+def test_expandir_shape(recursivo):
+    shapes, tipos = addendas.parse_xsd_shapes(recursivo)
+    hijo = shapes[0]["children"][0]["children"][0]
+    abierto = addendas.expandir_shape(hijo, tipos)
+    assert abierto is not hijo and not abierto["lazy"] and hijo["lazy"]
+    assert [c["name"] for c in abierto["children"]] == ["Hijo", "Extra"]
+    assert abierto["children"][0]["lazy"]          # el siguiente nivel sigue perezoso
+    assert addendas.expandir_shape(abierto, tipos) is abierto
+    assert addendas.expandir_shape(hijo, {}) is hijo   # sin la tabla de tipos no hay con qué abrirlo
+
+def test_cache_conserva_perezosos_y_compartidos(recursivo):
+    addendas.parse_xsd_cached(recursivo)
+    shapes, tipos = addendas.parse_xsd_cached(recursivo)
+    raiz, otro = shapes[0]["children"]
+    assert raiz["children"] is otro["children"] is tipos["{urn:r}NodoT"]["children"]
+    assert raiz["children"][0]["lazy"] and raiz["children"][0]["children"] == []
+
+def _paths(inst):
+    out = [inst.path]
+    for _sh, lst in inst.hijos:
+        for ch in lst:
+            out.extend(_paths(ch))
+    return out
+
+def test_formulario_obligatorios_un_nivel(recursivo):
+    model = FormModel(*addendas.parse_xsd_shapes(recursivo))
+    (arbol,) = model.raices[0][1]
+    # Hijo (minOccurs=1) se crea una vez debajo de Raiz/Otro; Extra (minOccurs=0) no; más abajo, nada
+    assert _paths(arbol) == ["Arbol", "Arbol/Raiz", "Arbol/Raiz/Hijo", "Arbol/Otro", "Arbol/Otro/Hijo"]
+    hijo = arbol.hijos[0][1][0].hijos[0][1][0]
+    assert [(sh["name"], lst) for sh, lst in hijo.hijos] == [("Hijo", []), ("Extra", [])]
+
+    # agregar a mano abre un nivel más
+    sh, lst = hijo.hijos[0]
+    nieto = model.agregar(lst, sh, "Arbol/Raiz/Hijo/Hijo")
+    assert _paths(nieto) == ["Arbol/Raiz/Hijo/Hijo", "Arbol/Raiz/Hijo/Hijo/Hijo"]
+    nieto.attrs["Id"].set("3")
+    roots = model.collect()["roots"]
+    assert roots[0]["children"][0]["children"][0]["children"][0]["attributes"] == {"Id": "3"}
+    assert model.faltantes().count("Id") == 5
@@ -0,0 +1,87 @@
+# test_validacion.py
+# Validación masiva: estado por archivo (valido/invalido/sin_xsd/sin_addenda) y reporte CSV/JSON.
+import csv
+import json
+import os
+import re
+
+import pytest
+
+import addendas
+import biblioteca_xsd
+import lote
+import validacion
+from conftest import CFDIS, perfil_prueba
+
+pytestmark = pytest.mark.skipif(not addendas.HAS_LXML, reason="sin lxml")
+
+def _leer(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def _escribir(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+@pytest.fixture
+def addendados(datos, tmp_path):
+    """Los tres CFDI de datos/ addendados, más uno inválido, uno sin XSD y uno sin Addenda."""
+    salida = tmp_path / "salida"
+    os.makedirs(salida)
+    est = lote.preparar_perfil(datos["xsd"], perfil_prueba(datos["xsd"]))
+    for n in CFDIS:
+        assert lote.procesar_cfdi(datos[n], est, str(salida))["estado"] == "ok"
+    ok = _leer(str(salida / "M_con_addenda.xml"))
+    _escribir(str(salida / "X_con_addenda.xml"), ok.replace(b'Version="1.0"', b'Version="1.0" Otro="1"', 1))
+    previa = _leer(datos["P.xml"])   # solo la DSCargaRemisionProv original, sin XSD conocido
+    _escribir(str(salida / "S_con_addenda.xml"), previa)
+    _escribir(str(salida / "V_con_addenda.xml"),
+              re.sub(rb"\s*<cfdi:Addenda>.*?</cfdi:Addenda>", b"", previa, flags=re.S))
+    _escribir(str(salida / "no_es_salida.xml"), previa)   # no casa con el patrón
+    return str(salida)
+
+ESPERADO = {"C_con_addenda.xml": "valido", "M_con_addenda.xml": "valido", "P_con_addenda.xml": "valido",
+            "X_con_addenda.xml": "invalido", "S_con_addenda.xml": "sin_xsd", "V_con_addenda.xml": "sin_addenda"}
+
+def _por_archivo(filas):
+    return {os.path.basename(f["archivo"]): f for f in filas}
+
+def test_lote_csv(datos, addendados):
+    filas, resumen = validacion.validar_lote_addendas(addendados, xsds=[datos["xsd"]], procesos=2, log=None)
+    por = _por_archivo(filas)
+    assert {n: f["estado"] for n, f in por.items()} == ESPERADO
+    assert resumen["archivos"] == 6 and resumen["validos"] == 3
+    assert (resumen["invalidos"], resumen["sin_xsd"], resumen["sin_addenda"], resumen["errores"]) == (1, 1, 1, 0)
+    x = por["X_con_addenda.xml"]
+    assert (x["ns"], x["raiz"], x["xsd"]) == ("urn:a", "Addenda1", os.path.abspath(datos["xsd"]))
+    assert x["errores"] and x["errores"][0]["linea"] and "Otro" in x["errores"][0]["mensaje"]
+    assert por["S_con_addenda.xml"]["raiz"] == "DSCargaRemisionProv"
+
+    assert resumen["reporte"] == os.path.join(addendados, "reporte_validacion.csv")
+    with open(resumen["reporte"], newline="", encoding="utf-8") as f:
+        csv_filas = {os.path.basename(r["archivo"]): r for r in csv.DictReader(f)}
+    assert {n: r["estado"] for n, r in csv_filas.items()} == ESPERADO
+    assert csv_filas["X_con_addenda.xml"]["lineas"] == str(x["errores"][0]["linea"])
+    assert csv_filas["X_con_addenda.xml"]["errores"].startswith(f"Línea {x['errores'][0]['linea']}: ")
+    assert csv_filas["C_con_addenda.xml"]["errores"] == ""
+
+def test_lote_json_y_patron(datos, addendados, tmp_path):
+    reporte = str(tmp_path / "reporte.json")
+    filas, resumen = validacion.validar_lote_addendas(addendados, xsds=[datos["xsd"]], procesos=1,
+                                                      reporte=reporte, patron="[CX]_*.xml", log=None)
+    assert {n: f["estado"] for n, f in _por_archivo(filas).items()} == \
+        {"C_con_addenda.xml": "valido", "X_con_addenda.xml": "invalido"}
+    with open(reporte, encoding="utf-8") as f:
+        data = json.load(f)
+    assert data["resumen"]["archivos"] == 2 and data["resumen"]["invalidos"] == 1
+    assert data["archivos"] == filas
+
+def test_sin_xsd_indicado_usa_la_biblioteca(datos, addendados):
+    # el XSD copiado a la biblioteca se ubica por namespace/raíz
+    os.makedirs(biblioteca_xsd.XSD_BIBLIOTECA_DIR)
+    dst = os.path.join(biblioteca_xsd.XSD_BIBLIOTECA_DIR, "a.xsd")
+    _escribir(dst, _leer(datos["xsd"]))
+    filas, _ = validacion.validar_lote_addendas(addendados, procesos=1, log=None)
+    por = _por_archivo(filas)
+    assert por["M_con_addenda.xml"]["estado"] == "valido"
+    assert por["M_con_addenda.xml"]["xsd"] == os.path.abspath(dst)
@@ -0,0 +1,96 @@
+# test_vigilancia.py
+# Vigilancia de carpeta (una_vez): asentamiento, bitácora (no repite, reprocesa si cambia) y errores al registrar.
+import json
+import os
+import shutil
+import sqlite3
+import time
+
+import pytest
+
+import addendas
+import vigilancia
+from conftest import CFDIS, perfil_prueba
+
+@pytest.fixture
+def carpetas(datos, tmp_path):
+    """(entrada con los tres CFDI ya asentados, salida, perfil.json)."""
+    entrada, salida = tmp_path / "entrada", tmp_path / "salida"
+    os.makedirs(entrada)
+    viejo = time.time() - 3600
+    for n in CFDIS:
+        shutil.copy(datos[n], entrada / n)
+        os.utime(entrada / n, (viejo, viejo))
+    perfil = tmp_path / "perfil.json"
+    perfil.write_text(json.dumps(perfil_prueba(datos["xsd"])), encoding="utf-8")
+    return str(entrada), str(salida), str(perfil)
+
+def _vigilar(entrada, salida, perfil, **kw):
+    kw.setdefault("intervalo", 0.01)
+    return vigilancia.vigilar_carpeta(entrada, salida, perfil=perfil, una_vez=True, log=None, **kw)
+
+def test_una_vez_procesa_lo_asentado(carpetas):
+    entrada, salida, perfil = carpetas
+    res = _vigilar(entrada, salida, perfil)
+    assert (res["procesados"], res["ok"], res["errores"]) == (3, 3, 0)
+    assert sorted(os.listdir(salida)) == sorted([n[:-4] + "_con_addenda.xml" for n in CFDIS]
+                                                + ["estado_vigilancia.json"])
+    with open(os.path.join(salida, "estado_vigilancia.json"), encoding="utf-8") as f:
+        assert json.load(f)["procesados"] == 3
+    bit = addendas.bitacora_vigilancia(entrada)
+    assert sorted(bit) == sorted(os.path.join(entrada, n) for n in CFDIS)
+    st = os.stat(os.path.join(entrada, "M.xml"))
+    assert bit[os.path.join(entrada, "M.xml")] == f"{st.st_size}:{st.st_mtime_ns}"
+
+def test_bitacora_no_repite_y_reprocesa_si_cambia(carpetas):
+    entrada, salida, perfil = carpetas
+    _vigilar(entrada, salida, perfil)
+    assert _vigilar(entrada, salida, perfil)["procesados"] == 0
+    m = os.path.join(entrada, "M.xml")
+    with open(m, "ab") as f:
+        f.write(b"\n")
+    viejo = time.time() - 3600
+    os.utime(m, (viejo, viejo))
+    res = _vigilar(entrada, salida, perfil)
+    assert (res["procesados"], res["ok"]) == (1, 1)
+    assert addendas.bitacora_vigilancia(entrada)[m].startswith(f"{os.path.getsize(m)}:")
+
+def test_asentamiento(carpetas):
+    # un archivo recién escrito (mtime reciente) espera a que pase el asentamiento
+    entrada, salida, perfil = carpetas
+    _vigilar(entrada, salida, perfil)
+    nuevo = os.path.join(entrada, "N.xml")
+    shutil.copy(os.path.join(entrada, "C.xml"), nuevo)
+    os.utime(nuevo, None)
+    assert _vigilar(entrada, salida, perfil, asentamiento=60)["procesados"] == 0
+    assert _vigilar(entrada, salida, perfil, asentamiento=0)["procesados"] == 1
+    assert os.path.exists(os.path.join(salida, "N_con_addenda.xml"))
+
+def test_omite_ocultos_y_salidas(carpetas):
+    entrada, salida, perfil = carpetas
+    for n in (".oculto.xml", "X_con_addenda.xml", "notas.txt"):
+        shutil.copy(os.path.join(entrada, "C.xml"), os.path.join(entrada, n))
+        os.utime(os.path.join(entrada, n), (0, 0))
+    assert _vigilar(entrada, salida, perfil)["procesados"] == 3
+
+def test_cliente_por_rfc(carpetas):
+    entrada, salida, perfil = carpetas
+    res = vigilancia.vigilar_carpeta(entrada, salida, clientes={"aaa010101aaa ": perfil}, una_vez=True,
+                                     intervalo=0.01, log=None)
+    assert (res["procesados"], res["ok"]) == (3, 3)
+
+def test_bitacora_ocupada_cuenta_como_error(carpetas, monkeypatch):
+    entrada, salida, perfil = carpetas
+
+    def ocupada(fila, firma):
+        raise sqlite3.OperationalError("database is locked")
+    monkeypatch.setattr(vigilancia, "bitacora_vigilancia_guardar", ocupada)
+    lineas = []
+    res = vigilancia.vigilar_carpeta(entrada, salida, perfil=perfil, una_vez=True, intervalo=0.01,
+                                     log=lineas.append)
+    assert (res["procesados"], res["ok"], res["errores"]) == (3, 0, 3)
+    assert any("database is locked" in x for x in lineas)
+    monkeypatch.setattr(vigilancia, "bitacora_vigilancia_guardar", addendas.bitacora_vigilancia_guardar)
+    # no quedó en la bitácora: la siguiente corrida los procesa
+    assert addendas.bitacora_vigilancia(entrada) == {}
+    assert _vigilar(entrada, salida, perfil)["ok"] == 3
@@ -0,0 +1,154 @@
+# validacion.py
+# Validación masiva de CFDI ya addendados.
+import os
+import csv
+import glob
+import fnmatch
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from addendas import (
+    HAS_LXML, cargar_xsd_desde_fuente, elegir_hijo_addenda_auto, hijos_addenda, leer_cfdi_lxml, localname,
+    ns_de, paquete_registrados, validar_cfdi_completo, validar_hijo_con_xsd)
+from biblioteca_xsd import cabecera_xsd, registro_xsd
+
+# ============== Validación masiva de CFDI ya addendados =====================
+# Cada worker del pool compila (una vez, en su caché LRU) los XSD que le tocan;
+# el mapa namespace → XSD se arma en el proceso principal y viaja en initargs.
+_VALIDACION = {}
+
+def mapa_xsd_validacion(xsds=None) -> list:
+    """
+    Fuentes para ubicar el XSD de una addenda, en orden de prioridad: los `xsds`
+    indicados, las addendas registradas en el paquete y la biblioteca de XSD.
+    Cada una es {ns: xsd, (ns, raiz): xsd}; sin namespace solo cuenta (ns, raiz).
+    """
+    explicitos = {}
+    for x in xsds or []:
+        local = os.path.abspath(cargar_xsd_desde_fuente(x))
+        tns, raices = cabecera_xsd(local)
+        explicitos[tns] = local
+        for r in raices:
+            explicitos[(tns, r)] = local
+    paquete = {ns: p for ns, p in paquete_registrados().items() if ns}
+    reg = registro_xsd()
+    biblioteca = {ns: rutas[0] for ns, rutas in reg["por_ns"].items() if ns}
+    biblioteca.update(reg["por_raiz"])
+    return [explicitos, paquete, biblioteca]
+
+def _xsd_de_hijo(fuentes, ns, raiz):
+    for m in fuentes:
+        p = m.get((ns, raiz)) or m.get(ns)
+        if p:
+            return p
+    return None
+
+def _validacion_init(fuentes, ns=None, completo=False):
+    _VALIDACION.clear()
+    _VALIDACION.update(fuentes=fuentes, ns=ns, completo=completo)
+
+def validar_archivo_addenda(path) -> dict:
+    """Un CFDI addendado: elige el hijo de la Addenda, lo valida con el XSD de su namespace. Fila del reporte."""
+    t0 = time.perf_counter()
+    fila = {"archivo": path, "estado": "", "ns": "", "raiz": "", "xsd": "", "hijos": 0,
+            "errores": [], "segundos": ""}
+    fuentes = _VALIDACION["fuentes"]
+    try:
+        root = leer_cfdi_lxml(path).getroot()
+        hijos = hijos_addenda(root)
+        fila["hijos"] = len(hijos)
+        ch = elegir_hijo_addenda_auto(hijos, lambda n, r: _xsd_de_hijo(fuentes, n, r), ns=_VALIDACION["ns"])
+        if ch is None:
+            fila["estado"] = "sin_addenda"
+            return fila
+        ns, raiz = ns_de(ch.tag), localname(ch.tag)
+        xsd = _xsd_de_hijo(fuentes, ns, raiz)
+        fila.update(ns=ns, raiz=raiz, xsd=xsd or "")
+        if not xsd:
+            fila["estado"] = "sin_xsd"
+            fila["errores"] = [{"linea": ch.sourceline, "mensaje": f"Sin XSD para {raiz} ({ns or 'sin namespace'})"}]
+            return fila
+        ok, fila["errores"] = validar_hijo_con_xsd(ch, xsd)
+        if ok and _VALIDACION["completo"]:
+            ok_c, msg = validar_cfdi_completo(path, extra={ns: xsd})
+            if ok_c is False:
+                ok = False
+                fila["errores"] = [{"linea": None, "mensaje": "CFDI: " + m} for m in msg.splitlines()]
+        fila["estado"] = "valido" if ok else "invalido"
+    except Exception as e:
+        fila["estado"] = "error"
+        fila["errores"] = [{"linea": getattr(e, "lineno", None), "mensaje": str(e)}]
+    finally:
+        fila["segundos"] = round(time.perf_counter() - t0, 4)
+    return fila
+
+def listar_addendados(entrada: str, patron: str = "*_con_addenda.xml") -> list:
+    """Carpeta (recorrida completa, archivos que casan con `patron`) o patrón glob."""
+    if not os.path.isdir(entrada):
+        return sorted(p for p in glob.glob(entrada, recursive=True) if os.path.isfile(p))
+    patron = patron.lower()
+    out = []
+    for dirpath, _dirs, files in os.walk(entrada):
+        out.extend(os.path.join(dirpath, f) for f in files if fnmatch.fnmatch(f.lower(), patron))
+    return sorted(out)
+
+def _fila_csv(fila) -> dict:
+    errs = fila["errores"]
+    return dict(fila, errores=" | ".join(f"Línea {e['linea']}: {e['mensaje']}" if e["linea"] else e["mensaje"]
+                                         for e in errs),
+                lineas=",".join(str(e["linea"]) for e in errs if e["linea"]))
+
+def validar_lote_addendas(entrada, xsds=None, ns=None, procesos=None, reporte=None, completo=False,
+                          patron="*_con_addenda.xml", log=print):
+    """
+    Valida en un pool de procesos la addenda de cada CFDI de `entrada` contra el XSD de su
+    namespace. Reporte CSV o JSON (según la extensión) por archivo: estado, errores con
+    línea y tiempos. Regresa (filas, resumen).
+    """
+    if not HAS_LXML:
+        raise RuntimeError("Validación deshabilitada: instala lxml (pip install lxml)")
+    archivos = listar_addendados(entrada, patron)
+    fuentes = mapa_xsd_validacion(xsds)
+    reporte = reporte or os.path.join(entrada if os.path.isdir(entrada) else ".", "reporte_validacion.csv")
+
+    t0 = time.perf_counter()
+    filas = []
+    if archivos:
+        procesos = procesos or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=procesos, initializer=_validacion_init,
+                                 initargs=(fuentes, ns, completo)) as pool:
+            # miles de archivos de pocos ms: en paquetes, no una tarea por archivo
+            filas = list(pool.map(validar_archivo_addenda, archivos,
+                                  chunksize=max(1, len(archivos) // (procesos * 8))))
+    elapsed = time.perf_counter() - t0
+
+    cuenta = {}
+    for f in filas:
+        cuenta[f["estado"]] = cuenta.get(f["estado"], 0) + 1
+    resumen = {
+        "archivos": len(filas),
+        "validos": cuenta.get("valido", 0),
+        "invalidos": cuenta.get("invalido", 0),
+        "sin_addenda": cuenta.get("sin_addenda", 0),
+        "sin_xsd": cuenta.get("sin_xsd", 0),
+        "errores": cuenta.get("error", 0),
+        "segundos": elapsed,
+        "archivos_por_seg": (len(filas) / elapsed) if elapsed > 0 else 0.0,
+        "reporte": reporte,
+    }
+    if reporte.lower().endswith(".json"):
+        with open(reporte, "w", encoding="utf-8") as f:
+            json.dump({"resumen": resumen, "archivos": filas}, f, ensure_ascii=False, indent=1)
+    else:
+        with open(reporte, "w", newline="", encoding="utf-8") as f:
+            w = csv.DictWriter(f, fieldnames=["archivo", "estado", "ns", "raiz", "xsd", "hijos",
+                                              "errores", "lineas", "segundos"])
+            w.writeheader()
+            w.writerows(_fila_csv(fila) for fila in filas)
+    if log:
+        log(f"{resumen['archivos']} archivos en {elapsed:.2f}s ({resumen['archivos_por_seg']:.1f} archivos/seg) • "
+            f"validos={resumen['validos']} invalidos={resumen['invalidos']} sin_addenda={resumen['sin_addenda']} "
+            f"sin_xsd={resumen['sin_xsd']} errores={resumen['errores']}")
+        log(f"Reporte: {reporte}")
+    return filas, resumen
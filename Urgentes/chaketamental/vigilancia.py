@@ -0,0 +1,219 @@
+# vigilancia.py
+# Vigilancia de carpeta: procesa los CFDI que van llegando.
+import os
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from addendas import (
+    bitacora_vigilancia, bitacora_vigilancia_guardar, cargar_perfil, cargar_xsd_desde_fuente,
+    extract_cfdi_context_stream, registrar_xsd_paquete, usar_backend_xml)
+from lote import preparar_perfil, procesar_cfdi
+
+# ========= Vigilancia de carpetas (inotify opcional, solo Linux) =========
+try:
+    from inotify_simple import INotify, flags as IN_FLAGS
+    HAS_INOTIFY = True
+except Exception:
+    HAS_INOTIFY = False
+
+# ============== Vigilancia de carpeta =====================
+# Los CFDI timbrados caen en una carpeta compartida. Cada vuelta toma una foto
+# de stat (size, mtime_ns) y, si hay inotify, despierta antes cuando un archivo
+# se cierra. Un archivo entra a la cola cuando lleva VIGILAR_ASENTAMIENTO
+# segundos sin cambiar (o inotify avisó que ya se cerró). La bitácora guarda la
+# firma procesada en la base de estado: al reiniciar no se repite nada, y si el
+# archivo cambia se vuelve a procesar.
+CLIENTES_PATH = "clientes_addenda.json"   # {"RFC receptor": "perfil.json"}
+VIGILAR_INTERVALO = 2.0
+VIGILAR_ASENTAMIENTO = 2.0
+_VIGILANCIA = {}
+
+def cargar_clientes(path=CLIENTES_PATH) -> dict:
+    """{RFC receptor: ruta del perfil} (vacío si no existe el archivo)."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return {k.strip().upper(): v for k, v in data.items()} if isinstance(data, dict) else {}
+
+def _foto_carpeta(entrada) -> dict:
+    """{ruta abs: stat} de los *.xml de la carpeta (sin ocultos ni *_con_addenda)."""
+    foto = {}
+    try:
+        it = os.scandir(entrada)
+    except OSError:
+        return foto
+    with it:
+        for de in it:
+            base, ext = os.path.splitext(de.name)
+            if ext.lower() != ".xml" or base.endswith("_con_addenda") or de.name.startswith("."):
+                continue
+            try:
+                if de.is_file():
+                    foto[os.path.abspath(de.path)] = de.stat()
+            except OSError:
+                continue
+    return foto
+
+def _firma_stat(st) -> str:
+    return f"{st.st_size}:{st.st_mtime_ns}"
+
+def _vigilar_procesar(path):
+    """Elige el perfil por RFC receptor (el de clientes o el default) y procesa como el lote."""
+    try:
+        ctx = extract_cfdi_context_stream(path)
+    except Exception as e:
+        return {"archivo": path, "estado": "error", "salida": "", "segundos": "",
+                "mensaje": f"XML mal formado o incompleto: {e}".replace("\n", " | ")}
+    rfc = (ctx.get("receptor_rfc") or "").strip().upper()
+    est = _VIGILANCIA["clientes"].get(rfc, _VIGILANCIA["default"])
+    return procesar_cfdi(path, est, _VIGILANCIA["salida"], plantillas=_VIGILANCIA["plantillas"],
+                         completo=_VIGILANCIA["completo"], ctx=ctx)
+
+def vigilancia_estado() -> dict:
+    """Contadores de la vigilancia en curso: cola, en curso, resultados y archivos/seg (último minuto)."""
+    v = _VIGILANCIA
+    ahora = time.time()
+    while v["recientes"] and ahora - v["recientes"][0] > 60:
+        v["recientes"].popleft()
+    ventana = min(60.0, ahora - v["inicio"]) or 1.0
+    return dict(v["contadores"], cola=len(v["cola"]), en_curso=len(v["en_vuelo"]),
+                archivos_por_seg=round(len(v["recientes"]) / ventana, 2), inotify=v["inotify"],
+                entrada=v["entrada"], segundos=round(ahora - v["inicio"], 1))
+
+def _vigilancia_publicar():
+    path = os.path.join(_VIGILANCIA["salida"], "estado_vigilancia.json")
+    tmp = path + f".{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(vigilancia_estado(), f, ensure_ascii=False, indent=1)
+    os.replace(tmp, path)
+
+def vigilar_carpeta(entrada, salida, clientes=None, perfil=None, plantillas=False, completo=False,
+                    hilos=None, intervalo=VIGILAR_INTERVALO, asentamiento=VIGILAR_ASENTAMIENTO,
+                    una_vez=False, backend=None, log=print) -> dict:
+    """
+    Adjunta la addenda a cada CFDI nuevo de `entrada` y escribe <salida>/<nombre>_con_addenda.xml.
+    El cliente se decide por el RFC receptor: plantilla compilada (con `plantillas`),
+    perfil de `clientes` ({RFC: perfil.json}) o el `perfil` default, en ese orden.
+    Corre hasta Ctrl+C; con `una_vez` procesa lo que ya está asentado y regresa.
+    """
+    if backend:
+        usar_backend_xml(backend)
+    entrada = os.path.abspath(entrada)
+    if not os.path.isdir(entrada):
+        raise ValueError(f"No existe la carpeta: {entrada}")
+    os.makedirs(salida, exist_ok=True)
+    preparados = {}
+
+    def preparar(path):
+        if path not in preparados:
+            p = cargar_perfil(path)
+            xsd = cargar_xsd_desde_fuente(p.get("xsd") or "")
+            registrar_xsd_paquete(xsd)
+            preparados[path] = preparar_perfil(xsd, p)
+        return preparados[path]
+
+    v = _VIGILANCIA
+    v.clear()
+    v.update(entrada=entrada, salida=salida, plantillas=plantillas, completo=completo,
+             clientes={rfc.strip().upper(): preparar(p) for rfc, p in (clientes or {}).items()},
+             default=preparar(perfil) if perfil else None,
+             contadores={"procesados": 0, "ok": 0, "invalidos": 0, "errores": 0, "sin_cliente": 0},
+             cola=deque(), en_vuelo={}, recientes=deque(), inicio=time.time(), inotify=False)
+    if not v["clientes"] and v["default"] is None and not plantillas:
+        raise ValueError("Indica perfiles por cliente, un perfil default o usa plantillas.")
+
+    ino = None
+    if HAS_INOTIFY and not una_vez:
+        try:
+            ino = INotify()
+            ino.add_watch(entrada, IN_FLAGS.CLOSE_WRITE | IN_FLAGS.MOVED_TO)
+            v["inotify"] = True
+        except OSError:
+            ino = None
+    hilos = hilos or min(8, (os.cpu_count() or 1) + 2)
+    pool = ThreadPoolExecutor(max_workers=hilos, thread_name_prefix="vigilar")
+    hechos = bitacora_vigilancia(entrada)
+    encolados, cerrados = set(), set()
+    cola, en_vuelo = v["cola"], v["en_vuelo"]
+    ultima_foto = ultimo_estado = 0.0
+    if log:
+        log(f"Vigilando {entrada} → {salida} • {hilos} hilos • "
+            f"{'inotify' if ino else f'sondeo cada {intervalo:g}s'} • {len(hechos)} ya en bitácora")
+
+    def recoger(fut):
+        ruta, firma = en_vuelo.pop(fut)
+        encolados.discard(ruta)
+        hechos[ruta] = firma
+        try:
+            fila = fut.result()
+            bitacora_vigilancia_guardar(fila, firma)
+        except Exception as e:
+            # p. ej. la base de estado ocupada: cuenta como error y no detiene la vigilancia;
+            # sin anotarlo en la bitácora, se vuelve a procesar al reiniciar
+            fila = {"archivo": ruta, "estado": "error", "salida": "", "segundos": "",
+                    "mensaje": f"No se pudo procesar o registrar: {e}".replace("\n", " | ")}
+        c = v["contadores"]
+        c["procesados"] += 1
+        clave = {"invalido": "invalidos", "error": "errores", "sin_cliente": "sin_cliente"}.get(fila["estado"], "ok")
+        c[clave] += 1
+        v["recientes"].append(time.time())
+        if log:
+            log(f"{fila['estado']:<12} {os.path.basename(ruta)}"
+                + (f" → {fila['salida']}" if fila["salida"] else "")
+                + (f" • {fila['mensaje']}" if fila["mensaje"] else ""))
+
+    try:
+        while True:
+            ahora = time.time()
+            if cerrados or ahora - ultima_foto >= intervalo:
+                ultima_foto = ahora
+                foto = _foto_carpeta(entrada)
+                for ruta, st in sorted(foto.items(), key=lambda kv: kv[1].st_mtime_ns):
+                    firma = _firma_stat(st)
+                    if ruta in encolados or hechos.get(ruta) == firma:
+                        continue
+                    # debounce: un archivo que se sigue escribiendo tiene mtime reciente
+                    if ahora - st.st_mtime_ns / 1e9 < asentamiento and ruta not in cerrados:
+                        continue
+                    cola.append((ruta, firma))
+                    encolados.add(ruta)
+                cerrados.clear()
+            while cola and len(en_vuelo) < hilos * 2:
+                ruta, firma = cola.popleft()
+                en_vuelo[pool.submit(_vigilar_procesar, ruta)] = (ruta, firma)
+            for fut in [f for f in en_vuelo if f.done()]:
+                recoger(fut)
+            if ahora - ultimo_estado >= 1.0:
+                ultimo_estado = ahora
+                _vigilancia_publicar()
+            if una_vez and not cola and not en_vuelo:
+                break
+            if en_vuelo:
+                wait(list(en_vuelo), timeout=intervalo, return_when=FIRST_COMPLETED)
+            elif ino is not None:
+                for ev in ino.read(timeout=int(intervalo * 1000)):
+                    cerrados.add(os.path.join(entrada, ev.name))
+            else:
+                time.sleep(intervalo)
+            if ino is not None and en_vuelo:
+                for ev in ino.read(timeout=0):
+                    cerrados.add(os.path.join(entrada, ev.name))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+        for fut in [f for f in en_vuelo if f.done() and not f.cancelled()]:
+            recoger(fut)
+        if ino is not None:
+            ino.close()
+        _vigilancia_publicar()
+    resumen = vigilancia_estado()
+    if log:
+        c = resumen
+        log(f"{c['procesados']} procesados • ok={c['ok']} invalidos={c['invalidos']} "
+            f"errores={c['errores']} sin_cliente={c['sin_cliente']}")
+    return resumen